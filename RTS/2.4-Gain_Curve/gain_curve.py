@@ -11,19 +11,11 @@ import glob
 import time
 
 import numpy as np
-import numpy.lib.recfunctions as nprec
 import matplotlib.pyplot as plt
-import matplotlib.widgets as widgets
 from matplotlib.backends.backend_pdf import PdfPages
-from scipy import optimize
-import scipy.interpolate as interpolate
 
 from katsdpscripts.reduction.analyse_point_source_scans import batch_mode_analyse_point_source_scans
-import scape
-import katpoint
-
-# These fields in the csv contain strings, while the rest of the fields are assumed to contain floats
-STRING_FIELDS = ['dataset', 'target', 'timestamp_ut', 'data_unit']
+from katsdpscripts.reduction.gain_curve_table import parse_csv, combine_results, GainCurveTable, TWO_K_PER_JY
 
 def parse_arguments():
     parser = optparse.OptionParser(usage="%prog [opts] <directories or files>",
@@ -42,264 +34,31 @@ def parse_arguments():
     parser.add_option("-u", "--units", default=None, help="Search for entries in the csv file with particular units. If units=counts, only compute gains. Default: first units in csv file, Options: counts, K")
     parser.add_option("-n", "--no_normalise_gain", action="store_true", default=False, help="Don't normalise the measured gains to the maximum fit to the data.")
     parser.add_option("--condition_select", type="string", default="normal", help="Flag according to atmospheric conditions (from: ideal,optimal,normal,none). Default: normal")
-    parser.add_option("--csv", action="store_true", help="Input file is assumed to be csv- this overrides specified baseline")
+    parser.add_option("--csv", action="store_true", help="Input files are assumed to be csv- this overrides specified baseline")
     parser.add_option("--bline", type="string", default="sd", help="Baseline to load. Default is first single dish baseline in file")
     (opts, args) = parser.parse_args()
     if len(args) ==0:
         print 'Please specify a file to process.'
         sys.exit(1)
-    filename = args[0]
-    return opts, filename
+    return opts, args
 
 def angle_wrap(angle, period=2.0 * np.pi):
     """Wrap angle into the interval -*period* / 2 ... *period* / 2."""
     return (angle + 0.5 * period) % period - 0.5 * period
 
 
-def parse_csv(filename):
-    """ Make an antenna object and a data array from the input csv file
-    update the data array with the desired flux for the give polarisation
-
-    Parameters
-    ----------
-    filename : string
-        Filename containing the result of analyse_point_source_scans.py
-        first line will contain the info to construct the antenna object
-
-    Return
-    ------
-    :class: katpoint Antenna object
-    data : heterogeneous record array
-    """
-    antenna = katpoint.Antenna(open(filename).readline().strip().partition('=')[2])
-    #Open the csv file as an array of strings without comment fields (antenna fields are comments)
-    data = np.loadtxt(filename, dtype='string', comments='#', delimiter=', ')
-    #First non-comment line is the header with fieldnames
-    fieldnames = data[0].tolist()
-    #Setup all fields as float32
-    formats = np.tile('float32', len(fieldnames))
-    #Label the string fields as input datatype
-    formats[[fieldnames.index(name) for name in STRING_FIELDS if name in fieldnames]] = data.dtype
-    #Save the data as a heterogeneous record array  
-    data = np.rec.fromarrays(data[1:].transpose(), dtype=zip(fieldnames, formats))
-    return data, antenna
-
-
-def compute_gain(data,pol):
-    """ Compute the gain and apeture efficiency from the data.
-
-    Parameters
-    ----------
-    data : heterogeneous record array containing 'calc_beam_height' and 'flux' records
-    
-    Return
-    ------
-    gain : The gains
-    """
-    gain = data['beam_height_' + pol] / data['flux']
-    
-    return gain
-
-
-def compute_tsys_sefd(data, gain, antenna, pol):
-    """ Compute Tsys and the SEFD from the gains and the baseline heights.
-
-    Parameters
-    ----------
-    data : heterogeneous record array containing 'calc_temp' and 'flux' records
-    gain : an array of gains calculated from the beam heights
-    antenna : a katpoint:antenna object describing the antenna to use
-
-    Return
-    ------
-    Tsys : The system temperature derived from the baseline heights
-    SEFD : The system equivalent flux density derived from Tsys and the gain
-    e    : The apeture efficiency (only meaningful if the units of 'calc_beam_height' are 'K'.)
-    """
-    # Get the geometric area of the dish
-    ant_area = np.pi * (antenna.diameter / 2.0) ** 2
-    # The apeture efficiency
-    e = gain*(2761/ant_area)*100
-    # Tsys can be estimated from the baseline height.
-    Tsys = data['baseline_height_'+pol]
-    # SEFD is Tsys/G
-    SEFD = Tsys/gain
-
-    return e, Tsys, SEFD
-
-
-def determine_good_data(data, antenna, targets=None, tsys=None, tsys_lim=150, eff=None, eff_lim=[35,100], units='K', interferometric=False, condition_select="none", pol='I'):
-    """ Apply conditions to the data to choose which can be used for 
-    fitting.
-    Conditions are:
-        1: Target name must be in 'targets' (use all targets if targets=None).
-        2: Range of aperture efficiencies between eff_lim[0] and eff_lim[1].
-        3: Tsys < tsys_lim.
-        4: Beam height and baseline data in csv file must not be 'nan'.
-        5: Units of beam height must be K
-
-    Parameters
-    ----------
-    data : heterogeneous record array containing 'targets', 'beam_height' records
-    targets (optional) : list of targets to keep. 'None' means use all targets.
-    tsys (optional): tsys array (same lengths as data). 'None' means don't select on Tsys.
-    eff (optional): array of apeture efficiencies/ 'None' means don't select on apeture efficiency.
-
-    Return
-    ------
-    good : boolean mask of data to keep True means good data, False means bad data.
-    """
-    #Initialise boolean array of True for defaults
-    good = [True] * data.shape[0]
-    print "1: All data",np.sum(good)
-    #Check for wanted targets
-    if targets is not None:
-        good = good & np.array([test_targ in targets for test_targ in data['target']])
-    print "2: Flag for unwanted targets",np.sum(good)
-    #Check for wanted tsys
-    if tsys is not None and not interferometric:
-        good = good & (tsys < tsys_lim)
-    print "3: Flag for Tsys",np.sum(good)
-    #Check for wanted eff
-    if eff is not None and not interferometric:
-        good = good & ((eff>eff_lim[0]) & (eff<eff_lim[1]))
-    print "4: Flag for efficiency",np.sum(good)
-    #Check for nans
-    good = good & ~(np.isnan(data['beam_height_'+pol])) & ~(np.isnan(data['baseline_height_'+pol]))
-    print "5: Flag for NaN in data",np.sum(good)
-    #Check for units
-    good = good & (data['data_unit'] == units)
-    print "6: Flag for correct units",np.sum(good)
-    #Check for environmental conditions if required
-    if condition_select!="none":
-        good = good & select_environment(data, antenna, condition_select)
-    print "7: Flag for environmental condition", np.sum(good)
-
-    return good
-
-def select_environment(data, antenna, condition="normal"):
-    """ Flag data for environmental conditions. Options are:
-    normal: Wind < 9.8m/s, -5C < Temperature < 40C, DeltaTemp < 3deg in 20 minutes
-    optimal: Wind < 2.9m/s, -5C < Temperature < 35C, DeltaTemp < 2deg in 10 minutes
-    ideal: Wind < 1m/s, 19C < Temp < 21C, DeltaTemp < 1deg in 30 minutes
-    """
-    # Convert timestamps to UTCseconds using katpoint
-    timestamps = np.array([katpoint.Timestamp(timestamp) for timestamp in data["timestamp_ut"]],dtype='float32')
-    # Fit a smooth function (cubic spline) in time to the temperature and wind data
-    raw_wind = data["wind_speed"]
-    raw_temp = data["temperature"]
-
-    fit_wind = interpolate.InterpolatedUnivariateSpline(timestamps,raw_wind,k=3)
-    fit_temp = interpolate.InterpolatedUnivariateSpline(timestamps,raw_temp,k=3)
-    #fit_temp_grad = fit_temp.derivative()
-
-    # Day/Night
-    # Night is defined as when the Sun is at -5deg.
-    # Set up Sun target
-    sun = katpoint.Target('Sun, special',antenna=antenna)
-    sun_elevation = katpoint.rad2deg(sun.azel(timestamps)[1])
-
-    # Apply limits on environmental conditions
-    good = [True] * data.shape[0]
-
-    # Set up limits on environmental conditions
-    if condition=='ideal':
-        windlim        =   1.
-        temp_low       =   19.
-        temp_high      =   21.
-        deltatemp      =   1./(30.*60.)
-        sun_elev_lim   =   -5.
-    elif condition=='optimum':
-        windlim        =   2.9
-        temp_low       =   -5.
-        temp_high      =   35.
-        deltatemp      =   2./(10.*60.)
-        sun_elev_lim   =   -5.
-    elif condition=='normal':
-        windlim        =   9.8
-        temp_low       =   -5.
-        temp_high      =   40.
-        deltatemp      =   3./(20.*60.)
-        sun_elev_lim   =   100.       #Daytime
-    else:
-        return good
-
-    good = good & (fit_wind(timestamps) < windlim)
-    good = good & ((fit_temp(timestamps) > temp_low) & (fit_temp(timestamps) < temp_high))
-    
-    #Get the temperature gradient
-    temp_grad = [fit_temp.derivatives(timestamp)[1] for timestamp in timestamps]
-    good = good & (np.abs(temp_grad) < deltatemp)
-
-    #Day or night?
-    good = good & (sun_elevation < sun_elev_lim)
-
-    return good
-
-
-
-def fit_atmospheric_absorption(gain, elevation):
-    """ Fit an elevation dependent atmospheric absorption model.
-        Model is G=G_0*exp(-tau*airmass)
-
-    """
-    #Airmass increases as inverse sine of the elevation    
-    airmass = 1/np.sin(elevation)
-    #
-    fit = np.polyfit(airmass, np.log(gain), 1)
-    #
-    tau,g_0 = -fit[0],np.exp(fit[1])
-
-    return g_0, tau
-
-def fit_atmospheric_emission(tsys, elevation, tau):
-    """ Fit an elevation dependent atmospheric emission model.
-
-    """
-    #Airmass increases as inverse sine of the elevation    
-    airmass = 1/np.sin(elevation)
-    #Fit T_rec + T_atm*(1-exp(-tau*airmass))
-    fit = np.polyfit(1 - np.exp(-tau*airmass),tsys,1)
-    # Get T_rec and T_atm
-    tatm,trec = fit[0],fit[1]
+def find_input_files(args, csv=False):
+    """Expand directories in *args* to the csv / h5 files they contain."""
+    filenames = []
+    for arg in args:
+        if os.path.isdir(arg):
+            filenames += sorted(glob.glob(os.path.join(arg, '*.csv' if csv else '*.h5')))
+        else:
+            filenames.append(arg)
+    return filenames
 
-    return tatm, trec
 
-def calc_atmospheric_opacity(T, RH, h, f):
-    """
-        Calculates zenith opacity according to NASA's Propagation Effects Handbook
-        for Satellite Systems, chapter VI (Ippolito 1989). For elevations > 10 deg.
-        Multiply by (1-exp(-opacity/sin(el))) for elevation dependence.
-        Taken from katlab.
-        @param T: temperature in deg C
-        @param RH: relative humidity, 0 < RH < 1
-        @param h: height above sea level in km
-        @param f: frequency in GHz (must be < 57 GHz)
-    """
-    T0 = 15 # Reference temp for calculations, deg C
-    # Vapour pressure
-    es = 100 * 6.1121*np.exp((18.678-T0/234.5)*T0/(257.14+T0)) # [Pa], from A. L. Buck research manual 1996 rather than NASA Handbook
-    rw = RH*es/(.461*(T0+273.15)) # [g/m^3]
-    # Basic values
-    yo = (7.19e-3+6.09/(f**2+.227)+4.81/((f-57)**2+1.50))*f**2*1e-3
-    yw = (.067+3/((f-22.3)**2+7.3)+9/((f-183.3)**2+6)+4.3/((f-323.8)**2+10))*f**2*rw*1e-4
-    # yw above is only for rw <= 12 g/m^3. the following alternative is suggested in NASA's handbook
-    if rw>12.0:
-        yw = (.05+0.0021*rw+3.6/((f-22.2)**2+8.5)+10.6/((f-183.3)**2+9)+8.9/((f-325.4)**2+26.3))*f**2*rw*1e-4
-    # Correct for temperature
-    yo = yo*(1-0.01*(T-T0))
-    yw = yw*(1-0.006*(T-T0))
-    # Scale heights
-    ho = 6.
-    hw = (2.2+3/((f-22.3)**2+3)+1/((f-183.3)**2+1)+1/((f-323.8)**2+1))
-    # Attenuation
-    A = yo*ho*np.exp(-h/ho) + yw*hw
-
-    return np.exp(A/10.*np.log(10))-1
-
-
-
-def make_result_report(data, good, opts, output_filename, gain, e, g_0, tau, Tsys=None, SEFD=None, T_atm=None, T_rec=None):
+def make_result_report(data, good, opts, output_filename, antenna, gain, e, g_0, tau, Tsys=None, SEFD=None, T_atm=None, T_rec=None):
     """ Generate a pdf report containing relevant results
         and a txt file with the plotting data.
     """
@@ -316,7 +75,7 @@ def make_result_report(data, good, opts, output_filename, gain, e, g_0, tau, Tsy
     #Separate masks for each target to plot separately
     targetmask={}
     for targ in targets:
-        targetmask[targ] = np.array([test_targ==targ.strip() for test_targ in data['target']])
+        targetmask[targ] = data['target'] == targ.strip()
 
     #Set up range of elevations for plotting fits
     fit_elev = np.linspace(5, 90, 85, endpoint=False)
@@ -332,9 +91,9 @@ def make_result_report(data, good, opts, output_filename, gain, e, g_0, tau, Tsy
         # Normalise the data by fit of line to it
         if not opts.no_normalise_gain:
             use_elev = data['elevation']>opts.min_elevation
-            fit_elev = data['elevation'][good & targetmask[targ] & use_elev]
-            fit_gain = gain[good & targetmask[targ] & use_elev]
-            fit=np.polyfit(fit_elev, fit_gain, 1)
+            norm_elev = data['elevation'][good & targetmask[targ] & use_elev]
+            norm_gain = gain[good & targetmask[targ] & use_elev]
+            fit=np.polyfit(norm_elev, norm_gain, 1)
             g90=fit[0]*90.0 + fit[1]
             plot_gain = gain[good & targetmask[targ]]/g90
             plot_elevation = data['elevation'][good & targetmask[targ]]
@@ -422,81 +181,89 @@ def make_result_report(data, good, opts, output_filename, gain, e, g_0, tau, Tsy
     output_file.write("# Gain vs elevation data for %s, units of gain are: %s/Jy, Atmospheric correction?: %s\n"%(antenna.name, opts.units, opts.correct_atmosphere))
     output_file.write("#Target        ,Elev. ,  Gain  \n")
     output_file.write("# name         ,(deg.), (%s/Jy)\n"%(opts.units))
-    for data in zip(data['target'], data['elevation'][good], gain[good]):
-        output_file.write("%-15s,%4.1f  ,%7.5f\n"%(data[0], data[1],data[2]))
+    for row in zip(data['target'][good], data['elevation'][good], gain[good]):
+        output_file.write("%-15s,%4.1f  ,%7.5f\n"%(row[0], row[1],row[2]))
+    output_file.close()
 
 
 #get the command line arguments
-opts, filename = parse_arguments()
-
-#Check if we're using an h5 file or a csv file and read appropriately
-if opts.csv:
-    # Get the data from the csv file
-    data, antenna = parse_csv(filename)
-else:
-    #Got an h5 file - run analyse point source scans.
-    file_basename = os.path.splitext(os.path.basename(filename))[0]
-    prep_basename = file_basename + '_' + opts.bline.translate(None,',') + '_point_source_scans'
-    antenna, data = batch_mode_analyse_point_source_scans(filename,outfilebase=os.path.abspath(prep_basename),baseline=opts.bline)
+opts, args = parse_arguments()
+
+#Check if we're using h5 files or csv files and read appropriately
+results = []
+for filename in find_input_files(args, opts.csv):
+    if opts.csv:
+        # Get the data from the csv file
+        antenna, data = parse_csv(filename)
+    else:
+        #Got an h5 file - run analyse point source scans.
+        file_basename = os.path.splitext(os.path.basename(filename))[0]
+        prep_basename = file_basename + '_' + opts.bline.translate(None,',') + '_point_source_scans'
+        antenna, data = batch_mode_analyse_point_source_scans(filename,outfilebase=os.path.abspath(prep_basename),baseline=opts.bline)
+    results.append((antenna, data))
+#Combine the results of all files into a single table covering all antennas
+table, antennas = combine_results(results)
+curves = GainCurveTable(table, antennas)
 
 if opts.units == None:
-    opts.units = data['data_unit'][0]
+    opts.units = table['data_unit'][0]
 
 #Get available polarisations to loop over or make a list out of options if available
 if opts.polarisation == None:
-    keys = np.array(data.dtype.names)
-    pol = np.unique([key.split('_')[-1] for key in keys if key.split('_')[-1] in ['HH','VV']])
+    pol = curves.pols
 else:
     pol = opts.polarisation.split(',')
+targets = opts.targets.split(',') if opts.targets else None
 
-for opts.polarisation in pol:
-
-    output_filename = opts.outfilebase + '_' + antenna.name + '_' + opts.polarisation + '_' + '%.0f'%data['frequency'][0]
+# Obtain desired elevations in radians
+el = curves.elevation
 
-    # Compute the gains from the data and fill the data recarray with the values
-    gain = compute_gain(data,opts.polarisation)
+for opts.polarisation in pol:
 
-    Tsys, SEFD, e = None, None, None
-    # Get TSys, SEFD if we have meaningful units
-    if opts.units=="K":
-        e, Tsys, SEFD = compute_tsys_sefd(data, gain, antenna,opts.polarisation)
+    # Compute the gains, Tsys and SEFD of all antennas and files at once
+    gain, e, Tsys, SEFD = curves.compute(opts.polarisation)
+    # Tsys, SEFD and efficiency are only meaningful for units of K
+    if opts.units!="K":
+        e, Tsys, SEFD = None, None, None
 
     # Determine "good" data to use for fitting and plotting
-    good = determine_good_data(data, antenna, targets=opts.targets, tsys=Tsys, tsys_lim=opts.tsys_lim, 
-                            eff=e, eff_lim=[opts.eff_min,opts.eff_max], units=opts.units,
-                            condition_select=opts.condition_select, pol=opts.polarisation)
-
-    # Check if we have flagged all the data
-    if np.sum(good)==0:
-        print('Pol: %s, All data flagged according to selection criteria.'%opts.polarisation)
-        continue
-
-    # Obtain desired elevations in radians
-    az, el = angle_wrap(katpoint.deg2rad(data['azimuth'])), katpoint.deg2rad(data['elevation'])
-
-    # Get a fit of an atmospheric absorption model if units are in "K", otherwise use weather data to estimate 
-    # opacity for each data point
-    if opts.units=="K":
-        g_0, tau = fit_atmospheric_absorption(gain[good],el[good])
-    else:
-        tau=np.array([])
-        for opacity_info in data:
-            tau=np.append(tau,(calc_atmospheric_opacity(opacity_info['temperature'],opacity_info['humidity']/100, 
-                                            antenna.observer.elevation/1000, opacity_info['frequency']/1000.0)))
-        g_0 = None
-
+    good, counts = curves.good_data(opts.polarisation, targets=targets, tsys=Tsys, tsys_lim=opts.tsys_lim,
+                                    eff=e, eff_lim=[opts.eff_min,opts.eff_max], units=opts.units,
+                                    condition_select=opts.condition_select)
+    for n, (label, count) in enumerate(counts):
+        print "%d: %s" % (n + 1, label), count
+
+    # Get a fit of an atmospheric absorption model per antenna if units are in "K", otherwise use weather data to
+    # estimate opacity for each data point
     T_atm, T_rec = None, None
-    # Fit T_atm and T_rec using atmospheric emission model for single dish case
     if opts.units=="K":
-        T_atm, T_rec = fit_atmospheric_emission(Tsys[good],el[good],tau)
+        g_0, tau = curves.fit_atmospheric_absorption(gain, good)
+        # Fit T_atm and T_rec using atmospheric emission model for single dish case
+        T_atm, T_rec = curves.fit_atmospheric_emission(Tsys, good, tau)
+        row_tau = tau[curves.ant_index]
+    else:
+        g_0, tau = None, None
+        row_tau = curves.opacity()
 
     #remove the effect of atmospheric attenuation from the data
     if opts.correct_atmosphere:
         if opts.units=="K":
-            e = (gain -  g_0*np.exp(-tau/np.sin(el)) + g_0)*(2761/(np.pi*(antenna.diameter/2.0)**2))*100
-        gain = gain/(np.exp(-tau/np.sin(el)))
-
-
-    # Make a report describing the results (no Tsys data if interferometric)
-    make_result_report(data, good, opts, output_filename, gain, e, g_0, tau, 
-                    Tsys=Tsys, SEFD=SEFD, T_atm=T_atm, T_rec=T_rec)
+            row_g_0 = g_0[curves.ant_index]
+            e = (gain - row_g_0*np.exp(-row_tau/np.sin(el)) + row_g_0)*(TWO_K_PER_JY/curves.ant_area)*100
+        gain = gain/(np.exp(-row_tau/np.sin(el)))
+
+    for n, name in enumerate(curves.ant_names):
+        rows = curves.ant_index == n
+        # Check if we have flagged all the data
+        if np.sum(good[rows])==0:
+            print('Antenna: %s, Pol: %s, All data flagged according to selection criteria.'%(name, opts.polarisation))
+            continue
+        data = table[rows]
+        output_filename = opts.outfilebase + '_' + name + '_' + opts.polarisation + '_' + '%.0f'%data['frequency'][0]
+        # Make a report describing the results (no Tsys data if interferometric)
+        if opts.units=="K":
+            make_result_report(data, good[rows], opts, output_filename, antennas[name], gain[rows], e[rows],
+                               g_0[n], tau[n], Tsys=Tsys[rows], SEFD=SEFD[rows], T_atm=T_atm[n], T_rec=T_rec[n])
+        else:
+            make_result_report(data, good[rows], opts, output_filename, antennas[name], gain[rows], None,
+                               g_0, row_tau[rows])
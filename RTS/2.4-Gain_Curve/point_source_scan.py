@@ -102,7 +102,7 @@ with verify_and_connect(opts) as kat:
             while keep_going:
                 targets_before_loop = len(targets_observed)
                 # Iterate through source list, picking the next one that is up
-                for target in pointing_sources.iterfilter(el_limit_deg=opts.horizon+7.0):
+                for target in session.visibility.iterfilter(pointing_sources, el_limit_deg=opts.horizon+7.0):
                     session.label('raster')
                     # Do different raster scan on strong and weak targets
                     if not opts.quick:
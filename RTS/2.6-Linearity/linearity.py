@@ -5,6 +5,7 @@ from optparse import OptionParser
 from scipy import integrate
 
 import katdal
+from katsdpscripts.reduction.memory_budget import MemoryBudget, Footprint
 
 import matplotlib
 import numpy
@@ -12,6 +13,51 @@ import os
 import pylab
 
 
+## -- Autocorrelation data of a single input, indexed by scan
+class ScanData(object):
+  """Read autocorrelation of input *inpt* and hand out per-scan slices of it.
+
+  The data of all selected scans is read in one pass if it fits in the memory
+  *budget*, otherwise the mean spectrum is accumulated in chunks of dumps and
+  each scan is only read when it is needed.
+  """
+  def __init__(self, h5, inpt, scans='track', budget=None):
+    h5.select(reset='T')
+    h5.select(inputs=inpt,corrprods='auto',scans=scans)
+    self.scan_indices = h5.scan_indices
+    self.passband     = h5.channel_freqs
+    self.channels     = h5.channels
+    self.channel_bw   = (h5.spectral_windows[0]).channel_width # Hz
+    # map scan indices to the range of dumps in the selection, once per input
+    scan_per_dump = numpy.asarray(h5.sensor['Observation/scan_index'])
+    self.dumps = {}
+    for scan_index in self.scan_indices:
+      dumps = numpy.flatnonzero(scan_per_dump == scan_index)
+      self.dumps[scan_index] = slice(dumps[0], dumps[-1] + 1) if len(dumps) else slice(0, 0)
+    self.budget = budget if budget is not None else MemoryBudget()
+    self._h5 = h5
+    self.vis = None
+    # visibilities and their amplitudes per dump
+    num_dumps = h5.shape[0]
+    footprint = Footprint().add(h5.shape[1:], numpy.complex64).add(h5.shape[1:], numpy.float32)
+    with self.budget.track('Autocorrelations of %s' % (inpt,), footprint, num_dumps):
+      if self.budget.fits(footprint, num_dumps):
+        # single sequential read of the data of all selected scans
+        self.vis = h5.vis[:]
+        self.mean_amplitude = numpy.mean(numpy.abs(self.vis), axis=0)
+      else:
+        amplitude_sum = numpy.zeros(h5.shape[1:])
+        for dumps in self.budget.chunks(footprint, num_dumps):
+          amplitude_sum += numpy.abs(h5.vis[dumps]).sum(axis=0)
+        self.mean_amplitude = amplitude_sum / max(num_dumps, 1)
+
+  def scan(self, scan_index):
+    """Visibilities of scan with given index."""
+    if self.vis is None:
+      return self._h5.vis[self.dumps[scan_index]]
+    return self.vis[self.dumps[scan_index]]
+## -- Autocorrelation data of a single input, indexed by scan
+
 ## -- Noise diode profile over passband frequency range
 def NoiseProfile(noise_model, frequency_range):
   nd_freqs = numpy.array(noise_model)[:,0]
@@ -113,16 +159,15 @@ def Report(pp, h5, data):
 ## -- Generate output report --
 
 ## -- Use headroom as a measure of linearity
-def Linearity(h5, ant, pol, null_hz, target_hz):
+def Linearity(h5, ant, pol, null_hz, target_hz, budget=None):
   inpt = ant + pol
 
-  # identify target spectrum observations
-  h5.select(reset='T')
-  h5.select(inputs=inpt,corrprods='auto',scans='track')
-  scan_indices = h5.scan_indices
-  passband     = h5.channel_freqs
-  nr_channels  = h5.channels
-  channel_bw   = (h5.spectral_windows[0]).channel_width # Hz
+  # identify target spectrum observations and read them
+  data = ScanData(h5, inpt, budget=budget)
+  scan_indices = data.scan_indices
+  passband     = data.passband
+  nr_channels  = data.channels
+  channel_bw   = data.channel_bw # Hz
   bandwidth    = channel_bw*len(nr_channels) # Hz
 
   # channel indices for null -- range of 10 MHz
@@ -136,7 +181,7 @@ def Linearity(h5, ant, pol, null_hz, target_hz):
   target_range = range(min_idx, max_idx)
 
   pylab.figure()
-  pylab.semilogy(passband[1:]/1e6, numpy.mean(numpy.abs(h5.vis[:]), axis=0)[1:], 'b')
+  pylab.semilogy(passband[1:]/1e6, data.mean_amplitude[1:], 'b')
   pylab.axvline(x=passband[null_range[0]]/1e6, color='g')
   pylab.axvline(x=passband[target_range[0]]/1e6, color='r')
   pylab.axvline(x=passband[null_range[-1]]/1e6, color='g')
@@ -156,9 +201,7 @@ def Linearity(h5, ant, pol, null_hz, target_hz):
   Pns = []
   Pgps = []
   for idx in range(2,len(scan_indices)):
-    h5.select(reset='T')
-    h5.select(inputs=inpt, corrprods='auto', scans=scan_indices[idx])
-    [spectrum, Tcal_factor] = Tcal(h5.vis[:], null_range, Tcal_passband)
+    [spectrum, Tcal_factor] = Tcal(data.scan(scan_indices[idx]), null_range, Tcal_passband)
     # apply calibration and compute integrated power over noise floor (null region) and target
     calib_vis=k*numpy.array(Tcal_factor)*numpy.array(spectrum)
     Pns.append(10.*numpy.log10(numpy.average(calib_vis[null_range])*bandwidth))
@@ -213,6 +256,12 @@ if __name__ == '__main__':
                     type=str,
                     default=None,
                     help='Name of output report file.')
+  parser.add_option('--memory-budget',
+                    action='store',
+                    dest='memory_budget',
+                    type=str,
+                    default=None,
+                    help='Memory available for data, e.g. \'4G\', default is $KATSDP_MEMORY_BUDGET or half of RAM.')
 
   (opts, args) = parser.parse_args()
 
@@ -239,17 +288,19 @@ if __name__ == '__main__':
 
   # Generate output report
   pp = PdfPages(outfile+'.pdf')
+  budget = MemoryBudget(opts.memory_budget)
 
   for ant in ants:
     for pol in pols:
       print 'Headroom analysis for antenna %s polarisation %s' % (ant, pol)
-      headroom_1db = Linearity(h5, ant, pol, opts.null, opts.target)
+      headroom_1db = Linearity(h5, ant, pol, opts.null, opts.target, budget)
       Report(pp, h5, {'headroom':headroom_1db, 'ant':ant, 'pol':pol})
       try: pylab.close('all')
       except: pass # nothing to close
 
   # cleanup before exit
   pp.close()
+  print budget.report()
   try: pylab.close('all')
   except: pass # nothing to close
 
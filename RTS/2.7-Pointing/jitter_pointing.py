@@ -8,6 +8,9 @@ import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 import optparse
 
+from katsdpscripts.reduction.binned_moments import BinnedMoments
+from katsdpscripts.reduction.memory_budget import MemoryBudget, Footprint
+
 def Ang_Separation(pos1,pos2):
     Ra1 = pos1[0]
     Dec1 = pos1[1]
@@ -56,10 +59,14 @@ def getper(x,c=50):
 # Parse command-line options and arguments
 parser = optparse.OptionParser(usage='%prog [options] <data file>',
                                description='This script reduces a data file to produce a Jitter plot in a pdf file.')
-parser.add_option( "--bins", default=40,
+parser.add_option( "--bins", type='int', default=40,
                   help="The nuber of bins to use when evaluation the different seperations', default = '%default'")
 parser.add_option( "--ant", default='ant4',
                   help="The antenna to do the reduction for', default = '%default'")
+parser.add_option( "--dumps-per-chunk", type='int', default=None,
+                  help="The number of dumps to read from the file at a time', default = as many as fit in the memory budget")
+parser.add_option( "--memory-budget", default=None,
+                  help="The memory available for data (e.g. 4G)', default = $KATSDP_MEMORY_BUDGET or half of RAM")
 
 (opts, args) = parser.parse_args()
 
@@ -89,12 +96,27 @@ binvals[-1] = binvals[-1] + 0.1
 digibins = np.digitize(sep,bins=binvals)
 
 
-var = np.zeros((np.array(hist.nonzero()[0]).shape[0],h5.channels.shape[0],h5.shape[-1]))
-mean  = np.zeros((np.array(hist.nonzero()[0]).shape[0],h5.channels.shape[0],h5.shape[-1]))
-baseline_mean = (np.mean(h5.vis[digibins == digibins.max(),:,:],axis=0))# Off source Mean
-peak_mean = (np.mean(h5.vis[digibins == digibins.min(),:,:],axis=0))# On source Mean
-norm = np.abs(1./(peak_mean-baseline_mean) *np.sqrt(2.*np.pi)*beamwidth(fwhm)[np.newaxis,:,np.newaxis])
-var_inf = (np.std((h5.vis[digibins == digibins.max(),:,:]-baseline_mean)*norm,axis=0))**2  # Off source variance
+# Read the data once, accumulating the mean and variance of every separation bin
+moments = BinnedMoments(bins, shape=h5.shape[1:])
+# Running moments per bin, plus each chunk of visibilities and the sorted copies and deviations made of it
+budget = MemoryBudget(opts.memory_budget)
+footprint = Footprint().add((bins,) + h5.shape[1:], np.complex128, per_dump=False).add((bins,) + h5.shape[1:], np.float64, per_dump=False)
+footprint.add(h5.shape[1:], np.complex64, copies=2).add(h5.shape[1:], np.complex128, copies=2).add(h5.shape[1:], np.float64, copies=2)
+dumps_per_chunk = opts.dumps_per_chunk or budget.dumps_per_chunk(footprint, h5.shape[0])
+with budget.track('Jitter moments', footprint, h5.shape[0], dumps_per_chunk):
+    for start in range(0, h5.shape[0], dumps_per_chunk):
+        dumps = slice(start, min(start + dumps_per_chunk, h5.shape[0]))
+        moments.add(digibins[dumps] - 1, h5.vis[dumps])  #  digitize has a [1..bins] index
+print budget.report()
+theta_bins = np.bincount(digibins - 1, sep, bins) / np.maximum(hist, 1)
+
+baseline_mean = moments.mean[digibins.max() - 1]# Off source Mean
+peak_mean = moments.mean[digibins.min() - 1]# On source Mean
+norm = np.abs(1./(peak_mean-baseline_mean) *np.sqrt(2.*np.pi)*beamwidth(fwhm)[:,np.newaxis])
+# The variance of (vis - baseline_mean) * norm in each bin follows from the variance of vis in that bin
+var_all = moments.variance * norm[np.newaxis] ** 2
+var_inf = var_all[digibins.max() - 1]  # Off source variance
+var = var_all[hist.nonzero()[0]] - var_inf
 
 returntext = []
 for blcount,blvalue in enumerate(h5.corr_products[:]) :
@@ -106,10 +128,8 @@ for blcount,blvalue in enumerate(h5.corr_products[:]) :
         returntext.append('Calculated Antenna short timescale jitter for %s'%(blvalue[0]))
         returntext.append('Antenna, Angle ,  mean ,  lower ,upper errors')
         for n,i in enumerate(hist.nonzero()[0]) :
-            data =  np.abs((h5.vis[digibins == i+1,:,:]-baseline_mean)*norm)
-            var[n,:,:] = (np.std(data,axis=0))**2 - var_inf #  digitize has a [1..bins] index
             var_amp = var[n,:,blcount]
-            theta = sep[digibins == i+1].mean()
+            theta = theta_bins[i]
             if theta > 0.01 and theta < fwhm.max() :
                 #var_0 = 1./(2.*np.pi*beamwidth(fwhm)**2*(-np.log(var_amp*beamwidth(fwhm)**6)))
                 var_theta = var_amp*2.*np.pi*beamwidth(fwhm)**6*(1./theta**2)*np.exp(theta**2/beamwidth(fwhm)**2)   
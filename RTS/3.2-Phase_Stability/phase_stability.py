@@ -7,6 +7,7 @@ import optparse
 import katdal
 from matplotlib.backends.backend_pdf import PdfPages
 import stefcal
+from katsdpscripts.reduction.memory_budget import MemoryBudget, Footprint
 import pandas
 
 def polyfitstd(x, y, deg, rcond=None, full=False, w=None, cov=False):
@@ -189,7 +190,7 @@ def plot_AntennaGain(gains,freq,inputs):
 
 
 
-def  fringe_stopping(data):
+def  fringe_stopping(data, budget=None):
     new_ants = {
     'ant1' : ('25.0950 -9.0950 0.0450', 23220.506e-9, 23228.551e-9),
     'ant2' : ('90.2844 26.3804 -0.22636', 23283.799e-9, 23286.823e-9),
@@ -207,20 +208,25 @@ def  fringe_stopping(data):
     # Number of turns of phase that signal B is behind signal A due to cable / receiver delay
     cable_delay_turns = np.array([(delays[inpB] - delays[inpA]) * center_freqs for inpA, inpB in data.corr_products]).T
     crosscorr = [(data.inputs.index(inpA), data.inputs.index(inpB)) for inpA, inpB in data.corr_products]
+    # Fringe-stopped data of all compscans, plus visibilities, delays and phase factors of a chunk of dumps
+    budget = budget if budget is not None else MemoryBudget()
+    footprint = Footprint().add(data.shape, np.complex64, per_dump=False)
+    footprint.add(data.shape[1:], np.complex64).add(data.shape[1:], np.float64, copies=2).add(data.shape[1:], np.complex128, copies=2)
     # Assemble fringe-stopped visibility data for main (bandpass) calibrator
-    vis_set = None
-    for compscan_no,compscan_label,target in data.compscans():
-        print "loop",compscan_no,compscan_label,target
-        vis = data.vis[:,:,:]
-        # Number of turns of phase that signal B is behind signal A due to geometric delay
-        geom_delay_turns = - data.w[:, np.newaxis, :] / wavelengths[:, np.newaxis]
-        # Visibility <A, B*> has phase (A - B), therefore add (B - A) phase to stop fringes (i.e. do delay tracking)
-        vis *= np.exp(2j * np.pi * (geom_delay_turns + cable_delay_turns))
-        if vis_set is None:
-            vis_set = vis.copy()
-        else:
-            vis_set = np.append(vis_set,vis,axis = 0)
-    return vis_set
+    vis_set = np.empty(data.shape, dtype=np.complex64)
+    num_dumps = 0
+    with budget.track('Fringe stopping', footprint, data.shape[0]):
+        for compscan_no,compscan_label,target in data.compscans():
+            print "loop",compscan_no,compscan_label,target
+            for dumps in budget.chunks(footprint, data.shape[0]):
+                vis = data.vis[dumps]
+                # Number of turns of phase that signal B is behind signal A due to geometric delay
+                geom_delay_turns = - data.w[dumps, np.newaxis, :] / wavelengths[:, np.newaxis]
+                # Visibility <A, B*> has phase (A - B), therefore add (B - A) phase to stop fringes (i.e. do delay tracking)
+                vis *= np.exp(2j * np.pi * (geom_delay_turns + cable_delay_turns))
+                vis_set[num_dumps:num_dumps + len(vis)] = vis
+                num_dumps += len(vis)
+    return vis_set[:num_dumps] if num_dumps else None
 
 
 def peak2peak(y):
@@ -277,6 +283,8 @@ parser = optparse.OptionParser(usage="%prog [opts] <file>",
                                description=" This produces a pdf file with graphs decribing the gain sability for each antenna in the file")
 parser.add_option("-f", "--frequency_channels", dest="freq_keep", type="string", default='200,800',
                   help="Range of frequency channels to keep (zero-based, specified as start,end). Default = %default")
+parser.add_option("--memory-budget", default=None,
+                  help="Memory available for data (e.g. 4G), larger selections are processed in chunks. Default = $KATSDP_MEMORY_BUDGET or half of RAM")
 
 (opts, args) = parser.parse_args()
 
@@ -293,6 +301,7 @@ end_freq_channel = 800
 
 
 h5 = katdal.open(args)
+budget = MemoryBudget(opts.memory_budget)
 #h5 = katdal.open('1387000585.h5')
 nice_filename =  args[0]+ '_phase_stability'
 pp = PdfPages(nice_filename+'.pdf')
@@ -301,7 +310,7 @@ for pol in ('h','v'):
     # loop over both polarisations
     if np.all(h5.sensor['DBE/auto-delay'] == '0') :
         print "Need to do fringe stopping "
-        vis = fringe_stopping(h5)
+        vis = fringe_stopping(h5, budget)
     else:
         print "Fringe stopping done in the correlator"
         vis = h5.vis[:,:,:]
@@ -332,7 +341,7 @@ for pol in ('h','v'):
         print scan
         if np.all(h5.sensor['DBE/auto-delay'] == '0') :
             print "stopping fringes for size ",h5.shape
-            vis = fringe_stopping(h5)
+            vis = fringe_stopping(h5, budget)
         else:
             vis = h5.vis[:,:,:]
         data[i:i+h5.shape[0]] = mean((vis*calfac[:,:,:h5.shape[-1]])[:,flaglist,:],axis=1)
@@ -371,6 +380,7 @@ for pol in ('h','v'):
 #plt.figtext(0.1,0.1,'\n'.join(returntext),fontsize=10)
 #fig.savefig(pp,format='pdf')
 pp.close()
+print budget.report()
 plt.close('all')
 
 
@@ -33,13 +33,14 @@ import optparse
 from katsdpscripts.RTS import weather_report
 
 def parse_arguments():
-    parser = optparse.OptionParser(usage="%prog [opts] <file>")
+    parser = optparse.OptionParser(usage="%prog [opts] <file> [<file> ...]")
     parser.add_option("-o", "--outputdir", type="string",default=".",help="Directory to save output file")
     parser.add_option("-a","--average",type="float",default=5.0,help="Averaging time in seconds for weather data. (default=5sec)")
     return parser.parse_args()
 
 opts, args = parse_arguments()
 
-weather_report(args[0], output_dirname=opts.outputdir, average_time=opts.average)
+# Several consecutive files are combined into a single report
+weather_report(args if len(args) > 1 else args[0], output_dirname=opts.outputdir, average_time=opts.average)
 
 
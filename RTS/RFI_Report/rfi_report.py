@@ -12,6 +12,7 @@ parser.add_option("-a", "--antenna", type="string", default=None, help="Name of
 parser.add_option("-t", "--targets", type="string", default=None, help="List of targets to produce report for, default is all targets in the file")
 parser.add_option("-f", "--freq_chans", default=None, help="Range of frequency channels to keep (zero-based, specified as 'start,end', default is 50% of the bandpass.")
 parser.add_option("-o", "--output_dir", default='.', help="Directory to place output .pdf report. Default is cwd")
+parser.add_option("-m", "--memory-budget", default=None, help="Memory available for data (e.g. 4G), larger selections are read in chunks. Default is $KATSDP_MEMORY_BUDGET or half of RAM")
 opts, args = parser.parse_args()
 
 # if no enough arguments, raise the runtimeError
@@ -20,6 +21,7 @@ if len(args) < 1:
 
 filename = args[0]
 
-generate_rfi_report(filename,output_root=opts.output_dir,antenna=opts.antenna,targets=opts.targets,freq_chans=opts.freq_chans)
+memory_report = generate_rfi_report(filename,output_root=opts.output_dir,antenna=opts.antenna,targets=opts.targets,freq_chans=opts.freq_chans,memory_budget=opts.memory_budget)
+print memory_report
 
 
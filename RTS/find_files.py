@@ -0,0 +1,65 @@
+#!/usr/bin/python
+#
+# Find observation files by their metadata, using a local index that is
+# updated incrementally from the file headers, e.g.
+#
+#   find_files.py /var/kat/archive/data/RTS           (index new or changed files)
+#   find_files.py --target Moon --ant ant4 --freq 1822  (query index)
+#   find_files.py --log 1393418142.h5                  (print script log from index, given
+#                                                        file name or full path of indexed file)
+#
+import optparse
+import time
+
+import katpoint
+
+from katsdpscripts.reduction.file_index import FileIndex
+
+parser = optparse.OptionParser(usage='%prog [options] [<files or directories to index>]',
+                               description='Index observation files and find those matching given metadata')
+parser.add_option('-d', '--database', default='~/.katsdpscripts_file_index.db',
+                  help='Index database file, default %default')
+parser.add_option('--prune', action='store_true', default=False,
+                  help='Remove files that no longer exist from the index')
+parser.add_option('-t', '--target', help='Name of target of at least one scan')
+parser.add_option('-a', '--ant', help='Name of antenna used in observation')
+parser.add_option('-s', '--state', help="Scan state, e.g. 'track' (of scans on --target, if given)")
+parser.add_option('-l', '--label', help='Compound scan label')
+parser.add_option('--description', help='Part of script description (e.g. RTS test code)')
+parser.add_option('--experiment-id', help='Part of experiment ID')
+parser.add_option('--observer', help='Part of observer name')
+parser.add_option('--start', help="Start of time range to search, e.g. '2014-02-26 10:00:00' (UTC)")
+parser.add_option('--end', help="End of time range to search, e.g. '2014-02-27' (UTC)")
+parser.add_option('-f', '--freq', type='float', help='Frequency in band of observation, in MHz')
+parser.add_option('-v', '--verbose', action='store_true', default=False,
+                  help='Print description, start time and targets of matching files')
+parser.add_option('--log', metavar='FILE', help='Print script log of indexed file (file name, or full path if name is ambiguous)')
+(opts, args) = parser.parse_args()
+
+index = FileIndex(opts.database)
+if args:
+    start = time.time()
+    updated, failed = index.update(args)
+    for path, err in failed:
+        print 'Could not index %s: %s' % (path, err)
+    print 'Indexed %d new or changed files in %.1f seconds (%d files in index)' % \
+          (len(updated), time.time() - start, len(index))
+if opts.prune:
+    print 'Removed %d missing files from index' % (len(index.prune()),)
+if opts.log:
+    print index.metadata(opts.log)['script_log']
+
+query = dict(target=opts.target, antenna=opts.ant, state=opts.state, label=opts.label,
+             description=opts.description, experiment_id=opts.experiment_id, observer=opts.observer,
+             start=katpoint.Timestamp(opts.start).secs if opts.start else None,
+             end=katpoint.Timestamp(opts.end).secs if opts.end else None,
+             freq=opts.freq * 1e6 if opts.freq else None)
+if any(value is not None for value in query.values()) or not (args or opts.prune or opts.log):
+    for path in index.find(**query):
+        if opts.verbose:
+            info = index.metadata(path)
+            print '%s: %s, %s, %s' % (path, katpoint.Timestamp(info['start_time']).local(),
+                                      info['description'], ' '.join(info['targets']))
+        else:
+            print path
+index.close()
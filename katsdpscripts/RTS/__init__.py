@@ -3,3 +3,4 @@ from rfilib import generate_rfi_report
 import diodelib                         # For QT 2_2
 import spectral_baseline                # For QT 2.10,3.8
 import strong_sources                   # For QT 2.8    
+import radiallib                        # For QT 3.1,3.5,3.6,3.7
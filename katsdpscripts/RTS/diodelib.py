@@ -5,78 +5,128 @@ import numpy as np
 from matplotlib.backends.backend_pdf import PdfPages
 import matplotlib.pyplot as plt
 
+def diode_states(on, buff=5):
+    """Dumps well away from noise diode transitions, with diode off and on respectively."""
+    n_off = ~(np.roll(on,buff) | np.roll(on,-buff))
+    n_on = np.roll(on,buff) & np.roll(on,-buff)
+    return n_off, n_on
+
+
+def read_hot_cold_spectra(h5, spw, ants, pols=('v','h'), freq_band=256e6, diode='coupler', buff=5,
+                          cold_target='OFF', hot_target='Moon', dumps_per_chunk=64):
+    """Median autocorrelation spectra on and off the hot target, with and without noise diode.
+
+    The autocorrelations of all antennas and polarisations are selected once
+    for both targets, and read in chunks of dumps with flagged data replaced
+    by NaNs. Each input's dumps are then split into cold / hot and noise diode
+    off / on classes (with the diode state of each target considered on its
+    own), and the median spectrum of each class is taken.
+
+    Parameters
+    ----------
+    h5 : :class:`katdal.DataSet` object
+        Data set to read (its selection is changed)
+    spw : int
+        Index of spectral window to use
+    ants : sequence of :class:`katpoint.Antenna` objects
+        Antennas to read
+    pols : sequence of strings, optional
+        Polarisations to read
+    freq_band : float, optional
+        Bandwidth around centre frequency of spectral window to read, in Hz
+    diode : string, optional
+        Noise diode used to determine diode state
+    buff : int, optional
+        Number of dumps on either side of diode transitions to discard
+    cold_target, hot_target : string, optional
+        Names of cold (off-source) and hot targets
+    dumps_per_chunk : int, optional
+        Number of dumps to read at a time
+
+    Returns
+    -------
+    freq : array of float, shape (C,)
+        Channel frequencies, in Hz
+    cold, hot, cold_nd, hot_nd : array of float, shape (A, P, C)
+        Median spectra off and on hot target with noise diode off, and off and
+        on hot target with noise diode on, per antenna, polarisation and
+        channel (NaN if input is missing or any of its samples is flagged)
+
+    """
+    f_c = h5.spectral_windows[spw].centre_freq
+    h5.select(ants=[a.name for a in ants],spw=spw,corrprods='auto',freqrange=(f_c - freq_band/2, f_c + freq_band/2),
+              targets=[cold_target, hot_target],scans='track')
+    freq = h5.channel_freqs
+    num_dumps, num_chans, num_prods = h5.shape
+    data = np.empty((num_dumps, num_chans, num_prods), dtype=np.float32)
+    for start in range(0, num_dumps, dumps_per_chunk):
+        dumps = slice(start, min(start + dumps_per_chunk, num_dumps))
+        data[dumps] = h5.vis[dumps].real
+        data[dumps][h5.flags()[dumps]] = np.nan
+    target_index = np.asarray(h5.sensor['Observation/target_index'])
+    target_names = np.array([target.name for target in h5.catalogue.targets])
+    hot_dumps = target_names[target_index] == hot_target
+    # Each target class is treated as a separate time series, as if it was selected on its own
+    classes = (np.flatnonzero(~hot_dumps), np.flatnonzero(hot_dumps))
+    spectra = np.tile(np.nan, (4, len(ants), len(pols), num_chans)).astype(np.float32)
+    corr_products = [tuple(prod) for prod in h5.corr_products]
+    for i, a in enumerate(ants):
+        on = np.asarray(h5.sensor['Antennas/'+a.name+'/nd_'+diode], dtype=bool)
+        for j, pol in enumerate(pols):
+            inp = a.name + pol
+            if (inp, inp) not in corr_products:
+                continue
+            prod = corr_products.index((inp, inp))
+            for k, dumps in enumerate(classes):
+                n_off, n_on = diode_states(on[dumps], buff)
+                spectra[k, i, j] = np.median(data[dumps[n_off], :, prod], 0)
+                spectra[k + 2, i, j] = np.median(data[dumps[n_on], :, prod], 0)
+    cold, hot, cold_nd, hot_nd = spectra
+    return freq, cold, hot, cold_nd, hot_nd
+
+
+def hot_cold_temperatures(freq, cold, hot, cold_nd, hot_nd, moon_temp=225., moon_radius=0.25, dish_diameter=12.):
+    """System and noise diode temperatures from spectra on and off the Moon (arrays of shape (..., C))."""
+    f = freq
+    Y = hot / cold
+    HPBW = 1.22 * (180/np.pi) *(3e8/(dish_diameter*f))
+    om = 1.133 * HPBW**2
+    R = moon_radius
+    Thot = moon_temp * (np.pi * R**2)/om
+    Tsys = (Thot)/(Y-1)
+    Ydiode = hot_nd / cold_nd
+    Tdiode = (Thot + Tsys*(1-Ydiode))/(Ydiode-1)
+    return Tsys, Tdiode
+
+
 def read_and_plot_data(filename,output_dir='.',freq_band = 256e6):
     nice_filename =  filename.split('/')[-1].split('.')[0]+ '_T_sys_T_nd'
     pp = PdfPages(output_dir+'/'+nice_filename+'.pdf')
 
     h5 = katfile.open(filename)
 
-    ants = h5.ants
-
     colour = ['b', 'g', 'r', 'c', 'm', 'y', 'k']
+    ants = [a for a in h5.ants[:len(colour)] if int(a.name[3]) <= 7]
     pols = ['v','h']
     diode= 'coupler'
     fig1 = plt.figure(1,figsize = (10,16))
     fig2 = plt.figure(2,figsize = (10,16))
 
-    for pol in pols:
-        for a,col in zip(ants,colour):    
+    #the first spw check is a kat-7 throwback and can be removed for RTS after testing
+    spws = [s_i for s_i,s in enumerate(h5.spectral_windows) if not (s_i == 0 and s.centre_freq != 1264e6)]
+    # Read hot and cold spectra of all antennas and polarisations in one pass (last suitable window is used)
+    f, cs, hs, cns, hns = read_hot_cold_spectra(h5, spws[-1], ants, pols, freq_band, diode)
+    Tsys_all, Tdiode_all = hot_cold_temperatures(f, cs, hs, cns, hns)
+
+    for j,pol in enumerate(pols):
+        for i,a in enumerate(ants):
             ant = a.name
             ant_num = int(ant[3])
-            if ant_num>7:
-                continue
-            air_temp = np.mean(h5.sensor['Enviro/asc.air.temperature'])
             nd_model = h5.file['MetaData/Configuration/Antennas/'+ant+'/'+pol+'_'+diode+'_noise_diode_model'].value
             nd = scape.gaincal.NoiseDiodeModel(freq = nd_model[:,0]/1e6,temp = nd_model[:,1])
-            
-            for s_i,s in enumerate(h5.spectral_windows):
-                #this if is a kat-7 throwback and can be removed for RTS after testing
-                if s_i == 0 and s.centre_freq != 1264e6:
-                    continue
-                f_c = s.centre_freq
-                #cold data
-                h5.select(ants=a.name,spw=s_i,pol=pol,freqrange=(f_c - freq_band/2, f_c + freq_band/2),targets = 'OFF',scans='track')
-                freq = h5.channel_freqs
-                nd_temp = nd.temperature(freq / 1e6)
-                cold_data = np.ma.array(h5.vis[:].real,mask=h5.flags()[:],fill_value=np.nan)
-                on = h5.sensor['Antennas/'+ant+'/nd_coupler']
-                buff = 5
-                n_off = ~(np.roll(on,buff) | np.roll(on,-buff))
-                n_on = np.roll(on,buff) & np.roll(on,-buff)
-                cold_off = n_off
-                cold_on = n_on
-                #hot data
-                h5.select(ants=a.name,spw=s_i,pol=pol,freqrange=(f_c - freq_band/2, f_c + freq_band/2),targets = 'Moon',scans='track')
-                hot_data = np.ma.array(h5.vis[:].real,mask=h5.flags()[:],fill_value=np.nan)
-                on = h5.sensor['Antennas/'+ant+'/nd_coupler']
-                buff = 5
-                n_off = ~(np.roll(on,buff) | np.roll(on,-buff))
-                n_on = np.roll(on,buff) & np.roll(on,-buff)
-                hot_off = n_off
-                hot_on = n_on
-                cold_spec = np.median(cold_data[cold_off,:,0].filled(np.nan),0)
-                hot_spec = np.median(hot_data[hot_off,:,0].filled(np.nan),0)
-                cold_nd_spec = np.median(cold_data[cold_on,:,0].filled(np.nan),0)
-                hot_nd_spec = np.median(hot_data[hot_on,:,0].filled(np.nan),0)
-                continue
+            nd_temp = nd.temperature(f / 1e6)
+            Tsys, Tdiode = Tsys_all[i, j], Tdiode_all[i, j]
 
-            
-            
-            hs,f = hot_spec,freq
-            cs = cold_spec
-            hns = hot_nd_spec
-            cns = cold_nd_spec
-            Y = hs / cs
-            HPBW = 1.22 * (180/np.pi) *(3e8/(12*f))
-            om = 1.133 * HPBW**2
-            R = 0.25
-            Thot = 225 * (np.pi * R**2)/om 
-            Tsys = (Thot)/(Y-1)
-            Ydiode = hns / cns
-            Tdiode = (Thot + Tsys*(1-Ydiode))/(Ydiode-1)
-            
-
-            
             plt.figure(1)
             if pol == 'v' : p = ant_num * 2 
             if pol == 'h' : p = ant_num * 2-1 
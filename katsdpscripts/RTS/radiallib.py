@@ -0,0 +1,195 @@
+"""Radial profiles of holography beam and aperture maps.
+
+The pixels of a map are binned by radius once, after which the statistics of
+all annuli are obtained with :func:`numpy.bincount` reductions and a single
+sort of the pixel values within their bins, instead of masking the full map
+for every annulus. The binning only depends on the map geometry, so it is
+cached and reused for all the maps in a report.
+
+"""
+import numpy as np
+
+# Cache of radial binnings, keyed on (map shape, annulus width, rmax)
+_bins_cache = {}
+# Limit the number of cached binnings to keep memory bounded
+MAX_CACHED_BINS = 16
+
+
+class radialDat:
+    """Empty object container.
+    """
+    def __init__(self):
+        self.mean = None
+        self.std = None
+        self.median = None
+        self.numel = None
+        self.max = None
+        self.min = None
+        self.r = None
+
+
+class RadialBins(object):
+    """Assignment of map pixels to annuli of constant width.
+
+    Annulus *i* contains the pixels with ``i * dr <= r < i * dr + dr``, for
+    *i* from 0 up to ``ceil(rmax / dr) - 1``.
+
+    Parameters
+    ----------
+    r : array of float
+        Radial coordinate of each pixel
+    dr : float
+        Width of each annulus
+    rmax : float
+        Maximum radius over which to compute statistics
+    working_mask : array of bool, same shape as *r*, optional
+        False for pixels that should be ignored
+
+    """
+    def __init__(self, r, dr, rmax, working_mask=None):
+        r = np.asarray(r, dtype=np.float64).ravel()
+        self.dr = dr
+        self.radial = np.arange(rmax / dr) * dr + dr / 2.
+        nrad = len(self.radial)
+        # Reproduce the annulus edges exactly (including their rounding errors)
+        index = np.floor(r / dr).astype(int)
+        index -= (r < index * dr).astype(int)
+        index += (r >= index * dr + dr).astype(int)
+        valid = (index >= 0) & (index < nrad)
+        if working_mask is not None:
+            valid &= np.asarray(working_mask, dtype=bool).ravel()
+        self.pixels = np.flatnonzero(valid)
+        self.index = index[self.pixels]
+        self.counts = np.bincount(self.index, minlength=nrad)
+
+    def __len__(self):
+        return len(self.radial)
+
+    def statistics(self, data, mask=None):
+        """Statistics of *data* within each annulus.
+
+        Parameters
+        ----------
+        data : array
+            Map with the same number of pixels as the binned radii
+        mask : array of bool, same shape as *data*, optional
+            True for additional pixels to ignore (e.g. mask of masked array)
+
+        Returns
+        -------
+        radialdata : :class:`radialDat` object
+            Container with per-annulus statistics (see :func:`radial_data`),
+            which are NaN for empty annuli
+
+        """
+        values = np.asarray(data).ravel()[self.pixels]
+        index = self.index
+        if mask is not None:
+            keep = ~np.asarray(mask, dtype=bool).ravel()[self.pixels]
+            values, index = values[keep], index[keep]
+        nrad = len(self.radial)
+        counts = np.bincount(index, minlength=nrad)
+        filled = counts > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.bincount(index, values, nrad) / counts
+            std = np.sqrt(np.bincount(index, (values - mean[index]) ** 2, nrad) / counts)
+        # A single sort by value, followed by a stable sort on annulus index (which is
+        # faster than np.lexsort), orders values within each annulus for extrema and percentiles
+        order = np.argsort(values)
+        values = values[order[np.argsort(index[order], kind='mergesort')]]
+        starts = np.r_[0, np.cumsum(counts)[:-1]]
+
+        def percentile(q):
+            """Linearly interpolated percentile *q* of each annulus (like np.percentile)."""
+            pos = (q / 100.) * (counts[filled] - 1)
+            lower = np.floor(pos).astype(int)
+            upper = np.minimum(lower + 1, counts[filled] - 1)
+            frac = pos - lower
+            low, high = values[starts[filled] + lower], values[starts[filled] + upper]
+            result = np.tile(np.nan, nrad)
+            result[filled] = low + (high - low) * frac
+            return result
+
+        radialdata = radialDat()
+        radialdata.r = self.radial
+        radialdata.mean = np.where(filled, mean, np.nan)
+        radialdata.std = np.where(filled, std, np.nan)
+        radialdata.numel = np.where(filled, counts, np.nan)
+        radialdata.min = np.tile(np.nan, nrad)
+        radialdata.min[filled] = values[starts[filled]]
+        radialdata.max = np.tile(np.nan, nrad)
+        radialdata.max[filled] = values[starts[filled] + counts[filled] - 1]
+        radialdata.median = percentile(50.)
+        radialdata.per10 = percentile(10.)
+        radialdata.per25 = percentile(25.)
+        return radialdata
+
+
+def radial_bins(shape, annulus_width=1, working_mask=None, x=None, y=None, rmax=None):
+    """Radial binning of map, cached for default coordinates and mask.
+
+    See :func:`radial_data` for a description of the parameters.
+
+    """
+    npix, npiy = shape
+    cacheable = working_mask is None and x is None and y is None
+    key = (tuple(shape), annulus_width, rmax)
+    if cacheable and key in _bins_cache:
+        return _bins_cache[key]
+    if working_mask is None:
+        working_mask = np.ones(shape, bool)
+    working_mask = np.asarray(working_mask, dtype=bool)
+    if x is None or y is None:
+        x1 = np.arange(-npix/2., npix/2.)
+        y1 = np.arange(-npiy/2., npiy/2.)
+        x, y = np.meshgrid(y1, x1)
+    r = abs(x + 1j * y)
+    if rmax is None:
+        rmax = r[working_mask].max()
+    dr = np.abs(x[0, 0] - x[0, 1]) * annulus_width
+    bins = RadialBins(r, dr, rmax, working_mask)
+    if cacheable:
+        if len(_bins_cache) >= MAX_CACHED_BINS:
+            _bins_cache.clear()
+        _bins_cache[key] = bins
+    return bins
+
+
+def radial_data(data, annulus_width=1, working_mask=None, x=None, y=None, rmax=None):
+    """
+    r = radial_data(data,annulus_width,working_mask,x,y)
+
+    A function to reduce an image to a radial cross-section.
+
+    INPUT:
+    ------
+    data   - whatever data you are radially averaging.  Data is
+            binned into a series of annuli of width 'annulus_width'
+            pixels. Masked pixels of a masked array are ignored.
+    annulus_width - width of each annulus.  Default is 1.
+    working_mask - array of same size as 'data', with zeros at
+                      whichever 'data' points you don't want included
+                      in the radial data computations.
+      x,y - coordinate system in which the data exists (used to set
+             the center of the data).  By default, these are set to
+             integer meshgrids
+      rmax -- maximum radial value over which to compute statistics
+
+     OUTPUT:
+     -------
+      r - a data structure containing the following
+                   statistics, computed across each annulus:
+          .r      - the radial coordinate used (outer edge of annulus)
+          .mean   - mean of the data in the annulus
+          .std    - standard deviation of the data in the annulus
+          .median - median value in the annulus
+          .max    - maximum value in the annulus
+          .min    - minimum value in the annulus
+          .per10  - 10% percental value in the annulus
+          .per25  - 25% percentail value in the annulus
+          .numel  - number of elements in the annulus
+    """
+    mask = np.ma.getmask(data)
+    data = np.ma.getdata(data)
+    bins = radial_bins(data.shape, annulus_width, working_mask, x, y, rmax)
+    return bins.statistics(data, None if mask is np.ma.nomask else mask)
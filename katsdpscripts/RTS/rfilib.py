@@ -1,7 +1,6 @@
 #Library to contain RFI flagging routines and other RFI related functions
 import katdal
 import katpoint 
-from matplotlib.backends.backend_pdf import PdfPages
 from mpl_toolkits.axes_grid.anchored_artists import AnchoredText
 from mpl_toolkits.axes_grid import Grid
 
@@ -19,6 +18,9 @@ import math
 import h5py
 import os
 
+from katsdpscripts.reduction.report_pages import ReportPages
+from katsdpscripts.reduction.memory_budget import MemoryBudget, Footprint, map_dumps
+
 #########################
 # RFI Detection routines
 #########################
@@ -434,7 +436,7 @@ def detect_spikes_orig(data, axis=0, spike_width=2, outlier_sigma=11.0):
 # End of RFI detection routines
 ##############################
 
-def get_flag_data(h5data, norm_spec=None):
+def get_flag_data(h5data, norm_spec=None, budget=None):
     """
     Given a katdal object, remove a dc offset for each record
     (ignoring severe spikes) and correct for changes in elevation
@@ -442,40 +444,69 @@ def get_flag_data(h5data, norm_spec=None):
     all of the scans in the data - rejecting outliers in the DC offset domain.
     Return the average spectrum with dc offset removed and the number of times
     each channel is flagged. Optinally provide a spectrum (norm_spec) to 
-    divide into the calculated bandpass.
+    divide into the calculated bandpass. The data is read in chunks of
+    records that fit in the memory budget (default budget if None).
     """
 
-    sumarray=np.zeros((h5data.shape[1],2))
-    offsetarray=np.zeros((h5data.shape[0],2))
-    weightsum=np.zeros((h5data.shape[1],2),dtype=np.int)
-    flags=np.zeros((h5data.shape[0],h5data.shape[1],2),dtype=np.bool)
-    for num,thisdata in enumerate(h5data.vis):
-        #Extract pols
-        thisdata = np.abs(thisdata[0,:,:2])
-        # normalise if defined
-        if norm_spec is not None: thisdata /= norm_spec
-        #Flag data for severe spikes
-        flags[num] = detect_spikes_sumthreshold(thisdata,outlier_sigma=8.0,spike_width=3.0)
-        #Get DC height (median rather than mean is more robust...)
-        offset = np.median(thisdata[np.where(flags[num]==0)],axis=0)
-        #Make an elevation corrected offset to remove outliers
-        offsetarray[num,:] = offset
-        #Remove the DC height
-        weights = (~flags[num]).astype(np.float)
-        thisdata = thisdata/offset
-        weightsum += weights
-        #Sum the data for this target
-        sumarray = sumarray + thisdata*weights
+    budget = budget if budget is not None else MemoryBudget()
+    num_dumps, num_chans = h5data.shape[0], h5data.shape[1]
+    #Flags of all records, plus the HH and VV data of a chunk of records and its per-record temporaries
+    footprint = Footprint().add((num_dumps,num_chans,2),np.bool,per_dump=False)
+    footprint.add((num_chans,2),np.complex64).add((num_chans,2),np.float64,per_dump=False,copies=8)
+    dumps_per_chunk = budget.dumps_per_chunk(footprint,num_dumps)
+    sumarray=np.zeros((num_chans,2))
+    offsetarray=np.zeros((num_dumps,2))
+    weightsum=np.zeros((num_chans,2),dtype=np.int)
+    flags=np.zeros((num_dumps,num_chans,2),dtype=np.bool)
+    with budget.track('RFI flags of %d records' % (num_dumps,),footprint,num_dumps,dumps_per_chunk):
+        for start in range(0,num_dumps,dumps_per_chunk):
+            #Extract pols of a chunk of records
+            chunk = h5data.vis[start:start+dumps_per_chunk,:,0:2]
+            for num,thisdata in enumerate(chunk,start):
+                thisdata = np.abs(thisdata)
+                # normalise if defined
+                if norm_spec is not None: thisdata /= norm_spec
+                #Flag data for severe spikes
+                flags[num] = detect_spikes_sumthreshold(thisdata,outlier_sigma=8.0,spike_width=3.0)
+                #Get DC height (median rather than mean is more robust...)
+                offset = np.median(thisdata[np.where(flags[num]==0)],axis=0)
+                #Make an elevation corrected offset to remove outliers
+                offsetarray[num,:] = offset
+                #Remove the DC height
+                weights = (~flags[num]).astype(np.float)
+                thisdata = thisdata/offset
+                weightsum += weights
+                #Sum the data for this target
+                sumarray = sumarray + thisdata*weights
     averagespec = sumarray/(weightsum.astype(np.float)+1.e-10)
     flagfrac = 1. - (weightsum.astype(np.float)/h5data.shape[0].astype(np.float))
     return {'spectrum': averagespec, 'numrecords_tot': h5data.shape[0], 'flagfrac': flagfrac, 'channel_freqs': h5data.channel_freqs, 'dump_period': h5data.dump_period},flags
 
+def get_waterfall_data(h5data, chan_range, budget=None):
+    """
+    Return the amplitudes of the HH and VV data in chan_range for all
+    records, for the waterfall plot of draw_flag_data. The data is read in
+    chunks of records that fit in the memory budget (default budget if None).
+    """
+    budget = budget if budget is not None else MemoryBudget()
+    label = 'RFI waterfall of %d records' % (h5data.shape[0],)
+    return map_dumps(np.abs,h5data.vis,(len(chan_range),2),np.float32,budget,label,index=(chan_range,slice(0,2)))
+
 def plot_flag_data(label,spectrum,flagfrac,vis,flags,freqs,pdf):
     """
     Produce a plot of the average spectrum in H and V 
     after flagging and attach it to the pdf output.
     Also show fraction of times flagged per channel.
     """
+    fig = draw_flag_data(label,spectrum,flagfrac,vis,flags,freqs)
+    pdf.savefig(fig)
+    plt.close('all')
+
+def draw_flag_data(label,spectrum,flagfrac,vis,flags,freqs):
+    """
+    Draw the flag data page of plot_flag_data in a new figure and return it.
+    This only needs arrays, so it can be queued as a page of a ReportPages report.
+    """
 
     #Set up the figure
     fig = plt.figure(figsize=(8.3,11.7))
@@ -529,8 +560,7 @@ def plot_flag_data(label,spectrum,flagfrac,vis,flags,freqs,pdf):
         plt.ylabel('Time')
         plt.xlabel('Frequency (Hz)')
 
-    pdf.savefig(fig)
-    plt.close('all')
+    return fig
  
 def plot_waterfall(visdata,flags,channel_freqs):
     fig = plt.figure(figsize=(8.3,11.7))
@@ -570,7 +600,7 @@ def plot_waterfall(visdata,flags,channel_freqs):
     pdf.savefig(fig)
     plt.close(fig)
 
-def generate_rfi_report(input_file,output_root='.',antenna=None,targets=None,freq_chans=None):
+def generate_rfi_report(input_file,output_root='.',antenna=None,targets=None,freq_chans=None,memory_budget=None):
 	"""
 	Create an RFI report- store flagged spectrum and number of flags in an output h5 file
 	and produce a pdf report.
@@ -582,9 +612,15 @@ def generate_rfi_report(input_file,output_root='.',antenna=None,targets=None,fre
 	antenna - which antenna to produce report on - default first in file
 	targets - which target to produce report on - default all
 	freq_chans - which frequency channels to work on format - <start_chan>,<end_chan> default - inner 60% of bandpass
+	memory_budget - memory available for data, e.g. '4G' - default KATSDP_MEMORY_BUDGET or half of RAM
+
+	Returns
+	=======
+	report - comparison of estimated and actual memory use of each step, as a string
 	"""
 
 	h5 = katdal.open(input_file)
+	budget = MemoryBudget(memory_budget)
 
 	#Get the selected antenna or default to first file antenna
 	ant=antenna or h5.ants[0].name
@@ -602,38 +638,38 @@ def generate_rfi_report(input_file,output_root='.',antenna=None,targets=None,fre
 
 	# Set up the output file
 	basename = os.path.join(output_root,os.path.splitext(input_file.split('/')[-1])[0]+'_' + ant + '_RFI')
-	pdf = PdfPages(basename+'.pdf')
-
-	# Select the desired antenna and remove slews from the file
-	h5.select(scans='~slew',ants=ant)
+	# Pages are rendered in worker processes while the flags of the next target are worked out
+	with ReportPages(basename+'.pdf') as pdf:
+		# Select the desired antenna and remove slews from the file
+		h5.select(scans='~slew',ants=ant)
 
-	if targets is None: targets = h5.catalogue.targets 
+		if targets is None: targets = h5.catalogue.targets 
 
 
-	#Set up the output data dictionary
-	data_dict = {}
+		#Set up the output data dictionary
+		data_dict = {}
 
-	# Loop through targets
-	for target in targets:
-		#Get the target name if it is a target object
-		if isinstance(target, katpoint.Target):
-			target = target.name
-		#Extract target from file
-		h5.select(targets=target)
-		#get an average over scans for this target
-		data_dict[target],flags=get_flag_data(h5)
-		label = 'Flag info for Target: ' + target + ', Antenna: ' + ant +', '+str(data_dict[target]['numrecords_tot'])+' records'
-		plot_flag_data(label,data_dict[target]['spectrum'][chan_range],data_dict[target]['flagfrac'][chan_range],h5.vis[:,chan_range,0:2],flags[:,chan_range,:],h5.channel_freqs[chan_range],pdf)
+		# Loop through targets
+		for target in targets:
+			#Get the target name if it is a target object
+			if isinstance(target, katpoint.Target):
+				target = target.name
+			#Extract target from file
+			h5.select(targets=target)
+			#get an average over scans for this target
+			data_dict[target],flags=get_flag_data(h5,budget=budget)
+			label = 'Flag info for Target: ' + target + ', Antenna: ' + ant +', '+str(data_dict[target]['numrecords_tot'])+' records'
+			pdf.add(draw_flag_data,label,data_dict[target]['spectrum'][chan_range],data_dict[target]['flagfrac'][chan_range],get_waterfall_data(h5,chan_range,budget),flags[:,chan_range,:],h5.channel_freqs[chan_range])
 
-	#Reset the selection
-	h5.select(scans='~slew',ants=ant)
+		#Reset the selection
+		h5.select(scans='~slew',ants=ant)
 
-	# Do calculation for all the data and store in the dictionary
-	data_dict['all_data'],all_flags=get_flag_data(h5)
+		# Do calculation for all the data and store in the dictionary
+		data_dict['all_data'],all_flags=get_flag_data(h5,budget=budget)
 
-	#Plot the flags for all data in the file
-	label = 'Flag info for all data, Antenna: ' + ant +', '+str(data_dict['all_data']['numrecords_tot'])+' records'
-	plot_flag_data(label,data_dict['all_data']['spectrum'][chan_range],data_dict['all_data']['flagfrac'][chan_range],h5.vis[:,chan_range,0:2],all_flags[:,chan_range,:],h5.channel_freqs[chan_range],pdf)
+		#Plot the flags for all data in the file
+		label = 'Flag info for all data, Antenna: ' + ant +', '+str(data_dict['all_data']['numrecords_tot'])+' records'
+		pdf.add(draw_flag_data,label,data_dict['all_data']['spectrum'][chan_range],data_dict['all_data']['flagfrac'][chan_range],get_waterfall_data(h5,chan_range,budget),all_flags[:,chan_range,:],h5.channel_freqs[chan_range])
 
 	#Output to h5 file
 	outfile=h5py.File(basename+'.h5','w')
@@ -647,5 +683,5 @@ def generate_rfi_report(input_file,output_root='.',antenna=None,targets=None,fre
 	#Finish with a waterfall plot
 	#plot_waterfall(h5.vis[:,chan_range,:],all_flags[:,chan_range,:],h5.channel_freqs[chan_range])
 
-	#close the plot
-	pdf.close()
+	#Compare estimated and actual memory use
+	return budget.report()
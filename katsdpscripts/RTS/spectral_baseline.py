@@ -11,6 +11,7 @@ import matplotlib.pyplot as plt
 from matplotlib import ticker
 
 from katsdpscripts.RTS import rfilib
+from katsdpscripts.reduction.scan_blocks import ScanBlockReader
 
 
 def read_and_select_file(file, bline=None, target=None, channels=None, polarisation=None, **kwargs):
@@ -183,17 +184,13 @@ def extract_and_average(data, timeav=None, freqav=None, stokesI=False):
     flag_data = np.empty((0,data.shape[1]//chanav,data.shape[2]),dtype=np.bool)
     weight_data = np.empty((0,data.shape[1]//chanav,data.shape[2]))
 
-    #Extract the required arrays from the data object for the averager on a scan by scan basis
-    for scan, state, target in data.scans():
-        scan_vis_data = data.vis[:]
-        scan_weight_data = data.weights()[:]
-        scan_flag_data = data.flags()[:]
-        scan_timestamps = data.timestamps[:]
-        scan_channel_freqs = data.channel_freqs[:]
-        
+    #Extract the required arrays from the data object for the averager on a scan by scan basis,
+    #reading the next scan in the background while the current one is averaged
+    data_channel_freqs = data.channel_freqs[:]
+    for block in ScanBlockReader(data):
         # Average
-        scan_vis_data, scan_weight_data, scan_flag_data, scan_timestamps, scan_channel_freqs = averager.average_visibilities(scan_vis_data, scan_weight_data, scan_flag_data, scan_timestamps, 
-                                                                                                    scan_channel_freqs, timeav=dumpav, chanav=chanav, flagav=False)        
+        scan_vis_data, scan_weight_data, scan_flag_data, scan_timestamps, scan_channel_freqs = averager.average_visibilities(block.vis, block.weights, block.flags, block.timestamps, 
+                                                                                                    data_channel_freqs.copy(), timeav=dumpav, chanav=chanav, flagav=False)        
         vis_data = np.append(vis_data,scan_vis_data,axis=0)
         flag_data = np.append(flag_data,scan_flag_data,axis=0)
         weight_data = np.append(weight_data, scan_weight_data, axis=0)
@@ -56,9 +56,10 @@ def read_and_select_file(file, bline=None, channels=None, **kwargs):
     return data,compscan_labels
 
 
-def get_system_temp(temperature):
-    
-    flags = rfilib.detect_spikes_sumthreshold(temperature)
+def get_system_temp(temperature, flags=None):
+    """Robust mean of spectrum (channels, HH/VV) per polarisation, ignoring spikes found in it."""
+    if flags is None:
+        flags = rfilib.detect_spikes_sumthreshold(temperature)
     temps=[]
     for polnum,thispol in enumerate(['HH','VV']):
         thisdata= temperature[:,polnum]
@@ -77,12 +78,11 @@ def present_results(pdf, temperature, freq, targname, antenna, channelwidth):
     flags = rfilib.detect_spikes_sumthreshold(temperature)
 
     #Loop over polarisations
-    temps=[]
+    temps = get_system_temp(temperature, flags)
     for polnum,thispol in enumerate(['HH','VV']):
         thisdata = temperature[:,polnum]
         thisflags = flags[:,polnum]
-        systemp, err = robust_mu_sigma(thisdata[np.where(thisflags==False)])
-        temps.append(systemp)
+        systemp = temps[polnum]
         ax = plt.subplot(211 + polnum)
         plt.title(targname + ', Antenna: ' + antenna + ', ' + thispol + ' pol')
         ax.text(0.05,0.8,'Tsys: %5.2f'%(systemp),transform=ax.transAxes)
@@ -126,28 +126,34 @@ def analyse_noise_diode(input_file,output_dir='.',antenna='sd',targets='all',fre
     #Convert the data to kelvin using the noise diode firings
     data.convert_power_to_temperature()
 
-    #average each required scan in time sensibly and plot the data
-    for num,compscan in enumerate(data.compscans):
-        compscan_data = np.empty((0,len(data.channel_select),4))
-        if (targets == 'all') or (compscan.target.name in targets):
-            for scan in compscan.scans:
-                scan_data = scan.data[np.where(scan.flags['nd_on']==False)]
-                compscan_data=np.append(compscan_data,scan_data,axis=0)
-            average_spec, sigma_spec = robust_mu_sigma(compscan_data, axis=0)
-            plottitle = compscan.target.name + ' ' + compscan_labels[num]
-            systemp=present_results(pdf, average_spec[:,:2], data.freqs*1.e6, plottitle, data.antenna.name, data.bandwidths[0]*1e6)
-
-    #Get the system temperature in each scan and plot it
+    #Average each required compscan and scan in time sensibly in a single pass over the scans,
+    #plotting the compscan spectra and collecting the system temperature of each scan
     alltempshh,alltempsvv,alltimes=[],[],[]
     zerotime = data.scans[0].timestamps[0]
-    for scan in data.scans:
-        if (targets == 'all') or (scan.compscan.target.name in targets):
-            scan_data = scan.data[np.where(scan.flags['nd_on']==False)]
+    #Buffer for the noise diode off data of a compscan, reused (and grown if needed) for every compscan
+    buffer = np.empty((0,len(data.channel_select),4))
+    for num,compscan in enumerate(data.compscans):
+        if not ((targets == 'all') or (compscan.target.name in targets)):
+            continue
+        nd_off = [scan.flags['nd_on']==False for scan in compscan.scans]
+        num_dumps = sum(off.sum() for off in nd_off)
+        if num_dumps > len(buffer):
+            buffer = np.empty((num_dumps,) + buffer.shape[1:])
+        compscan_data = buffer[:num_dumps]
+        start = 0
+        for scan,off in zip(compscan.scans,nd_off):
+            scan_data = scan.data[off]
+            compscan_data[start:start + len(scan_data)] = scan_data
+            start += len(scan_data)
+            #Get the system temperature in each scan
             average_spec, sigma_spec = robust_mu_sigma(scan_data, axis=0)
             systemp=get_system_temp(average_spec[:,:2])
             alltempshh.append(systemp[0])
             alltempsvv.append(systemp[1])
-            alltimes.append((np.mean(scan.timestamps[np.where(scan.flags['nd_on']==False)])-zerotime)/(60*60))      
+            alltimes.append((np.mean(scan.timestamps[off])-zerotime)/(60*60))
+        average_spec, sigma_spec = robust_mu_sigma(compscan_data, axis=0)
+        plottitle = compscan.target.name + ' ' + compscan_labels[num]
+        systemp=present_results(pdf, average_spec[:,:2], data.freqs*1.e6, plottitle, data.antenna.name, data.bandwidths[0]*1e6)
 
     plot_temps_time(pdf,alltimes,alltempshh,alltempsvv,data.antenna.name)
 
@@ -1,14 +1,15 @@
-import katdal
 import katpoint
 import os
 import pylab as plt
 import numpy as np
-import scipy.interpolate as interpolate
+
+from katsdpscripts.reduction import environment
+from katsdpscripts.reduction.multi_dataset import open_datasets
 
 def select_and_average(filename, average_time):
-    # Read a file into katdal, and average the data to the prescribed averaging time
+    # Read a file (or a list of consecutive files) into katdal, and average the data to the prescribed averaging time
     # Returns the weather data and timestamps with the correct averaging interval
-    data = katdal.open(filename)
+    data = open_datasets(filename)
 
     raw_timestamps = data.sensor.timestamps
     raw_wind_speed = data.sensor.get('Enviro/asc.wind.speed')
@@ -18,9 +19,10 @@ def select_and_average(filename, average_time):
     # Get azel of each antenna and separation of each antenna
     sun = katpoint.Target('Sun, special',antenna=data.ants[0])
     alltimestamps=data.timestamps[:]
+    az, el = data.az[:,0], data.el[:,0]
     solar_seps=np.zeros_like(alltimestamps)
     for dumpnum,timestamp in enumerate(alltimestamps):
-        azeltarget = katpoint.construct_azel_target(katpoint.deg2rad(data.az[dumpnum,0]),katpoint.deg2rad(data.el[dumpnum,0]))
+        azeltarget = katpoint.construct_azel_target(katpoint.deg2rad(az[dumpnum]),katpoint.deg2rad(el[dumpnum]))
         azeltarget.antenna = data.ants[0]
         solar_seps[dumpnum] = katpoint.rad2deg(azeltarget.separation(sun,timestamp))
     #Determine number of dumps to average
@@ -105,64 +107,10 @@ def select_environment(timestamps, wind_speed, temperature, dump_time, antenna,
     return 3 sets of flags for the normal ideal and optimal cases (one flag per timestamp) 
     """
 
-    # Get the sustained 5 minute wind speeds
-    wind_5min = np.mean(rolling_window(wind_speed, int(np.round(300.0/dump_time)), pad=True),axis=1)
-    temp_10min = np.mean(rolling_window(temperature, int(np.round(600.0/dump_time)), pad=True), axis=1)
-
-    # Fit a smooth function (cubic spline) in time to the temperature data
-    fit_temp = interpolate.UnivariateSpline(timestamps,temp_10min,k=3,s=0)
-
-    #fit_temp_grad = fit_temp.derivative()
-
-    # Day/Night
-    # Night is defined as when the Sun is at -5deg.
-    # Set up Sun target
-    sun = katpoint.Target('Sun, special',antenna=antenna)
-    sun_elevation = katpoint.rad2deg(sun.azel(timestamps)[1])
-
-    # Apply limits on environmental conditions
-    good = [True] * timestamps.shape[0]
-
-    # Set up limits on environmental conditions
-    if condition=='ideal':
-        wind5minlim    =   1.
-        windgustlim    =   1.
-        temp_low       =   19.
-        temp_high      =   21.
-        deltatemp      =   1./(30.*60.)
-        sun_elev_lim   =   -5.
-    elif condition=='optimal':
-        wind5minlim    =   2.9
-        windgustlim    =   4.1
-        temp_low       =   -5.
-        temp_high      =   35.
-        deltatemp      =   2./(10.*60.)
-        sun_elev_lim    =   -5.
-    elif condition=='normal':
-        wind5minlim    =   9.8
-        windgustlim    =   13.4
-        temp_low       =   -5.
-        temp_high      =   40.
-        deltatemp      =   3./(20.*60.)
-        sun_elev_lim   =   100.       #Daytime
-    else:
-        return good
-
-    #Average and wind gust limits
-    good = good & (wind_5min < wind5minlim)
-    good = good & (wind_speed < windgustlim)
-
-    #Temperature limits
-    good = good & ((fit_temp(timestamps) > temp_low) & (fit_temp(timestamps) < temp_high))
-    
-    #Get the temperature gradient
-    temp_grad = [fit_temp.derivatives(timestamp)[1] for timestamp in timestamps]
-    good = good & (np.abs(temp_grad) < deltatemp)
-
-    #Day or night?
-    good = good & (sun_elevation < sun_elev_lim)
-
-    return good
+    if condition not in environment.CONDITIONS:
+        return [True] * timestamps.shape[0]
+    quantities = environment.environment_quantities(timestamps, wind_speed, temperature, dump_time, antenna)
+    return environment.screen_conditions(quantities, [condition])[condition]
 
                 
 def plot_weather(filename,timestamps,alltimestamps,wind_speed,temperature,dump_time,solar_seps,antenna,normalflag,optimalflag,idealflag):
@@ -223,10 +171,11 @@ def plot_weather(filename,timestamps,alltimestamps,wind_speed,temperature,dump_t
 
 def weather_report(filename, output_dirname = '.', average_time=5.0):
     timestamps, alltimestamps, wind_speed, temperature, dump_time, sun_distance, antenna = select_and_average(filename, average_time)
-    #Got the data now make the bins
-    normalflag=select_environment(timestamps, wind_speed, temperature, dump_time, antenna, condition='normal')
-    optimalflag=select_environment(timestamps, wind_speed, temperature, dump_time, antenna, condition='optimal')
-    idealflag=select_environment(timestamps, wind_speed, temperature, dump_time, antenna, condition='ideal')
-    output_filename = os.path.join(output_dirname, os.path.splitext(os.path.basename(filename))[0]+'_ConditionReport.pdf')
+    #Got the data now make the bins (derived quantities are shared by all conditions)
+    quantities = environment.environment_quantities(timestamps, wind_speed, temperature, dump_time, antenna)
+    flags = environment.screen_conditions(quantities, ['normal', 'optimal', 'ideal'])
+    normalflag, optimalflag, idealflag = flags['normal'], flags['optimal'], flags['ideal']
+    first_filename = filename if isinstance(filename, basestring) else filename[0]
+    output_filename = os.path.join(output_dirname, os.path.splitext(os.path.basename(first_filename))[0]+'_ConditionReport.pdf')
     plot_weather(output_filename,timestamps,alltimestamps,wind_speed,temperature,dump_time,sun_distance,antenna,normalflag,optimalflag,idealflag)
 
@@ -0,0 +1,301 @@
+###############################################################################
+# SKA South Africa (http://ska.ac.za/)                                        #
+# Author: cam@ska.ac.za                                                       #
+# Copyright @ 2013 SKA SA. All rights reserved.                               #
+#                                                                             #
+# THIS SOFTWARE MAY NOT BE COPIED OR DISTRIBUTED IN ANY FORM WITHOUT THE      #
+# WRITTEN PERMISSION OF SKA SA.                                               #
+###############################################################################
+"""Concurrent adjustment of attenuators to reach desired power levels.
+
+Setting attenuators by polling each power sensor many times per input and
+sleeping a fixed period between iterations spends most of its time waiting.
+Instead, a :class:`PowerSampler` subscribes once to the power sensors of all
+inputs with a sensor strategy and collects the sample streams in the sensor
+callbacks, so that medians of recent samples of all inputs are available
+together. :func:`adjust_attenuation` then issues the attenuation requests of
+all inputs concurrently, waits only until fresh samples of the adjusted inputs
+have arrived, and stops adjusting each input as soon as its power is in range.
+
+Typical use::
+
+    inputs = [AttenuatorInput('ant1 H', (ped, 'rfe5_attenuator_horizontal'),
+                              lambda value: ped.req.rfe5_attenuation('h', value),
+                              (dbe, 'dbe_ant1h_adc_power')), ...]
+    att, power, success = adjust_attenuation(inputs, -26.0, 0.0, 63.5, 0.5)
+
+"""
+
+import threading
+import time
+import logging
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+
+user_logger = logging.getLogger("user")
+
+# Sensor strategies that can be restored without knowing their parameters
+PARAMETERLESS_STRATEGIES = ('none', 'auto', 'event')
+
+
+class AttenuatorInput(object):
+    """Attenuator and subsequent power sensor of a single signal path.
+
+    Parameters
+    ----------
+    name : string
+        Name of input (e.g. 'ant1 H'), used in log messages
+    att_sensor : (client, string) pair
+        Device and name of sensor reporting attenuation, in dB
+    set_att : callable
+        Function requesting new attenuation in dB, as set_att(value)
+    power_sensor : (client, string) pair
+        Device and name of sensor measuring power after attenuator, in dBm
+
+    """
+    def __init__(self, name, att_sensor, set_att, power_sensor):
+        self.name = name
+        self.att_sensor = att_sensor
+        self.set_att = set_att
+        self.power_sensor = power_sensor
+
+    def get_att(self):
+        """Current attenuation, in dB."""
+        client, sensor_name = self.att_sensor
+        return getattr(client.sensor, sensor_name).get_value()
+
+
+class PowerSampler(object):
+    """Collect sample streams of power sensors and provide medians of recent samples.
+
+    Parameters
+    ----------
+    sensors : sequence of (client, string) pairs
+        Devices and names of sensors to sample (each client needs a *sensor*
+        attribute and a *req.sensor_sampling* request)
+    strategy : string, optional
+        Sensor sampling strategy ('period' or 'event')
+    params : float or None, optional
+        Sampling strategy parameter (period in seconds for 'period' strategy)
+    max_samples : int, optional
+        Number of most recent samples per sensor to keep
+
+    Notes
+    -----
+    When sampling stops, each sensor gets back the strategy it had before
+    sampling started. As the parameters of that strategy are unknown, an
+    earlier strategy that needs parameters (e.g. 'period') becomes 'none'.
+
+    """
+    def __init__(self, sensors, strategy='period', params=0.05, max_samples=100):
+        self.sensors = list(sensors)
+        self.strategy = strategy
+        self.params = params
+        self._samples = [deque(maxlen=max_samples) for sensor in self.sensors]
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._previous_strategies = []
+
+    def __enter__(self):
+        """Start sampling on entering context."""
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Stop sampling on leaving context."""
+        self.stop()
+        # Don't suppress exceptions
+        return False
+
+    def start(self):
+        """Subscribe to all sensors (once)."""
+        if self._listeners:
+            return
+        for n, (client, sensor_name) in enumerate(self.sensors):
+            sensor = getattr(client.sensor, sensor_name)
+            self._previous_strategies.append(getattr(sensor, 'strategy', 'none'))
+            if self.params is None:
+                client.req.sensor_sampling(sensor_name, self.strategy)
+            else:
+                client.req.sensor_sampling(sensor_name, self.strategy, self.params)
+            listener = self._make_listener(n)
+            sensor.register_listener(listener)
+            self._listeners.append((sensor, listener))
+
+    def stop(self):
+        """Unsubscribe from all sensors and restore their previous strategies."""
+        for (client, sensor_name), (sensor, listener), previous in zip(self.sensors, self._listeners,
+                                                                        self._previous_strategies):
+            sensor.unregister_listener(listener)
+            # Don't leave the fast sampling strategy running after we are done
+            client.req.sensor_sampling(sensor_name, previous if previous in PARAMETERLESS_STRATEGIES else 'none')
+        self._listeners = []
+        self._previous_strategies = []
+
+    def _make_listener(self, index):
+        """Sensor callback that stores new sample of sensor *index*."""
+        def listener(update_seconds, value_seconds, status, value):
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                return
+            with self._lock:
+                self._samples[index].append(value)
+        return listener
+
+    def clear(self, indices=None):
+        """Discard samples of given sensors (all by default), e.g. after changing attenuation."""
+        with self._lock:
+            for n in range(len(self.sensors)) if indices is None else indices:
+                self._samples[n].clear()
+
+    @property
+    def counts(self):
+        """Number of samples collected per sensor."""
+        with self._lock:
+            return np.array([len(samples) for samples in self._samples])
+
+    def wait(self, num_samples, indices=None, timeout=5.0, clock=time, poll_period=0.1):
+        """Wait until enough samples of given sensors have been collected.
+
+        Parameters
+        ----------
+        num_samples : int
+            Minimum number of samples per sensor
+        indices : sequence of int, optional
+            Indices of sensors to wait for (default is all)
+        timeout : float, optional
+            Maximum time to wait, in seconds
+        clock : object with *time* and *sleep* methods, optional
+            Time source (e.g. the :mod:`time` module or a telescope object)
+        poll_period : float, optional
+            Time between checks on the sample counts, in seconds
+
+        Returns
+        -------
+        done : bool
+            True if all requested sensors have enough samples
+
+        """
+        indices = range(len(self.sensors)) if indices is None else list(indices)
+        deadline = clock.time() + timeout
+        while True:
+            counts = self.counts[indices]
+            if len(counts) == 0 or counts.min() >= num_samples:
+                return True
+            remaining = deadline - clock.time()
+            if remaining <= 0.0:
+                return False
+            clock.sleep(min(poll_period, remaining))
+
+    def medians(self, indices=None):
+        """Median of collected samples per sensor, using current value if there are no samples."""
+        indices = range(len(self.sensors)) if indices is None else list(indices)
+        medians = np.zeros(len(indices))
+        for m, n in enumerate(indices):
+            with self._lock:
+                samples = list(self._samples[n])
+            if not samples:
+                client, sensor_name = self.sensors[n]
+                value = getattr(client.sensor, sensor_name).get_value()
+                samples = [np.nan if value is None else value]
+            medians[m] = np.median(samples)
+        return medians
+
+
+def quantise_attenuation(att, min_att, max_att, att_step):
+    """Round attenuation to the nearest allowed setting within the attenuator range."""
+    att = np.round((np.asarray(att, dtype=np.float64) - min_att) / att_step) * att_step + min_att
+    return np.clip(att, min_att, max_att)
+
+
+def _silent_inputs(inputs, power, indices):
+    """Indices of inputs among *indices* without power values, with a warning for each."""
+    silent = [n for n in indices if np.isnan(power[n])]
+    for n in silent:
+        user_logger.warning("%s: power sensor %r is not returning a value" %
+                            (inputs[n].name, inputs[n].power_sensor[1]))
+    return silent
+
+
+def adjust_attenuation(inputs, desired_power, min_att, max_att, att_step, power_range=2.0,
+                       max_iterations=5, settle_time=0.5, num_samples=10, timeout=5.0,
+                       strategy='period', params=0.05, clock=time, max_workers=16):
+    """Iteratively adjust attenuators of all inputs to move power towards desired value.
+
+    The difference between measured and desired power is taken as the extra
+    attenuation needed. All inputs are adjusted concurrently, and each input
+    stops as soon as its power is within range (or its attenuator cannot move
+    any further).
+
+    Parameters
+    ----------
+    inputs : sequence of :class:`AttenuatorInput` objects
+        Inputs to adjust
+    desired_power : float
+        Desired power, in dBm
+    min_att, max_att, att_step : float
+        Minimum attenuation, maximum attenuation and finest resolution to
+        which attenuation can be set, all in dB
+    power_range : float, optional
+        Width of acceptable power range centred on desired power, in dB
+    max_iterations : int, optional
+        Maximum number of adjustments per input
+    settle_time : float, optional
+        Time to wait for power to settle after changing attenuation, in seconds
+    num_samples : int, optional
+        Number of power samples per median
+    timeout : float, optional
+        Maximum time to wait for power samples, in seconds
+    strategy, params : string and float, optional
+        Sampling strategy of power sensors (see :class:`PowerSampler`)
+    clock : object with *time* and *sleep* methods, optional
+        Time source (e.g. the :mod:`time` module or a telescope object)
+    max_workers : int, optional
+        Maximum number of attenuation requests in flight at the same time
+
+    Returns
+    -------
+    att : array of float, shape (N,)
+        Final attenuation of each input, in dB
+    power : array of float, shape (N,)
+        Final median power of each input, in dBm
+    success : array of bool, shape (N,)
+        True for inputs with power within range
+
+    """
+    inputs = list(inputs)
+    num_inputs = len(inputs)
+    in_range = lambda power: np.abs(power - desired_power) <= power_range / 2.
+    pool = ThreadPool(max(1, min(max_workers, num_inputs)))
+    try:
+        with PowerSampler([inp.power_sensor for inp in inputs], strategy, params) as sampler:
+            sampler.wait(num_samples, timeout=timeout, clock=clock)
+            power = sampler.medians()
+            att = np.array([inp.get_att() for inp in inputs], dtype=np.float64)
+            active = ~in_range(power)
+            active[_silent_inputs(inputs, power, range(num_inputs))] = False
+            for iteration in range(max_iterations):
+                new_att = quantise_attenuation(att + power - desired_power, min_att, max_att, att_step)
+                # Stop once attenuator value has settled
+                active &= new_att != att
+                adjust = np.flatnonzero(active)
+                if len(adjust) == 0:
+                    break
+                pool.map(lambda n: inputs[n].set_att(new_att[n]), adjust)
+                # Wait until power has stabilised before collecting fresh samples of the adjusted inputs
+                clock.sleep(settle_time)
+                sampler.clear(adjust)
+                sampler.wait(num_samples, adjust, timeout=timeout, clock=clock)
+                power[adjust] = sampler.medians(adjust)
+                att[adjust] = [inputs[n].get_att() for n in adjust]
+                active &= ~in_range(power)
+                # Never set attenuation based on a power sensor that stopped returning values
+                active[_silent_inputs(inputs, power, adjust)] = False
+    finally:
+        pool.close()
+        pool.join()
+    return att, power, in_range(power)
@@ -1,3 +1,5 @@
+import numpy as np
+
 from katpoint import (Antenna, Target, rad2deg, deg2rad, wrap_angle,
                       construct_azel_target)
 
@@ -125,3 +127,31 @@ class ObservationModel(FakeModel):
     def __init__(self, **kwargs):
         self.label = ''
         self.params = ''
+
+
+class RFChainModel(FakeModel):
+    """Two attenuator stages followed by an ADC power detector per input."""
+    def __init__(self, inputs, input_power, rfe5_gain, rfe7_gain, noise_db=0.1, **kwargs):
+        self.inputs = inputs
+        self.input_power = dict(zip(inputs, input_power))
+        self.rfe5_gain = rfe5_gain
+        self.rfe7_gain = rfe7_gain
+        self.noise_db = noise_db
+        for inp in inputs:
+            setattr(self, 'rfe5_attenuation_' + inp, 0.0)
+            setattr(self, 'rfe7_attenuation_' + inp, 0.0)
+        self.update(0.0)
+
+    def req_rfe5_attenuation(self, inp, value):
+        setattr(self, 'rfe5_attenuation_' + inp, float(value))
+
+    def req_rfe7_attenuation(self, inp, value):
+        setattr(self, 'rfe7_attenuation_' + inp, float(value))
+
+    def update(self, timestamp):
+        for inp in self.inputs:
+            noise = self.noise_db * np.random.randn(2)
+            rfe5_out = self.input_power[inp] + self.rfe5_gain - getattr(self, 'rfe5_attenuation_' + inp)
+            adc = rfe5_out + self.rfe7_gain - getattr(self, 'rfe7_attenuation_' + inp)
+            setattr(self, 'rfe5_power_out_' + inp, rfe5_out + noise[0])
+            setattr(self, 'adc_power_' + inp, adc + noise[1])
@@ -0,0 +1,277 @@
+###############################################################################
+# SKA South Africa (http://ska.ac.za/)                                        #
+# Author: cam@ska.ac.za                                                       #
+# Copyright @ 2013 SKA SA. All rights reserved.                               #
+#                                                                             #
+# THIS SOFTWARE MAY NOT BE COPIED OR DISTRIBUTED IN ANY FORM WITHOUT THE      #
+# WRITTEN PERMISSION OF SKA SA.                                               #
+###############################################################################
+"""Spiral scan trajectories for holography observations.
+
+The spiral holography scans consist of a number of arms, which are rotated
+copies of a single Archimedean spiral arm ``x = r cos(2 pi r)``,
+``y = r sin(2 pi r)`` scaled to the requested extent. For the 'uniform' kind,
+consecutive points on the arm are equally spaced so that the scanning antenna
+moves at constant speed. Instead of solving for each point in turn with a
+least-squares fit, the arm is obtained from the closed-form arc length of the
+spiral, which is inverted with a vectorised Newton iteration. A few
+vectorised corrections of the arc-length increments then turn equal arc
+lengths into equal chords, which reproduces the original point-by-point
+solution to machine precision.
+
+Optionally the speed along the arm may be reduced where the curvature is high
+(near the centre of the spiral) to limit the centripetal acceleration of the
+scanning antenna, in which case the arm has more points.
+
+Generated patterns are cached by parameter set, as they are reused for every
+cycle of an observation.
+
+"""
+
+import numpy as np
+
+# Cache of generated spiral patterns, keyed on parameters
+_spiral_cache = {}
+# Limit the number of cached patterns to keep memory bounded
+MAX_CACHED_SPIRALS = 32
+# Number of Newton iterations used to invert the spiral arc length
+NEWTON_ITERATIONS = 12
+# Maximum number of corrections turning equal arc lengths into equal chords
+MAX_CHORD_ITERATIONS = 100
+
+
+def plane_to_sphere_holography(targetaz, targetel, ll, mm):
+    """Turn direction cosines (ll, mm) around target into (az, el) of scanning antenna."""
+    scanaz = targetaz - np.arcsin(np.clip(ll / np.cos(targetel), -1.0, 1.0))
+    scanel = np.arcsin(np.clip((np.sqrt(1.0 - ll ** 2 - mm ** 2) * np.sin(targetel) +
+                                np.sqrt(np.cos(targetel) ** 2 - ll ** 2) * mm) / (1.0 - ll ** 2), -1.0, 1.0))
+    return scanaz, scanel
+
+
+def sphere_to_plane_holography(targetaz, targetel, scanaz, scanel):
+    """Turn (az, el) of scanning antenna into direction cosines around target.
+
+    This is the same as ``katpoint.projection._sphere_to_plane_common`` with
+    az0=scanaz, el0=scanel, az=targetaz, el=targetel, ll=ortho_x, mm=-ortho_y.
+
+    """
+    ll = np.cos(targetel) * np.sin(targetaz - scanaz)
+    mm = np.cos(targetel) * np.sin(scanel) * np.cos(targetaz - scanaz) - np.cos(scanel) * np.sin(targetel)
+    return ll, mm
+
+
+def scan_offsets(targetaz, targetel, x, y):
+    """Offsets to request from scanning antenna to reach spiral points (x, y).
+
+    Parameters
+    ----------
+    targetaz, targetel : float or array
+        Azimuth and elevation of target, in radians
+    x, y : float or array
+        Points in spiral pattern (direction cosines around target), in degrees
+
+    Returns
+    -------
+    offsetx, offsety : float or array
+        Offsets for 'offset_fixed' request, in degrees
+
+    """
+    scanaz, scanel = plane_to_sphere_holography(targetaz, targetel, np.radians(x), np.radians(y))
+    targetx, targety = sphere_to_plane_holography(scanaz, scanel, targetaz, targetel)
+    return np.degrees(targetx), -np.degrees(targety)
+
+
+def spiral_arc_length(r):
+    """Arc length along spiral ``(r cos(2 pi r), r sin(2 pi r))`` from centre to radius *r*."""
+    u = 2.0 * np.pi * r
+    return (u * np.sqrt(1.0 + u * u) + np.arcsinh(u)) / (4.0 * np.pi)
+
+
+def spiral_radius(s):
+    """Radius on spiral reached after arc length *s* along it (inverse of :func:`spiral_arc_length`)."""
+    s = np.asarray(s, dtype=np.float64)
+    # The guess is exact for small and large s and the iteration converges quadratically from above
+    u = np.sqrt(4.0 * np.pi * s)
+    for iteration in range(NEWTON_ITERATIONS):
+        u -= (spiral_arc_length(u / (2.0 * np.pi)) - s) * (2.0 * np.pi) / np.sqrt(1.0 + u * u)
+    return u / (2.0 * np.pi)
+
+
+def spiral_curvature_radius(r):
+    """Radius of curvature of spiral at radius *r*."""
+    u = 2.0 * np.pi * r
+    return (1.0 + u * u) ** 1.5 / (2.0 + u * u) / (2.0 * np.pi)
+
+
+def _spiral_points(r):
+    """Cartesian coordinates of spiral at radius *r*."""
+    return r * np.cos(2.0 * np.pi * r), r * np.sin(2.0 * np.pi * r)
+
+
+def uniform_spiral_arm(ntime):
+    """Spiral arm of *ntime* points spaced 1 / ntime apart, starting at the centre.
+
+    Parameters
+    ----------
+    ntime : int
+        Number of points in arm
+
+    Returns
+    -------
+    r : array of float, shape (ntime,)
+        Radius of each point on spiral ``(r cos(2 pi r), r sin(2 pi r))``
+
+    """
+    step = 1.0 / ntime
+    ds = np.tile(step, max(ntime - 1, 0))
+    for iteration in range(MAX_CHORD_ITERATIONS):
+        x, y = _spiral_points(spiral_radius(np.r_[0.0, np.cumsum(ds)]))
+        ratio = step / np.sqrt(np.diff(x) ** 2 + np.diff(y) ** 2)
+        ds *= ratio
+        if np.all(np.abs(ratio - 1.0) < 1e-12):
+            break
+    return spiral_radius(np.r_[0.0, np.cumsum(ds)])
+
+
+def accel_limited_spiral_arm(r_end, scale, speed, max_accel, sampletime=1.0, oversample=64):
+    """Spiral arm sampled in time with speed limited by centripetal acceleration.
+
+    The arm runs from the centre to radius *r_end* at a speed of *speed*,
+    except where that would exceed *max_accel* given the local curvature of
+    the spiral, in which case the speed is reduced to sqrt(max_accel * rho).
+
+    Parameters
+    ----------
+    r_end : float
+        Radius of last point on unscaled spiral
+    scale : float
+        Factor scaling the unscaled spiral to degrees on the sky
+    speed : float
+        Nominal scan speed, in degrees per second
+    max_accel : float
+        Maximum centripetal acceleration, in degrees per second squared
+    sampletime : float, optional
+        Time between points on arm, in seconds
+    oversample : int, optional
+        Number of integration steps per nominal point
+
+    Returns
+    -------
+    r : array of float
+        Radius of each point on unscaled spiral
+
+    """
+    length = spiral_arc_length(r_end)
+    num_nominal = max(int(np.ceil(length * scale / (speed * sampletime))), 1)
+    s = np.linspace(0.0, length, num_nominal * oversample + 1)
+    rho = spiral_curvature_radius(spiral_radius(s)) * scale
+    v = np.minimum(speed, np.sqrt(max_accel * rho))
+    dt = np.diff(s) * scale * 0.5 * (1.0 / v[:-1] + 1.0 / v[1:])
+    t = np.r_[0.0, np.cumsum(dt)]
+    # Stretch sample times slightly so that the arm still ends on its last point
+    times = np.linspace(0.0, t[-1], int(np.ceil(t[-1] / sampletime - 1e-6)) + 1)
+    return spiral_radius(np.interp(times, t, s))
+
+
+def _cached_readonly(arrays):
+    """Mark arrays as read-only, since they are shared via the cache."""
+    for array in arrays:
+        array.setflags(write=False)
+    return arrays
+
+
+def generatespiral(totextent, tottime, tracktime=1, sampletime=1, kind='uniform', mirrorx=False,
+                   max_accel=None):
+    """Generate spiral scan pattern consisting of a number of rotated arms.
+
+    Note that the spiral should only extend above the horizon for the first
+    few scans in case the source is rising, which is why a version rotated in
+    the opposite direction is also returned (use it if the source is setting).
+
+    Parameters
+    ----------
+    totextent : float
+        Diameter of pattern, in degrees
+    tottime : float
+        Total duration of pattern, in seconds
+    tracktime : float, optional
+        Extra time to track target at the start / end of each arm, in seconds
+    sampletime : float, optional
+        Time between points on pattern, in seconds
+    kind : {'uniform', 'dense-core', 'approx'}, optional
+        Kind of spiral
+    mirrorx : {False, True}, optional
+        True to mirror x coordinates of pattern
+    max_accel : float or None, optional
+        Maximum centripetal acceleration along 'uniform' arms, in degrees per
+        second squared (default is no limit); limiting it adds points (and
+        time) to each arm
+
+    Returns
+    -------
+    compositex, compositey : list of arrays
+        Coordinates of points on each arm, in degrees
+    ncompositex, ncompositey : list of arrays
+        Coordinates of points on each arm of oppositely rotated pattern
+
+    Notes
+    -----
+    The patterns are cached and shared between calls with the same
+    parameters, so the returned arrays are read-only.
+
+    """
+    key = (float(totextent), float(tottime), float(tracktime), float(sampletime), kind,
+           bool(mirrorx), max_accel if max_accel is None else float(max_accel))
+    pattern = _spiral_cache.get(key)
+    if pattern is None:
+        if len(_spiral_cache) >= MAX_CACHED_SPIRALS:
+            _spiral_cache.clear()
+        pattern = _spiral_cache[key] = _generatespiral(*key)
+    return tuple(list(arms) for arms in pattern)
+
+
+def _generatespiral(totextent, tottime, tracktime, sampletime, kind, mirrorx, max_accel):
+    """Uncached version of :func:`generatespiral` (see its docstring)."""
+    nextrazeros = int(tracktime / sampletime)
+    tracktime = nextrazeros * sampletime
+    radextent = totextent / 2.0
+    c = 180.0 / (16.0 * np.pi)
+    if kind == 'dense-core':
+        c *= np.sqrt(2)
+    # Ensures even number of arms - then scan pattern ends on target (if odd it will not)
+    narms = 2 * int(np.sqrt(tottime / c + (tracktime / c) ** 2) - tracktime / c)
+    ntime = int((tottime - tracktime * narms) / (sampletime * narms))
+    if kind in ('dense-core', 'approx'):
+        armrad = radextent * np.linspace(0, 1, ntime)
+        armtheta = np.linspace(0, np.pi, ntime)
+        armx = armrad * np.cos(armtheta)
+        army = armrad * np.sin(armtheta)
+        if kind == 'approx':
+            dist = np.sqrt((armx[:-1] - armx[1:]) ** 2 + (army[:-1] - army[1:]) ** 2)
+            narmrad = np.cumsum(np.concatenate([np.array([0]), 1.0 / dist]))
+            narmrad *= radextent / max(narmrad)
+            narmtheta = narmrad / radextent * np.pi
+            armx = narmrad * np.cos(narmtheta)
+            army = narmrad * np.sin(narmtheta)
+    else:
+        # 'uniform': equally spaced points on curve x = r cos(2 pi r), y = r sin(2 pi r)
+        r = uniform_spiral_arm(ntime)
+        scale = radextent / r[-1]
+        if max_accel is not None:
+            r = accel_limited_spiral_arm(r[-1], scale, scale / ntime / sampletime, max_accel, sampletime)
+        armx, army = _spiral_points(r)
+        armx, army = armx * scale, army * scale
+
+    compositex, compositey, ncompositex, ncompositey = [], [], [], []
+    zeros = np.zeros(nextrazeros)
+    sign = -1.0 if mirrorx else 1.0
+    for ia in range(narms):
+        rot = ia * np.pi * 2.0 / narms
+        # Odd-numbered arms are scanned from the outside in
+        order = slice(None, None, -1) if ia % 2 else slice(None)
+        for xs, ys, angle in ((compositex, compositey, -rot), (ncompositex, ncompositey, rot)):
+            x = np.r_[zeros, armx * np.cos(angle) - army * np.sin(angle)][order]
+            y = np.r_[zeros, armx * np.sin(angle) + army * np.cos(angle)][order]
+            xs.append(sign * x)
+            ys.append(y)
+    return tuple(_cached_readonly(arms) for arms in (compositex, compositey, ncompositex, ncompositey))
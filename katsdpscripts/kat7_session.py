@@ -28,6 +28,8 @@ from katcorelib.targets import Offset
 from .array import Array
 from .katcp_client import KATClient
 from .defaults import user_logger, activity_logger
+from . import obstime
+from .visibility import VisibilityEngine
 from katmisc.utils.utils import dynamic_doc
 
 
@@ -178,6 +180,8 @@ class CaptureSession(CaptureSessionBase):
             self.output_file = ''
             self.dump_period = self._requested_dump_period = 0.0
             self.horizon = 3.0
+            # Cached target elevation tracks used for visibility checks
+            self.visibility = VisibilityEngine()
             self._end_of_previous_session = dbe.sensor.k7w_last_dump_timestamp.get_value()
 
             if mode is None:
@@ -390,7 +394,9 @@ class CaptureSession(CaptureSessionBase):
         session.experiment_id = experiment_id = session.experiment_id if experiment_id is None else experiment_id
         session.nd_params = nd_params = session.nd_params if nd_params is None else nd_params
         session.stow_when_done = stow_when_done = session.stow_when_done if stow_when_done is None else stow_when_done
-        session.horizon = session.horizon if horizon is None else horizon
+        session.horizon = session.visibility.horizon = session.horizon if horizon is None else horizon
+        # Antenna locations used for target selection and visibility checks
+        session.visibility.antennas = session._usable_antennas()
         # Requested dump period, replaced by actual value after capture started
         session._requested_dump_period = 1.0 / dump_rate
 
@@ -525,6 +531,14 @@ class CaptureSession(CaptureSessionBase):
                 return False
         return True
 
+    def _usable_antennas(self):
+        """Locations of session antennas that are connected and have observer strings."""
+        # Ignore disconnected antennas or ones with missing sensors
+        ant_descriptions = [ant.sensor.observer.get_value() for ant in self.ants
+                            if ant.is_connected() and 'observer' in ant.sensor]
+        # Also ignore antennas with empty or missing observer strings
+        return [katpoint.Antenna(descr) for descr in ant_descriptions if descr]
+
     def target_visible(self, target, duration=0., timeout=300.):
         """Check whether target is visible for given duration.
 
@@ -554,28 +568,25 @@ class CaptureSession(CaptureSessionBase):
             return False
         # Convert description string to target object, or keep object as is
         target = target if isinstance(target, katpoint.Target) else katpoint.Target(target)
-        horizon = katpoint.deg2rad(self.horizon)
+        horizon = self.horizon
         # Include an average time to slew to the target (worst case about 90 seconds, so half that)
         now = time.time() + 45.
         average_el, visible_before, visible_after = [], [], []
-        # Ignore disconnected antennas or ones with missing sensors
-        ant_descriptions = [ant.sensor.observer.get_value() for ant in self.ants
-                            if ant.is_connected() and 'observer' in ant.sensor]
-        # Also ignore antennas with empty or missing observer strings
-        antennas = [katpoint.Antenna(descr) for descr in ant_descriptions if descr]
+        antennas = self._usable_antennas()
         if not antennas:
             user_logger.warning("No usable antennas found - target '%s' assumed to be down" % (target.name,))
             return False
+        self.visibility.antennas, self.visibility.horizon = antennas, self.horizon
         for antenna in antennas:
-            az, el = target.azel(now, antenna)
-            average_el.append(katpoint.rad2deg(el))
+            el = self.visibility.elevation(target, now, antenna)
+            average_el.append(el)
             # If not up yet, see if the target will pop out before the timeout
             if el < horizon:
                 now += timeout
-                az, el = target.azel(now, antenna)
+                el = self.visibility.elevation(target, now, antenna)
             visible_before.append(el >= horizon)
             # Check what happens at end of observation
-            az, el = target.azel(now + duration, antenna)
+            el = self.visibility.elevation(target, now + duration, antenna)
             visible_after.append(el >= horizon)
         if all(visible_before) and all(visible_after):
             return True
@@ -1083,6 +1094,8 @@ class TimeSession(CaptureSessionBase):
         self.output_file = ''
         self.dump_period = self._requested_dump_period = 0.0
         self.horizon = 3.0
+        # Cached target elevation tracks used for visibility checks
+        self.visibility = VisibilityEngine()
 
         self.start_time = self._end_of_previous_session = time.time()
         self.time = self.start_time
@@ -1151,12 +1164,8 @@ class TimeSession(CaptureSessionBase):
                 """Obtain instantaneous target position and estimate time to slew there."""
                 # Target position right now
                 az, el = self._azel(target, timestamp, ant)
-                # If target is below horizon, aim at closest point on horizon
-                az_dist, el_dist = np.abs(az - ant_az), np.abs(max(el, self.el_limit) - ant_el)
-                # Ignore azimuth wraps and drive strategies
-                az_dist = az_dist if az_dist < 180. else 360. - az_dist
-                # Assume az speed of 2 deg/s, el speed of 1 deg/s and overhead of 1 second
-                slew_time = max(0.5 * az_dist, 1.0 * el_dist) + 1.0
+                # If target is below horizon, aim at closest point on horizon (same drive model as obstime)
+                slew_time = float(obstime.slew_time(az, el, ant_az, ant_el, self.el_limit))
                 return az, el, slew_time
             # Initial estimate of slew time, based on a stationary target
             az1, el1, slew_time = estimate_slew(self.time)
@@ -1223,11 +1232,12 @@ class TimeSession(CaptureSessionBase):
                                         ant.sensor.pos_actual_scan_elev.get_value()))
             except AttributeError:
                 pass
+        self.visibility.antennas = [ant[0] for ant in self._fake_ants]
         # Override provided session parameters (or initialize them from existing parameters if not provided)
         self.experiment_id = experiment_id = self.experiment_id if experiment_id is None else experiment_id
         self.nd_params = nd_params = self.nd_params if nd_params is None else nd_params
         self.stow_when_done = stow_when_done = self.stow_when_done if stow_when_done is None else stow_when_done
-        self.horizon = self.horizon if horizon is None else horizon
+        self.horizon = self.visibility.horizon = self.horizon if horizon is None else horizon
         self._requested_dump_period = 1.0 / dump_rate
 
         user_logger.info('Antennas used = %s' % (' '.join([ant[0].name for ant in self._fake_ants]),))
@@ -1280,20 +1290,20 @@ class TimeSession(CaptureSessionBase):
             return False
         # Convert description string to target object, or keep object as is
         target = target if isinstance(target, katpoint.Target) else katpoint.Target(target)
-        horizon = katpoint.deg2rad(self.horizon)
+        horizon = self.horizon
         # Include an average time to slew to the target (worst case about 90 seconds, so half that)
         now = self.time + 45.
         average_el, visible_before, visible_after = [], [], []
         for antenna, mode, ant_az, ant_el in self._fake_ants:
-            az, el = target.azel(now, antenna)
-            average_el.append(katpoint.rad2deg(el))
+            el = self.visibility.elevation(target, now, antenna)
+            average_el.append(el)
             # If not up yet, see if the target will pop out before the timeout
             if el < horizon:
                 now += timeout
-                az, el = target.azel(now, antenna)
+                el = self.visibility.elevation(target, now, antenna)
             visible_before.append(el >= horizon)
             # Check what happens at end of observation
-            az, el = target.azel(now + duration, antenna)
+            el = self.visibility.elevation(target, now + duration, antenna)
             visible_after.append(el >= horizon)
         if all(visible_before) and all(visible_after):
             return True
@@ -0,0 +1,408 @@
+###############################################################################
+# SKA South Africa (http://ska.ac.za/)                                        #
+# Author: cam@ska.ac.za                                                       #
+# Copyright @ 2013 SKA SA. All rights reserved.                               #
+#                                                                             #
+# THIS SOFTWARE MAY NOT BE COPIED OR DISTRIBUTED IN ANY FORM WITHOUT THE      #
+# WRITTEN PERMISSION OF SKA SA.                                               #
+###############################################################################
+"""Vectorised estimates of observation time for catalogues of targets.
+
+This provides the same slew and visibility model as the fake
+:class:`TimeSession` class, but evaluates it on whole arrays of targets,
+antennas and candidate start times at once. The (az, el) coordinates of
+fixed celestial targets are computed in closed form from their apparent
+(ra, dec) coordinates and a linear local sidereal time, which agrees with
+the full katpoint calculation to well below an arcsecond over a day. Moving
+targets (Sun, Moon, satellites, ...) fall back to katpoint.
+
+The :class:`ObservationTimeEstimator` answers catalogue-wide questions (slew
+times and horizon visibility), while :class:`PlanTimer` steps through a
+sequence of canned commands like a dry run of an observation script and
+reports the total duration, which makes it easy to compare observation plans.
+
+"""
+
+import numpy as np
+import katpoint
+
+
+# Ratio of sidereal to solar time
+SIDEREAL_RATE = 1.00273790935
+# Antenna drive model used by TimeSession
+AZ_SLEW_RATE = 2.0
+EL_SLEW_RATE = 1.0
+SLEW_OVERHEAD = 1.0
+# Actual antenna elevation limit (as opposed to user-requested session horizon)
+EL_LIMIT = 2.5
+# Average time to slew to target assumed by target_visible (worst case about 90 seconds, so half that)
+AVERAGE_SLEW = 45.0
+# Body types with fixed (ra, dec) coordinates that can be evaluated in closed form
+FIXED_BODY_TYPES = ('radec', 'gal')
+
+
+def slew_time(az, el, ant_az, ant_el, el_limit=EL_LIMIT):
+    """Estimate time to slew from antenna position to target position.
+
+    This is the simple drive model of :class:`TimeSession`, which ignores
+    azimuth wraps and drive strategies, and assumes an azimuth speed of
+    2 deg/s, an elevation speed of 1 deg/s and an overhead of 1 second. If the
+    target is below the elevation limit, the antenna aims at the closest point
+    on the horizon instead. All arguments may be arrays that broadcast.
+
+    Parameters
+    ----------
+    az, el : float or array
+        Target position, in degrees
+    ant_az, ant_el : float or array
+        Current antenna position, in degrees
+    el_limit : float, optional
+        Antenna elevation limit, in degrees
+
+    Returns
+    -------
+    slew_time : float or array
+        Slew time, in seconds
+
+    """
+    az_dist = np.abs(np.asarray(az) - ant_az)
+    el_dist = np.abs(np.maximum(el, el_limit) - ant_el)
+    az_dist = np.where(az_dist < 180., az_dist, 360. - az_dist)
+    return np.maximum(az_dist / AZ_SLEW_RATE, el_dist / EL_SLEW_RATE) + SLEW_OVERHEAD
+
+
+def _as_target_list(targets):
+    """Turn catalogue, target, description string or sequence into target list."""
+    if isinstance(targets, katpoint.Catalogue):
+        return list(targets.targets)
+    if isinstance(targets, (katpoint.Target, basestring)):
+        targets = [targets]
+    return [t if isinstance(t, katpoint.Target) else katpoint.Target(t) for t in targets]
+
+
+def catalogue_azel(targets, antenna, timestamps, per_target=False):
+    """Calculate (az, el) coordinates of many targets at many times.
+
+    Parameters
+    ----------
+    targets : :class:`katpoint.Catalogue` object, or sequence of targets
+        Targets as objects or description strings
+    antenna : :class:`katpoint.Antenna` object
+        Antenna pointing at the targets
+    timestamps : float or array
+        Timestamps in UTC seconds since Unix epoch
+    per_target : {False, True}, optional
+        If True, the first axis of *timestamps* is indexed by target, which
+        allows each target to be evaluated at its own set of times
+
+    Returns
+    -------
+    az, el : array, shape (len(targets),) + timestamps.shape[per_target:]
+        Azimuth and elevation angles, in radians
+
+    """
+    targets = _as_target_list(targets)
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    if per_target:
+        if len(timestamps) != len(targets):
+            raise ValueError('Expected %d rows of timestamps (one per target), got %d' %
+                             (len(targets), len(timestamps)))
+        shape = timestamps.shape
+    else:
+        shape = (len(targets),) + timestamps.shape
+        timestamps = timestamps[np.newaxis]
+    az, el = np.zeros(shape), np.zeros(shape)
+    if not len(targets):
+        return az, el
+    timestamps = timestamps * np.ones(shape)
+    t_ref = float(timestamps.flat[0]) if timestamps.size else 0.0
+    lst_ref = float(antenna.local_sidereal_time(t_ref))
+    lat = float(antenna.observer.lat)
+    fixed = [n for n, t in enumerate(targets) if t.body_type in FIXED_BODY_TYPES]
+    if fixed:
+        radec = np.array([targets[n].apparent_radec(t_ref, antenna) for n in fixed], dtype=np.float64)
+        extra_dims = (1,) * (len(shape) - 1)
+        ra, dec = radec[:, 0].reshape((-1,) + extra_dims), radec[:, 1].reshape((-1,) + extra_dims)
+        # Apparent coordinates hardly change over a day, so only sidereal time needs to vary
+        ha = lst_ref + 2.0 * np.pi * SIDEREAL_RATE * (timestamps[fixed] - t_ref) / 86400. - ra
+        sin_el = np.sin(lat) * np.sin(dec) + np.cos(lat) * np.cos(dec) * np.cos(ha)
+        el[fixed] = np.arcsin(np.clip(sin_el, -1.0, 1.0))
+        az[fixed] = np.arctan2(-np.cos(dec) * np.sin(ha),
+                               np.sin(dec) * np.cos(lat) - np.cos(dec) * np.sin(lat) * np.cos(ha)) % (2.0 * np.pi)
+    for n, target in enumerate(targets):
+        if target.body_type in FIXED_BODY_TYPES:
+            continue
+        # Stationary and moving targets are left to katpoint (which wants a flat time sequence)
+        target_az, target_el = target.azel(timestamps[n].ravel(), antenna)
+        az[n], el[n] = np.reshape(target_az, shape[1:]), np.reshape(target_el, shape[1:])
+    return az, el
+
+
+class ObservationTimeEstimator(object):
+    """Estimate slew times and visibility of targets for a set of antennas.
+
+    All methods operate on a whole catalogue of targets and an array of
+    candidate start times at once, and reproduce the timing model of the fake
+    :class:`TimeSession`.
+
+    Parameters
+    ----------
+    antennas : sequence of :class:`katpoint.Antenna` objects or strings
+        Antennas taking part in the observation
+    horizon : float, optional
+        Elevation limit serving as horizon for session, in degrees
+    el_limit : float, optional
+        Actual antenna elevation limit, in degrees
+
+    """
+    def __init__(self, antennas, horizon=3.0, el_limit=EL_LIMIT):
+        self.antennas = [ant if isinstance(ant, katpoint.Antenna) else katpoint.Antenna(ant)
+                         for ant in antennas]
+        self.horizon = horizon
+        self.el_limit = el_limit
+
+    def azel(self, targets, timestamps, offset=None, per_target=False):
+        """Target positions as seen by all antennas, in degrees.
+
+        Parameters
+        ----------
+        targets : :class:`katpoint.Catalogue` object, or sequence of targets
+            Targets as objects or description strings
+        timestamps : float or array
+            Timestamps in UTC seconds since Unix epoch
+        offset : sequence of (string, float, float), optional
+            Projection type and (x, y) offset in degrees from target, as in
+            the *projection* attribute of :class:`TimeSession`
+        per_target : {False, True}, optional
+            If True, the first axis of *timestamps* is indexed by target
+
+        Returns
+        -------
+        az, el : array, shape (len(targets), len(antennas)) + timestamps.shape[per_target:]
+            Azimuth and elevation angles, in degrees
+
+        """
+        azel = [self._antenna_azel(antenna, targets, timestamps, offset, per_target)
+                for antenna in self.antennas]
+        return np.array([a[0] for a in azel]).swapaxes(0, 1), np.array([a[1] for a in azel]).swapaxes(0, 1)
+
+    def _antenna_azel(self, antenna, targets, timestamps, offset=None, per_target=False):
+        """Target positions as seen by a single antenna, in degrees."""
+        az, el = catalogue_azel(targets, antenna, timestamps, per_target)
+        if offset is not None:
+            projection_type, x, y = offset
+            az, el = katpoint.plane_to_sphere[projection_type](az, el, katpoint.deg2rad(x), katpoint.deg2rad(y))
+        return katpoint.rad2deg(az), katpoint.rad2deg(el)
+
+    def visible(self, targets, start_times, duration=0., timeout=300.):
+        """Check whether targets are visible for given duration.
+
+        This is the vectorised equivalent of :meth:`TimeSession.target_visible`,
+        including its peculiarity that the timeout is accumulated over the
+        antennas that find the target below the horizon.
+
+        Parameters
+        ----------
+        targets : :class:`katpoint.Catalogue` object, or sequence of targets
+            Targets as objects or description strings
+        start_times : float or array
+            Candidate start times in UTC seconds since Unix epoch
+        duration : float, optional
+            Duration of observation of target, in seconds
+        timeout : float, optional
+            Timeout involved when antenna cannot reach the target
+
+        Returns
+        -------
+        visible : array of bool, shape (len(targets),) + start_times.shape
+            True if target is visible from all antennas for entire duration
+
+        """
+        targets = _as_target_list(targets)
+        horizon = katpoint.deg2rad(self.horizon)
+        now = np.asarray(start_times, dtype=np.float64)[np.newaxis] + \
+              np.zeros((len(targets),) + np.shape(start_times)) + AVERAGE_SLEW
+        visible = np.ones(now.shape, dtype=np.bool)
+        if not self.antennas:
+            return ~visible
+        # Antennas are visited in turn as the start time depends on the previous antennas
+        for antenna in self.antennas:
+            az, el = catalogue_azel(targets, antenna, now, per_target=True)
+            # If not up yet, see if the target will pop out before the timeout
+            rising = el < horizon
+            now = np.where(rising, now + timeout, now)
+            if rising.any():
+                az, el_later = catalogue_azel(targets, antenna, now, per_target=True)
+                el = np.where(rising, el_later, el)
+            visible &= el >= horizon
+            # Check what happens at end of observation
+            az, el = catalogue_azel(targets, antenna, now + duration, per_target=True)
+            visible &= el >= horizon
+        return visible
+
+    def slew_times(self, targets, start_times, ant_az, ant_el, timeout=300., offset=None):
+        """Time taken by all antennas to reach targets, in seconds.
+
+        This is the vectorised equivalent of :meth:`TimeSession._slew_to`,
+        chasing the target position for two iterations and estimating the
+        rise time of targets that are below the elevation limit.
+
+        Parameters
+        ----------
+        targets : :class:`katpoint.Catalogue` object, or sequence of targets
+            Targets as objects or description strings
+        start_times : float or array
+            Candidate start times in UTC seconds since Unix epoch
+        ant_az, ant_el : float or sequence of float
+            Initial antenna positions (one per antenna, or shared), in degrees
+        timeout : float, optional
+            Maximum slew time, in seconds
+        offset : sequence of (string, float, float), optional
+            Projection type and (x, y) offset in degrees from target
+
+        Returns
+        -------
+        slew_time : array, shape (len(targets),) + start_times.shape
+            Overall slew time (maximum over antennas), in seconds
+
+        """
+        targets = _as_target_list(targets)
+        start = np.asarray(start_times, dtype=np.float64)[np.newaxis] + \
+                np.zeros((len(targets),) + np.shape(start_times))
+        # Antenna positions broadcast against (targets, antennas, times...)
+        extra_dims = (1,) * np.ndim(start_times)
+        ant_az = np.broadcast_to(np.atleast_1d(ant_az), (len(self.antennas),)).reshape((1, -1) + extra_dims)
+        ant_el = np.broadcast_to(np.atleast_1d(ant_el), (len(self.antennas),)).reshape((1, -1) + extra_dims)
+        if not self.antennas:
+            return np.zeros(start.shape)
+        at = lambda t: self.azel(targets, t, offset, per_target=True)
+        # Initial estimate of slew time, based on a stationary target
+        az1, el1 = at(start)
+        slew = slew_time(az1, el1, ant_az, ant_el, self.el_limit)
+        # Crude adjustment for target motion: chase target position for 2 iterations
+        # (each antenna chases the target from its own position)
+        for iteration in range(2):
+            azel = [self._antenna_azel(antenna, targets, start + slew[:, n], offset, per_target=True)
+                    for n, antenna in enumerate(self.antennas)]
+            az2 = np.array([a[0] for a in azel]).swapaxes(0, 1)
+            el2 = np.array([a[1] for a in azel]).swapaxes(0, 1)
+            slew = slew_time(az2, el2, ant_az, ant_el, self.el_limit)
+        # Ensure slew does not take longer than timeout
+        slew = np.minimum(slew, timeout)
+        # If source is below horizon, handle timeout and potential rise in that interval
+        down = el2 < self.el_limit
+        if down.any():
+            az_after_timeout, el_after_timeout = at(start + timeout)
+            # If source is still down, slew time == timeout, else estimate rise time through linear interpolation
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rise_time = (self.el_limit - el1) / (el_after_timeout - el1) * timeout
+            slew = np.where(down, np.where(el_after_timeout > self.el_limit, rise_time, timeout), slew)
+        return slew.max(axis=1)
+
+
+class PlanTimer(object):
+    """Estimate the duration of a sequence of canned observation commands.
+
+    This mirrors the time accounting of :class:`TimeSession` (tracks, scans
+    and raster scans with their slews, but no noise diode firings) without
+    replacing the time module or logging anything, so that several
+    observation plans can be timed side by side.
+
+    Parameters
+    ----------
+    antennas : sequence of :class:`katpoint.Antenna` objects or strings
+        Antennas taking part in the observation
+    start_time : float
+        Start time of plan in UTC seconds since Unix epoch
+    ant_az, ant_el : float or sequence of float, optional
+        Initial antenna positions (one per antenna, or shared), in degrees
+    horizon : float, optional
+        Elevation limit serving as horizon for session, in degrees
+
+    """
+    def __init__(self, antennas, start_time, ant_az=0.0, ant_el=90.0, horizon=3.0):
+        self.estimator = ObservationTimeEstimator(antennas, horizon)
+        self.start_time = self.time = float(start_time)
+        num_ants = len(self.estimator.antennas)
+        self.ant_az = np.broadcast_to(np.atleast_1d(ant_az), (num_ants,)).astype(np.float64)
+        self.ant_el = np.broadcast_to(np.atleast_1d(ant_el), (num_ants,)).astype(np.float64)
+        self.mode = 'STOP'
+        self.projection = ('ARC', 0., 0.)
+        self.skipped = []
+
+    @property
+    def duration(self):
+        """Elapsed time of plan so far, in seconds."""
+        return self.time - self.start_time
+
+    def _azel(self, target):
+        az, el = self.estimator.azel([target], self.time, self.projection)
+        return az[0], el[0]
+
+    def _teleport_to(self, target, mode='POINT'):
+        """Move antennas instantaneously onto target (or nearest point on horizon)."""
+        az, el = self._azel(target)
+        self.ant_az, self.ant_el = az, np.maximum(el, self.estimator.el_limit)
+        self.mode = mode
+
+    def _slew_to(self, target, mode='POINT', timeout=300.):
+        """Slew antennas to target (or nearest point on horizon), with timeout."""
+        self.time += float(self.estimator.slew_times([target], self.time, self.ant_az, self.ant_el,
+                                                     timeout, self.projection)[0])
+        self._teleport_to(target, mode)
+
+    def on_target(self, target):
+        """Determine whether antennas are tracking a given target."""
+        az, el = self._azel(target)
+        return self.mode == 'POINT' and np.all(az == self.ant_az) and np.all(el == self.ant_el)
+
+    def target_visible(self, target, duration=0., timeout=300.):
+        """Check whether target is visible for given duration."""
+        visible = bool(self.estimator.visible([target], self.time, duration, timeout)[0])
+        if not visible:
+            self.skipped.append(getattr(target, 'name', target))
+        return visible
+
+    def track(self, target, duration=20.0):
+        """Estimate time taken to perform track."""
+        target = target if isinstance(target, katpoint.Target) else katpoint.Target(target)
+        if not self.target_visible(target, duration):
+            return False
+        if not self.on_target(target):
+            self._slew_to(target)
+        self.time += duration + 1.0
+        self._teleport_to(target)
+        return True
+
+    def scan(self, target, duration=30.0, start=(-3.0, 0.0), end=(3.0, 0.0), projection='ARC'):
+        """Estimate time taken to perform single linear scan."""
+        target = target if isinstance(target, katpoint.Target) else katpoint.Target(target)
+        if not self.target_visible(target, duration):
+            return False
+        self.projection = (projection, start[0], start[1])
+        self._slew_to(target, mode='SCAN')
+        self.time += duration + 1.0
+        self.projection = (projection, end[0], end[1])
+        self._teleport_to(target)
+        return True
+
+    def raster_scan(self, target, num_scans=3, scan_duration=30.0, scan_extent=6.0, scan_spacing=0.5,
+                    scan_in_azimuth=True, projection='ARC'):
+        """Estimate time taken to perform raster scan."""
+        target = target if isinstance(target, katpoint.Target) else katpoint.Target(target)
+        if not self.target_visible(target, scan_duration * num_scans):
+            return False
+        # Create start and end positions of each scan, based on scan parameters
+        scan_levels = np.arange(-(num_scans // 2), num_scans // 2 + 1)
+        scanning_coord = (scan_extent / 2.0) * (-1.0) ** scan_levels
+        stepping_coord = scan_spacing * scan_levels
+        # Flip sign of elevation offsets to ensure that the first scan always starts at the top left of target
+        scan_starts = zip(scanning_coord, -stepping_coord) if scan_in_azimuth else zip(stepping_coord, -scanning_coord)
+        scan_ends = zip(-scanning_coord, -stepping_coord) if scan_in_azimuth else zip(stepping_coord, scanning_coord)
+        for start, end in zip(scan_starts, scan_ends):
+            self.projection = (projection, start[0], start[1])
+            self._slew_to(target, mode='SCAN')
+            self.time += scan_duration + 1.0
+            self.projection = (projection, end[0], end[1])
+            self._teleport_to(target)
+        return True
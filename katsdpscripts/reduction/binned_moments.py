@@ -0,0 +1,83 @@
+"""Streaming accumulation of per-bin means and variances.
+
+Reductions that need the mean and variance of data in a number of bins (e.g.
+dumps grouped by angular separation from a target) traditionally select the
+data of each bin in turn, which reads the same data set once per bin. Instead,
+:class:`BinnedMoments` accumulates the count, mean and sum of squared
+deviations of every bin while the data is streamed in chunks, so that all the
+statistics are available after a single pass over the data. Each chunk is
+sorted by bin and reduced with :func:`numpy.add.reduceat`, and the chunk
+statistics are merged into the running ones with the pairwise update of Chan
+et al., which avoids the round-off problems of accumulating raw sums of
+squares for data with a large mean (such as autocorrelations).
+
+"""
+import numpy as np
+
+
+class BinnedMoments(object):
+    """Running count, mean and variance per bin of streamed (complex) data.
+
+    Parameters
+    ----------
+    num_bins : int
+        Number of bins
+    shape : tuple of int, optional
+        Shape of each data sample (e.g. (channels, correlation products))
+    dtype : :class:`numpy.dtype` object or equivalent, optional
+        Type of mean (use a complex type for visibilities)
+
+    Attributes
+    ----------
+    count : array of int, shape (num_bins,)
+        Number of samples accumulated in each bin
+    mean : array of *dtype*, shape (num_bins,) + *shape*
+        Mean of samples in each bin (zero for empty bins)
+
+    """
+    def __init__(self, num_bins, shape=(), dtype=np.complex128):
+        self.count = np.zeros(num_bins, dtype=np.int64)
+        self.mean = np.zeros((num_bins,) + tuple(shape), dtype=dtype)
+        self._m2 = np.zeros((num_bins,) + tuple(shape), dtype=np.float64)
+
+    def add(self, bin_index, data):
+        """Accumulate chunk of samples.
+
+        Parameters
+        ----------
+        bin_index : array of int, shape (N,)
+            Bin of each sample, from 0 to *num_bins* - 1 (samples with indices
+            outside this range are ignored)
+        data : array, shape (N,) + *shape*
+            Samples to accumulate
+
+        """
+        bin_index, data = np.asarray(bin_index), np.asarray(data)
+        valid = (bin_index >= 0) & (bin_index < len(self.count))
+        if not valid.all():
+            bin_index, data = bin_index[valid], data[valid]
+        if len(bin_index) == 0:
+            return
+        order = np.argsort(bin_index, kind='mergesort')
+        sorted_bins, data = bin_index[order], data[order]
+        starts = np.r_[0, np.flatnonzero(np.diff(sorted_bins)) + 1]
+        bins = sorted_bins[starts]
+        expand = (slice(None),) + (np.newaxis,) * (data.ndim - 1)
+        chunk_count = np.diff(np.r_[starts, len(sorted_bins)])
+        chunk_mean = np.add.reduceat(data, starts, axis=0) / chunk_count[expand]
+        deviation = data - np.repeat(chunk_mean, chunk_count, axis=0)
+        chunk_m2 = np.add.reduceat(np.abs(deviation) ** 2, starts, axis=0)
+        # Merge chunk statistics into running statistics (Chan, Golub & LeVeque 1979)
+        count_a, count_b = self.count[bins][expand], chunk_count[expand]
+        total = count_a + count_b
+        delta = chunk_mean - self.mean[bins]
+        self.mean[bins] += delta * (count_b / total.astype(np.float64))
+        self._m2[bins] += chunk_m2 + np.abs(delta) ** 2 * (count_a * count_b / total.astype(np.float64))
+        self.count[bins] += chunk_count
+
+    @property
+    def variance(self):
+        """Variance of samples in each bin (mean squared magnitude of deviations, NaN for empty bins)."""
+        expand = (slice(None),) + (np.newaxis,) * (self._m2.ndim - 1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self._m2 / self.count[expand]
@@ -0,0 +1,270 @@
+"""Screening of environmental conditions against operating limits.
+
+The condition report classifies each (averaged) weather sample as 'ideal',
+'optimal' or 'normal' operating conditions based on the 5-minute mean wind
+speed, wind gusts, the 10-minute mean temperature and its rate of change, and
+the elevation of the Sun. This module computes these quantities on whole
+arrays in O(n) time: rolling means use cumulative sums (with the same
+reflected edges as :func:`katsdpscripts.RTS.weatherlib.rolling_window`), and
+the temperature rate is the derivative of the interpolating cubic spline
+through the smoothed temperature, evaluated in a single vectorised call.
+
+An :class:`EnvironmentScreen` applies the same screening to a stream of
+sensor chunks (e.g. days of data from a :class:`SensorStore`), keeping only
+one chunk plus a small overlap in memory. The overlap covers the rolling
+windows and the (rapidly decaying) reach of the spline, so that the streamed
+result matches that of a single pass over the whole series.
+
+"""
+import numpy as np
+import scipy.interpolate as interpolate
+import katpoint
+
+
+# Limits of each condition: 5-minute mean wind speed and gust (m/s), mean temperature (deg C),
+# rate of change of temperature (deg C / s) and Sun elevation (deg)
+CONDITIONS = {
+    'ideal': {'wind_5min': 1.0, 'wind_gust': 1.0, 'temp_low': 19.0, 'temp_high': 21.0,
+              'temp_rate': 1.0 / (30. * 60.), 'sun_elevation': -5.0},
+    'optimal': {'wind_5min': 2.9, 'wind_gust': 4.1, 'temp_low': -5.0, 'temp_high': 35.0,
+                'temp_rate': 2.0 / (10. * 60.), 'sun_elevation': -5.0},
+    'normal': {'wind_5min': 9.8, 'wind_gust': 13.4, 'temp_low': -5.0, 'temp_high': 40.0,
+               'temp_rate': 3.0 / (20. * 60.), 'sun_elevation': 100.0},
+}
+# Averaging times of wind speed and temperature, in seconds
+WIND_AVERAGE_TIME = 300.0
+TEMPERATURE_AVERAGE_TIME = 600.0
+# Number of extra samples beyond which the interpolating spline has negligible influence
+SPLINE_MARGIN = 50
+
+
+def window_samples(duration, dump_time):
+    """Number of samples in averaging window of given duration."""
+    return max(int(np.round(duration / dump_time)), 1)
+
+
+def rolling_mean(data, window):
+    """Centred rolling mean over *window* samples, with reflected edges.
+
+    This matches ``rolling_window(data, window, pad=True).mean(axis=-1)`` of
+    :mod:`katsdpscripts.RTS.weatherlib` for 1-D data, but takes O(n) time.
+    Windows containing NaN values (e.g. gaps in the data) produce NaN.
+
+    """
+    data = np.asarray(data, dtype=np.float64)
+    before, after = window // 2, window // 2 - 1 + window % 2
+    padded = np.pad(data, (before, after), mode='reflect') if len(data) > 1 else np.repeat(data, window)
+    missing = np.isnan(padded)
+    # Remove overall mean first to limit round-off in cumulative sums
+    offset = padded[~missing].mean() if (~missing).any() else 0.0
+    sums = np.r_[0.0, np.cumsum(np.where(missing, 0.0, padded - offset))]
+    num_missing = np.r_[0, np.cumsum(missing)]
+    means = (sums[window:] - sums[:-window]) / window + offset
+    means[num_missing[window:] > num_missing[:-window]] = np.nan
+    return means
+
+
+def sun_elevation(timestamps, antenna):
+    """Elevation of the Sun as seen by antenna at given times, in degrees."""
+    sun = katpoint.Target('Sun, special', antenna=antenna)
+    return katpoint.rad2deg(sun.azel(timestamps)[1])
+
+
+def environment_quantities(timestamps, wind_speed, temperature, dump_time, antenna):
+    """Quantities that are screened against the limits of each condition.
+
+    Parameters
+    ----------
+    timestamps : array of float, shape (N,)
+        Regularly spaced (averaged) sample times, in UTC seconds
+    wind_speed, temperature : array of float, shape (N,)
+        Wind speed (m/s) and air temperature (deg C) at each sample
+    dump_time : float
+        Time between samples, in seconds
+    antenna : :class:`katpoint.Antenna` object
+        Location used to calculate Sun elevation
+
+    Returns
+    -------
+    quantities : dict of arrays of float, shape (N,)
+        5-minute mean wind speed ('wind_5min'), wind gust ('wind_gust'),
+        10-minute mean temperature ('temperature'), its rate of change
+        ('temp_rate', deg C / s) and Sun elevation ('sun_elevation', deg),
+        with NaN where averaging windows contain missing data
+
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    wind_5min = rolling_mean(wind_speed, window_samples(WIND_AVERAGE_TIME, dump_time))
+    temp_10min = rolling_mean(temperature, window_samples(TEMPERATURE_AVERAGE_TIME, dump_time))
+    temp_fit, temp_rate = np.tile(np.nan, len(timestamps)), np.tile(np.nan, len(timestamps))
+    valid = ~np.isnan(temp_10min)
+    if valid.sum() > 3:
+        # Fit a smooth function (interpolating cubic spline) in time to the temperature data
+        fit_temp = interpolate.UnivariateSpline(timestamps[valid], temp_10min[valid], k=3, s=0)
+        temp_fit[valid], temp_rate[valid] = fit_temp(timestamps[valid]), fit_temp(timestamps[valid], nu=1)
+    return {'wind_5min': wind_5min, 'wind_gust': np.asarray(wind_speed, dtype=np.float64),
+            'temperature': temp_fit, 'temp_rate': temp_rate,
+            'sun_elevation': sun_elevation(timestamps, antenna)}
+
+
+def screen_conditions(quantities, conditions=('normal', 'optimal', 'ideal')):
+    """Check environment quantities against the limits of each condition.
+
+    Parameters
+    ----------
+    quantities : dict of arrays
+        Output of :func:`environment_quantities`
+    conditions : sequence of string, optional
+        Names of conditions in :const:`CONDITIONS`
+
+    Returns
+    -------
+    good : dict mapping string to array of bool, shape (N,)
+        True where all limits of the condition are met, per condition
+
+    """
+    good = {}
+    with np.errstate(invalid='ignore'):
+        for condition in conditions:
+            limits = CONDITIONS[condition]
+            good[condition] = ((quantities['wind_5min'] < limits['wind_5min']) &
+                               (quantities['wind_gust'] < limits['wind_gust']) &
+                               (quantities['temperature'] > limits['temp_low']) &
+                               (quantities['temperature'] < limits['temp_high']) &
+                               (np.abs(quantities['temp_rate']) < limits['temp_rate']) &
+                               (quantities['sun_elevation'] < limits['sun_elevation']))
+    return good
+
+
+def violation_intervals(timestamps, bad, dump_time):
+    """Time intervals of consecutive samples that violate limits.
+
+    Parameters
+    ----------
+    timestamps : array of float, shape (N,)
+        Sample times, in seconds
+    bad : array of bool, shape (N,)
+        True for samples that violate limits
+    dump_time : float
+        Time between samples (the last bad sample covers this time), in seconds
+
+    Returns
+    -------
+    intervals : list of (float, float) pairs
+        Start and end time of each interval of violations
+
+    """
+    bad = np.asarray(bad, dtype=np.int8)
+    edges = np.diff(np.r_[0, bad, 0])
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) - 1
+    return zip(timestamps[starts].tolist(), (timestamps[ends] + dump_time).tolist())
+
+
+class EnvironmentScreen(object):
+    """Screen streamed environment sensor data against condition limits.
+
+    Feed consecutive chunks of regularly sampled data to :meth:`add` and
+    call :meth:`finish` at the end. Each call returns the results for all
+    samples whose averaging windows are complete, as a dict with the sample
+    'timestamps', the environment quantities and a boolean array per
+    condition. Violation intervals and sample counts per condition are also
+    accumulated in the `intervals` and `num_good` / `num_samples` attributes.
+
+    Parameters
+    ----------
+    dump_time : float
+        Time between samples, in seconds
+    antenna : :class:`katpoint.Antenna` object
+        Location used to calculate Sun elevation
+    conditions : sequence of string, optional
+        Names of conditions in :const:`CONDITIONS`
+
+    """
+    def __init__(self, dump_time, antenna, conditions=('normal', 'optimal', 'ideal')):
+        self.dump_time = dump_time
+        self.antenna = antenna
+        self.conditions = list(conditions)
+        longest = max(WIND_AVERAGE_TIME, TEMPERATURE_AVERAGE_TIME)
+        # Samples on either side of output that affect it (rolling windows plus spline reach)
+        self.overlap = window_samples(longest, dump_time) // 2 + 1 + SPLINE_MARGIN
+        self._buffer = [np.zeros(0), np.zeros(0), np.zeros(0)]
+        self._done = 0
+        self.intervals = dict((condition, []) for condition in self.conditions)
+        self.num_good = dict((condition, 0) for condition in self.conditions)
+        self.num_samples = 0
+
+    def add(self, timestamps, wind_speed, temperature):
+        """Add next chunk of samples and return results that are complete (or None)."""
+        self._buffer = [np.r_[old, np.asarray(new, dtype=np.float64)]
+                        for old, new in zip(self._buffer, (timestamps, wind_speed, temperature))]
+        return self._process(len(self._buffer[0]) - self.overlap)
+
+    def finish(self):
+        """Return results of remaining samples (or None)."""
+        return self._process(len(self._buffer[0]))
+
+    def _process(self, stop):
+        """Screen buffered samples up to index *stop* and discard samples no longer needed."""
+        timestamps, wind_speed, temperature = self._buffer
+        start = self._done
+        if stop <= start:
+            return None
+        quantities = environment_quantities(timestamps, wind_speed, temperature, self.dump_time, self.antenna)
+        results = dict((key, value[start:stop]) for key, value in quantities.items())
+        results['timestamps'] = timestamps[start:stop]
+        good = screen_conditions(results, self.conditions)
+        for condition in self.conditions:
+            results[condition] = good[condition]
+            self.num_good[condition] += good[condition].sum()
+            new = violation_intervals(results['timestamps'], ~good[condition], self.dump_time)
+            intervals = self.intervals[condition]
+            # Join interval that continues across chunk boundary
+            if new and intervals and new[0][0] - intervals[-1][1] < 0.5 * self.dump_time:
+                intervals[-1] = (intervals[-1][0], new.pop(0)[1])
+            intervals.extend(new)
+        self.num_samples += stop - start
+        # Keep enough earlier samples to fill the windows of the next output samples
+        keep = max(stop - self.overlap, 0)
+        self._buffer = [data[keep:] for data in self._buffer]
+        self._done = stop - keep
+        return results
+
+
+def screen_sensor_store(store, wind_sensor, temperature_sensor, antenna, start, end,
+                        average_time=5.0, chunk_time=86400.0, conditions=('normal', 'optimal', 'ideal')):
+    """Screen environment sensors in a sensor store over a long time range.
+
+    The sensors are resampled to *average_time* bins and processed in chunks
+    of *chunk_time* seconds, so that only one chunk is in memory at a time.
+    Bins without data fail all conditions.
+
+    Parameters
+    ----------
+    store : :class:`katsdpscripts.reduction.sensor_store.SensorStore` object
+        Store containing sensor histories
+    wind_sensor, temperature_sensor : string
+        Names of wind speed and air temperature sensors in store
+    antenna : :class:`katpoint.Antenna` object
+        Location used to calculate Sun elevation
+    start, end : float
+        Time range to screen, in UTC seconds
+    average_time, chunk_time : float, optional
+        Averaging time and chunk length, in seconds
+    conditions : sequence of string, optional
+        Names of conditions in :const:`CONDITIONS`
+
+    Returns
+    -------
+    screen : :class:`EnvironmentScreen` object
+        Screen with accumulated violation intervals and sample counts
+
+    """
+    screen = EnvironmentScreen(average_time, antenna, conditions)
+    chunk_time = average_time * max(int(chunk_time // average_time), 1)
+    for chunk_start in np.arange(start, end, chunk_time):
+        chunk_end = min(chunk_start + chunk_time, end)
+        timestamps, wind_speed = store.resample(wind_sensor, chunk_start, chunk_end, average_time)
+        temperature = store.resample(temperature_sensor, chunk_start, chunk_end, average_time)[1]
+        screen.add(timestamps + 0.5 * average_time, wind_speed, temperature)
+    screen.finish()
+    return screen
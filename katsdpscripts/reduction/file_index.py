@@ -0,0 +1,370 @@
+"""Local searchable index of observation files and their metadata.
+
+Finding the files that contain, say, tracks of the Moon on ant4 in a given
+band normally means opening hundreds of HDF5 files with katdal or h5py every
+time the question is asked. A :class:`FileIndex` instead keeps the metadata of
+each file in an SQLite database, read once from the file header: start and
+end time, description, experiment ID, observer, antennas, frequency setup,
+script log and the scans (state, target and label of each activity segment of
+the reference antenna). Queries then only touch the database and return the
+matching paths in milliseconds, and updates only reread files that are new or
+have changed (according to their size and modification time).
+
+Only the metadata groups of version 2 (KAT-7) HDF5 files are read, directly
+with h5py, so that indexing does not load any visibility data.
+
+Typical use::
+
+    index = FileIndex('~/.katsdpscripts_index.db')
+    index.update(['/var/kat/archive/data/RTS'])
+    paths = index.find(target='Moon', antenna='ant4', state='track', freq=1822e6)
+
+"""
+import os
+import sqlite3
+
+import numpy as np
+import h5py
+import katpoint
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    error TEXT,
+    version TEXT,
+    start_time REAL,
+    end_time REAL,
+    description TEXT,
+    experiment_id TEXT,
+    observer TEXT,
+    centre_freq REAL,
+    bandwidth REAL,
+    num_chans INTEGER,
+    dump_period REAL,
+    script_log TEXT
+);
+CREATE TABLE IF NOT EXISTS antennas (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS scans (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    scan_index INTEGER,
+    start_time REAL,
+    end_time REAL,
+    state TEXT,
+    target TEXT,
+    label TEXT
+);
+CREATE INDEX IF NOT EXISTS files_start_time ON files(start_time);
+CREATE INDEX IF NOT EXISTS antennas_name ON antennas(name COLLATE NOCASE, file_id);
+CREATE INDEX IF NOT EXISTS scans_target ON scans(target COLLATE NOCASE, file_id);
+CREATE INDEX IF NOT EXISTS scans_file ON scans(file_id);
+"""
+
+# Columns of files table that make up the file metadata
+METADATA_FIELDS = ('version', 'start_time', 'end_time', 'description', 'experiment_id', 'observer',
+                   'centre_freq', 'bandwidth', 'num_chans', 'dump_period', 'script_log')
+
+
+def _single_value(group, name, default=None):
+    """Return single value from attribute or dataset with given name in group."""
+    if name in group.attrs:
+        return group.attrs[name]
+    elif name in group:
+        return group[name][-1]
+    return default
+
+
+def _sensor_events(sensors, name):
+    """Timestamps and values of sensor in HDF5 sensor group, or empty lists if missing."""
+    if name not in sensors:
+        return np.zeros(0), []
+    data = sensors[name][:]
+    return data['timestamp'], [str(value) for value in data['value']]
+
+
+def _value_at(times, values, t, default=''):
+    """Value of sensor at time *t* (last event at or before *t*, else first event)."""
+    if len(values) == 0:
+        return default
+    return values[max(np.searchsorted(times, t, side='right') - 1, 0)]
+
+
+def _target_name(description):
+    """Preferred name of target description (or the description itself if unparsable)."""
+    try:
+        return katpoint.Target(description).name
+    except (ValueError, TypeError):
+        return description.partition(',')[0].strip()
+
+
+def read_metadata(filename):
+    """Read metadata of version 2 (KAT-7) HDF5 file from its header.
+
+    Parameters
+    ----------
+    filename : string
+        Name of HDF5 file
+
+    Returns
+    -------
+    metadata : dict
+        File metadata, with keys given by :const:`METADATA_FIELDS`
+    antennas : list of string
+        Names of antennas used by observation script
+    scans : list of tuples
+        One (scan_index, start_time, end_time, state, target, label) tuple per
+        activity segment of the reference antenna (the first script antenna)
+
+    Raises
+    ------
+    ValueError
+        If the file is not a version 2 HDF5 file
+
+    """
+    with h5py.File(filename, 'r') as f:
+        version = str(f.attrs.get('version', '1.x'))
+        if not version.startswith('2.'):
+            raise ValueError('Only version 2 (KAT-7) HDF5 files can be indexed (got version %s instead)'
+                             % (version,))
+        config, sensors = f['MetaData/Configuration'], f['MetaData/Sensors']
+        obs, correlator = config['Observation'].attrs, config['Correlator']
+        antennas = [ant.strip() for ant in str(obs.get('script_ants', '')).split(',') if ant.strip()]
+        if not antennas:
+            antennas = sorted(config['Antennas'].keys())
+        dump_period = float(_single_value(correlator, 'int_time', 0.0))
+        timestamps = f['Data/timestamps']
+        start_time = float(timestamps[0]) if len(timestamps) else None
+        end_time = float(timestamps[-1]) + dump_period if len(timestamps) else None
+        bandwidth = _single_value(correlator, 'bandwidth')
+        num_chans = _single_value(correlator, 'n_chans')
+        rfe_times, rfe_freqs = _sensor_events(sensors, 'RFE/center-frequency-hz')
+        centre_freq = _value_at(rfe_times, rfe_freqs, start_time, None)
+        if centre_freq is None:
+            centre_freq = _single_value(correlator, 'center_freq')
+        script_log = [str(line[1]) for line in f['History/script_log'][:]] if 'History/script_log' in f else []
+        metadata = {'version': version, 'start_time': start_time, 'end_time': end_time,
+                    'description': str(obs.get('script_description', '')),
+                    'experiment_id': str(obs.get('script_experiment_id', '')),
+                    'observer': str(obs.get('script_observer', '')),
+                    'centre_freq': None if centre_freq is None else float(centre_freq),
+                    'bandwidth': None if bandwidth is None else float(bandwidth),
+                    'num_chans': None if num_chans is None else int(num_chans),
+                    'dump_period': dump_period, 'script_log': '\n'.join(script_log)}
+        # Split the observation into scans at changes in the activity of the reference antenna
+        ref_ant = antennas[0] if antennas else ''
+        activity_times, activities = _sensor_events(sensors, 'Antennas/%s/activity' % (ref_ant,))
+        target_times, targets = _sensor_events(sensors, 'Antennas/%s/target' % (ref_ant,))
+        label_times, labels = _sensor_events(sensors, 'Observation/label')
+        scans = []
+        if start_time is not None:
+            starts = [start_time] + [t for t in activity_times if start_time < t < end_time]
+            for n, start in enumerate(starts):
+                state = _value_at(activity_times, activities, start, 'unknown')
+                if scans and state == scans[-1][3]:
+                    continue
+                end = starts[n + 1] if n + 1 < len(starts) else end_time
+                target = _value_at(target_times, targets, start)
+                scans.append([len(scans), start, end, state, _target_name(target) if target else '',
+                              _value_at(label_times, labels, start)])
+            # Merged scans end where the next scan starts
+            for scan, next_scan in zip(scans[:-1], scans[1:]):
+                scan[2] = next_scan[1]
+            if scans:
+                scans[-1][2] = end_time
+    return metadata, antennas, [tuple(scan) for scan in scans]
+
+
+def find_h5_files(paths):
+    """List HDF5 files given directly or found (recursively) in given directories."""
+    filenames = []
+    for path in paths:
+        path = os.path.abspath(os.path.expanduser(path))
+        if os.path.isdir(path):
+            for directory, subdirs, files in os.walk(path):
+                subdirs.sort()
+                filenames.extend(os.path.join(directory, f) for f in sorted(files) if f.endswith('.h5'))
+        else:
+            filenames.append(path)
+    return filenames
+
+
+class FileIndex(object):
+    """SQLite index of observation file metadata.
+
+    Parameters
+    ----------
+    filename : string, optional
+        Name of database file (created if it does not exist), or ':memory:'
+
+    """
+    def __init__(self, filename=':memory:'):
+        self.filename = filename if filename == ':memory:' else os.path.expanduser(filename)
+        self.db = sqlite3.connect(self.filename)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        """Close database."""
+        self.db.close()
+
+    def __len__(self):
+        """Number of files in index (including unreadable ones)."""
+        return self.db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def update(self, paths, reader=read_metadata):
+        """Add new or changed files to the index.
+
+        Parameters
+        ----------
+        paths : sequence of string
+            HDF5 files and/or directories to search recursively for them
+        reader : function, optional
+            Function that reads metadata from a file (see :func:`read_metadata`)
+
+        Returns
+        -------
+        updated : list of string
+            Paths of files that were (re)indexed
+        failed : list of (string, string) pairs
+            Paths and error messages of files that could not be read (these
+            are remembered and only retried once they change)
+
+        Notes
+        -----
+        Each file is committed to the index as soon as it is read, so that an
+        interrupted update keeps the files indexed so far.
+
+        """
+        updated, failed = [], []
+        for path in find_h5_files(paths):
+            try:
+                stat = os.stat(path)
+            except OSError as err:
+                failed.append((path, str(err)))
+                continue
+            known = self.db.execute('SELECT size, mtime FROM files WHERE path = ?', (path,)).fetchone()
+            if known == (stat.st_size, stat.st_mtime):
+                continue
+            try:
+                metadata, antennas, scans = reader(path)
+            except Exception as err:
+                # Any problem with a (corrupt or unusual) file should not stop the indexing of the rest
+                error = str(err) or err.__class__.__name__
+                with self.db:
+                    self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+                    self.db.execute('INSERT INTO files (path, size, mtime, error) VALUES (?, ?, ?, ?)',
+                                    (path, stat.st_size, stat.st_mtime, error))
+                failed.append((path, error))
+                continue
+            fields = ('path', 'size', 'mtime') + METADATA_FIELDS
+            values = (path, stat.st_size, stat.st_mtime) + tuple(metadata.get(field) for field in METADATA_FIELDS)
+            with self.db:
+                self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+                file_id = self.db.execute('INSERT INTO files (%s) VALUES (%s)' %
+                                          (', '.join(fields), ', '.join('?' * len(fields))), values).lastrowid
+                self.db.executemany('INSERT INTO antennas VALUES (?, ?)', [(file_id, ant) for ant in antennas])
+                self.db.executemany('INSERT INTO scans VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    [(file_id,) + tuple(scan) for scan in scans])
+            updated.append(path)
+        return updated, failed
+
+    def prune(self):
+        """Remove files that no longer exist from the index, returning their paths."""
+        missing = [path for (path,) in self.db.execute('SELECT path FROM files') if not os.path.exists(path)]
+        with self.db:
+            self.db.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in missing])
+        return missing
+
+    def find(self, target=None, antenna=None, state=None, label=None, description=None,
+             experiment_id=None, observer=None, start=None, end=None, freq=None):
+        """Find indexed files matching all given criteria.
+
+        Parameters
+        ----------
+        target : string, optional
+            Name of target of at least one scan (case-insensitive)
+        antenna : string, optional
+            Name of antenna used in observation
+        state : string, optional
+            Scan state, e.g. 'track' or 'scan' (applies to scans on *target*
+            with *label* if these are also given)
+        label : string, optional
+            Compound scan label of at least one scan
+        description, experiment_id, observer : string, optional
+            Substring of script description, experiment ID or observer name
+        start, end : float, optional
+            Only files overlapping this time range (in UTC seconds since Unix epoch)
+        freq : float, optional
+            Only files with this frequency in their band, in Hz
+
+        Returns
+        -------
+        paths : list of string
+            Paths of matching files, in order of start time
+
+        """
+        conditions, params = ['f.error IS NULL'], []
+        for field, value in (('description', description), ('experiment_id', experiment_id),
+                             ('observer', observer)):
+            if value is not None:
+                conditions.append('f.%s LIKE ?' % (field,))
+                params.append('%' + value + '%')
+        if start is not None:
+            conditions.append('f.end_time > ?')
+            params.append(start)
+        if end is not None:
+            conditions.append('f.start_time < ?')
+            params.append(end)
+        if freq is not None:
+            conditions.append('ABS(? - f.centre_freq) <= f.bandwidth / 2')
+            params.append(freq)
+        if antenna is not None:
+            conditions.append('EXISTS (SELECT 1 FROM antennas a WHERE a.file_id = f.id '
+                              'AND a.name = ? COLLATE NOCASE)')
+            params.append(antenna)
+        scan_conditions = [('s.%s = ? COLLATE NOCASE' % (field,), value) for field, value in
+                           (('target', target), ('state', state), ('label', label)) if value is not None]
+        if scan_conditions:
+            conditions.append('EXISTS (SELECT 1 FROM scans s WHERE s.file_id = f.id AND %s)' %
+                              (' AND '.join(condition for condition, value in scan_conditions),))
+            params.extend(value for condition, value in scan_conditions)
+        query = 'SELECT f.path FROM files f WHERE %s ORDER BY f.start_time, f.path' % (' AND '.join(conditions),)
+        return [path for (path,) in self.db.execute(query, params)]
+
+    def metadata(self, path):
+        """Indexed metadata of file as a dict (with 'antennas', 'targets' and 'scans' lists).
+
+        The file is given by its path, or by its name only (e.g. '1393418142.h5')
+        if no other indexed file has the same name.
+
+        """
+        full_path = os.path.abspath(os.path.expanduser(path))
+        cursor = self.db.execute('SELECT * FROM files WHERE path = ?', (full_path,))
+        row = cursor.fetchone()
+        if row is None and os.path.basename(path) == path:
+            # Match file name against end of indexed paths
+            cursor = self.db.execute('SELECT * FROM files WHERE substr(path, -?) = ?',
+                                     (len(path) + 1, os.sep + path))
+            rows = cursor.fetchall()
+            if len(rows) > 1:
+                raise KeyError('File name %r matches %d files in index %r - please give full path' %
+                               (path, len(rows), self.filename))
+            row = rows[0] if rows else None
+        if row is None:
+            raise KeyError('File %r is not in index %r' % (full_path, self.filename))
+        info = dict(zip([column[0] for column in cursor.description], row))
+        file_id = info.pop('id')
+        info['antennas'] = [name for (name,) in
+                            self.db.execute('SELECT name FROM antennas WHERE file_id = ?', (file_id,))]
+        info['scans'] = self.db.execute('SELECT scan_index, start_time, end_time, state, target, label '
+                                        'FROM scans WHERE file_id = ? ORDER BY scan_index',
+                                        (file_id,)).fetchall()
+        info['targets'] = sorted(set(scan[4] for scan in info['scans'] if scan[4]))
+        return info
@@ -0,0 +1,305 @@
+"""Gain curve calculations on a table of point source scan results.
+
+The results of ``analyse_point_source_scans.py`` for many observations (and
+antennas) are combined into a single typed table, with one row per compound
+scan. Gains, aperture efficiencies, system temperatures and SEFDs then follow
+for all rows at once, and the data selection and atmospheric model fits are
+done for all antennas together, using grouped least-squares fits based on
+:func:`numpy.bincount` sums instead of one fit per antenna and file.
+
+"""
+import numpy as np
+from scipy import interpolate
+import katpoint
+
+# These fields in the csv contain strings, while the rest of the fields are assumed to contain floats
+STRING_FIELDS = ['dataset', 'target', 'timestamp_ut', 'data_unit']
+# Twice Boltzmann's constant divided by 1 Jy, in m^2 K / Jy (converts gain in K/Jy to effective area)
+TWO_K_PER_JY = 2761.
+# Limits on (wind speed in m/s, min temperature in deg C, max temperature in deg C,
+# temperature gradient in deg C/s, sun elevation in deg) for each environmental condition
+CONDITION_LIMITS = {'ideal': (1., 19., 21., 1. / (30. * 60.), -5.),
+                    'optimum': (2.9, -5., 35., 2. / (10. * 60.), -5.),
+                    'normal': (9.8, -5., 40., 3. / (20. * 60.), 100.)}
+
+
+def parse_csv(filename):
+    """Load antenna object and typed record array from analyse_point_source_scans.py output.
+
+    Parameters
+    ----------
+    filename : string
+        Name of CSV file (first line contains antenna description)
+
+    Returns
+    -------
+    antenna : :class:`katpoint.Antenna` object
+        Antenna that produced the results
+    data : record array
+        Results table, with strings in :data:`STRING_FIELDS` and floats elsewhere
+
+    """
+    lines = open(filename).read().splitlines()
+    antenna = katpoint.Antenna(lines[0].strip().partition('=')[2])
+    rows = [line.split(', ') for line in lines if line.strip() and not line.startswith('#')]
+    fieldnames, columns = rows[0], zip(*rows[1:]) if len(rows) > 1 else [()] * len(rows[0])
+    arrays = [np.array(column, dtype=str if name in STRING_FIELDS else np.float64)
+              for name, column in zip(fieldnames, columns)]
+    return antenna, np.rec.fromarrays(arrays, names=fieldnames)
+
+
+def combine_results(results):
+    """Combine results of several antennas / observations into one table.
+
+    Parameters
+    ----------
+    results : sequence of (antenna, data) pairs
+        Antenna objects and corresponding results record arrays
+
+    Returns
+    -------
+    table : record array
+        Rows of all results, with fields of all inputs (missing values are
+        NaN or empty strings) and an extra 'antenna' field with antenna names
+    antennas : dict mapping string to :class:`katpoint.Antenna` objects
+        Antenna objects, keyed on name
+
+    """
+    fieldnames = []
+    for antenna, data in results:
+        fieldnames += [name for name in data.dtype.names if name not in fieldnames + ['antenna']]
+    columns = {'antenna': np.concatenate([np.repeat(antenna.name, len(data)) for antenna, data in results])}
+    for name in fieldnames:
+        parts = []
+        for antenna, data in results:
+            if name in data.dtype.names:
+                parts.append(np.asarray(data[name], dtype=str if name in STRING_FIELDS else np.float64))
+            else:
+                parts.append(np.repeat('' if name in STRING_FIELDS else np.nan, len(data)))
+        columns[name] = np.concatenate(parts)
+    names = ['antenna'] + fieldnames
+    table = np.rec.fromarrays([columns[name] for name in names], names=names)
+    antennas = dict((antenna.name, antenna) for antenna, data in results)
+    return table, antennas
+
+
+def load_results(filenames):
+    """Load and combine analyse_point_source_scans.py CSV files (see :func:`combine_results`)."""
+    return combine_results([parse_csv(filename) for filename in filenames])
+
+
+def utc_seconds(timestamp_ut):
+    """Convert array of 'YYYY-MM-DD HH:MM:SS.SSS' UTC strings to seconds since the Unix epoch."""
+    timestamps = np.array([s.strip().replace(' ', 'T') for s in timestamp_ut], dtype='datetime64[us]')
+    return (timestamps - np.datetime64(0, 'us')).astype(np.int64) * 1e-6
+
+
+def calc_atmospheric_opacity(T, RH, h, f):
+    """
+        Calculates zenith opacity according to NASA's Propagation Effects Handbook
+        for Satellite Systems, chapter VI (Ippolito 1989). For elevations > 10 deg.
+        Multiply by (1-exp(-opacity/sin(el))) for elevation dependence.
+        Taken from katlab. All parameters may be arrays.
+        @param T: temperature in deg C
+        @param RH: relative humidity, 0 < RH < 1
+        @param h: height above sea level in km
+        @param f: frequency in GHz (must be < 57 GHz)
+    """
+    T0 = 15 # Reference temp for calculations, deg C
+    # Vapour pressure
+    es = 100 * 6.1121*np.exp((18.678-T0/234.5)*T0/(257.14+T0)) # [Pa], from A. L. Buck research manual 1996 rather than NASA Handbook
+    rw = RH*es/(.461*(T0+273.15)) # [g/m^3]
+    # Basic values
+    yo = (7.19e-3+6.09/(f**2+.227)+4.81/((f-57)**2+1.50))*f**2*1e-3
+    yw = (.067+3/((f-22.3)**2+7.3)+9/((f-183.3)**2+6)+4.3/((f-323.8)**2+10))*f**2*rw*1e-4
+    # yw above is only for rw <= 12 g/m^3. the following alternative is suggested in NASA's handbook
+    yw_wet = (.05+0.0021*rw+3.6/((f-22.2)**2+8.5)+10.6/((f-183.3)**2+9)+8.9/((f-325.4)**2+26.3))*f**2*rw*1e-4
+    yw = np.where(rw > 12.0, yw_wet, yw)
+    # Correct for temperature
+    yo = yo*(1-0.01*(T-T0))
+    yw = yw*(1-0.006*(T-T0))
+    # Scale heights
+    ho = 6.
+    hw = (2.2+3/((f-22.3)**2+3)+1/((f-183.3)**2+1)+1/((f-323.8)**2+1))
+    # Attenuation
+    A = yo*ho*np.exp(-h/ho) + yw*hw
+
+    return np.exp(A/10.*np.log(10))-1
+
+
+def grouped_linear_fit(x, y, groups, num_groups):
+    """Least-squares straight line fits ``y = slope * x + intercept`` per group.
+
+    Parameters
+    ----------
+    x, y : array of float, shape (N,)
+        Data points
+    groups : array of int, shape (N,)
+        Group index of each data point, from 0 to *num_groups* - 1
+    num_groups : int
+        Number of groups
+
+    Returns
+    -------
+    slope, intercept : array of float, shape (num_groups,)
+        Fitted line per group (NaN for groups with fewer than 2 distinct x)
+
+    """
+    n = np.bincount(groups, minlength=num_groups).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_x = np.bincount(groups, x, num_groups) / n
+        mean_y = np.bincount(groups, y, num_groups) / n
+        dx = x - mean_x[groups]
+        slope = np.bincount(groups, dx * (y - mean_y[groups]), num_groups) / np.bincount(groups, dx * dx, num_groups)
+    return slope, mean_y - slope * mean_x
+
+
+class GainCurveTable(object):
+    """Gain curve calculations for all antennas in a table of results.
+
+    Parameters
+    ----------
+    table : record array
+        Combined results table (see :func:`combine_results`)
+    antennas : dict mapping string to :class:`katpoint.Antenna` objects
+        Antenna objects, keyed on name
+
+    """
+    def __init__(self, table, antennas):
+        self.table = table
+        self.antennas = antennas
+        self.ant_names, self.ant_index = np.unique(table['antenna'], return_inverse=True)
+        self.elevation = katpoint.deg2rad(table['elevation'])
+        self.airmass = 1.0 / np.sin(self.elevation)
+        self.timestamps = utc_seconds(table['timestamp_ut'])
+        diameter = np.array([antennas[name].diameter for name in self.ant_names])
+        self.ant_area = (np.pi * (diameter / 2.0) ** 2)[self.ant_index]
+
+    def __len__(self):
+        return len(self.table)
+
+    @property
+    def pols(self):
+        """Polarisations with beam heights in table."""
+        names = self.table.dtype.names
+        return [pol for pol in ('HH', 'VV') if 'beam_height_' + pol in names]
+
+    def antenna_rows(self, name):
+        """Boolean mask selecting rows of antenna *name*."""
+        return self.ant_index == np.flatnonzero(self.ant_names == name)[0]
+
+    def compute(self, pol):
+        """Compute gains, aperture efficiencies, Tsys and SEFDs of all rows.
+
+        Returns
+        -------
+        gain : array of float
+            Beam height per Jy of source flux
+        e : array of float
+            Aperture efficiency, in percent (only meaningful for units of K)
+        Tsys : array of float
+            System temperature derived from the baseline heights
+        SEFD : array of float
+            System equivalent flux density derived from Tsys and the gain
+
+        """
+        gain = self.table['beam_height_' + pol] / self.table['flux']
+        e = gain * (TWO_K_PER_JY / self.ant_area) * 100
+        Tsys = self.table['baseline_height_' + pol]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            SEFD = Tsys / gain
+        return gain, e, Tsys, SEFD
+
+    def select_environment(self, condition='normal'):
+        """Flag data for environmental conditions (see :data:`CONDITION_LIMITS`).
+
+        The wind and temperature are smoothed with a cubic spline in time per
+        antenna, to obtain the temperature gradient.
+
+        """
+        good = np.ones(len(self), dtype=bool)
+        if condition not in CONDITION_LIMITS:
+            return good
+        windlim, temp_low, temp_high, deltatemp, sun_elev_lim = CONDITION_LIMITS[condition]
+        wind, temp, temp_grad = np.zeros(len(self)), np.zeros(len(self)), np.zeros(len(self))
+        sun_elevation = np.zeros(len(self))
+        for n, name in enumerate(self.ant_names):
+            rows = np.flatnonzero(self.ant_index == n)
+            order = rows[np.argsort(self.timestamps[rows], kind='mergesort')]
+            t = self.timestamps[order]
+            raw_wind, raw_temp = self.table['wind_speed'][order], self.table['temperature'][order]
+            unique_t, first = np.unique(t, return_index=True)
+            if len(unique_t) > 3:
+                fit_wind = interpolate.InterpolatedUnivariateSpline(unique_t, raw_wind[first], k=3)
+                fit_temp = interpolate.InterpolatedUnivariateSpline(unique_t, raw_temp[first], k=3)
+                wind[order], temp[order] = fit_wind(t), fit_temp(t)
+                temp_grad[order] = fit_temp.derivative()(t)
+            else:
+                wind[order], temp[order] = raw_wind, raw_temp
+                temp_grad[order] = np.gradient(raw_temp, t) if len(unique_t) == len(t) > 1 else 0.0
+            sun = katpoint.Target('Sun, special', antenna=self.antennas[name])
+            sun_elevation[order] = katpoint.rad2deg(sun.azel(t)[1])
+        good &= wind < windlim
+        good &= (temp > temp_low) & (temp < temp_high)
+        good &= np.abs(temp_grad) < deltatemp
+        good &= sun_elevation < sun_elev_lim
+        return good
+
+    def good_data(self, pol, targets=None, tsys=None, tsys_lim=150, eff=None, eff_lim=(35, 100), units='K',
+                  interferometric=False, condition_select='none'):
+        """Apply conditions to the data to choose which can be used for fitting.
+
+        Conditions are:
+            1: Target name must be in 'targets' (use all targets if targets=None).
+            2: Tsys < tsys_lim.
+            3: Range of aperture efficiencies between eff_lim[0] and eff_lim[1].
+            4: Beam height and baseline data in csv file must not be 'nan'.
+            5: Units of beam height must be *units*.
+            6: Environmental conditions must satisfy *condition_select*.
+
+        Returns
+        -------
+        good : array of bool
+            Mask of data to keep (True means good data)
+        counts : list of (string, int) pairs
+            Number of rows left after each condition
+
+        """
+        good = np.ones(len(self), dtype=bool)
+        counts = [('All data', good.sum())]
+        if targets is not None:
+            good &= np.in1d(self.table['target'], [target.strip() for target in targets])
+        counts.append(('Flag for unwanted targets', good.sum()))
+        if tsys is not None and not interferometric:
+            good &= tsys < tsys_lim
+        counts.append(('Flag for Tsys', good.sum()))
+        if eff is not None and not interferometric:
+            good &= (eff > eff_lim[0]) & (eff < eff_lim[1])
+        counts.append(('Flag for efficiency', good.sum()))
+        good &= ~np.isnan(self.table['beam_height_' + pol]) & ~np.isnan(self.table['baseline_height_' + pol])
+        counts.append(('Flag for NaN in data', good.sum()))
+        good &= self.table['data_unit'] == units
+        counts.append(('Flag for correct units', good.sum()))
+        if condition_select != 'none':
+            good &= self.select_environment(condition_select)
+        counts.append(('Flag for environmental condition', good.sum()))
+        return good, counts
+
+    def opacity(self):
+        """Zenith opacity of each row estimated from weather data."""
+        height = np.array([self.antennas[name].observer.elevation / 1000. for name in self.ant_names])
+        return calc_atmospheric_opacity(self.table['temperature'], self.table['humidity'] / 100.,
+                                        height[self.ant_index], self.table['frequency'] / 1000.)
+
+    def fit_atmospheric_absorption(self, gain, good):
+        """Fit model G = G_0 * exp(-tau * airmass) per antenna to good data, returning (g_0, tau) arrays."""
+        slope, intercept = grouped_linear_fit(self.airmass[good], np.log(gain[good]),
+                                              self.ant_index[good], len(self.ant_names))
+        return np.exp(intercept), -slope
+
+    def fit_atmospheric_emission(self, tsys, good, tau):
+        """Fit model Tsys = T_rec + T_atm * (1 - exp(-tau * airmass)) per antenna, returning (T_atm, T_rec)."""
+        groups = self.ant_index[good]
+        tau = tau[groups] if np.ndim(tau) and len(tau) == len(self.ant_names) else tau
+        x = 1 - np.exp(-tau * self.airmass[good])
+        return grouped_linear_fit(x, tsys[good], groups, len(self.ant_names))
@@ -0,0 +1,122 @@
+"""Gridding of scattered (az, el) samples for horizon masks.
+
+Horizon mask scans produce many scattered samples of power as a function of
+azimuth and elevation. Instead of Delaunay interpolation of all samples onto
+the grid, :func:`grid_horizon` bins the samples into (az, el) cells with
+:func:`numpy.bincount` accumulation, which yields the mean, number of samples
+and variance of each cell in a few passes over the data. Empty cells are then
+filled from the nearest occupied cells found with a KD-tree (either the value
+of the nearest cell or an inverse-distance weighted average of a few of them),
+as long as they are within a few cells of a sample, so that the mask does not
+show invented values far from any measurement.
+Samples outside the azimuth extent of the grid are wrapped into it by whole
+turns where possible. Only a grid spanning exactly one turn is treated as
+periodic, with neighbours found across the 0 / 360 degree wrap-around; grids
+spanning more than a turn (e.g. the -185 to 275 degree azimuth range of
+KAT-7) keep each sample at its own azimuth.
+
+"""
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def grid_edges(centres):
+    """Lower edge of first cell, cell width and number of cells of regular grid with given cell centres."""
+    centres = np.asarray(centres, dtype=np.float64)
+    width = (centres[-1] - centres[0]) / (len(centres) - 1) if len(centres) > 1 else 1.0
+    return centres[0] - 0.5 * width, width, len(centres)
+
+
+def wrap_azimuth(az, start):
+    """Wrap azimuth angles (in degrees) into the 360-degree interval starting at *start*."""
+    return start + np.mod(np.asarray(az, dtype=np.float64) - start, 360.0)
+
+
+def grid_horizon(az, el, values, az_pos, el_pos, fill='nearest', neighbours=8, max_distance=None):
+    """Grid scattered samples onto regular (az, el) grid, with per-cell statistics.
+
+    Parameters
+    ----------
+    az, el : array of float, shape (N,)
+        Azimuth and elevation of each sample, in degrees
+    values : array of float, shape (N,)
+        Value of each sample (e.g. power in dB)
+    az_pos, el_pos : array of float, shape (A,) and (E,)
+        Regularly spaced azimuth and elevation cell centres, in degrees
+    fill : {'nearest', 'idw', None}, optional
+        Fill empty cells with value of nearest occupied cell, inverse-distance
+        weighted average of nearest occupied cells, or leave them as NaN
+    neighbours : int, optional
+        Number of occupied cells contributing to inverse-distance weighting
+    max_distance : float or None, optional
+        Only fill empty cells within this distance of an occupied cell, in
+        degrees (cells further away are left as NaN). The default is twice
+        the cell diagonal; use `np.inf` to fill all empty cells.
+
+    Returns
+    -------
+    grid : array of float, shape (E, A)
+        Mean value in each cell, with empty cells filled as requested
+    counts : array of int, shape (E, A)
+        Number of samples in each cell (0 for filled / empty cells)
+    variance : array of float, shape (E, A)
+        Variance of samples in each cell (NaN for filled / empty cells)
+
+    """
+    if fill not in ('nearest', 'idw', None):
+        raise ValueError("Unknown fill method %r (should be 'nearest', 'idw' or None)" % (fill,))
+    az_start, az_width, num_az = grid_edges(az_pos)
+    el_start, el_width, num_el = grid_edges(el_pos)
+    az = np.asarray(az, dtype=np.float64).ravel()
+    el = np.asarray(el, dtype=np.float64).ravel()
+    values = np.asarray(values, dtype=np.float64).ravel()
+    az_end = az_start + num_az * az_width
+    if max_distance is None:
+        max_distance = 2.0 * np.hypot(az_width, el_width)
+    # Azimuth is only periodic on the grid if it spans a full turn (to within half a cell)
+    periodic = abs(az_end - az_start - 360.0) < 0.5 * az_width
+    # Wrap samples beyond the grid into it, but leave those already on a grid spanning more than a turn
+    outside = (az < az_start) | (az >= az_end)
+    az = np.where(outside, wrap_azimuth(az, az_start), az)
+    az_index = np.floor((az - az_start) / az_width).astype(int)
+    el_index = np.floor((el - el_start) / el_width).astype(int)
+    valid = (az_index >= 0) & (az_index < num_az) & (el_index >= 0) & (el_index < num_el) & np.isfinite(values)
+    cell = el_index[valid] * num_az + az_index[valid]
+    values = values[valid]
+    num_cells = num_el * num_az
+    counts = np.bincount(cell, minlength=num_cells)
+    occupied = counts > 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(cell, values, num_cells) / counts
+        variance = np.bincount(cell, (values - mean[cell]) ** 2, num_cells) / counts
+    mean[~occupied] = np.nan
+    variance[~occupied] = np.nan
+
+    empty = np.flatnonzero(~occupied)
+    if fill and len(empty) and occupied.any():
+        cell_az = np.tile(az_start + az_width * (np.arange(num_az) + 0.5), num_el)
+        cell_el = np.repeat(el_start + el_width * (np.arange(num_el) + 0.5), num_az)
+        source = np.flatnonzero(occupied)
+        if periodic:
+            # Add copies of occupied cells shifted by a full turn so that neighbours are found across the wrap
+            tree_az = np.r_[cell_az[source] - 360.0, cell_az[source], cell_az[source] + 360.0]
+            tree_el = np.tile(cell_el[source], 3)
+        else:
+            tree_az, tree_el = cell_az[source], cell_el[source]
+        tree = cKDTree(np.c_[tree_az, tree_el])
+        k = 1 if fill == 'nearest' else min(neighbours, len(tree_az))
+        distance, index = tree.query(np.c_[cell_az[empty], cell_el[empty]], k=k,
+                                     distance_upper_bound=max_distance)
+        distance, index = distance.reshape(len(empty), k), index.reshape(len(empty), k)
+        found = np.isfinite(distance)
+        # Missing neighbours have an index of len(tree_az), so map them onto any valid cell and give them zero weight
+        neighbour_values = mean[source[np.where(found, index, 0) % len(source)]]
+        if fill == 'nearest':
+            filled = np.where(found[:, 0], neighbour_values[:, 0], np.nan)
+        else:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                weights = np.where(found, 1.0 / np.maximum(distance, 1e-12 * az_width) ** 2, 0.0)
+                filled = (weights * neighbour_values).sum(axis=1) / weights.sum(axis=1)
+        mean[empty] = filled
+    shape = (num_el, num_az)
+    return mean.reshape(shape), counts.reshape(shape), variance.reshape(shape)
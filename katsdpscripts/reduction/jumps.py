@@ -0,0 +1,190 @@
+"""Detection of step changes (jumps) in power time series.
+
+Noise diode firings show up as jumps in the recorded power, and the instant of
+each jump can be estimated to within a fraction of a dump by comparing the
+power in the dump straddling the jump to the average power levels before and
+after it. :func:`find_jumps` does this for many time series at once (e.g. all
+channels and inputs of a scan), by flagging candidate jumps for all samples
+with array comparisons and obtaining the power levels on either side of each
+jump from cumulative sums, instead of examining one series and one jump at a
+time. It reproduces the results of the original per-jump detector of the
+``check_noise_diode_timing.py`` script.
+
+"""
+import numpy as np
+
+# Description of each detected jump
+JUMP_DTYPE = np.dtype([('series', np.int64), ('dump_index', np.int64), ('subdump', np.float64),
+                       ('time', np.float64), ('std_time', np.float64), ('significance', np.float64)])
+
+
+def ratio_stats(mean_num, std_num, mean_den, std_den, corrcoef=0):
+    """Approximate second-order statistics of ratio of correlated normal variables."""
+    # Transform num/den to standard form (a + x) / (b + y), with x and y uncorrelated standard normal vars
+    # Then num/den is distributed as 1/r (a + x) / (b + y) + s
+    # Therefore determine parameters a and b, scale r and translation s
+    s = corrcoef * std_num / std_den
+    a, b = mean_num - s * mean_den, mean_den / std_den
+    # Pick the sign of h so that a and b have the same sign
+    sign_h = 2 * (a >= 0) * (b >= 0) - 1
+    h = sign_h * std_num * np.sqrt(1. - corrcoef ** 2)
+    a, r = a / h, std_den / h
+    # Calculate the approximate mean and standard deviation of (a + x) / (b + y) a la F-distribution
+    mean_axby = a * b / (b**2 - 1)
+    std_axby = np.abs(b) / (b**2 - 1) * np.sqrt((a**2 + b**2 - 1) / (b**2 - 2))
+    # Translate by s and scale by r
+    return s + mean_axby / r, std_axby / np.abs(r)
+
+
+def _shift(x, step):
+    """Shift array along first axis by *step* (+1 = previous, -1 = next), repeating edge values."""
+    return np.concatenate((x[:1], x[:-1])) if step > 0 else np.concatenate((x[1:], x[-1:]))
+
+
+def _clique_starts(candidate, delta_power, rising):
+    """Starts of runs of 1 or 2 candidate samples along time axis that form a clean jump.
+
+    A run of 2 samples is only kept if the biggest power change occurs at its
+    first sample (i.e. the first sample is the midpoint of the jump).
+
+    """
+    previous, following = _shift(candidate, 1), _shift(candidate, -1)
+    previous[0] = following[-1] = False
+    after_next = np.zeros_like(candidate)
+    after_next[:-2] = candidate[2:]
+    start = candidate & ~previous
+    single = start & ~following
+    steeper = delta_power > _shift(delta_power, -1) if rising else delta_power < _shift(delta_power, -1)
+    double = start & following & ~after_next & steeper
+    return single | double
+
+
+def find_jumps(timestamps, power, std_power, margin_factor=24., jump_significance=10.,
+               max_onoff_segment_duration=0., **kwargs):
+    """Find significant jumps in power and estimate the time instant of each jump.
+
+    A jump is a rise (or drop) in power spanning at most two dumps that exceeds
+    the expected variation in power (*margin_factor* times *std_power*) by a
+    factor of *jump_significance*. The instant of the jump is obtained from
+    the power in the dump straddling it relative to the mean power of the
+    stable segments before and after the jump.
+
+    Parameters
+    ----------
+    timestamps : array of float, shape (T,)
+        Timestamps of dumps (increasing), in seconds
+    power : array of float, shape (T,) or (T, N)
+        Power time series, one per column
+    std_power : array of float, same shape as *power*
+        Theoretical standard deviation of each power value
+    margin_factor : float, optional
+        Allowed variation in power, as multiple of its standard deviation
+    jump_significance : float, optional
+        Keep jumps that are bigger than the margin by this factor
+    max_onoff_segment_duration : float, optional
+        Maximum duration of segments around jump used to estimate its
+        instant, in seconds (at least one dump is always used)
+    kwargs : dict, optional
+        Extra keyword arguments are ignored (e.g. other script options)
+
+    Returns
+    -------
+    jumps : record array of :data:`JUMP_DTYPE`, shape (J,)
+        Detected jumps sorted by series and time, with fields 'series'
+        (column of *power*, 0 for 1-D power), 'dump_index' (index of
+        dump straddling jump), 'subdump' (fraction of the way from that dump to
+        the next at which jump occurred), 'time' and 'std_time' (instant of
+        jump with uncertainty, in seconds) and 'significance' (refined size of
+        jump, in margins, which is negative for drops in power)
+
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    power = np.asarray(power, dtype=np.float64)
+    std_power = np.asarray(std_power, dtype=np.float64)
+    if power.ndim == 1:
+        power, std_power = power[:, np.newaxis], std_power[:, np.newaxis]
+    num_dumps = power.shape[0]
+    if num_dumps < 3:
+        return np.zeros(0, dtype=JUMP_DTYPE).view(np.recarray)
+    # Margin within which power is deemed to be constant (i.e. expected variation of power)
+    # This works around potential biases in power levels, such as small linear slopes across jump
+    margin = margin_factor * std_power
+    upper, lower = power + margin, power - margin
+    delta_power = _shift(power, -1) - _shift(power, 1)
+    # Shifted versions of the upper and lower power bounds
+    previous_upper, next_upper = _shift(upper, 1), _shift(upper, -1)
+    previous_lower, next_lower = _shift(lower, 1), _shift(lower, -1)
+
+    # Look for large instantaneous rises and drops in power (spanning at most 2 dumps)
+    # Then pick midpoint of jump (or end of jump if no clear midpoint) as candidate jump
+    rise = _clique_starts((power > previous_upper) & (power < next_upper), delta_power, True)
+    drop = _clique_starts((power < previous_lower) & (power > next_lower), delta_power, False)
+    candidate = rise | drop
+    # Throw out jumps on the very edges of time series (we need a dump before and after the jump)
+    candidate[0] = candidate[-1] = False
+    # Throw out insignificant jumps, based on margin of samples adjacent to jump
+    jump_margin = np.sqrt(_shift(margin, 1) ** 2 + _shift(margin, -1) ** 2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        candidate &= np.abs(delta_power) / jump_margin > jump_significance
+    jump, series = np.nonzero(candidate)
+    order = np.lexsort((jump, series))
+    jump, series = jump[order], series[order]
+
+    # Last dump at or before each dump that differs from the one on its left (start of stable segment)
+    dumps = np.arange(num_dumps)[:, np.newaxis]
+    same_as_previous = (power > previous_lower) & (power < previous_upper)
+    same_as_previous[0] = False
+    segment_start = np.maximum.accumulate(np.where(same_as_previous, 0, dumps), axis=0)
+    # First dump at or after each dump that differs from the one on its right (end of stable segment)
+    same_as_next = (power > next_lower) & (power < next_upper)
+    same_as_next[-1] = False
+    segment_end = np.minimum.accumulate(np.where(same_as_next, num_dumps - 1, dumps)[::-1], axis=0)[::-1]
+    # Limit the range of points around jump to use in estimation of jump instant (to ensure stationarity)
+    in_range_start, in_range_end = _range_within(timestamps, timestamps[jump], max_onoff_segment_duration)
+    before = np.maximum(segment_start[jump - 1, series], np.minimum(in_range_start, jump - 1))
+    after = np.minimum(segment_end[jump + 1, series], np.maximum(in_range_end, jump + 1))
+
+    # Estimate power before and after jump, with corresponding uncertainty
+    zero = np.zeros((1, power.shape[1]))
+    cum_power = np.concatenate((zero, power.cumsum(axis=0)))
+    cum_var = np.concatenate((zero, (std_power ** 2).cumsum(axis=0)))
+    num_before, num_after = jump - before, after - jump
+    mean_power_before = (cum_power[jump, series] - cum_power[before, series]) / num_before
+    mean_power_after = (cum_power[after + 1, series] - cum_power[jump + 1, series]) / num_after
+    std_power_before = np.sqrt(np.abs(cum_var[jump, series] - cum_var[before, series])) / num_before
+    std_power_after = np.sqrt(np.abs(cum_var[after + 1, series] - cum_var[jump + 1, series])) / num_after
+    # Use ratio of power differences (at - before) / (after - before) to estimate where in dump the jump happened
+    mean_num, mean_den = power[jump, series] - mean_power_before, mean_power_after - mean_power_before
+    std_num = np.sqrt(std_power[jump, series] ** 2 + std_power_before ** 2)
+    std_den = np.sqrt(std_power_after ** 2 + std_power_before ** 2)
+    # Since "before" power appears in both numerator and denominator, they are (slightly) correlated.
+    # NOTE: The complementary ratio (after - at) / (after - before) can also be used, and at first glance
+    # it appears to be better if std_power_after < std_power_before, which will result in smaller std_num
+    # for the same std_den. The correlation coefficient will change in such a way to cancel out this advantage,
+    # however, resulting in the same stats. We therefore do not need to consider the complementary ratio.
+    corrcoef = std_power_before ** 2 / std_num / std_den
+    mean_subdump, std_subdump = ratio_stats(mean_num, std_num, mean_den, std_den, corrcoef)
+
+    jumps = np.zeros(len(jump), dtype=JUMP_DTYPE).view(np.recarray)
+    jumps.series, jumps.dump_index = series, jump
+    jumps.subdump = 1. - mean_subdump
+    # Estimate instant of jump with corresponding uncertainty (assumes timestamps are accurately known)
+    jumps.time = mean_subdump * timestamps[jump] + (1. - mean_subdump) * timestamps[jump + 1]
+    jumps.std_time = std_subdump * (timestamps[jump + 1] - timestamps[jump])
+    # Refined estimate of the significance of the jump, using averaged data instead of single dumps
+    jumps.significance = mean_den / std_den / margin_factor
+    return jumps
+
+
+def _range_within(timestamps, centres, duration):
+    """First and last index of increasing *timestamps* within *duration* of each of *centres*."""
+    last = len(timestamps) - 1
+    within = lambda index: np.abs(timestamps[np.clip(index, 0, last)] - centres) <= duration
+    # Start from binary search and correct for rounding differences in the comparison
+    start = np.searchsorted(timestamps, centres - duration, side='left')
+    start -= (start > 0) & within(start - 1)
+    start += (start < last) & ~within(start)
+    end = np.searchsorted(timestamps, centres + duration, side='right') - 1
+    end += (end < last) & within(end + 1)
+    end -= (end > 0) & ~within(end)
+    return start, end
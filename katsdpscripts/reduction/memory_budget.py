@@ -0,0 +1,373 @@
+"""Memory budgets for reductions that read visibility data.
+
+Many reductions read the visibilities (and flags and weights) of their whole
+selection with ``data.vis[:]``, which works for short observations but
+exhausts the memory of a shared analysis node for long ones. Instead, a
+reduction describes the arrays it holds as a :class:`Footprint` (a fixed
+part plus a part per dump of data in memory) and asks a
+:class:`MemoryBudget` how many dumps to read at a time. Selections that fit
+in the budget are still read in one go, while larger ones are processed in
+chunks of dumps.
+
+The budget is given explicitly (e.g. '4G'), or taken from the
+KATSDP_MEMORY_BUDGET environment variable, or defaults to half of the
+physical memory. Each budgeted step can be wrapped in
+:meth:`MemoryBudget.track`, which measures the actual peak resident memory
+of the step and records it next to the estimate, so that footprints that are
+too optimistic are easy to spot.
+
+"""
+import os
+import re
+import threading
+import logging
+from collections import namedtuple
+
+import numpy as np
+
+# Environment variable that sets the default budget
+BUDGET_ENV_VAR = 'KATSDP_MEMORY_BUDGET'
+# Multipliers of size suffixes (powers of 1024)
+_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+def parse_size(size):
+    """Turn memory size with optional unit (e.g. '512M', '1.5GB', 2e9) into bytes."""
+    if isinstance(size, (int, long, float)):
+        return int(size)
+    match = re.match(r'^\s*([0-9.]+(?:[eE][-+]?[0-9]+)?)\s*([kKmMgGtT]?)(?:i?[bB])?\s*$', size)
+    if not match:
+        raise ValueError('Invalid memory size %r (expected e.g. 500M or 4G)' % (size,))
+    return int(float(match.group(1)) * _UNITS[match.group(2).upper()])
+
+
+def format_size(nbytes):
+    """Human-readable memory size."""
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if abs(nbytes) < 1024.:
+            return '%.1f %s' % (nbytes, unit) if unit != 'B' else '%d B' % (nbytes,)
+        nbytes /= 1024.
+    return '%.1f TB' % (nbytes,)
+
+
+def physical_memory():
+    """Total physical memory of the machine in bytes (or None if unknown)."""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def _status_field(field):
+    """Value of memory field (e.g. 'VmRSS') of /proc/self/status in bytes (or None if unavailable)."""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError, IndexError):
+        pass
+    return None
+
+
+def resident_memory():
+    """Current resident memory of this process in bytes (or None if unknown)."""
+    return _status_field('VmRSS')
+
+
+def _reset_peak_memory():
+    """Reset peak resident memory of this process, returning True if it worked (Linux only)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except IOError:
+        return False
+    return _status_field('VmHWM') is not None
+
+
+class Footprint(object):
+    """Memory held by a reduction step, as a fixed part and a part per dump.
+
+    Build it up from the arrays that the step holds at its peak, e.g. for a
+    step that reads complex visibilities and flags and keeps a spectrum::
+
+        footprint = Footprint().add((chans, prods), np.complex64).add((chans, prods), np.bool_)
+        footprint.add((chans, prods), np.float64, per_dump=False)
+
+    Parameters
+    ----------
+    fixed, per_dump : int, optional
+        Initial number of bytes independent of / per dump in memory
+
+    """
+    def __init__(self, fixed=0, per_dump=0):
+        self.fixed = int(fixed)
+        self.per_dump = int(per_dump)
+
+    def add(self, shape, dtype, per_dump=True, copies=1):
+        """Add array(s) to footprint.
+
+        Parameters
+        ----------
+        shape : tuple of int
+            Shape of array per dump (excluding the dump axis) if *per_dump*,
+            otherwise the shape of the whole array
+        dtype : :class:`numpy.dtype` object or equivalent
+            Type of array elements
+        per_dump : {True, False}, optional
+            True if the array has one entry per dump in memory
+        copies : int, optional
+            Number of arrays of this shape and type (e.g. temporaries)
+
+        Returns
+        -------
+        footprint : :class:`Footprint` object
+            This footprint, to allow chaining
+
+        """
+        nbytes = int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize * copies
+        if per_dump:
+            self.per_dump += nbytes
+        else:
+            self.fixed += nbytes
+        return self
+
+    def nbytes(self, num_dumps):
+        """Estimated memory in bytes when holding *num_dumps* dumps."""
+        return self.fixed + self.per_dump * num_dumps
+
+    def __repr__(self):
+        return 'Footprint(fixed=%d, per_dump=%d)' % (self.fixed, self.per_dump)
+
+
+class MemoryUsage(namedtuple('MemoryUsage', 'label estimate peak num_dumps dumps_per_chunk')):
+    """Estimated and actual peak memory of a budgeted step.
+
+    Attributes
+    ----------
+    label : string
+        Description of step
+    estimate : int
+        Estimated peak memory of step in bytes, from its footprint
+    peak : int or None
+        Measured increase of peak resident memory during step, in bytes
+        (None if it could not be measured)
+    num_dumps, dumps_per_chunk : int
+        Number of dumps processed and maximum number of dumps per chunk
+
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        peak = format_size(self.peak) if self.peak is not None else 'unknown'
+        chunks = ('in one chunk' if self.dumps_per_chunk >= self.num_dumps else
+                  'in chunks of %d' % (self.dumps_per_chunk,))
+        return '%s: estimated %s, actual peak %s (%d dumps %s)' % (self.label, format_size(self.estimate),
+                                                                   peak, self.num_dumps, chunks)
+
+
+class _Tracker(object):
+    """Measure peak resident memory while active."""
+    def __init__(self, interval):
+        self.interval = interval
+        self.baseline = resident_memory()
+        self.peak = self.baseline
+        self._use_hwm = self.baseline is not None and _reset_peak_memory()
+        self._stop = threading.Event()
+        self._thread = None
+        if self.baseline is not None and not self._use_hwm:
+            # Fall back to sampling resident memory in the background
+            self._thread = threading.Thread(target=self._sample, name='MemoryTracker')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.update(resident_memory())
+
+    def update(self, nbytes):
+        """Include peak memory *nbytes* (e.g. of a nested tracker) in measured peak."""
+        if nbytes is not None and self.peak is not None:
+            self.peak = max(self.peak, nbytes)
+
+    def checkpoint(self):
+        """Include peak memory so far in measured peak, before a nested tracker resets it."""
+        if self._use_hwm:
+            self.update(_status_field('VmHWM'))
+
+    def stop(self):
+        """Stop tracking and return increase of peak over baseline memory in bytes (or None)."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+        if self.baseline is None:
+            return None
+        self.update(_status_field('VmHWM') if self._use_hwm else resident_memory())
+        return max(self.peak - self.baseline, 0)
+
+
+class MemoryBudget(object):
+    """Memory available to a reduction, used to decide how much data to read at a time.
+
+    Parameters
+    ----------
+    limit : int, float, string or None, optional
+        Budget in bytes or as a size string like '4G' (None for the value of
+        the KATSDP_MEMORY_BUDGET environment variable, or half of the
+        physical memory if that is not set either)
+    interval : float, optional
+        Sampling interval of memory tracking in seconds, on systems where the
+        peak resident memory cannot be reset (peaks that last less than this
+        may be missed)
+
+    Attributes
+    ----------
+    limit : int
+        Budget in bytes
+    usage : list of :class:`MemoryUsage` objects
+        Estimated and actual peak memory of every tracked step
+
+    """
+    def __init__(self, limit=None, interval=0.01):
+        if limit is None:
+            limit = os.environ.get(BUDGET_ENV_VAR)
+        if limit is None:
+            physical = physical_memory()
+            limit = physical // 2 if physical else 4 * _UNITS['G']
+        self.limit = parse_size(limit)
+        if self.limit <= 0:
+            raise ValueError('Memory budget should be positive, not %r' % (limit,))
+        self.interval = interval
+        self.usage = []
+        self._trackers = []
+
+    def fits(self, footprint, num_dumps):
+        """True if *num_dumps* dumps with given footprint fit in the budget."""
+        return footprint.nbytes(num_dumps) <= self.limit
+
+    def dumps_per_chunk(self, footprint, num_dumps):
+        """Maximum number of dumps to hold in memory at a time.
+
+        This is all *num_dumps* dumps if they fit in the budget, otherwise
+        as many as fit next to the fixed part of the footprint (at least one).
+
+        """
+        num_dumps = max(int(num_dumps), 1)
+        if self.fits(footprint, num_dumps) or footprint.per_dump <= 0:
+            return num_dumps
+        if footprint.fixed >= self.limit:
+            logger.warning('Fixed memory of %s exceeds budget of %s, processing one dump at a time',
+                           format_size(footprint.fixed), format_size(self.limit))
+        spare = max(self.limit - footprint.fixed, 0)
+        return int(min(max(spare // footprint.per_dump, 1), num_dumps))
+
+    def chunks(self, footprint, num_dumps):
+        """Slices of consecutive dumps that each fit in the budget."""
+        step = self.dumps_per_chunk(footprint, num_dumps)
+        return [slice(start, min(start + step, num_dumps)) for start in range(0, num_dumps, step)]
+
+    def track(self, label, footprint, num_dumps, dumps_per_chunk=None):
+        """Context manager that measures actual peak memory of a budgeted step.
+
+        Parameters
+        ----------
+        label : string
+            Description of step, for diagnostics
+        footprint : :class:`Footprint` object
+            Declared memory of step
+        num_dumps : int
+            Number of dumps processed by step
+        dumps_per_chunk : int or None, optional
+            Maximum number of dumps in memory at a time (None for the value
+            given by :meth:`dumps_per_chunk`)
+
+        """
+        if dumps_per_chunk is None:
+            dumps_per_chunk = self.dumps_per_chunk(footprint, num_dumps)
+        return _TrackedStep(self, label, footprint.nbytes(min(dumps_per_chunk, num_dumps)),
+                            num_dumps, dumps_per_chunk)
+
+    def report(self):
+        """Estimated versus actual peak memory of all tracked steps, one line per step."""
+        return '\n'.join(['Memory budget %s' % (format_size(self.limit),)] +
+                         ['  ' + str(usage) for usage in self.usage])
+
+
+class _TrackedStep(object):
+    """Context manager returned by :meth:`MemoryBudget.track`."""
+    def __init__(self, budget, label, estimate, num_dumps, dumps_per_chunk):
+        self.budget = budget
+        self.label = label
+        self.estimate = estimate
+        self.num_dumps = num_dumps
+        self.dumps_per_chunk = dumps_per_chunk
+        self.usage = None
+
+    def __enter__(self):
+        for outer in self.budget._trackers:
+            outer.checkpoint()
+        self._tracker = _Tracker(self.budget.interval)
+        self.budget._trackers.append(self._tracker)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.budget._trackers.remove(self._tracker)
+        peak = self._tracker.stop()
+        # Resetting the peak for this step hides it from enclosing steps, so pass it on
+        for outer in self.budget._trackers:
+            outer.update(None if peak is None else self._tracker.baseline + peak)
+        self.usage = MemoryUsage(self.label, self.estimate, peak, self.num_dumps, self.dumps_per_chunk)
+        self.budget.usage.append(self.usage)
+        if peak is not None and peak > self.budget.limit:
+            logger.warning('%s exceeded memory budget of %s', self.usage, format_size(self.budget.limit))
+        else:
+            logger.info('%s', self.usage)
+        return False
+
+
+def map_dumps(func, array, shape, dtype, budget, label, index=(), temporaries=1):
+    """Apply function to a (lazily indexed) array in chunks of dumps that fit in the budget.
+
+    This replaces ``func(array[(slice(None),) + index])``, which holds all of
+    the selected input in memory at once, by a loop that only holds one
+    chunk of input next to the output.
+
+    Parameters
+    ----------
+    func : function
+        Function that maps a chunk of input with shape (T,) + *shape* to
+        output of the same shape, e.g. :func:`numpy.abs`
+    array : array-like, shape (N, ...)
+        Input indexed by dump along first axis (e.g. `data.vis` of katdal)
+    shape : tuple of int
+        Shape of input and output per dump, after applying *index*
+    dtype : :class:`numpy.dtype` object or equivalent
+        Type of output
+    budget : :class:`MemoryBudget` object
+        Memory budget that sets the chunk size
+    label : string
+        Description of step, for diagnostics
+    index : tuple, optional
+        Index applied to non-dump axes of input (e.g. channel range)
+    temporaries : int, optional
+        Number of temporary arrays of output type per chunk created by *func*
+
+    Returns
+    -------
+    output : array of *dtype*, shape (N,) + *shape*
+        Function applied to all dumps of input
+
+    """
+    num_dumps = array.shape[0]
+    footprint = Footprint().add((num_dumps,) + tuple(shape), dtype, per_dump=False)
+    footprint.add(shape, array.dtype).add(shape, dtype, copies=temporaries)
+    output = np.empty((num_dumps,) + tuple(shape), dtype)
+    dumps_per_chunk = budget.dumps_per_chunk(footprint, num_dumps)
+    with budget.track(label, footprint, num_dumps, dumps_per_chunk):
+        for start in range(0, num_dumps, dumps_per_chunk):
+            dumps = slice(start, min(start + dumps_per_chunk, num_dumps))
+            output[dumps] = func(array[(dumps,) + tuple(index)])
+    return output
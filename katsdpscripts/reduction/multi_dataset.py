@@ -0,0 +1,432 @@
+"""Several observation files presented as a single time-concatenated data set.
+
+Most reductions accept a single katdal data set, so cross-file analyses
+(e.g. gain or phase stability over a multi-night campaign) concatenate their
+results by hand. A :class:`MultiDataSet` instead wraps an ordered set of
+compatible katdal data sets and presents them as one data set along the time
+axis, with:
+
+- unified timestamps and per-dump attributes (az, el, lst, ...),
+- global scan and compound scan indices (also in the 'Observation/scan_index'
+  and 'Observation/compscan_index' sensors),
+- a merged target catalogue (also used by the 'Observation/target_index'
+  sensor),
+- concatenated sensor data, and
+- selections that are applied to every file, with scan, compscan and dump
+  indices interpreted globally.
+
+Visibilities, flags and weights are read lazily per underlying file, only for
+the dumps that are actually indexed. Files whose channel frequencies,
+correlation products or dump periods differ cannot be concatenated and are
+reported with a :exc:`IncompatibleDataSets` error.
+
+Typical use::
+
+    data = open_datasets(['1393418142.h5', '1393504533.h5'])
+    data.select(ants='ant1', scans='track')
+    for scan, state, target in data.scans():
+        vis = data.vis[:]
+
+"""
+import numpy as np
+import katpoint
+
+try:
+    import katdal
+except ImportError:
+    katdal = None
+
+
+class IncompatibleDataSets(ValueError):
+    """Data sets cannot be concatenated in time."""
+
+
+# Selection criteria of katdal that select along the time axis
+TIME_KEYWORDS = ('dumps', 'timerange', 'scans', 'compscans', 'targets')
+# Attributes of data sets with one entry per selected dump along the first axis
+PER_DUMP_ATTRS = ('timestamps', 'az', 'el', 'ra', 'dec', 'parangle', 'target_x', 'target_y',
+                  'u', 'v', 'w', 'lst', 'mjd')
+
+
+def _call_or_self(attr):
+    """Array attribute of data set, which is a function on older katdal versions."""
+    return attr() if callable(attr) else attr
+
+
+class LazyConcatenation(object):
+    """Array-like concatenation of lazily indexed arrays along first axis.
+
+    Parameters
+    ----------
+    arrays : sequence of array-like objects
+        Arrays with matching shape except along first axis, supporting
+        indexing with a slice or (increasing) integer array on the first axis
+
+    """
+    def __init__(self, arrays, dtype=None, shape=None):
+        self.arrays = list(arrays)
+        self.bounds = np.cumsum([0] + [array.shape[0] for array in self.arrays])
+        self.dtype = self.arrays[0].dtype if self.arrays else dtype
+        inner_shape = tuple(self.arrays[0].shape[1:]) if self.arrays else tuple(shape[1:]) if shape else ()
+        self.shape = (int(self.bounds[-1]),) + inner_shape
+
+    def __call__(self):
+        """Return self, so that old-style `data.flags()[:]` also works."""
+        return self
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, keys):
+        keys = keys if isinstance(keys, tuple) else (keys,)
+        first, rest = (keys[0] if keys else slice(None)), keys[1:]
+        num_dumps = self.shape[0]
+        if isinstance(first, slice) and first.step in (None, 1):
+            # Contiguous range is read as one slice per array
+            start, stop, step = first.indices(num_dumps)
+            parts = []
+            for array, lo, hi in zip(self.arrays, self.bounds[:-1], self.bounds[1:]):
+                part_start, part_stop = max(start, lo), min(stop, hi)
+                if part_start < part_stop:
+                    parts.append(np.asarray(array[(slice(part_start - lo, part_stop - lo),) + rest]))
+            return self._join(parts, rest)
+        scalar = np.isscalar(first)
+        if isinstance(first, slice):
+            indices = np.arange(*first.indices(num_dumps))
+        else:
+            indices = np.atleast_1d(np.asarray(first))
+            if indices.dtype == np.bool:
+                if len(indices) != num_dumps:
+                    raise IndexError('Boolean index has length %d instead of %d' % (len(indices), num_dumps))
+                indices = np.flatnonzero(indices)
+            indices = np.where(indices < 0, indices + num_dumps, indices)
+            if len(indices) and (indices.min() < 0 or indices.max() >= num_dumps):
+                raise IndexError('Index out of range for %d dumps' % (num_dumps,))
+        which = np.searchsorted(self.bounds, indices, side='right') - 1
+        # Read per array in file order, then restore requested order
+        order = np.argsort(which, kind='mergesort')
+        parts = []
+        for n in np.unique(which):
+            local = indices[order][which[order] == n] - self.bounds[n]
+            parts.append(np.asarray(self.arrays[n][(local,) + rest]))
+        result = self._join(parts, rest)
+        if not np.all(np.diff(order) > 0):
+            result = result[np.argsort(order)]
+        return result[0] if scalar else result
+
+    def _join(self, parts, rest):
+        """Concatenate parts along first axis (handling no parts)."""
+        if parts:
+            return np.concatenate(parts)
+        return np.empty((0,) + self.shape[1:], dtype=self.dtype)[(slice(None),) + rest]
+
+
+class MultiSensorCache(object):
+    """Concatenated sensor data of several data sets.
+
+    Index sensors ('Observation/scan_index', 'Observation/compscan_index' and
+    'Observation/target_index') are converted to the global indices of the
+    :class:`MultiDataSet` that owns the cache.
+
+    """
+    def __init__(self, multi):
+        self._multi = multi
+
+    def __getitem__(self, name):
+        parts = []
+        for n, data in self._multi._contributing():
+            values = np.asarray(data.sensor[name])
+            if name == 'Observation/scan_index':
+                values = values + self._multi._scan_offsets[n]
+            elif name == 'Observation/compscan_index':
+                values = values + self._multi._compscan_offsets[n]
+            elif name == 'Observation/target_index':
+                values = self._multi._target_maps[n][values]
+            parts.append(values)
+        return np.concatenate(parts) if parts else np.zeros(0)
+
+    def get(self, name):
+        """Sensor data of selected dumps, concatenated over data sets."""
+        return self[name]
+
+    def __contains__(self, name):
+        return all(name in data.sensor for data in self._multi.datasets)
+
+    def keys(self):
+        """Names of sensors present in all data sets."""
+        names = set(self._multi.datasets[0].sensor.keys())
+        for data in self._multi.datasets[1:]:
+            names &= set(data.sensor.keys())
+        return sorted(names)
+
+    @property
+    def timestamps(self):
+        """Timestamps of underlying sensor caches, concatenated."""
+        return np.concatenate([np.asarray(data.sensor.timestamps) for n, data in self._multi._contributing()])
+
+
+class MultiDataSet(object):
+    """Ordered set of compatible data sets presented as one along the time axis.
+
+    Parameters
+    ----------
+    datasets : sequence of :class:`katdal.DataSet` objects
+        Data sets to concatenate (sorted by start time here, with their
+        default selection of all dumps)
+
+    Raises
+    ------
+    IncompatibleDataSets
+        If data sets overlap in time or differ in channel frequencies,
+        correlation products or dump period
+
+    Notes
+    -----
+    Any attribute not handled explicitly (e.g. `ants`, `channel_freqs`,
+    `spectral_windows`, `description`) is taken from the first data set.
+
+    """
+    def __init__(self, datasets):
+        self.datasets = sorted(datasets, key=lambda data: data.start_time)
+        if not self.datasets:
+            raise ValueError('MultiDataSet needs at least one data set')
+        for prev, data in zip(self.datasets[:-1], self.datasets[1:]):
+            if data.start_time < prev.end_time:
+                raise IncompatibleDataSets('Data sets %s (ends %s) and %s (starts %s) overlap in time' %
+                                           (prev.name, prev.end_time, data.name, data.start_time))
+        self._excluded = set()
+        self._active = None
+        self.check_compatible()
+        # Global scan, compscan and dump numbering is based on the full files
+        self._counts = {'dumps': [data.shape[0] for data in self.datasets],
+                        'scans': self._count('Observation/scan_index'),
+                        'compscans': self._count('Observation/compscan_index')}
+        self._scan_offsets = np.cumsum([0] + self._counts['scans'][:-1])
+        self._compscan_offsets = np.cumsum([0] + self._counts['compscans'][:-1])
+        self.catalogue = katpoint.Catalogue()
+        self._target_maps = []
+        for data in self.datasets:
+            descriptions = [target.description for target in self.catalogue.targets]
+            target_map = []
+            for target in data.catalogue.targets:
+                if target.description not in descriptions:
+                    self.catalogue.add(target)
+                    descriptions.append(target.description)
+                target_map.append(descriptions.index(target.description))
+            self._target_maps.append(np.array(target_map, dtype=np.int))
+        self.sensor = MultiSensorCache(self)
+
+    def _count(self, index_sensor):
+        """Number of scans / compscans in each data set."""
+        return [int(np.max(data.sensor[index_sensor])) + 1 if data.shape[0] else 0 for data in self.datasets]
+
+    def check_compatible(self):
+        """Check that selections of data sets can be concatenated.
+
+        Raises
+        ------
+        IncompatibleDataSets
+            If channel frequencies, correlation products or dump periods differ
+
+        """
+        datasets = [data for n, data in enumerate(self.datasets) if n not in self._excluded]
+        if not datasets:
+            return
+        first = datasets[0]
+        for data in datasets[1:]:
+            if len(data.channel_freqs) != len(first.channel_freqs) or \
+               not np.allclose(data.channel_freqs, first.channel_freqs):
+                raise IncompatibleDataSets('Data sets %s and %s have different channels: %d channels from %.3f to '
+                                           '%.3f MHz vs %d channels from %.3f to %.3f MHz' %
+                                           (first.name, data.name, len(first.channel_freqs),
+                                            first.channel_freqs[0] / 1e6, first.channel_freqs[-1] / 1e6,
+                                            len(data.channel_freqs), data.channel_freqs[0] / 1e6,
+                                            data.channel_freqs[-1] / 1e6))
+            first_corrprods, corrprods = [[tuple(cp) for cp in d.corr_products] for d in (first, data)]
+            if corrprods != first_corrprods:
+                missing = sorted(set(first_corrprods) - set(corrprods))
+                extra = sorted(set(corrprods) - set(first_corrprods))
+                raise IncompatibleDataSets('Data sets %s and %s have different correlation products '
+                                           '(%s lacks %s and has extra %s%s)' %
+                                           (first.name, data.name, data.name, missing[:4], extra[:4],
+                                            '' if missing or extra else ', or they are in a different order'))
+            if not np.isclose(data.dump_period, first.dump_period, rtol=1e-3):
+                raise IncompatibleDataSets('Data sets %s and %s have different dump periods (%g vs %g seconds)' %
+                                           (first.name, data.name, first.dump_period, data.dump_period))
+
+    def _contributing(self):
+        """Indices and data sets that contribute to the current selection."""
+        return [(n, data) for n, data in enumerate(self.datasets)
+                if n not in self._excluded and (self._active is None or n == self._active)]
+
+    def select(self, **kwargs):
+        """Select subset of data in all data sets (see :meth:`katdal.DataSet.select`).
+
+        Integer (or boolean) `scans`, `compscans` and `dumps` selections refer
+        to the global indices of the combined data set, and integer `targets`
+        index its merged catalogue. Data sets without any of the selected
+        scans, dumps or targets drop out of the selection, but still get the
+        non-time criteria so that they match the rest when they come back.
+        All other criteria are passed to each data set unchanged. A new time
+        selection (any time criterion with the default 'auto' reset, or a
+        reset that includes 'T') starts again from all data sets.
+
+        """
+        reset = kwargs.get('reset', 'auto')
+        if reset == 'auto':
+            time_selection = any(key in kwargs for key in TIME_KEYWORDS)
+        else:
+            time_selection = 'T' in reset
+        local = [{} for data in self.datasets]
+        for key in ('scans', 'compscans', 'dumps'):
+            value = kwargs.pop(key, None)
+            if value is None:
+                continue
+            time_selection = True
+            values = value if isinstance(value, basestring) else np.atleast_1d(np.asarray(value))
+            if isinstance(value, slice):
+                values = np.arange(sum(self._counts[key]))[value]
+            elif isinstance(values, np.ndarray) and values.dtype == np.bool:
+                values = np.flatnonzero(values)
+            if isinstance(values, basestring) or values.dtype.kind in 'SU':
+                # Scan states and compscan labels apply to every data set
+                for selection in local:
+                    selection[key] = value
+                continue
+            bounds = np.cumsum([0] + self._counts[key])
+            which = np.searchsorted(bounds, values, side='right') - 1
+            for n, selection in enumerate(local):
+                selection[key] = [int(index) for index in values[which == n] - bounds[n]]
+        targets = kwargs.get('targets')
+        if targets is not None and not isinstance(targets, basestring) and \
+           all(isinstance(target, (int, long, np.integer)) for target in np.atleast_1d(targets)):
+            # Integer targets index the merged catalogue, so map them to the catalogue of each data set
+            kwargs.pop('targets')
+            values = np.atleast_1d(targets)
+            for n, selection in enumerate(local):
+                selection['targets'] = [int(index) for index in
+                                        np.flatnonzero(np.in1d(self._target_maps[n], values))]
+        # Non-time part of selection, for data sets that drop out of the time selection
+        others = dict((key, value) for key, value in kwargs.items() if key not in TIME_KEYWORDS + ('reset',))
+        if reset != 'auto':
+            others['reset'] = reset.replace('T', '')
+        self._active = None
+        for n, data in enumerate(self.datasets):
+            selection = dict(kwargs, **local[n])
+            if time_selection:
+                if any(isinstance(indices, list) and not indices for indices in local[n].values()):
+                    self._excluded.add(n)
+                    if others:
+                        data.select(**others)
+                    continue
+                self._excluded.discard(n)
+            data.select(**selection)
+        self.check_compatible()
+
+    @property
+    def num_dumps(self):
+        """Total number of dumps in all files (ignoring selection)."""
+        return sum(self._counts['dumps'])
+
+    @property
+    def shape(self):
+        """Shape of selected visibility data."""
+        contributing = self._contributing()
+        inner = tuple(self.datasets[0].shape[1:]) if not contributing else tuple(contributing[0][1].shape[1:])
+        return (sum(data.shape[0] for n, data in contributing),) + inner
+
+    def _concatenate(self, name):
+        arrays = [_call_or_self(getattr(data, name)) for n, data in self._contributing()]
+        template = _call_or_self(getattr(self.datasets[0], name))
+        return LazyConcatenation(arrays, dtype=template.dtype, shape=(0,) + self.shape[1:])
+
+    @property
+    def vis(self):
+        """Visibilities of selection, read lazily per underlying file."""
+        return self._concatenate('vis')
+
+    @property
+    def flags(self):
+        """Flags of selection, read lazily per underlying file."""
+        return self._concatenate('flags')
+
+    @property
+    def weights(self):
+        """Weights of selection, read lazily per underlying file."""
+        return self._concatenate('weights')
+
+    def __getattr__(self, name):
+        """Concatenate per-dump attributes, and take the rest from first data set."""
+        if name.startswith('_') or name == 'datasets':
+            raise AttributeError(name)
+        if name in PER_DUMP_ATTRS:
+            parts = [np.asarray(getattr(data, name)[:]) for n, data in self._contributing()]
+            return np.concatenate(parts) if parts else np.zeros(0)
+        return getattr(self.datasets[0], name)
+
+    @property
+    def name(self):
+        names = [data.name for data in self.datasets]
+        return names[0] if len(names) == 1 else '%s (+%d more)' % (names[0], len(names) - 1)
+
+    @property
+    def start_time(self):
+        return self.datasets[0].start_time
+
+    @property
+    def end_time(self):
+        return self.datasets[-1].end_time
+
+    @property
+    def scan_indices(self):
+        """Global indices of selected scans."""
+        return [self._scan_offsets[n] + scan for n, data in self._contributing() for scan in data.scan_indices]
+
+    @property
+    def compscan_indices(self):
+        """Global indices of selected compound scans."""
+        return [self._compscan_offsets[n] + compscan for n, data in self._contributing()
+                for compscan in data.compscan_indices]
+
+    @property
+    def target_indices(self):
+        """Indices of selected targets in merged catalogue."""
+        return sorted(set(int(self._target_maps[n][index]) for n, data in self._contributing()
+                          for index in data.target_indices))
+
+    def _iterate(self, method, offsets):
+        """Iterate over scans / compscans of each data set, activating one data set at a time."""
+        for n, data in enumerate(self.datasets):
+            if n in self._excluded:
+                continue
+            self._active = n
+            try:
+                for index, state_or_label, target in getattr(data, method)():
+                    yield offsets[n] + index, state_or_label, target
+            finally:
+                self._active = None
+
+    def scans(self):
+        """Iterate over selected scans of all data sets, yielding (global index, state, target)."""
+        return self._iterate('scans', self._scan_offsets)
+
+    def compscans(self):
+        """Iterate over selected compound scans, yielding (global index, label, target)."""
+        return self._iterate('compscans', self._compscan_offsets)
+
+
+def open_datasets(filenames, **kwargs):
+    """Open several files with katdal and combine them into a :class:`MultiDataSet`.
+
+    Parameters
+    ----------
+    filenames : string or sequence of string
+        Names of files (a single name gives a data set of one file)
+    kwargs : dict, optional
+        Extra keyword arguments passed to :func:`katdal.open`
+
+    """
+    if katdal is None:
+        raise ImportError('katdal is needed to open data sets')
+    filenames = [filenames] if isinstance(filenames, basestring) else list(filenames)
+    return MultiDataSet([katdal.open(filename, **kwargs) for filename in filenames])
@@ -0,0 +1,134 @@
+"""Precomputed data products for the observation report.
+
+The observation report shows, for each antenna and polarisation, the mean /
+min / max autocorrelation spectra, the autocorrelation time series and the
+percentage of data flagged per channel. Instead of selecting and reading the
+data again for every plot, :class:`ObsReportData` streams the autocorrelations
+of all antennas once, a chunk of dumps at a time, and accumulates all of these
+products in a single pass. The plotting functions only consume the results.
+The chunk size follows from a :class:`MemoryBudget`, so short observations are
+read in one go and long ones in as few chunks as fit in memory.
+
+"""
+import datetime as dt
+
+import numpy as np
+
+from katsdpscripts.reduction.memory_budget import MemoryBudget, Footprint
+
+# Reference date used to turn LST into datetimes for plotting
+LST_DATE = dt.datetime(2013, 4, 18)
+
+
+def lst_datetimes(lst):
+    """Turn LST (in hours) into datetimes on a reference date, for plotting.
+
+    The LST is truncated to the minute, and every wrap of the LST past
+    midnight moves it on to the next day.
+
+    Parameters
+    ----------
+    lst : array of float, shape (T,)
+        Local sidereal time, in hours
+
+    Returns
+    -------
+    lst_time : list of :class:`datetime.datetime` objects, length T
+        LST as datetimes on (or following) :data:`LST_DATE`
+
+    """
+    lst = np.asarray(lst, dtype=np.float64)
+    hours = np.floor(lst)
+    minutes = 60 * hours + np.floor((lst - hours) * 60)
+    days = np.r_[0, np.cumsum(np.diff(lst) < 0)]
+    minutes = (minutes + 24 * 60 * days).astype(np.int64)
+    return [LST_DATE + dt.timedelta(minutes=int(m)) for m in minutes]
+
+
+def local_datetimes(timestamps):
+    """Turn UTC timestamps into local datetimes, truncated to the second."""
+    return [dt.datetime.fromtimestamp(int(t)) for t in np.floor(timestamps)]
+
+
+class ObsReportData(object):
+    """Per-antenna products for the observation report, gathered in one pass.
+
+    Parameters
+    ----------
+    f : :class:`katdal.DataSet` object
+        Opened data file (its selection is reset to all autocorrelations)
+    pols : sequence of string, optional
+        Polarisations to include
+    chunk_dumps : int or None, optional
+        Number of dumps to read at a time (None to follow memory budget)
+    budget : :class:`MemoryBudget` object, optional
+        Memory budget that sets the chunk size and tracks actual memory use
+        (default budget if None)
+
+    Attributes
+    ----------
+    spectrum_mean, spectrum_min, spectrum_max : dict of arrays, shape (F,)
+        Mean / min / max autocorrelation amplitude per channel, keyed on
+        (antenna name, pol)
+    time_series : dict of arrays, shape (T,)
+        Mean autocorrelation amplitude per dump, over the central channels
+        (200 to 799) for 1K modes and over all channels otherwise
+    flags_per_channel, flags_per_dump : dict of arrays, shape (F,) and (T,)
+        Percentage of data flagged per channel and per dump
+    lst_time, loc_datetime : list of :class:`datetime.datetime` objects
+        LST and local time of each dump, for plot axes
+
+    """
+    def __init__(self, f, pols=('h', 'v'), chunk_dumps=None, budget=None):
+        f.select(corrprods='auto', pol=pols)
+        self.channels = f.channels
+        self.channel_freqs = f.channel_freqs
+        self.channel_width = f.channel_width
+        self.lst = f.lst
+        self.timestamps = f.timestamps
+        self.lst_time = lst_datetimes(self.lst)
+        self.loc_datetime = local_datetimes(self.timestamps)
+        self.series_channels = slice(200, 800) if len(self.channels) < 1025 else slice(None)
+        self.keys = [(inpA[:-1], inpA[-1]) for inpA, inpB in f.corr_products]
+        self.budget = budget if budget is not None else MemoryBudget()
+        self._accumulate(f, chunk_dumps)
+
+    def _accumulate(self, f, chunk_dumps):
+        """Stream through visibilities and flags, accumulating all products."""
+        num_dumps, num_chans, num_prods = f.shape
+        # Accumulators and per-dump outputs, plus visibilities, amplitudes and flags of each chunk
+        footprint = Footprint().add((num_chans, num_prods), np.float64, per_dump=False, copies=3)
+        footprint.add((num_chans, num_prods), np.int64, per_dump=False)
+        footprint.add((num_dumps, num_prods), np.float64, per_dump=False, copies=2)
+        footprint.add((num_chans, num_prods), np.complex64).add((num_chans, num_prods), np.float32)
+        footprint.add((num_chans, num_prods), np.bool_)
+        if chunk_dumps is None:
+            chunk_dumps = self.budget.dumps_per_chunk(footprint, num_dumps)
+        vis_sum = np.zeros((num_chans, num_prods))
+        vis_min = np.tile(np.inf, (num_chans, num_prods))
+        vis_max = np.tile(-np.inf, (num_chans, num_prods))
+        flags_chan = np.zeros((num_chans, num_prods), dtype=np.int64)
+        series = np.zeros((num_dumps, num_prods))
+        flags_dump = np.zeros((num_dumps, num_prods))
+        flags = f.flags()
+        with self.budget.track('Observation report products', footprint, num_dumps, chunk_dumps):
+            for start in range(0, num_dumps, chunk_dumps):
+                stop = min(start + chunk_dumps, num_dumps)
+                amp = np.abs(f.vis[start:stop])
+                vis_sum += amp.sum(axis=0)
+                np.minimum(vis_min, amp.min(axis=0), vis_min)
+                np.maximum(vis_max, amp.max(axis=0), vis_max)
+                series[start:stop] = amp[:, self.series_channels].mean(axis=1)
+                flagged = flags[start:stop]
+                flags_chan += flagged.sum(axis=0)
+                flags_dump[start:stop] = 100. * flagged.mean(axis=1)
+        percent_chan = 100. * flags_chan / float(max(num_dumps, 1))
+        self.spectrum_mean, self.spectrum_min, self.spectrum_max = {}, {}, {}
+        self.time_series, self.flags_per_channel, self.flags_per_dump = {}, {}, {}
+        for n, key in enumerate(self.keys):
+            self.spectrum_mean[key] = vis_sum[:, n] / num_dumps
+            self.spectrum_min[key] = vis_min[:, n]
+            self.spectrum_max[key] = vis_max[:, n]
+            self.time_series[key] = series[:, n]
+            self.flags_per_channel[key] = percent_chan[:, n]
+            self.flags_per_dump[key] = flags_dump[:, n]
@@ -0,0 +1,242 @@
+"""Incremental fitting of pointing models to pointing offsets.
+
+The standard pointing model is linear in its parameters, so a fit to a set of
+measured (az, el) offsets is a linear least-squares problem. Instead of
+rebuilding the design matrix and refitting from scratch each time a data point
+is flagged or a parameter is toggled (as :meth:`katpoint.PointingModel.fit`
+does), :class:`PointingFit` evaluates the basis functions of all parameters at
+all data points once. It then maintains the normal equations of the kept data
+points, which change by rank-one updates when points are flagged / unflagged.
+Enabling or disabling parameters merely selects a different submatrix of the
+normal equations, and the residuals of all points follow from the cached basis.
+
+The same engine serves interactive and batch fitting, so that both produce
+identical models from the same data and selections.
+
+"""
+import numpy as np
+import katpoint
+
+# Parameters that are not allowed for an alt-az mount (P2 is meaningless and P10 is the same as P8)
+INVALID_PARAMS = (2, 10)
+# Default parameters to fit if none are specified (P1, P3, P4, P5, P6 and P7)
+DEFAULT_PARAMS = (1, 3, 4, 5, 6, 7)
+# Rebuild the normal equations from scratch after this many updates, to avoid build-up of round-off errors
+MAX_UPDATES = 256
+
+
+def pointing_basis(az, el):
+    """Pointing offsets produced by each parameter of a unit pointing model.
+
+    Parameters
+    ----------
+    az, el : array of float, shape (N,)
+        Azimuth and elevation angles, in radians
+
+    Returns
+    -------
+    basis_az, basis_el : array of float, shape (N, P)
+        Azimuth and elevation offset at each position for each of the *P*
+        pointing model parameters set to 1 (with the rest zero)
+
+    """
+    model = katpoint.PointingModel()
+    num_params = model.num_params if hasattr(model, 'num_params') else len(model)
+    basis_az, basis_el = np.zeros((len(az), num_params)), np.zeros((len(el), num_params))
+    for param in range(num_params):
+        unit_vector = np.zeros(num_params)
+        unit_vector[param] = 1.0
+        basis_az[:, param], basis_el[:, param] = katpoint.PointingModel(unit_vector).offset(az, el)
+    return basis_az, basis_el
+
+
+class PointingFit(object):
+    """Pointing model fit that is updated incrementally as selections change.
+
+    Parameters
+    ----------
+    az, el : array of float, shape (N,)
+        Requested azimuth and elevation angles, in radians
+    delta_az, delta_el : array of float, shape (N,)
+        Measured azimuth and elevation offsets, in radians
+    sigma_daz, sigma_del : array of float, shape (N,), optional
+        Standard deviation of azimuth and elevation offsets, in radians
+        (default is 1)
+    keep : array of bool, shape (N,), optional
+        True for data points to include in the fit (default is all)
+    enabled_params : sequence of ints or bools, optional
+        Parameters to fit, as integer P-numbers (starting at 1) or a boolean
+        flag per parameter (default is P1, P3, P4, P5, P6 and P7)
+
+    Attributes
+    ----------
+    keep : array of bool, shape (N,)
+        Current selection of data points (change it via :meth:`set_keep`)
+    enabled : array of bool, shape (P,)
+        Current selection of parameters (change it via :meth:`set_enabled`)
+
+    """
+    def __init__(self, az, el, delta_az, delta_el, sigma_daz=None, sigma_del=None, keep=None,
+                 enabled_params=None):
+        self.az, self.el = np.asarray(az, dtype=np.float64), np.asarray(el, dtype=np.float64)
+        self.delta_az = np.asarray(delta_az, dtype=np.float64)
+        self.delta_el = np.asarray(delta_el, dtype=np.float64)
+        num_points = len(self.az)
+        self.sigma_daz = np.ones(num_points) if sigma_daz is None else np.asarray(sigma_daz, dtype=np.float64)
+        self.sigma_del = np.ones(num_points) if sigma_del is None else np.asarray(sigma_del, dtype=np.float64)
+        self.keep = np.ones(num_points, dtype=bool) if keep is None else np.array(keep, dtype=bool)
+        self.basis_az, self.basis_el = pointing_basis(self.az, self.el)
+        num_params = self.basis_az.shape[1]
+        # Weighted design matrix rows and measurements for az (scaled to cross-el) and el offsets
+        cos_el = np.cos(self.el)
+        self._rows_az = self.basis_az * (cos_el / self.sigma_daz)[:, np.newaxis]
+        self._rows_el = self.basis_el / self.sigma_del[:, np.newaxis]
+        self._meas_az = self.delta_az * cos_el / self.sigma_daz
+        self._meas_el = self.delta_el / self.sigma_del
+        self.enabled = np.zeros(num_params, dtype=bool)
+        enabled_params = np.asarray(DEFAULT_PARAMS if enabled_params is None else enabled_params)
+        if enabled_params.dtype == bool:
+            self.enabled[:] = enabled_params
+        else:
+            self.enabled[np.asarray(enabled_params, dtype=int) - 1] = True
+        self._rebuild()
+
+    def _rebuild(self):
+        """Build normal equations of kept data points from scratch."""
+        rows_az, rows_el = self._rows_az[self.keep], self._rows_el[self.keep]
+        self._normal = rows_az.T.dot(rows_az) + rows_el.T.dot(rows_el)
+        self._rhs = rows_az.T.dot(self._meas_az[self.keep]) + rows_el.T.dot(self._meas_el[self.keep])
+        self._updates = 0
+        self._solution = None
+
+    def set_keep(self, index, state=True):
+        """Include (*state* True) or exclude data point(s) at *index* from the fit."""
+        for n in np.atleast_1d(np.arange(len(self.keep))[index]):
+            if self.keep[n] == state:
+                continue
+            self.keep[n] = state
+            sign = 1.0 if state else -1.0
+            row_az, row_el = self._rows_az[n], self._rows_el[n]
+            self._normal += sign * (np.outer(row_az, row_az) + np.outer(row_el, row_el))
+            self._rhs += sign * (row_az * self._meas_az[n] + row_el * self._meas_el[n])
+            self._updates += 1
+            self._solution = None
+        if self._updates > MAX_UPDATES:
+            self._rebuild()
+
+    def toggle(self, index):
+        """Toggle inclusion of data point at *index* in the fit."""
+        self.set_keep(index, not self.keep[index])
+
+    def set_enabled(self, param, state=True):
+        """Enable (*state* True) or disable parameter with 0-based index *param*."""
+        if self.enabled[param] != state:
+            self.enabled[param] = state
+            self._solution = None
+
+    @property
+    def active_params(self):
+        """Indices (0-based) of parameters actually fitted (enabled and valid for alt-az mount)."""
+        active = self.enabled.copy()
+        active[np.array(INVALID_PARAMS) - 1] = False
+        return np.flatnonzero(active)
+
+    def fit(self):
+        """Fit enabled parameters to kept data points.
+
+        Returns
+        -------
+        params : array of float, shape (P,)
+            Fitted model parameters (disabled parameters are zero), in radians
+        sigma_params : array of float, shape (P,)
+            Standard errors on fitted parameters, in radians
+
+        """
+        if self._solution is None:
+            num_params = len(self.enabled)
+            params, sigma_params = np.zeros(num_params), np.zeros(num_params)
+            active = self.active_params
+            if len(active) > 0:
+                normal = self._normal[np.ix_(active, active)]
+                # Scale normal equations to unit diagonal to improve their conditioning
+                scale = np.sqrt(np.diag(normal))
+                scale[scale == 0.0] = 1.0
+                covariance = np.linalg.pinv(normal / np.outer(scale, scale)) / np.outer(scale, scale)
+                params[active] = covariance.dot(self._rhs[active])
+                sigma_params[active] = np.sqrt(np.abs(np.diag(covariance)))
+            self._solution = (params, sigma_params)
+        params, sigma_params = self._solution
+        return params.copy(), sigma_params.copy()
+
+    def model(self):
+        """Fitted pointing model as :class:`katpoint.PointingModel` object."""
+        return katpoint.PointingModel(self.fit()[0])
+
+    def offsets(self, params):
+        """Pointing offsets of model with given *params* at all data points (from the cached basis)."""
+        params = np.asarray(params, dtype=np.float64)
+        return self.basis_az.dot(params), self.basis_el.dot(params)
+
+    def results(self, params=None):
+        """Residuals and statistics of model with *params* (fitted model by default)."""
+        return PointingResults(self, self.fit()[0] if params is None else params)
+
+
+class PointingResults(object):
+    """Residuals and sky RMS of given pointing model on data points of fit.
+
+    Parameters
+    ----------
+    fit : :class:`PointingFit` object
+        Data points (and selection) to evaluate model on
+    params : array of float, shape (P,)
+        Parameters of pointing model, in radians
+    clip_sigma : float, optional
+        Threshold for sigma-clipped RMS, as a multiple of per-axis error
+
+    """
+    def __init__(self, fit, params, clip_sigma=3.0):
+        self.fit = fit
+        self.clip_sigma = clip_sigma
+        self.update(params)
+
+    def update(self, params):
+        """Determine new residuals and sky RMS from pointing model parameters."""
+        model_delta_az, model_delta_el = self.fit.offsets(params)
+        self.residual_az = self.fit.delta_az - model_delta_az
+        self.residual_el = self.fit.delta_el - model_delta_el
+        self.residual_xel = self.residual_az * np.cos(self.fit.el)
+        self.abs_sky_error = katpoint.rad2deg(np.sqrt(self.residual_xel ** 2 + self.residual_el ** 2)) * 60.
+        self.metrics(self.fit.keep)
+
+    def metrics(self, keep):
+        """Calculate sky RMS statistics of selected data points (in arcminutes)."""
+        ###### On the calculation of all-sky RMS #####
+        # Assume the el and cross-el errors have zero mean, are distributed normally, and are uncorrelated
+        # They are therefore described by a 2-dimensional circular Gaussian pdf with zero mean and *per-component*
+        # standard deviation of sigma
+        # The absolute sky error (== Euclidean length of 2-dim error vector) then has a Rayleigh distribution
+        # The RMS sky error has a mean value of sqrt(2) * sigma, since each squared error term is the sum of
+        # two squared Gaussian random values, each with an expected value of sigma^2.
+        abs_sky_error = self.abs_sky_error[keep]
+        self.sky_rms = np.sqrt(np.mean(abs_sky_error ** 2))
+        # A more robust estimate of the RMS sky error is obtained via the median of the Rayleigh distribution,
+        # which is sigma * sqrt(log(4)) -> convert this to the RMS sky error = sqrt(2) * sigma
+        self.robust_sky_rms = np.median(abs_sky_error) * np.sqrt(2. / np.log(4.))
+        # The chi^2 value is what is actually optimised by the least-squares fitter (evaluated on the training set)
+        self.chi2 = np.sum(((self.residual_xel / self.fit.sigma_daz) ** 2 +
+                            (self.residual_el / self.fit.sigma_del) ** 2)[keep])
+        # Sky RMS after iteratively discarding points beyond clip_sigma times the per-component sigma
+        inliers = np.ones(len(abs_sky_error), dtype=bool)
+        sigma = self.robust_sky_rms / np.sqrt(2.)
+        for iteration in range(10):
+            new_inliers = abs_sky_error <= self.clip_sigma * sigma
+            if not new_inliers.any():
+                break
+            sigma = np.sqrt(np.mean(abs_sky_error[new_inliers] ** 2) / 2.)
+            converged = (new_inliers == inliers).all()
+            inliers = new_inliers
+            if converged:
+                break
+        self.clipped_sky_rms = np.sqrt(2.) * sigma
+        self.num_clipped = len(abs_sky_error) - inliers.sum()
@@ -0,0 +1,331 @@
+"""Rendering of PDF report pages in worker processes.
+
+Report scripts traditionally draw every figure in the main process and save it
+to a single :class:`matplotlib.backends.backend_pdf.PdfPages` object, so that
+figure rendering is serialised with (and often takes as long as) the
+reduction itself. Instead, a script can queue page specifications on a
+:class:`ReportPages` object: a module-level function that draws one or more
+figures, together with the (picklable) data it needs. Each page is rendered to
+a standalone PDF in a pool of worker processes with the non-interactive Agg
+backend while the script carries on, and the page PDFs are spliced into the
+output file in the order in which they were queued. Figures are closed as
+soon as they are written and pages are written as soon as they are done, so
+that only a bounded number of pages are held in memory at any time.
+
+Typical use::
+
+    def spectrum_page(label, freqs, spectrum):
+        fig = plt.figure()
+        plt.plot(freqs, spectrum)
+        plt.title(label)
+
+    with ReportPages('report.pdf') as report:
+        for target in targets:
+            report.add(spectrum_page, target, freqs, spectra[target])
+
+"""
+import re
+import io
+import multiprocessing
+
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_pdf import PdfPages
+
+
+def _figures_drawn_by(func, args, kwargs):
+    """Call figure function and return the figures it created, in order."""
+    existing = set(plt.get_fignums())
+    try:
+        func(*args, **kwargs)
+    except Exception:
+        # Don't leave half-drawn figures lying around
+        for num in set(plt.get_fignums()) - existing:
+            plt.close(num)
+        raise
+    return [plt.figure(num) for num in sorted(plt.get_fignums()) if num not in existing]
+
+
+def render_page(func, args=(), kwargs={}):
+    """Render all figures drawn by page function to PDF and close them.
+
+    Parameters
+    ----------
+    func : callable
+        Function that draws one or more new figures via :mod:`matplotlib.pyplot`
+    args, kwargs : tuple and dict, optional
+        Positional and keyword arguments of `func`
+
+    Returns
+    -------
+    pdf : string
+        PDF document with one page per figure drawn by `func`, in order of
+        figure number
+
+    """
+    figures = _figures_drawn_by(func, args, kwargs)
+    output = io.BytesIO()
+    try:
+        with PdfPages(output) as pages:
+            for fig in figures:
+                pages.savefig(fig)
+                plt.close(fig)
+    finally:
+        for fig in figures:
+            plt.close(fig)
+    return output.getvalue()
+
+
+def _init_worker():
+    """Switch worker processes to a non-interactive backend."""
+    plt.switch_backend('Agg')
+    plt.close('all')
+
+
+_OBJECT_HEADER = re.compile(br'\s*(\d+)\s+(\d+)\s+obj\b')
+_REFERENCE = re.compile(br'(?<![\w.])(\d+)\s+(\d+)\s+R\b')
+_STREAM_START = re.compile(br'>>\s*stream(\r\n|\n)')
+
+
+def _split_pdf(pdf):
+    """Split PDF document into its objects and page references.
+
+    This handles classic PDF 1.4 files with a single cross-reference table,
+    such as those written by matplotlib.
+
+    Parameters
+    ----------
+    pdf : string
+        Contents of PDF file
+
+    Returns
+    -------
+    objects : dict mapping int to string
+        Body of each object (between 'obj' and 'endobj' keywords), keyed by
+        object number
+    pages : list of int
+        Object numbers of page objects, in page order
+    skip : set of int
+        Object numbers of document-level objects (catalog, page tree nodes and
+        document information) that should not be copied
+
+    Raises
+    ------
+    ValueError
+        If the PDF structure is not understood
+
+    """
+    startxref = pdf.rfind(b'startxref')
+    if startxref < 0:
+        raise ValueError('PDF file has no startxref')
+    xref_offset = int(pdf[startxref + 9:].split()[0])
+    if not pdf.startswith(b'xref', xref_offset):
+        raise ValueError('PDF cross-reference streams are not supported')
+    trailer_start = pdf.index(b'trailer', xref_offset)
+    tokens = pdf[xref_offset + 4:trailer_start].split()
+    offsets = {}
+    while tokens:
+        first, count = int(tokens[0]), int(tokens[1])
+        entries, tokens = tokens[2:2 + 3 * count], tokens[2 + 3 * count:]
+        for n in range(count):
+            offset, generation, kind = entries[3 * n:3 * n + 3]
+            if kind == b'n':
+                offsets[first + n] = int(offset)
+    # Objects extend up to the next object (or the cross-reference table)
+    ends = dict(zip(sorted(offsets, key=offsets.get),
+                    sorted(offsets.values())[1:] + [xref_offset]))
+    objects = {}
+    for num, offset in offsets.items():
+        chunk = pdf[offset:ends[num]]
+        header = _OBJECT_HEADER.match(chunk)
+        body_end = chunk.rfind(b'endobj')
+        if not header or int(header.group(1)) != num or body_end < 0:
+            raise ValueError('PDF object %d not found at offset %d' % (num, offset))
+        objects[num] = chunk[header.end():body_end].strip()
+
+    def ref(body, key):
+        match = re.search(br'/' + key + br'\s+(\d+)\s+\d+\s+R', _dictionary(body))
+        return int(match.group(1)) if match else None
+
+    trailer = pdf[trailer_start:startxref]
+    root, info = ref(trailer, b'Root'), ref(trailer, b'Info')
+    if root not in objects:
+        raise ValueError('PDF document catalog not found')
+    skip = set([root, info]) - set([None])
+    pages = []
+
+    def walk(num):
+        body = _dictionary(objects[num])
+        if re.search(br'/Type\s*/Pages\b', body):
+            skip.add(num)
+            kids = re.search(br'/Kids\s*\[([^\]]*)\]', body)
+            for kid in _REFERENCE.finditer(kids.group(1) if kids else b''):
+                walk(int(kid.group(1)))
+        else:
+            pages.append(num)
+    walk(ref(objects[root], b'Pages'))
+    return objects, pages, skip
+
+
+def _dictionary(body):
+    """Part of object body before any stream data."""
+    stream = _STREAM_START.search(body)
+    return body[:stream.start() + 2] if stream else body
+
+
+class PdfConcatenator(object):
+    """Write pages of several PDF documents to a single PDF file, in order.
+
+    The objects of each document are renumbered and copied verbatim (stream
+    data is not decoded), while the document catalogs and page trees are
+    replaced by a single page tree. Attributes inherited by pages from page
+    tree nodes are not preserved, which is fine for documents written by
+    matplotlib.
+
+    Parameters
+    ----------
+    fileobj : file-like object
+        Binary file open for writing
+
+    """
+    # Object numbers reserved for the page tree and catalog of output file
+    _PAGES, _CATALOG = 1, 2
+
+    def __init__(self, fileobj):
+        self._file = fileobj
+        self._position = 0
+        self._offsets = {}
+        self._pages = []
+        self._write(b'%PDF-1.4\n%\xac\xdc \xab\xba\n')
+
+    def _write(self, data):
+        self._file.write(data)
+        self._position += len(data)
+
+    def _write_object(self, num, body):
+        self._offsets[num] = self._position
+        self._write(b'%d 0 obj\n' % (num,) + body + b'\nendobj\n')
+
+    @property
+    def num_pages(self):
+        """Number of pages written so far."""
+        return len(self._pages)
+
+    def add(self, pdf):
+        """Append all pages of PDF document (given as a string)."""
+        objects, pages, skip = _split_pdf(pdf)
+        first = max(self._offsets.keys() + [self._CATALOG]) + 1
+        renumber = dict((old, first + n) for n, old in enumerate(sorted(set(objects) - skip)))
+        # Document-level objects are dropped and the parents of pages become the output page tree
+        renumber.update((old, self._PAGES) for old in skip)
+
+        def replace(match):
+            return b'%d 0 R' % (renumber.get(int(match.group(1)), 0),)
+        for old in sorted(renumber, key=renumber.get):
+            if old in skip:
+                continue
+            body = objects[old]
+            header = _dictionary(body)
+            self._write_object(renumber[old], _REFERENCE.sub(replace, header) + body[len(header):])
+        self._pages.extend(renumber[old] for old in pages)
+
+    def close(self):
+        """Write page tree, catalog, cross-reference table and trailer."""
+        kids = b' '.join(b'%d 0 R' % (num,) for num in self._pages)
+        self._write_object(self._PAGES, b'<< /Type /Pages /Kids [ %s ] /Count %d >>' % (kids, len(self._pages)))
+        self._write_object(self._CATALOG, b'<< /Type /Catalog /Pages %d 0 R >>' % (self._PAGES,))
+        size = max(self._offsets) + 1
+        xref = [b'xref\n0 %d\n' % (size,), b'0000000000 65535 f \n']
+        xref += [(b'%010d 00000 n \n' % (self._offsets[num],)) if num in self._offsets
+                 else b'0000000000 00000 f \n' for num in range(1, size)]
+        startxref = self._position
+        self._write(b''.join(xref))
+        self._write(b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+                    % (size, self._CATALOG, startxref))
+
+
+class ReportPages(object):
+    """PDF report whose pages are rendered in worker processes.
+
+    Parameters
+    ----------
+    filename : string
+        Name of output PDF file
+    processes : int or None, optional
+        Number of worker processes (None for one per CPU, 0 to render pages
+        in the calling process instead)
+    max_pending : int or None, optional
+        Maximum number of queued pages that are not yet written to the file
+        (None for twice the number of processes), which bounds the memory
+        taken up by page data and rendered pages
+
+    Notes
+    -----
+    Page functions are called as `func(*args, **kwargs)` and should draw one
+    or more new figures with :mod:`matplotlib.pyplot`, which become pages of
+    the report in order of figure number. When rendering in worker processes
+    the function and its arguments are pickled, so the function has to be
+    defined at the top level of a module and the data should be plain arrays
+    and values (not data sets or open files).
+
+    """
+    def __init__(self, filename, processes=None, max_pending=None):
+        self.filename = filename
+        processes = multiprocessing.cpu_count() if processes is None else processes
+        self.max_pending = max(1, 2 * processes if max_pending is None else max_pending)
+        self._pool = multiprocessing.Pool(processes, _init_worker) if processes > 0 else None
+        self._pending = []
+        self._file = open(filename, 'wb')
+        self._pdf = PdfConcatenator(self._file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Finish report, or abandon unwritten pages on error."""
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+        # Don't suppress exceptions
+        return False
+
+    def add(self, func, *args, **kwargs):
+        """Queue page(s) drawn by `func(*args, **kwargs)` (see class notes)."""
+        if self._pool is None:
+            self._pending.append(render_page(func, args, kwargs))
+        else:
+            self._pending.append(self._pool.apply_async(render_page, (func, args, kwargs)))
+        self._flush(self.max_pending)
+
+    def _flush(self, max_pending=0):
+        """Write finished pages in order, waiting until at most `max_pending` remain."""
+        while self._pending:
+            page = self._pending[0]
+            if not isinstance(page, bytes):
+                if len(self._pending) <= max_pending and not page.ready():
+                    break
+                page = page.get()
+            self._pdf.add(page)
+            self._pending.pop(0)
+
+    @property
+    def num_pages(self):
+        """Number of pages written to the file so far."""
+        return self._pdf.num_pages
+
+    def close(self):
+        """Wait for all pages to be rendered and write the complete report."""
+        try:
+            self._flush()
+            self._pdf.close()
+        finally:
+            self.terminate()
+
+    def terminate(self):
+        """Stop worker processes and close output file (which is incomplete unless closed)."""
+        self._pending = []
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        self._file.close()
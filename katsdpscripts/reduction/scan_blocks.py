@@ -0,0 +1,161 @@
+"""Iteration over blocks of scan data with background prefetching.
+
+Most katdal-based reductions select a scan, read its visibilities, flags and
+weights synchronously and then crunch the numbers, so that disk I/O and numpy
+work never overlap. :class:`ScanBlockReader` applies the selection once and
+then reads the data scan by scan (optionally in chunks of dumps) in a
+background thread, which stays a bounded number of blocks ahead of the
+consumer. The blocks are yielded in the same order and with the same contents
+as the equivalent synchronous loop over ``data.scans()``.
+
+Given a :class:`MemoryBudget` instead of a fixed block size, scans that fit
+in the budget (together with the blocks read ahead) are read whole and
+larger scans are split into blocks of as many dumps as fit.
+
+While iterating, the data set belongs to the reader thread: the consumer
+should get any metadata it needs (channel frequencies, etc.) from the reader
+before iteration starts, or from the yielded blocks.
+
+"""
+import threading
+import Queue
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+from katsdpscripts.reduction.memory_budget import Footprint
+
+
+class ScanBlock(namedtuple('ScanBlock', 'scan_index state target dumps timestamps vis flags weights')):
+    """Block of consecutive dumps from one scan.
+
+    Attributes
+    ----------
+    scan_index : int
+        Index of scan in data set
+    state : string
+        Scan state (e.g. 'track' or 'slew')
+    target : :class:`katpoint.Target` object
+        Target of scan
+    dumps : slice
+        Range of dumps of block within scan
+    timestamps : array of float, shape (T,)
+        Timestamps of dumps in block
+    vis, flags, weights : arrays, shape (T, C, B)
+        Visibilities, flags and weights of block (weights are None if not read)
+
+    """
+    __slots__ = ()
+
+
+# Marker for end of data in queue
+_DONE = object()
+
+
+class _ReaderError(object):
+    """Exception raised in reader thread, to be re-raised in consumer."""
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+def _call_or_index(attr):
+    """All of data set array attribute, which is a function on older katdal versions."""
+    return attr()[:] if callable(attr) else attr[:]
+
+
+class ScanBlockReader(object):
+    """Iterate over blocks of selected scans, reading ahead in a background thread.
+
+    Parameters
+    ----------
+    data : :class:`katdal.DataSet` object
+        Data set to read (its selection is changed)
+    dumps_per_block : int or None, optional
+        Maximum number of dumps per block (None for one block per scan)
+    prefetch : int, optional
+        Maximum number of blocks read ahead of the consumer
+    read_weights : {True, False}, optional
+        True to read weights as well (otherwise the *weights* of blocks are None)
+    budget : :class:`MemoryBudget` object or None, optional
+        Memory budget that sets the number of dumps per block of each scan
+        if *dumps_per_block* is None (otherwise one block per scan)
+    selection : dict, optional
+        Selection criteria passed to :meth:`data.select`, e.g. `scans`,
+        `compscans` (scan label), `targets` or `corrprods`
+
+    """
+    def __init__(self, data, dumps_per_block=None, prefetch=2, read_weights=True, budget=None, **selection):
+        self.data = data
+        self.dumps_per_block = dumps_per_block
+        self.prefetch = max(1, prefetch)
+        self.read_weights = read_weights
+        self.budget = budget
+        if selection:
+            data.select(**selection)
+
+    def _blocks(self):
+        """Read blocks synchronously (runs in reader thread)."""
+        data = self.data
+        for scan_index, state, target in data.scans():
+            num_dumps = data.shape[0]
+            dumps_per_block = self.dumps_per_block
+            if not dumps_per_block and self.budget is not None:
+                dumps_per_block = self.budget.dumps_per_chunk(self.footprint(), num_dumps)
+                dumps_per_block = None if dumps_per_block >= num_dumps else dumps_per_block
+            if not dumps_per_block:
+                # Read whole scan in one go, exactly as a synchronous loop would
+                yield ScanBlock(scan_index, state, target, slice(0, num_dumps), data.timestamps[:],
+                                data.vis[:], _call_or_index(data.flags),
+                                _call_or_index(data.weights) if self.read_weights else None)
+                continue
+            flags = data.flags() if callable(data.flags) else data.flags
+            weights = (data.weights() if callable(data.weights) else data.weights) if self.read_weights else None
+            for start in range(0, num_dumps, dumps_per_block):
+                dumps = slice(start, min(start + dumps_per_block, num_dumps))
+                yield ScanBlock(scan_index, state, target, dumps, data.timestamps[dumps], data.vis[dumps],
+                                flags[dumps], weights[dumps] if weights is not None else None)
+
+    def footprint(self):
+        """Memory of blocks in flight: those read ahead, the one being read and the one being consumed."""
+        shape, blocks = self.data.shape[1:], self.prefetch + 2
+        footprint = Footprint().add(shape, np.complex64, copies=blocks).add(shape, np.bool_, copies=blocks)
+        return footprint.add(shape, np.float32, copies=blocks) if self.read_weights else footprint
+
+    def _read(self, queue, stop):
+        """Fill queue with blocks until done or told to stop."""
+        def put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+        try:
+            for block in self._blocks():
+                if not put(block):
+                    return
+        except Exception:
+            put(_ReaderError(sys.exc_info()))
+            return
+        put(_DONE)
+
+    def __iter__(self):
+        """Yield :class:`ScanBlock` objects in order, while reading ahead."""
+        queue, stop = Queue.Queue(maxsize=self.prefetch), threading.Event()
+        reader = threading.Thread(target=self._read, args=(queue, stop), name='ScanBlockReader')
+        reader.daemon = True
+        reader.start()
+        try:
+            while True:
+                item = queue.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, _ReaderError):
+                    raise item.exc_info[0], item.exc_info[1], item.exc_info[2]
+                yield item
+        finally:
+            # Stop the reader if the consumer bails out early, and wait for it to release the data set
+            stop.set()
+            reader.join()
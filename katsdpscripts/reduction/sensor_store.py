@@ -0,0 +1,449 @@
+"""Columnar, time-indexed store of sensor histories.
+
+Cross-file studies (e.g. wind speed versus pointing error over months) read
+the same sensor histories from the sensor caches of many observation files or
+from CSV exports of the monitoring store, over and over again. A
+:class:`SensorStore` keeps these histories in a single HDF5 file, with one
+group per sensor holding chunked, compressed arrays of timestamps and values
+sorted by time. A small index of the first timestamp of every chunk is kept
+in memory, so that a time range query does a binary search on the index and
+only reads (and decompresses) the chunks that overlap the range. Queries can
+resample the data onto a regular grid or compute rolling aggregates on the
+fly, vectorised over the selected samples.
+
+Typical use::
+
+    store = SensorStore('sensors.h5')
+    import_h5_sensors(store, '1393418142.h5', ['Enviro/asc.air.temperature', 'Enviro/asc.wind.speed'])
+    import_csv_sensor(store, 'anc.asc.wind.speed.csv')
+    t, wind = store.resample('Enviro/asc.wind.speed', start, end, period=60.0, how='max')
+
+"""
+import os
+import csv
+
+import numpy as np
+import h5py
+
+
+def coverage_intervals(timestamps, max_gap, ends=None):
+    """Merge sorted sample times (or periods) into intervals without gaps longer than *max_gap*.
+
+    Parameters
+    ----------
+    timestamps : array of float, shape (N,)
+        Sorted sample times (or start times of periods), in seconds
+    max_gap : float
+        Largest gap between samples inside an interval, in seconds
+    ends : array of float, shape (N,), optional
+        End times of periods, in seconds (default is samples without duration)
+
+    Returns
+    -------
+    intervals : list of (float, float) pairs
+        Start and end time of each interval of data coverage
+
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    if len(timestamps) == 0:
+        return []
+    # Latest end time of all periods so far
+    ends = np.maximum.accumulate(timestamps if ends is None else np.asarray(ends, dtype=np.float64))
+    breaks = np.flatnonzero(timestamps[1:] > ends[:-1] + max_gap)
+    starts = timestamps[np.r_[0, breaks + 1]]
+    ends = ends[np.r_[breaks, len(timestamps) - 1]]
+    return zip(starts.tolist(), ends.tolist())
+
+
+def _reduce_windows(ufunc, values, lo, hi):
+    """Apply reducing *ufunc* to values[lo[i]:hi[i]] for each i (all windows non-empty)."""
+    # Interleave window starts and ends so that every second reduceat result is a window
+    padded = np.r_[values, values[-1:]]
+    indices = np.empty(2 * len(lo), dtype=np.intp)
+    indices[0::2], indices[1::2] = lo, hi
+    return ufunc.reduceat(padded, indices)[0::2]
+
+
+class SensorStore(object):
+    """Store of sensor histories as chunked, compressed and time-sorted arrays.
+
+    Parameters
+    ----------
+    filename : string
+        Name of HDF5 file containing store (created if it does not exist)
+    mode : {'a', 'r'}, optional
+        Open store for reading and appending ('a') or read-only ('r')
+    chunk_size : int, optional
+        Number of samples per chunk of newly created sensors
+    compression : string or None, optional
+        HDF5 compression filter of newly created sensors
+
+    """
+    def __init__(self, filename, mode='a', chunk_size=65536, compression='gzip'):
+        self.filename = filename
+        self.file = h5py.File(filename, mode)
+        self.chunk_size = chunk_size
+        self.compression = compression
+        # Index of first timestamp of each chunk, per sensor (loaded on demand)
+        self._chunk_starts = {}
+
+    def close(self):
+        """Close store."""
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        # Don't suppress exceptions
+        return False
+
+    def names(self):
+        """Sorted names of sensors in store."""
+        names = []
+        self.file.visititems(lambda name, obj: names.append(name) if 'columns' in obj.attrs else None)
+        return sorted(names)
+
+    def __contains__(self, name):
+        return name in self.file and 'columns' in self.file[name].attrs
+
+    def __len__(self):
+        return len(self.names())
+
+    def num_samples(self, name):
+        """Number of samples of sensor."""
+        return len(self.file[name]['timestamp'])
+
+    def time_range(self, name):
+        """First and last timestamp of sensor (None if it has no samples)."""
+        timestamps = self.file[name]['timestamp']
+        return (timestamps[0], timestamps[-1]) if len(timestamps) else None
+
+    def _chunk_index(self, name):
+        """First timestamp of each chunk of sensor (cached)."""
+        if name not in self._chunk_starts:
+            group = self.file[name]
+            self._chunk_starts[name] = group['chunk_start'][:]
+        return self._chunk_starts[name]
+
+    def _chunk_size(self, name):
+        """Number of samples per chunk of sensor."""
+        return self.file[name]['timestamp'].chunks[0]
+
+    def _create(self, name, dtype):
+        """Create empty sensor with values of given type."""
+        group = self.file.create_group(name)
+        group.attrs['columns'] = ['timestamp', 'value']
+        for column, column_dtype in (('timestamp', np.float64), ('value', dtype)):
+            group.create_dataset(column, shape=(0,), maxshape=(None,), dtype=column_dtype,
+                                 chunks=(self.chunk_size,), compression=self.compression, shuffle=True)
+        group.create_dataset('chunk_start', shape=(0,), maxshape=(None,), dtype=np.float64, chunks=True)
+        return group
+
+    def append(self, name, timestamps, values):
+        """Add samples to sensor, creating it if necessary.
+
+        Samples may arrive in any order and may overlap with stored data:
+        they are merged into the stored samples, with new values replacing
+        stored values at identical timestamps. Data before the earliest new
+        sample is not touched, so appending in time order is cheap.
+
+        Parameters
+        ----------
+        name : string
+            Sensor name (may contain '/' to group sensors)
+        timestamps : array of float, shape (N,)
+            Sample times, in UTC seconds since Unix epoch
+        values : array, shape (N,)
+            Sample values (numeric, or strings for discrete sensors)
+
+        Returns
+        -------
+        num_samples : int
+            Number of samples of sensor after the merge
+
+        """
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        values = np.asarray(values)
+        if timestamps.shape != values.shape or timestamps.ndim != 1:
+            raise ValueError('Sensor %r needs equal-length 1-D timestamps and values (got shapes %s and %s)'
+                             % (name, timestamps.shape, values.shape))
+        if name not in self:
+            discrete = values.dtype.kind == 'S'
+            self._create(name, 'S%d' % (max(values.dtype.itemsize, 32),) if discrete else np.float64)
+        group = self.file[name]
+        if len(timestamps) == 0:
+            return self.num_samples(name)
+        stored_ts, stored_values = group['timestamp'], group['value']
+        if stored_values.dtype.kind == 'S':
+            if values.dtype.kind == 'S' and np.char.str_len(values).max() > stored_values.dtype.itemsize:
+                raise ValueError('Values of sensor %r are longer than the %d characters it can store'
+                                 % (name, stored_values.dtype.itemsize))
+            values = values.astype(stored_values.dtype)
+        chunk_size = self._chunk_size(name)
+        order = np.argsort(timestamps, kind='mergesort')
+        timestamps, values = timestamps[order], values[order]
+        # Merge with stored samples from the first chunk that could be affected
+        num_stored = len(stored_ts)
+        chunk_starts = self._chunk_index(name)
+        first_chunk = max(np.searchsorted(chunk_starts, timestamps[0], side='right') - 1, 0)
+        start = first_chunk * chunk_size if num_stored and stored_ts[-1] >= timestamps[0] else num_stored
+        if start < num_stored:
+            old_ts, old_values = stored_ts[start:], stored_values[start:]
+            keep = old_ts >= timestamps[0]
+            start += np.argmax(keep) if keep.any() else len(keep)
+            old_ts, old_values = old_ts[keep], old_values[keep]
+            merged_ts = np.r_[old_ts, timestamps]
+            merged_values = np.r_[old_values, values]
+            order = np.argsort(merged_ts, kind='mergesort')
+            timestamps, values = merged_ts[order], merged_values[order]
+        # Later samples win at identical timestamps (mergesort is stable, so new samples come last)
+        last = np.r_[timestamps[1:] != timestamps[:-1], True]
+        timestamps, values = timestamps[last], values[last]
+        total = start + len(timestamps)
+        stored_ts.resize((total,))
+        stored_values.resize((total,))
+        stored_ts[start:] = timestamps
+        stored_values[start:] = values
+        # Update index entries of chunks starting in the rewritten part
+        num_chunks = (total + chunk_size - 1) // chunk_size
+        first_new = (start + chunk_size - 1) // chunk_size
+        chunk_starts = np.r_[chunk_starts[:first_new],
+                             timestamps[np.arange(first_new, num_chunks) * chunk_size - start]]
+        group['chunk_start'].resize((num_chunks,))
+        group['chunk_start'][:] = chunk_starts
+        self._chunk_starts[name] = chunk_starts
+        return total
+
+    def _sample_range(self, name, start, end):
+        """Index range of samples of sensor with start <= timestamp <= end."""
+        timestamps = self.file[name]['timestamp']
+        num_samples = len(timestamps)
+        if num_samples == 0:
+            return 0, 0
+        chunk_starts, chunk_size = self._chunk_index(name), self._chunk_size(name)
+        lo = 0
+        if start is not None:
+            # Binary search on chunk index, then within the relevant chunk only
+            chunk = max(np.searchsorted(chunk_starts, start, side='left') - 1, 0)
+            offset = chunk * chunk_size
+            lo = offset + np.searchsorted(timestamps[offset:offset + 2 * chunk_size], start, side='left')
+        hi = num_samples
+        if end is not None:
+            chunk = max(np.searchsorted(chunk_starts, end, side='right') - 1, 0)
+            offset = chunk * chunk_size
+            hi = offset + np.searchsorted(timestamps[offset:offset + chunk_size], end, side='right')
+        return lo, max(lo, hi)
+
+    def get(self, name, start=None, end=None):
+        """Samples of sensor in time range.
+
+        Parameters
+        ----------
+        name : string
+            Sensor name
+        start, end : float or None, optional
+            Time range (inclusive), in UTC seconds (None for no limit)
+
+        Returns
+        -------
+        timestamps : array of float, shape (N,)
+            Sorted sample times
+        values : array, shape (N,)
+            Sample values
+
+        """
+        lo, hi = self._sample_range(name, start, end)
+        group = self.file[name]
+        return group['timestamp'][lo:hi], group['value'][lo:hi]
+
+    def coverage(self, name, max_gap=300.0, start=None, end=None):
+        """Intervals of data coverage of sensor (see :func:`coverage_intervals`)."""
+        lo, hi = self._sample_range(name, start, end)
+        return coverage_intervals(self.file[name]['timestamp'][lo:hi], max_gap)
+
+    def resample(self, name, start, end, period, how='mean'):
+        """Aggregate samples of numeric sensor in bins of a regular time grid.
+
+        Parameters
+        ----------
+        name : string
+            Sensor name
+        start, end : float
+            Time range, in UTC seconds
+        period : float
+            Width of bins, in seconds
+        how : {'mean', 'min', 'max', 'sum', 'count', 'last'}, optional
+            Aggregate of samples in each bin
+
+        Returns
+        -------
+        timestamps : array of float, shape (M,)
+            Start time of each bin
+        values : array of float, shape (M,)
+            Aggregate of each bin (NaN for empty bins, except for 'count' and 'sum')
+
+        """
+        edges = start + period * np.arange(int(np.ceil((end - start) / period)) + 1)
+        timestamps, values = self.get(name, start, end)
+        values = values.astype(np.float64)
+        # Samples are sorted, so each bin is a contiguous range of samples
+        bounds = np.searchsorted(timestamps, edges, side='left')
+        lo, hi = bounds[:-1], bounds[1:]
+        count = hi - lo
+        if how == 'count':
+            return edges[:-1], count.astype(np.float64)
+        result = np.full(len(lo), 0.0 if how == 'sum' else np.nan)
+        full = count > 0
+        if how in ('mean', 'sum'):
+            sums = np.r_[0.0, np.cumsum(values)]
+            result[full] = sums[hi[full]] - sums[lo[full]]
+            if how == 'mean':
+                result[full] /= count[full]
+        elif how in ('min', 'max'):
+            if full.any():
+                result[full] = _reduce_windows(np.minimum if how == 'min' else np.maximum,
+                                               values, lo[full], hi[full])
+        elif how == 'last':
+            result[full] = values[hi[full] - 1]
+        else:
+            raise ValueError("Unknown aggregate %r (should be 'mean', 'min', 'max', 'sum', 'count' or 'last')"
+                             % (how,))
+        return edges[:-1], result
+
+    def rolling(self, name, window, start=None, end=None, how='mean'):
+        """Aggregate of numeric sensor over trailing time window at each sample.
+
+        Parameters
+        ----------
+        name : string
+            Sensor name
+        window : float
+            Length of window ending at each sample (inclusive), in seconds
+        start, end : float or None, optional
+            Time range of output samples, in UTC seconds (earlier samples
+            within *window* of *start* are used to fill the first windows)
+        how : {'mean', 'std', 'min', 'max', 'count'}, optional
+            Aggregate of samples in each window
+
+        Returns
+        -------
+        timestamps : array of float, shape (N,)
+            Sample times
+        values : array of float, shape (N,)
+            Rolling aggregate at each sample
+
+        """
+        timestamps, values = self.get(name, None if start is None else start - window, end)
+        values = values.astype(np.float64)
+        first = 0 if start is None else np.searchsorted(timestamps, start, side='left')
+        hi = np.arange(first + 1, len(timestamps) + 1)
+        lo = np.searchsorted(timestamps, timestamps[first:] - window, side='left')
+        count = hi - lo
+        if how == 'count':
+            result = count.astype(np.float64)
+        elif how in ('mean', 'std'):
+            # Remove overall mean first to limit round-off in cumulative sums
+            offset = values.mean() if len(values) else 0.0
+            sums = np.r_[0.0, np.cumsum(values - offset)]
+            mean = (sums[hi] - sums[lo]) / count
+            if how == 'mean':
+                result = mean + offset
+            else:
+                sums_sq = np.r_[0.0, np.cumsum((values - offset) ** 2)]
+                result = np.sqrt(np.maximum((sums_sq[hi] - sums_sq[lo]) / count - mean ** 2, 0.0))
+        elif how in ('min', 'max'):
+            result = _reduce_windows(np.minimum if how == 'min' else np.maximum, values, lo, hi)
+        else:
+            raise ValueError("Unknown aggregate %r (should be 'mean', 'std', 'min', 'max' or 'count')" % (how,))
+        return timestamps[first:], result
+
+
+def _numeric(values):
+    """Convert sensor values to floats if possible, else return None."""
+    try:
+        return np.asarray(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        return None
+
+
+def import_h5_sensors(store, filename, sensors=None):
+    """Import numeric sensor histories from version 2 (KAT-7) HDF5 file into store.
+
+    Parameters
+    ----------
+    store : :class:`SensorStore` object
+        Destination store
+    filename : string
+        Name of HDF5 file
+    sensors : sequence of string, optional
+        Names of sensors relative to 'MetaData/Sensors' (e.g.
+        'Enviro/asc.air.temperature'), default all numeric sensors
+
+    Returns
+    -------
+    imported : list of string
+        Names of sensors that were imported
+    skipped : list of string
+        Names of requested sensors that are missing or not numeric
+
+    """
+    imported, skipped = [], []
+    with h5py.File(filename, 'r') as f:
+        group = f['MetaData/Sensors']
+        if sensors is None:
+            sensors = []
+            group.visititems(lambda name, obj: sensors.append(name) if isinstance(obj, h5py.Dataset) else None)
+        for name in sensors:
+            data = group[name][:] if name in group else None
+            values = _numeric(data['value']) if data is not None else None
+            if values is None:
+                skipped.append(name)
+                continue
+            store.append(name, data['timestamp'], values)
+            imported.append(name)
+    return imported, skipped
+
+
+def import_csv_sensor(store, filename, name=None, time_column=0, value_column=-1):
+    """Import sensor history exported from monitoring store as CSV file.
+
+    Lines that do not start with a numeric timestamp (headers and comments)
+    are ignored. Timestamps in milliseconds are converted to seconds.
+
+    Parameters
+    ----------
+    store : :class:`SensorStore` object
+        Destination store
+    filename : string
+        Name of CSV file
+    name : string, optional
+        Name of sensor in store (default is file name without extension)
+    time_column, value_column : int, optional
+        Columns of timestamp and value
+
+    Returns
+    -------
+    num_samples : int
+        Number of samples imported
+
+    """
+    name = name or os.path.splitext(os.path.basename(filename))[0]
+    timestamps, values = [], []
+    with open(filename, 'rb') as f:
+        for row in csv.reader(f, skipinitialspace=True):
+            try:
+                timestamp = float(row[time_column])
+                value = row[value_column].strip()
+            except (IndexError, ValueError):
+                continue
+            timestamps.append(timestamp)
+            values.append(value)
+    timestamps = np.array(timestamps)
+    # Monitoring store exports use milliseconds (anything after 5138 AD in seconds must be that)
+    if len(timestamps) and timestamps.max() > 1e11:
+        timestamps /= 1000.
+    numeric = _numeric(values)
+    store.append(name, timestamps, numeric if numeric is not None else np.array(values, dtype=np.str_))
+    return len(timestamps)
@@ -0,0 +1,173 @@
+###############################################################################
+# SKA South Africa (http://ska.ac.za/)                                        #
+# Author: cam@ska.ac.za                                                       #
+# Copyright @ 2013 SKA SA. All rights reserved.                               #
+#                                                                             #
+# THIS SOFTWARE MAY NOT BE COPIED OR DISTRIBUTED IN ANY FORM WITHOUT THE      #
+# WRITTEN PERMISSION OF SKA SA.                                               #
+###############################################################################
+"""Event-driven monitoring of antenna safety state for observation scripts.
+
+Scripts that step antennas through a pattern one request at a time need to
+stop when any antenna is stowed (e.g. due to wind). Instead of polling the
+mode sensor of every antenna on every step, a :class:`SafetyMonitor`
+subscribes once to the relevant sensors with an event strategy and keeps the
+combined state up to date from the sensor callbacks. Checking the state in the
+scanning loop then costs an attribute lookup, and :meth:`SafetyMonitor.check`
+interrupts the loop by raising :exc:`SafetyInterrupt` when it becomes unsafe.
+
+Typical use::
+
+    with SafetyMonitor(session.ants, enabled=not kat.dry_run) as safety:
+        try:
+            for x, y in pattern:
+                session.ants.req.offset_fixed(x, y, opts.projection)
+                safety.check()
+        except SafetyInterrupt, e:
+            user_logger.info("Scan interrupted: %s" % (e,))
+            safety.wait_until_safe(timeout=600)
+
+"""
+
+import threading
+import time
+
+# Sensor values that make an antenna unsafe to use, per sensor
+UNSAFE_VALUES = {'mode': ('STOW', 'ERROR'), 'activity': ('wind_stow', 'stow', 'error')}
+# Sensors that are tracked without affecting safety
+TRACKED_SENSORS = ('lock',)
+
+
+class SafetyInterrupt(Exception):
+    """Antennas became unsafe to use while executing a script."""
+
+
+def _is_true(value):
+    """Interpret boolean sensor value, which may be a string from the KATCP inform."""
+    return value in (True, 1, '1', 'True', 'true')
+
+
+class SafetyMonitor(object):
+    """Track mode, wind stow and lock state of a group of antennas.
+
+    Parameters
+    ----------
+    ants : :class:`ClientGroup` object or sequence of clients
+        Antennas to monitor (each needs a *sensor* attribute with sensors
+        supporting *set_strategy*, as on KATClient / FakeClient objects)
+    unsafe_values : dict mapping string to sequence, optional
+        Sensor values that make an antenna unsafe, per sensor name (sensors
+        not present on an antenna are ignored)
+    enabled : {True, False}, optional
+        False to disable monitoring, e.g. for dry runs (never unsafe then)
+
+    """
+    def __init__(self, ants, unsafe_values=None, enabled=True):
+        self.ants = list(ants)
+        self.unsafe_values = UNSAFE_VALUES if unsafe_values is None else unsafe_values
+        self.enabled = enabled
+        self.values = {}
+        self.locked = {}
+        self.reasons = {}
+        self.changes = 0
+        self.unsafe = False
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._listeners = []
+
+    def __enter__(self):
+        """Start monitoring on entering context."""
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Stop monitoring on leaving context."""
+        self.stop()
+        # Don't suppress exceptions
+        return False
+
+    def start(self):
+        """Subscribe to the relevant sensors on all antennas (once)."""
+        if not self.enabled or self._listeners:
+            return
+        for ant in self.ants:
+            for sensor_name in list(self.unsafe_values) + list(TRACKED_SENSORS):
+                sensor = getattr(ant.sensor, sensor_name, None)
+                if not sensor:
+                    continue
+                sensor.set_strategy('event')
+                listener = self._make_listener(ant.name, sensor_name)
+                sensor.register_listener(listener)
+                self._listeners.append((sensor, listener))
+                self._update(ant.name, sensor_name, sensor.get_value())
+
+    def stop(self):
+        """Unsubscribe from all sensors."""
+        for sensor, listener in self._listeners:
+            sensor.unregister_listener(listener)
+        self._listeners = []
+
+    def _make_listener(self, ant_name, sensor_name):
+        """Sensor callback that updates the state of *sensor_name* on *ant_name*."""
+        def listener(update_seconds, value_seconds, status, value):
+            self._update(ant_name, sensor_name, value)
+        return listener
+
+    def _update(self, ant_name, sensor_name, value):
+        """Update state with new sensor value and notify waiting scripts of changes."""
+        with self._lock:
+            if sensor_name in TRACKED_SENSORS:
+                self.locked[ant_name] = _is_true(value)
+                return
+            if self.values.get((ant_name, sensor_name)) == value:
+                return
+            self.values[ant_name, sensor_name] = value
+            if value in self.unsafe_values[sensor_name]:
+                self.reasons[ant_name, sensor_name] = "%s %s is %r" % (ant_name, sensor_name, value)
+            else:
+                self.reasons.pop((ant_name, sensor_name), None)
+            unsafe = bool(self.reasons)
+            if unsafe != self.unsafe:
+                self.unsafe = unsafe
+                self.changes += 1
+                self._changed.notify_all()
+
+    @property
+    def reason(self):
+        """Description of why antennas are unsafe (empty string if safe)."""
+        with self._lock:
+            return ', '.join(sorted(self.reasons.values()))
+
+    @property
+    def unlocked_ants(self):
+        """Names of antennas not locked on target."""
+        with self._lock:
+            return sorted(name for name, locked in self.locked.items() if not locked)
+
+    def check(self):
+        """Raise :exc:`SafetyInterrupt` if any antenna is unsafe to use."""
+        if self.unsafe:
+            raise SafetyInterrupt(self.reason)
+
+    def wait_until_safe(self, timeout=None):
+        """Wait until all antennas are safe to use.
+
+        Parameters
+        ----------
+        timeout : float or None, optional
+            Maximum time to wait, in seconds (None waits indefinitely)
+
+        Returns
+        -------
+        safe : bool
+            True if all antennas are safe to use
+
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while self.unsafe:
+                remaining = 1.0 if deadline is None else min(deadline - time.time(), 1.0)
+                if remaining <= 0.0:
+                    break
+                self._changed.wait(remaining)
+            return not self.unsafe
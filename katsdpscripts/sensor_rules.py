@@ -0,0 +1,330 @@
+###############################################################################
+# SKA South Africa (http://ska.ac.za/)                                        #
+# Author: cam@ska.ac.za                                                       #
+# Copyright @ 2013 SKA SA. All rights reserved.                               #
+#                                                                             #
+# THIS SOFTWARE MAY NOT BE COPIED OR DISTRIBUTED IN ANY FORM WITHOUT THE      #
+# WRITTEN PERMISSION OF SKA SA.                                               #
+###############################################################################
+"""Compiled sensor rules for health checks.
+
+Health check scripts describe their expected sensor values as a list of
+tuples of the form ``(checker, min_val, max_val, m, n)`` where *checker* is an
+expression like ``"kat.ant1.sensor.mode.get_value()"``, *min_val* and
+*max_val* give the allowed range (or *min_val* is a list of allowed string
+options and *max_val* is blank) and the alarm is raised if the sensor is in
+error in *m* out of the last *n* checks. Blank tuples are used for spacing.
+
+A :class:`RuleSet` parses and validates these tuples once, resolves the sensor
+objects once and then checks all sensor readings in a single vectorised pass,
+instead of evaluating each checker string on every cycle. The m-of-n alarm
+state is kept in :class:`AlarmWindows`, a set of ring buffers. Since the rules
+only need values and statuses, they can also be replayed offline against
+recorded sensor histories via :meth:`RuleSet.replay`.
+
+"""
+
+import re
+
+import numpy as np
+
+# Sensor statuses that always indicate a problem
+SENSOR_STATUS_ERRORS = ('unreachable', 'failure', 'error', 'unknown')
+# Form of a checker expression, e.g. "kat.ant1.sensor.mode.get_value()"
+CHECKER_PATTERN = re.compile(r'^kat((?:\.[A-Za-z_]\w*)+)\.get_value\(\)$')
+
+
+def _is_blank(rule):
+    """True if sensor rule tuple is a blank spacer line."""
+    return str(rule[0]).strip() == ''
+
+
+def _to_float(value):
+    """Convert sensor value to float, or NaN if it is missing / not numeric."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class SensorRule(object):
+    """Single parsed and validated sensor check.
+
+    Parameters
+    ----------
+    checker : string
+        Expression of the form "kat.<object>...<sensor>.get_value()"
+    min_val : float or list of strings
+        Minimum allowed value, or list of allowed (string) values
+    max_val : float or string
+        Maximum allowed value (ignored if *min_val* is a list of options)
+    m, n : int
+        Alarm is raised if check fails in *m* of the last *n* checks
+
+    Raises
+    ------
+    ValueError
+        If the rule is malformed
+
+    """
+    def __init__(self, checker, min_val, max_val, m, n):
+        self.checker = checker = checker.strip()
+        match = CHECKER_PATTERN.match(checker)
+        if not match:
+            raise ValueError("Sensor rule %r is not of the form "
+                             "'kat.<object>.sensor.<name>.get_value()'" % (checker,))
+        self.path = tuple(match.group(1).split('.')[1:])
+        self.min_val, self.max_val = min_val, max_val
+        if isinstance(min_val, (list, tuple)):
+            self.options = frozenset(str(option) for option in min_val)
+            if not self.options:
+                raise ValueError("Sensor rule %r has an empty list of options" % (checker,))
+            self.low = self.high = np.nan
+        else:
+            self.options = None
+            try:
+                self.low, self.high = float(min_val), float(max_val)
+            except (TypeError, ValueError):
+                raise ValueError("Sensor rule %r has non-numeric range (%r, %r)" %
+                                 (checker, min_val, max_val))
+            if self.low > self.high:
+                raise ValueError("Sensor rule %r has min %r > max %r" % (checker, min_val, max_val))
+        try:
+            self.m, self.n = int(m), int(n)
+        except (TypeError, ValueError):
+            raise ValueError("Sensor rule %r has non-integer m-of-n (%r, %r)" % (checker, m, n))
+        if not 1 <= self.m <= self.n:
+            raise ValueError("Sensor rule %r needs 1 <= m <= n, got m=%d, n=%d" %
+                             (checker, self.m, self.n))
+
+    def __repr__(self):
+        return "<SensorRule %r [%r, %r] %d/%d>" % (self.checker, self.min_val,
+                                                   self.max_val, self.m, self.n)
+
+    def resolve(self, kat):
+        """Look up sensor object referred to by this rule on *kat* object."""
+        obj = kat
+        for attr in self.path:
+            obj = getattr(obj, attr)
+        return obj
+
+
+class AlarmWindows(object):
+    """Ring buffers tracking m-of-n alarm state for a number of rules.
+
+    Parameters
+    ----------
+    m, n : sequence of int, length *N*
+        Each alarm is raised when its check fails in m of the last n updates
+
+    """
+    def __init__(self, m, n):
+        self.m = np.asarray(m, dtype=int)
+        self.n = np.asarray(n, dtype=int)
+        self._rows = np.arange(len(self.m))
+        self.reset()
+
+    def reset(self):
+        """Clear all alarms and forget past checks."""
+        width = self.n.max() if len(self.n) else 1
+        self.failures = np.zeros((len(self.m), width), dtype=bool)
+        self.counts = np.zeros(len(self.m), dtype=int)
+        self.active = np.zeros(len(self.m), dtype=bool)
+        self.updates = 0
+
+    def update(self, failed):
+        """Add the latest check results to the windows.
+
+        Parameters
+        ----------
+        failed : array of bool, shape (N,)
+            True for each rule whose check failed in this cycle
+
+        Returns
+        -------
+        raised, cleared : array of bool, shape (N,)
+            Alarms that became active / inactive in this cycle
+
+        """
+        failed = np.asarray(failed, dtype=bool)
+        slot = self.updates % self.n
+        self.counts += failed.astype(int) - self.failures[self._rows, slot]
+        self.failures[self._rows, slot] = failed
+        self.updates += 1
+        active = self.counts >= self.m
+        raised, cleared = active & ~self.active, ~active & self.active
+        self.active = active
+        return raised, cleared
+
+
+class RuleSet(object):
+    """Collection of sensor rules compiled into arrays for fast checking.
+
+    Parameters
+    ----------
+    sensor_rules : sequence of tuples
+        Tuples of (checker, min_val, max_val, m, n), with blank tuples
+        (checker of '') marking spacer lines in the output
+
+    Raises
+    ------
+    ValueError
+        If any of the rules is malformed (all problems are reported at once)
+
+    """
+    def __init__(self, sensor_rules):
+        self.rules, self.layout, problems = [], [], []
+        for rule in sensor_rules:
+            if _is_blank(rule):
+                self.layout.append(None)
+                continue
+            try:
+                self.rules.append(SensorRule(*rule))
+            except (TypeError, ValueError), e:
+                problems.append(str(e))
+            else:
+                self.layout.append(len(self.rules) - 1)
+        if problems:
+            raise ValueError('Invalid sensor rules:\n' + '\n'.join(problems))
+        self.low = np.array([rule.low for rule in self.rules])
+        self.high = np.array([rule.high for rule in self.rules])
+        self.is_range = np.array([rule.options is None for rule in self.rules], dtype=bool)
+        self._option_rules = [(index, rule.options) for index, rule in enumerate(self.rules)
+                              if rule.options is not None]
+        self.sensors = [None] * len(self.rules)
+        self.errors = [None] * len(self.rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __getitem__(self, index):
+        return self.rules[index]
+
+    def resolve(self, kat):
+        """Look up all sensor objects on *kat* object once.
+
+        Rules whose sensors cannot be found are marked as unresolved, with
+        the reason stored in :attr:`errors`.
+
+        Returns
+        -------
+        resolved : array of bool, shape (N,)
+            True for each rule with a valid sensor object
+
+        """
+        for index, rule in enumerate(self.rules):
+            try:
+                self.sensors[index], self.errors[index] = rule.resolve(kat), None
+            except AttributeError, e:
+                self.sensors[index], self.errors[index] = None, str(e)
+        return np.array([sensor is not None for sensor in self.sensors], dtype=bool)
+
+    def read(self):
+        """Read current values and statuses of all resolved sensors.
+
+        Returns
+        -------
+        values : list of objects, length N
+            Sensor values (None for unresolved / unreadable sensors)
+        statuses : array of string, shape (N,)
+            Sensor statuses ('unknown' for unresolved / unreadable sensors)
+
+        """
+        values, statuses = [], []
+        for index, sensor in enumerate(self.sensors):
+            value, status = None, 'unknown'
+            if sensor is not None:
+                try:
+                    value, status = sensor.get_value(), str(sensor.status)
+                    self.errors[index] = None
+                except Exception, e:
+                    self.errors[index] = str(e)
+            values.append(value)
+            statuses.append(status)
+        return values, np.array(statuses, dtype=str)
+
+    def evaluate(self, values, statuses, warn_is_error=False):
+        """Check sensor readings against all rules in one pass.
+
+        Parameters
+        ----------
+        values : sequence of objects, length N
+            Sensor values, with None indicating a missing value
+        statuses : sequence of string, length N
+            Sensor statuses
+        warn_is_error : {False, True}, optional
+            True if a 'warn' status should also fail the check
+
+        Returns
+        -------
+        ok : array of bool, shape (N,)
+            True for each sensor that passes its check
+
+        """
+        statuses = np.asarray(statuses, dtype=str)
+        numbers = np.array([_to_float(value) for value in values])
+        with np.errstate(invalid='ignore'):
+            ok = (numbers >= self.low) & (numbers <= self.high)
+        for index, options in self._option_rules:
+            ok[index] = values[index] is not None and str(values[index]) in options
+        ok &= ~np.in1d(statuses, SENSOR_STATUS_ERRORS)
+        if warn_is_error:
+            ok &= (statuses != 'warn')
+        return ok
+
+    def alarm_windows(self):
+        """Fresh set of m-of-n alarm ring buffers matching these rules."""
+        return AlarmWindows([rule.m for rule in self.rules], [rule.n for rule in self.rules])
+
+    def replay(self, values, statuses=None, warn_is_error=False):
+        """Run rules offline over recorded sensor histories.
+
+        Parameters
+        ----------
+        values : dict or sequence
+            Either a dict mapping checker string to a sequence of recorded
+            values (one per check cycle), or a sequence of cycles, each being
+            a sequence of N values in rule order
+        statuses : dict or sequence, optional
+            Recorded statuses in the same form as *values* (default is
+            'nominal' for all values that are not None)
+        warn_is_error : {False, True}, optional
+            True if a 'warn' status should also fail the check
+
+        Returns
+        -------
+        ok : array of bool, shape (T, N)
+            Result of each check per cycle
+        active : array of bool, shape (T, N)
+            State of each m-of-n alarm after each cycle
+
+        """
+        values = self._cycles(values)
+        if statuses is None:
+            statuses = [['unknown' if value is None else 'nominal' for value in cycle]
+                        for cycle in values]
+        else:
+            statuses = self._cycles(statuses)
+        if len(statuses) != len(values):
+            raise ValueError('Recorded values and statuses have different lengths (%d vs %d)' %
+                             (len(values), len(statuses)))
+        alarms = self.alarm_windows()
+        ok = np.zeros((len(values), len(self.rules)), dtype=bool)
+        active = np.zeros_like(ok)
+        for cycle, (cycle_values, cycle_statuses) in enumerate(zip(values, statuses)):
+            ok[cycle] = self.evaluate(cycle_values, cycle_statuses, warn_is_error)
+            alarms.update(~ok[cycle])
+            active[cycle] = alarms.active
+        return ok, active
+
+    def _cycles(self, history):
+        """Turn history (dict of per-rule sequences or sequence of cycles) into list of cycles."""
+        if not isinstance(history, dict):
+            return [list(cycle) for cycle in history]
+        missing = [rule.checker for rule in self.rules if rule.checker not in history]
+        if missing:
+            raise KeyError('No recorded history for sensor rules %s' % (missing,))
+        lengths = set(len(history[rule.checker]) for rule in self.rules)
+        if len(lengths) > 1:
+            raise ValueError('Recorded sensor histories differ in length: %s' % (sorted(lengths),))
+        return [list(cycle) for cycle in zip(*[history[rule.checker] for rule in self.rules])]
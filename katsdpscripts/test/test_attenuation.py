@@ -0,0 +1,125 @@
+import unittest
+import os.path
+
+import numpy as np
+
+from katsdpscripts.fake.telescope import FakeTelescope
+from katsdpscripts.attenuation import AttenuatorInput, PowerSampler, adjust_attenuation, quantise_attenuation
+
+
+CONFIG = os.path.join(os.path.dirname(__file__), os.path.pardir, 'fake', 'rf_chain_model.cfg')
+INPUTS = ['ant1h', 'ant1v', 'ant2h', 'ant2v']
+
+
+class SilencedSensor(object):
+    """Sensor wrapper that stops reporting values once *silent* is set."""
+    def __init__(self, sensor):
+        self.sensor = sensor
+        self.silent = False
+        self._wrappers = {}
+
+    def __getattr__(self, name):
+        return getattr(self.sensor, name)
+
+    def get_value(self):
+        return None if self.silent else self.sensor.get_value()
+
+    def register_listener(self, listener):
+        def wrapper(*args):
+            if not self.silent:
+                listener(*args)
+        self._wrappers[listener] = wrapper
+        self.sensor.register_listener(wrapper)
+
+    def unregister_listener(self, listener):
+        self.sensor.unregister_listener(self._wrappers.pop(listener))
+
+
+class SensorClient(object):
+    """Client with the requests of *client* and the given sensors."""
+    def __init__(self, client, **sensors):
+        self.req = client.req
+        self.sensor = type('Sensors', (object,), sensors)()
+
+
+class TestAdjustAttenuation(unittest.TestCase):
+    def setUp(self):
+        self.kat = FakeTelescope(CONFIG)
+        self.kat.dry_run = True
+        self.rfc = self.kat.rfc
+
+    def tearDown(self):
+        self.kat.updater.stop()
+        self.kat.updater.join()
+
+    def stage_inputs(self, stage, power):
+        set_att = lambda inp: lambda value: getattr(self.rfc.req, stage + '_attenuation')(inp, value)
+        return [AttenuatorInput(inp, (self.rfc, '%s_attenuation_%s' % (stage, inp)), set_att(inp),
+                                (self.rfc, '%s_%s' % (power, inp))) for inp in INPUTS]
+
+    def test_sampler(self):
+        """Sampler should collect sample streams of all sensors and discard them on request."""
+        sensors = [(self.rfc, 'adc_power_' + inp) for inp in INPUTS]
+        self.rfc.req.sensor_sampling('adc_power_ant1v', 'event')
+        with PowerSampler(sensors, 'period', 0.05) as sampler:
+            self.assertEqual([getattr(self.rfc.sensor, name).strategy for client, name in sensors], ['period'] * 4)
+            self.assertTrue(sampler.wait(10, timeout=5.0, clock=self.kat))
+            np.testing.assert_allclose(sampler.medians(), [-20., -23., -40., -5.], atol=0.3)
+        # Previous sensor strategies should be restored
+        self.assertEqual([getattr(self.rfc.sensor, name).strategy for client, name in sensors],
+                         ['none', 'event', 'none', 'none'])
+        counts = sampler.counts
+        self.kat.sleep(1.0)
+        np.testing.assert_array_equal(sampler.counts, counts)
+        sampler.clear([1])
+        np.testing.assert_array_equal(sampler.counts, [counts[0], 0, counts[2], counts[3]])
+        # Fall back to current sensor value if there are no samples
+        self.assertAlmostEqual(sampler.medians([1])[0], -23., delta=1.)
+
+    def test_adjust(self):
+        """Inputs should be adjusted concurrently, stopping once in range or out of attenuation."""
+        att, power, success = adjust_attenuation(self.stage_inputs('rfe7', 'adc_power'), -26.0,
+                                                 0.0, 31.5, 0.5, clock=self.kat)
+        np.testing.assert_array_equal(success, [True, True, False, True])
+        np.testing.assert_allclose(att, [6.0, 3.0, 0.0, 21.0], atol=0.5)
+        self.assertTrue(np.all(np.abs(power[success] + 26.0) <= 1.0))
+        # Input that ran out of RFE7 attenuation is not adjustable via RFE5 either (already at minimum)
+        att, power, success = adjust_attenuation(self.stage_inputs('rfe5', 'adc_power'), -26.0,
+                                                 0.0, 63.5, 0.5, clock=self.kat)
+        np.testing.assert_array_equal(success, [True, True, False, True])
+        np.testing.assert_array_equal(att, [0.0, 0.0, 0.0, 0.0])
+
+    def test_silent_sensor(self):
+        """Inputs whose power sensor goes silent after an adjustment should not be adjusted further."""
+        inputs = self.stage_inputs('rfe7', 'adc_power')
+        sensor = SilencedSensor(self.rfc.sensor.adc_power_ant2v)
+        inputs[3].power_sensor = (SensorClient(self.rfc, adc_power_ant2v=sensor), 'adc_power_ant2v')
+        requested = []
+        set_att = inputs[3].set_att
+
+        def set_att_and_silence(value):
+            requested.append(value)
+            set_att(value)
+            sensor.silent = True
+        inputs[3].set_att = set_att_and_silence
+        att, power, success = adjust_attenuation(inputs, -26.0, 0.0, 31.5, 0.5, timeout=1.0, clock=self.kat)
+        self.assertEqual(len(requested), 1)
+        self.assertFalse(np.isnan(requested).any())
+        self.assertTrue(np.isnan(power[3]))
+        np.testing.assert_array_equal(success, [True, True, False, False])
+        np.testing.assert_allclose(att[:2], [6.0, 3.0], atol=0.5)
+
+    def test_rfe5(self):
+        """RFE5 output power should be reached in range of attenuator."""
+        att, power, success = adjust_attenuation(self.stage_inputs('rfe5', 'rfe5_power_out'), -47.0,
+                                                 0.0, 63.5, 0.5, clock=self.kat)
+        self.assertTrue(success[[0, 1, 3]].all())
+        np.testing.assert_allclose(att, [12.0, 9.0, 0.0, 27.0], atol=0.5)
+
+    def test_quantise(self):
+        """Attenuation should be rounded to allowed steps within range."""
+        np.testing.assert_array_equal(quantise_attenuation([-3., 1.26, 70.], 0.0, 63.5, 0.5), [0., 1.5, 63.5])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+
+import numpy as np
+
+from katsdpscripts.reduction.binned_moments import BinnedMoments
+
+
+class TestBinnedMoments(unittest.TestCase):
+    def setUp(self):
+        rs = np.random.RandomState(42)
+        self.bins = rs.randint(0, 4, 100)
+        # Large offset to check that variance does not suffer from cancellation
+        self.data = 1e6 + rs.randn(100, 3, 2) + 1j * rs.randn(100, 3, 2)
+
+    def test_chunks(self):
+        """Moments accumulated in chunks should match those of each bin's data."""
+        moments = BinnedMoments(5, shape=(3, 2))
+        for start in range(0, 100, 7):
+            moments.add(self.bins[start:start + 7], self.data[start:start + 7])
+        for n in range(4):
+            selected = self.data[self.bins == n]
+            self.assertEqual(moments.count[n], len(selected))
+            np.testing.assert_allclose(moments.mean[n], selected.mean(axis=0))
+            np.testing.assert_allclose(moments.variance[n], np.std(selected, axis=0) ** 2, rtol=1e-8)
+        self.assertEqual(moments.count[4], 0)
+        self.assertTrue(np.isnan(moments.variance[4]).all())
+
+    def test_out_of_range(self):
+        """Samples with bin indices outside the valid range should be ignored."""
+        moments = BinnedMoments(2)
+        moments.add([-1, 0, 1, 2], [5., 1., 2., 5.])
+        np.testing.assert_array_equal(moments.count, [1, 1])
+        np.testing.assert_array_equal(moments.mean, [1., 2.])
+
+
+if __name__ == "__main__":
+    unittest.main()
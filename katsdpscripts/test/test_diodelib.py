@@ -0,0 +1,136 @@
+import unittest
+
+import numpy as np
+import katpoint
+
+from katsdpscripts.RTS.diodelib import read_hot_cold_spectra, hot_cold_temperatures
+
+
+class SpectralWindow(object):
+    def __init__(self, centre_freq):
+        self.centre_freq = centre_freq
+
+
+class FakeDataSet(object):
+    """Autocorrelations on and off the Moon with the katdal interface used by diodelib."""
+    def __init__(self):
+        rs = np.random.RandomState(7)
+        self.ants = [katpoint.Antenna('ant%d, -30:43:17.3, 21:24:38.5, 1038.0, 12.0' % (n,)) for n in (1, 2)]
+        # Input ant2h is missing from the data
+        self._inputs = [('ant1', 'v'), ('ant1', 'h'), ('ant2', 'v')]
+        self.spectral_windows = [SpectralWindow(1822e6)]
+        num_dumps, num_chans = 200, 32
+        self._freqs = 1822e6 + 16e6 * (np.arange(num_chans) - num_chans // 2)
+        self.catalogue = katpoint.Catalogue(['Moon, special', 'OFF, radec, 0, -90'])
+        # Alternate between Moon and OFF in blocks of 40 dumps
+        self._target = (np.arange(num_dumps) // 40) % 2
+        hot = (self._target == 0)[:, np.newaxis, np.newaxis]
+        self._nd = dict(('ant%d' % (n,), np.arange(num_dumps) % (30 + 6 * n) < 14) for n in (1, 2))
+        nd = np.array([self._nd[ant] for ant, pol in self._inputs]).T[:, np.newaxis, :]
+        power = 20. + 5. * hot + 2. * nd + rs.rand(num_dumps, num_chans, len(self._inputs))
+        self._vis = (power + 1j * rs.randn(*power.shape)).astype(np.complex64)
+        self._flags = np.zeros(power.shape, dtype=np.bool)
+        self._flags[40:80, 12, 0] = True
+        self._flags[[3, 50, 120], [4, 9, 20], [0, 1, 2]] = True
+        self.select()
+
+    def select(self, ants=None, spw=0, pol=None, corrprods=None, freqrange=None, targets=None, scans=None):
+        ants = [ants] if isinstance(ants, basestring) else ants
+        targets = [targets] if isinstance(targets, basestring) else targets
+        names = np.array([target.name for target in self.catalogue.targets])[self._target]
+        self._dumps = np.flatnonzero(np.in1d(names, targets) if targets is not None else np.ones(len(names), bool))
+        self._chans = np.flatnonzero((self._freqs >= freqrange[0]) & (self._freqs <= freqrange[1])
+                                     if freqrange is not None else np.ones(len(self._freqs), bool))
+        self._prods = [n for n, (ant, p) in enumerate(self._inputs)
+                       if (ants is None or ant in ants) and (pol is None or p == pol)]
+
+    def _selected(self, array):
+        return array[self._dumps][:, self._chans][:, :, self._prods]
+
+    @property
+    def shape(self):
+        return (len(self._dumps), len(self._chans), len(self._prods))
+
+    @property
+    def channel_freqs(self):
+        return self._freqs[self._chans]
+
+    @property
+    def corr_products(self):
+        inputs = [ant + pol for ant, pol in self._inputs]
+        return np.array([(inputs[n], inputs[n]) for n in self._prods])
+
+    @property
+    def vis(self):
+        return self._selected(self._vis)
+
+    def flags(self):
+        return self._selected(self._flags)
+
+    @property
+    def sensor(self):
+        sensors = {'Observation/target_index': self._target}
+        sensors.update(('Antennas/%s/nd_coupler' % (ant,), on) for ant, on in self._nd.items())
+        return dict((name, values[self._dumps]) for name, values in sensors.items())
+
+
+def reference_spectra(h5, spw, ant, pol, freq_band=256e6, buff=5):
+    """Spectra of one input, read and reduced per target as in the original per-input loop."""
+    f_c = h5.spectral_windows[spw].centre_freq
+    spectra = []
+    for target in ('OFF', 'Moon'):
+        h5.select(ants=ant, spw=spw, pol=pol, freqrange=(f_c - freq_band/2, f_c + freq_band/2),
+                  targets=target, scans='track')
+        data = np.ma.array(h5.vis[:].real, mask=h5.flags()[:], fill_value=np.nan)
+        on = h5.sensor['Antennas/' + ant + '/nd_coupler']
+        n_off = ~(np.roll(on, buff) | np.roll(on, -buff))
+        n_on = np.roll(on, buff) & np.roll(on, -buff)
+        spectra.append((np.median(data[n_off, :, 0].filled(np.nan), 0),
+                        np.median(data[n_on, :, 0].filled(np.nan), 0)))
+    (cold, cold_nd), (hot, hot_nd) = spectra
+    return h5.channel_freqs, cold, hot, cold_nd, hot_nd
+
+
+def reference_temperatures(f, cs, hs, cns, hns):
+    """System and diode temperatures as calculated in the original per-input loop."""
+    Y = hs / cs
+    HPBW = 1.22 * (180/np.pi) * (3e8/(12*f))
+    om = 1.133 * HPBW**2
+    R = 0.25
+    Thot = 225 * (np.pi * R**2)/om
+    Tsys = (Thot)/(Y-1)
+    Ydiode = hns / cns
+    Tdiode = (Thot + Tsys*(1-Ydiode))/(Ydiode-1)
+    return Tsys, Tdiode
+
+
+class TestHotColdSpectra(unittest.TestCase):
+    def setUp(self):
+        self.h5 = FakeDataSet()
+
+    def test_matches_per_input_loop(self):
+        """Reading all inputs in one pass should reproduce the per-input hot / cold results."""
+        h5 = self.h5
+        freq, cold, hot, cold_nd, hot_nd = read_hot_cold_spectra(h5, 0, h5.ants, freq_band=256e6,
+                                                                 dumps_per_chunk=7)
+        Tsys, Tdiode = hot_cold_temperatures(freq, cold, hot, cold_nd, hot_nd)
+        self.assertEqual(Tsys.shape, (2, 2, 17))
+        for i, ant in enumerate(h5.ants):
+            for j, pol in enumerate(('v', 'h')):
+                if (ant.name, pol) not in h5._inputs:
+                    # Missing input has no spectra
+                    self.assertTrue(np.isnan(cold[i, j]).all() and np.isnan(Tsys[i, j]).all())
+                    continue
+                ref = reference_spectra(h5, 0, ant.name, pol)
+                np.testing.assert_array_equal(freq, ref[0])
+                for spectrum, ref_spectrum in zip((cold, hot, cold_nd, hot_nd), ref[1:]):
+                    np.testing.assert_array_equal(spectrum[i, j], ref_spectrum)
+                ref_Tsys, ref_Tdiode = reference_temperatures(*ref)
+                np.testing.assert_array_equal(Tsys[i, j], ref_Tsys)
+                np.testing.assert_array_equal(Tdiode[i, j], ref_Tdiode)
+        # Flagged samples show up as NaN in the spectra of their input
+        self.assertTrue(np.isnan(Tsys[0, 0, 4]) and not np.isnan(Tsys[0, 0, :4]).any())
+
+
+if __name__ == "__main__":
+    unittest.main()
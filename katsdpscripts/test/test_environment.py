@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import scipy.interpolate as interpolate
+import katpoint
+
+from katsdpscripts.reduction.environment import (rolling_mean, environment_quantities, screen_conditions,
+                                                  violation_intervals, EnvironmentScreen, screen_sensor_store)
+from katsdpscripts.reduction.sensor_store import SensorStore
+
+
+def reference_rolling_mean(data, window):
+    """Rolling mean of reflected data, one window at a time."""
+    padded = np.pad(data, (window // 2, window // 2 - 1 + window % 2), mode='reflect')
+    return np.array([padded[n:n + window].mean() for n in range(len(data))])
+
+
+class TestEnvironment(unittest.TestCase):
+    def setUp(self):
+        self.antenna = katpoint.Antenna('ant1, -30:43:17.3, 21:24:38.5, 1038.0, 12.0')
+        rs = np.random.RandomState(3)
+        num_samples, self.dump_time = 3000, 5.0
+        # Night time at the site, so that all conditions can be met
+        self.timestamps = 1.4e9 + 7200. + self.dump_time * np.arange(num_samples)
+        self.wind_speed = np.abs(0.8 + 0.05 * np.cumsum(rs.randn(num_samples)) + 0.3 * rs.randn(num_samples))
+        # Add a windy spell that violates even the normal limits
+        self.wind_speed[1000:1200] += 12.
+        self.temperature = 20. + 2. * np.sin(np.arange(num_samples) / 2000.) + 0.01 * np.cumsum(rs.randn(num_samples))
+
+    def test_rolling_mean(self):
+        """Rolling mean should match mean of each reflected window and mark windows with gaps."""
+        data = np.random.RandomState(1).randn(50) + 1000.
+        for window in [1, 2, 7, 10, 49]:
+            np.testing.assert_allclose(rolling_mean(data, window), reference_rolling_mean(data, window), rtol=1e-12)
+        data[20] = np.nan
+        means = rolling_mean(data, 5)
+        np.testing.assert_array_equal(np.isnan(means), (np.arange(50) >= 18) & (np.arange(50) <= 22))
+
+    def test_screen_matches_reference(self):
+        """Vectorised screening should match the per-sample spline derivative screening."""
+        t, dump_time = self.timestamps, self.dump_time
+        temp_10min = reference_rolling_mean(self.temperature, 120)
+        fit_temp = interpolate.UnivariateSpline(t, temp_10min, k=3, s=0)
+        temp_grad = np.array([fit_temp.derivatives(timestamp)[1] for timestamp in t])
+        quantities = environment_quantities(t, self.wind_speed, self.temperature, dump_time, self.antenna)
+        np.testing.assert_allclose(quantities['wind_5min'], reference_rolling_mean(self.wind_speed, 60), rtol=1e-10)
+        np.testing.assert_allclose(quantities['temp_rate'], temp_grad, atol=1e-12)
+        good = screen_conditions(quantities)
+        self.assertTrue(0 < good['ideal'].sum() < good['optimal'].sum() < good['normal'].sum() < len(t))
+        expected = ((reference_rolling_mean(self.wind_speed, 60) < 2.9) & (self.wind_speed < 4.1) &
+                    (temp_10min > -5.) & (temp_10min < 35.) & (np.abs(temp_grad) < 2. / 600.))
+        np.testing.assert_array_equal(good['optimal'], expected)
+
+    def test_violation_intervals(self):
+        """Runs of bad samples should become time intervals."""
+        bad = np.array([1, 1, 0, 0, 1, 0, 1, 1, 1], dtype=bool)
+        self.assertEqual(violation_intervals(10. * np.arange(9), bad, 10.), [(0., 20.), (40., 50.), (60., 90.)])
+        self.assertEqual(violation_intervals(np.arange(3.), np.zeros(3, dtype=bool), 1.), [])
+
+    def test_streaming(self):
+        """Screening chunks of data should match screening all of it at once."""
+        quantities = environment_quantities(self.timestamps, self.wind_speed, self.temperature,
+                                            self.dump_time, self.antenna)
+        good = screen_conditions(quantities)
+        screen = EnvironmentScreen(self.dump_time, self.antenna)
+        results = []
+        for start in range(0, len(self.timestamps), 400):
+            chunk = slice(start, start + 400)
+            results.append(screen.add(self.timestamps[chunk], self.wind_speed[chunk], self.temperature[chunk]))
+        results.append(screen.finish())
+        results = [result for result in results if result is not None]
+        np.testing.assert_array_equal(np.concatenate([result['timestamps'] for result in results]), self.timestamps)
+        np.testing.assert_allclose(np.concatenate([result['temp_rate'] for result in results]),
+                                   quantities['temp_rate'], atol=1e-12)
+        self.assertEqual(screen.num_samples, len(self.timestamps))
+        for condition in good:
+            np.testing.assert_array_equal(np.concatenate([result[condition] for result in results]), good[condition])
+            self.assertEqual(screen.num_good[condition], good[condition].sum())
+            self.assertEqual(screen.intervals[condition],
+                             violation_intervals(self.timestamps, ~good[condition], self.dump_time))
+
+    def test_sensor_store(self):
+        """Screening resampled sensors from a store in chunks should cover the whole time range."""
+        tempdir = tempfile.mkdtemp()
+        try:
+            store = SensorStore(os.path.join(tempdir, 'store.h5'))
+            # Raw sensors at 1 second intervals, with a gap of 20 minutes
+            t = self.timestamps[0] + np.r_[np.arange(3000.), 4200. + np.arange(7000.)]
+            store.append('wind', t, np.interp(t, self.timestamps, self.wind_speed))
+            store.append('temp', t, np.interp(t, self.timestamps, self.temperature))
+            screen = screen_sensor_store(store, 'wind', 'temp', self.antenna, t[0], t[-1] + 1., chunk_time=3600.)
+            store.close()
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertEqual(screen.num_samples, 2240)
+        self.assertTrue(0 < screen.num_good['normal'] < 2000)
+        # The gap and its neighbourhood should fail all conditions
+        start, end = [(s, e) for s, e in screen.intervals['normal'] if s <= t[0] + 3500. < e][0]
+        self.assertTrue(start <= t[0] + 3000. - 250. and end >= t[0] + 4200. + 250.)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+import h5py
+
+from katsdpscripts.reduction.file_index import FileIndex, read_metadata
+
+
+SENSOR_DTYPE = [('timestamp', np.float64), ('value', 'S128'), ('status', 'S7')]
+MOON = 'Moon, special'
+SUN = 'Sun, special'
+
+
+def write_sensor(group, name, events):
+    group.create_dataset(name, data=np.array([(t, value, 'nominal') for t, value in events], dtype=SENSOR_DTYPE))
+
+
+def write_file(filename, start, ants, centre_freq, activities, targets, labels, description='Test'):
+    """Write skeleton of version 2 HDF5 file with header only."""
+    with h5py.File(filename, 'w') as f:
+        f.attrs['version'] = '2.1'
+        f['Data/timestamps'] = start + np.arange(100.)
+        config = f.create_group('MetaData/Configuration')
+        obs = config.create_group('Observation')
+        obs.attrs['script_ants'] = ','.join(ants)
+        obs.attrs['script_description'] = description
+        obs.attrs['script_experiment_id'] = '%d' % (start,)
+        obs.attrs['script_observer'] = 'RTS'
+        correlator = config.create_group('Correlator')
+        correlator.attrs['int_time'] = 1.0
+        correlator.attrs['bandwidth'] = 400e6
+        correlator.attrs['n_chans'] = 1024
+        sensors = f.create_group('MetaData/Sensors')
+        write_sensor(sensors, 'RFE/center-frequency-hz', [(start - 10., str(centre_freq))])
+        write_sensor(sensors, 'Antennas/%s/activity' % (ants[0],), [(start + t, a) for t, a in activities])
+        write_sensor(sensors, 'Antennas/%s/target' % (ants[0],), [(start + t, a) for t, a in targets])
+        write_sensor(sensors, 'Observation/label', [(start + t, a) for t, a in labels])
+        f['History/script_log'] = np.array([(start, 'Starting script'), (start + 50., 'Done')],
+                                           dtype=[('timestamp', np.float64), ('details', 'S64')])
+
+
+class TestFileIndex(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.subdir = os.path.join(self.tempdir, 'night2')
+        os.mkdir(self.subdir)
+        self.files = [os.path.join(self.tempdir, '1000.h5'), os.path.join(self.subdir, '2000.h5')]
+        write_file(self.files[0], 1000., ['ant4', 'ant5'], 1822e6,
+                   [(-5., 'slew'), (10., 'track'), (40., 'slew'), (45., 'slew'), (60., 'track')],
+                   [(-5., MOON), (40., SUN)], [(-5., ''), (10., 'raster'), (60., 'track')])
+        write_file(self.files[1], 2000., ['ant1', 'ant4'], 1300e6,
+                   [(-2., 'slew'), (20., 'track')], [(-2., SUN)], [(-2., 'track')], 'Tipping curve')
+        self.index = FileIndex(os.path.join(self.tempdir, 'index.db'))
+        self.updated, self.failed = self.index.update([self.tempdir])
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_read_metadata(self):
+        """Metadata and scans should be read from the file header."""
+        metadata, antennas, scans = read_metadata(self.files[0])
+        self.assertEqual(antennas, ['ant4', 'ant5'])
+        self.assertEqual((metadata['start_time'], metadata['end_time']), (1000., 1100.))
+        self.assertEqual(metadata['centre_freq'], 1822e6)
+        self.assertEqual(metadata['script_log'], 'Starting script\nDone')
+        self.assertEqual(scans, [(0, 1000., 1010., 'slew', 'Moon', ''),
+                                 (1, 1010., 1040., 'track', 'Moon', 'raster'),
+                                 (2, 1040., 1060., 'slew', 'Sun', 'raster'),
+                                 (3, 1060., 1100., 'track', 'Sun', 'track')])
+
+    def test_find(self):
+        """Queries should combine file and scan criteria."""
+        self.assertEqual(self.updated, self.files)
+        self.assertEqual(self.index.find(), self.files)
+        self.assertEqual(self.index.find(target='moon', antenna='ant4', state='track'), self.files[:1])
+        self.assertEqual(self.index.find(target='Sun', state='track', label='track'), self.files)
+        self.assertEqual(self.index.find(target='Moon', state='track', label='track'), [])
+        self.assertEqual(self.index.find(antenna='ant4', freq=1300e6), self.files[1:])
+        self.assertEqual(self.index.find(description='tipping'), self.files[1:])
+        self.assertEqual(self.index.find(start=1050., end=1500.), self.files[:1])
+        info = self.index.metadata(self.files[1])
+        self.assertEqual(info['targets'], ['Sun'])
+        self.assertEqual(info['experiment_id'], '2000')
+        # Files can also be looked up by name only
+        self.assertEqual(self.index.metadata('2000.h5')['path'], self.files[1])
+        self.assertRaises(KeyError, self.index.metadata, '000.h5')
+
+    def test_incremental_update(self):
+        """Only new or changed files should be reread, and broken files remembered."""
+        self.assertEqual(self.index.update([self.tempdir]), ([], []))
+        write_file(self.files[1], 3000., ['ant2'], 1300e6, [(0., 'track')], [(0., MOON)], [(0., 'track')])
+        os.utime(self.files[1], (time.time() + 10, time.time() + 10))
+        broken = os.path.join(self.subdir, 'broken.h5')
+        open(broken, 'w').write('not an HDF5 file')
+        updated, failed = self.index.update([self.tempdir])
+        self.assertEqual(updated, self.files[1:])
+        self.assertEqual([path for path, err in failed], [broken])
+        self.assertEqual(self.index.update([self.tempdir]), ([], []))
+        self.assertEqual(self.index.find(antenna='ant2'), self.files[1:])
+        self.assertEqual(self.index.find(antenna='ant1'), [])
+        self.assertEqual(len(self.index), 3)
+        os.remove(self.files[0])
+        self.assertEqual(self.index.prune(), self.files[:1])
+        self.assertEqual(self.index.find(), self.files[1:])
+
+    def test_update_errors(self):
+        """Any error reading a file should be recorded, and files indexed before an interruption kept."""
+        def reader(path):
+            if path.endswith('1000.h5'):
+                raise RuntimeError('Unable to read attribute')
+            raise KeyboardInterrupt
+        for path in self.files:
+            os.utime(path, (time.time() + 10, time.time() + 10))
+        self.assertRaises(KeyboardInterrupt, self.index.update, [self.tempdir], reader)
+        # The first file was committed before the update was interrupted on the second
+        index = FileIndex(os.path.join(self.tempdir, 'index.db'))
+        self.assertEqual(index.find(), self.files[1:])
+        self.assertEqual(index.metadata(self.files[0])['error'], 'Unable to read attribute')
+        index.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
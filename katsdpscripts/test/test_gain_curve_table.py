@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import katpoint
+
+from katsdpscripts.reduction.gain_curve_table import (parse_csv, load_results, utc_seconds, grouped_linear_fit,
+                                                      calc_atmospheric_opacity, GainCurveTable)
+
+
+ANTENNAS = {'ant1': 'ant1, -30:43:17.3, 21:24:38.5, 1038.0, 12.0',
+            'ant2': 'ant2, -30:43:17.3, 21:24:38.5, 1038.0, 15.0'}
+FIELDS = ['dataset', 'target', 'timestamp_ut', 'azimuth', 'elevation', 'flux', 'data_unit',
+          'beam_height_HH', 'baseline_height_HH', 'frequency', 'temperature', 'humidity', 'wind_speed']
+
+
+def write_csv(filename, ant, g_0, tau, num_rows, fields=FIELDS):
+    elevation = np.linspace(20., 80., num_rows)
+    gain = g_0 * np.exp(-tau / np.sin(np.radians(elevation)))
+    with open(filename, 'w') as f:
+        f.write('# antenna = %s\n' % (ANTENNAS[ant],))
+        f.write(', '.join(fields) + '\n')
+        for n in range(num_rows):
+            values = {'dataset': 'obs', 'target': 'src%d' % (n % 2), 'azimuth': 10. * n, 'flux': 10.,
+                      'timestamp_ut': '2013-06-01 %02d:%02d:00.000' % (n // 60, n % 60),
+                      'elevation': elevation[n], 'data_unit': 'K', 'beam_height_HH': 10. * gain[n],
+                      'baseline_height_HH': 20. + n, 'frequency': 1822., 'temperature': 20.,
+                      'humidity': 30., 'wind_speed': 1.5}
+            f.write(', '.join(str(values[name]) for name in fields) + '\n')
+
+
+class TestGainCurveTable(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filenames = [os.path.join(self.tempdir, 'ant%d.csv' % (n,)) for n in (1, 2)]
+        write_csv(self.filenames[0], 'ant1', 0.1, 0.01, 10)
+        write_csv(self.filenames[1], 'ant2', 0.2, 0.02, 6, [name for name in FIELDS if name != 'wind_speed'])
+        self.table, self.antennas = load_results(self.filenames)
+        self.curves = GainCurveTable(self.table, self.antennas)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_parse_csv(self):
+        """CSV files should be parsed into typed arrays, and combined with missing fields filled in."""
+        antenna, data = parse_csv(self.filenames[0])
+        self.assertEqual(antenna.name, 'ant1')
+        self.assertEqual(data.elevation.dtype, np.float64)
+        self.assertEqual(len(self.table), 16)
+        np.testing.assert_array_equal(self.table.antenna, ['ant1'] * 10 + ['ant2'] * 6)
+        self.assertTrue(np.isnan(self.table.wind_speed[10:]).all())
+        self.assertEqual(self.curves.pols, ['HH'])
+
+    def test_utc_seconds(self):
+        """Timestamp strings should be converted to seconds at full precision."""
+        expected = katpoint.Timestamp('2013-06-01 00:01:00.250').secs
+        self.assertAlmostEqual(utc_seconds(['2013-06-01 00:01:00.250'])[0], expected, places=6)
+
+    def test_compute(self):
+        """Gains and efficiencies should use the dish area of each row's antenna."""
+        gain, e, Tsys, SEFD = self.curves.compute('HH')
+        area = np.pi * np.r_[np.tile(6. ** 2, 10), np.tile(7.5 ** 2, 6)]
+        np.testing.assert_allclose(e, gain * 2761. / area * 100)
+        np.testing.assert_allclose(SEFD, Tsys / gain)
+
+    def test_fits(self):
+        """Atmospheric absorption should be fitted separately per antenna."""
+        gain, e, Tsys, SEFD = self.curves.compute('HH')
+        good, counts = self.curves.good_data('HH', targets=['src0'])
+        self.assertEqual(counts[-1][1], 8)
+        g_0, tau = self.curves.fit_atmospheric_absorption(gain, np.ones(len(gain), dtype=bool))
+        np.testing.assert_allclose(g_0, [0.1, 0.2])
+        np.testing.assert_allclose(tau, [0.01, 0.02])
+
+    def test_grouped_linear_fit(self):
+        """Grouped fits should match separate polynomial fits."""
+        x, y = np.arange(10.), np.random.RandomState(1).randn(10)
+        groups = np.array([0, 1] * 5)
+        slope, intercept = grouped_linear_fit(x, y, groups, 3)
+        for n in (0, 1):
+            np.testing.assert_allclose([slope[n], intercept[n]], np.polyfit(x[n::2], y[n::2], 1))
+        self.assertTrue(np.isnan(slope[2]))
+
+    def test_opacity(self):
+        """Vectorised opacity should match scalar evaluation, including the wet branch."""
+        humidity = np.array([0.3, 0.99])
+        opacity = calc_atmospheric_opacity(20., humidity, 1.038, 22.)
+        for n in range(2):
+            self.assertAlmostEqual(opacity[n], calc_atmospheric_opacity(20., humidity[n], 1.038, 22.))
+        self.assertTrue(opacity[1] > opacity[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
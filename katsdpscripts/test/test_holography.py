@@ -0,0 +1,42 @@
+import unittest
+
+import numpy as np
+
+from katsdpscripts.holography import (generatespiral, spiral_arc_length, spiral_radius,
+                                      uniform_spiral_arm, scan_offsets)
+
+
+class TestSpiral(unittest.TestCase):
+    def test_arc_length(self):
+        """Spiral radius should invert arc length."""
+        r = np.r_[0.0, np.logspace(-6, 1, 50)]
+        np.testing.assert_allclose(spiral_radius(spiral_arc_length(r)), r, rtol=1e-12, atol=1e-15)
+
+    def test_uniform_arm(self):
+        """Points on uniform arm should be spaced 1 / ntime apart."""
+        for ntime in (3, 17, 200):
+            x, y = [r * f(2.0 * np.pi * r) for r in [uniform_spiral_arm(ntime)] for f in (np.cos, np.sin)]
+            np.testing.assert_allclose(np.hypot(np.diff(x), np.diff(y)), 1.0 / ntime, rtol=1e-10)
+
+    def test_generatespiral(self):
+        """Pattern should have even number of arms of right extent, and be cached."""
+        cx, cy, ncx, ncy = generatespiral(4.0, 1000.0, tracktime=2, sampletime=1)
+        self.assertEqual(len(cx) % 2, 0)
+        radius = [np.hypot(x, y).max() for x, y in zip(cx, cy)]
+        np.testing.assert_allclose(radius, 2.0)
+        # Arms alternately start and end on target, after tracking it for 2 samples
+        np.testing.assert_array_equal(cx[0][:3], 0.0)
+        np.testing.assert_array_equal(cx[1][-3:], 0.0)
+        np.testing.assert_allclose(ncx[0], cx[0])
+        np.testing.assert_allclose(ncy[0], cy[0])
+        self.assertTrue(generatespiral(4.0, 1000.0, 2, 1)[0][1] is cx[1])
+        limited = generatespiral(4.0, 1000.0, tracktime=2, sampletime=1, max_accel=0.001)
+        self.assertTrue(len(limited[0][0]) > len(cx[0]))
+        np.testing.assert_allclose(np.hypot(limited[0][0], limited[1][0]).max(), 2.0)
+
+    def test_scan_offsets(self):
+        """Offsets should be close to pattern coordinates (with x flipped) near target."""
+        x, y = np.array([0.0, 0.1, -0.2]), np.array([0.0, 0.05, 0.1])
+        offsetx, offsety = scan_offsets(1.0, np.radians(45.0), x, y)
+        np.testing.assert_allclose(offsetx, -x, atol=1e-3)
+        np.testing.assert_allclose(offsety, y, atol=1e-3)
@@ -0,0 +1,94 @@
+import unittest
+
+import numpy as np
+
+from katsdpscripts.reduction.horizon_grid import grid_horizon
+
+
+class TestGridHorizon(unittest.TestCase):
+    def setUp(self):
+        self.az_pos = np.arange(0.5, 360., 1.0)
+        self.el_pos = np.arange(15.5, 20., 1.0)
+
+    def test_statistics(self):
+        """Cells should get mean, count and variance of their samples."""
+        az = np.array([10.2, 10.8, 10.5, 200.1])
+        el = np.array([16.1, 16.9, 16.5, 18.2])
+        values = np.array([1.0, 3.0, 5.0, 7.0])
+        grid, counts, variance = grid_horizon(az, el, values, self.az_pos, self.el_pos, fill=None)
+        self.assertEqual(grid.shape, (len(self.el_pos), len(self.az_pos)))
+        self.assertEqual(counts[1, 10], 3)
+        self.assertEqual(counts[3, 200], 1)
+        self.assertEqual(counts.sum(), 4)
+        self.assertAlmostEqual(grid[1, 10], 3.0)
+        self.assertAlmostEqual(variance[1, 10], 8.0 / 3.0)
+        self.assertTrue(np.isnan(grid[0, 0]) and np.isnan(variance[0, 0]))
+
+    def test_wrap(self):
+        """Azimuths should wrap around, also when filling gaps from neighbours."""
+        az = np.array([-0.5, 359.7, 720.2, 180.0])
+        el = np.array([15.6, 15.6, 15.6, 15.6])
+        values = np.array([2.0, 4.0, 9.0, 100.0])
+        grid, counts, variance = grid_horizon(az, el, values, self.az_pos, self.el_pos, max_distance=np.inf)
+        self.assertEqual(counts[0, 359], 2)
+        self.assertEqual(counts[0, 0], 1)
+        self.assertAlmostEqual(grid[0, 359], 3.0)
+        # Cell at 358 is closer to 359 than to any other sampled cell, and cell 2 to cell 0
+        self.assertAlmostEqual(grid[0, 358], 3.0)
+        self.assertAlmostEqual(grid[0, 2], 9.0)
+        self.assertEqual(counts[0, 358], 0)
+        self.assertFalse(np.isnan(grid).any())
+
+    def test_beyond_full_turn(self):
+        """Grid spanning more than a turn should keep samples at their own azimuth."""
+        # KAT-7 azimuth range of -185 to 275 degrees
+        az_pos = np.arange(-184.5, 275., 1.0)
+        az = np.array([-170.2, 190.2, 250.5, 300.5, -190.5])
+        el = np.array([15.6, 15.6, 15.6, 15.6, 15.6])
+        values = np.array([1.0, 2.0, 3.0, 4.0, 5.0])
+        grid, counts, variance = grid_horizon(az, el, values, az_pos, self.el_pos, fill=None)
+        # Samples in overlapping part of grid stay in their own cells instead of being wrapped together
+        self.assertEqual(counts[0, 14], 1)
+        self.assertEqual(counts[0, 375], 1)
+        self.assertAlmostEqual(grid[0, 14], 1.0)
+        self.assertAlmostEqual(grid[0, 375], 2.0)
+        # Samples beyond the grid are wrapped into it (300.5 -> -59.5 and -190.5 -> 169.5)
+        self.assertAlmostEqual(grid[0, 125], 4.0)
+        self.assertAlmostEqual(grid[0, 354], 5.0)
+        self.assertEqual(counts.sum(), 5)
+        # Neighbours are not found across the ends of the grid
+        grid, counts, variance = grid_horizon(np.array([-184.0, 100.0]), el[:2], values[:2],
+                                              az_pos, self.el_pos, max_distance=np.inf)
+        self.assertAlmostEqual(grid[0, -1], 2.0)
+
+    def test_idw(self):
+        """Inverse-distance weighting should interpolate between sampled cells."""
+        az_pos, el_pos = np.arange(0., 5.), np.arange(0., 3.)
+        az, el, values = np.array([0.0, 4.0]), np.array([1.0, 1.0]), np.array([0.0, 1.0])
+        grid, counts, variance = grid_horizon(az, el, values, az_pos, el_pos, fill='idw', neighbours=2,
+                                              max_distance=3.5)
+        self.assertAlmostEqual(grid[1, 2], 0.5)
+        self.assertAlmostEqual(grid[1, 1], 0.1)
+        self.assertTrue(0.0 < grid[0, 1] < 0.5)
+        # Cells too far from samples stay empty
+        grid, counts, variance = grid_horizon(az, el, values, az_pos, el_pos, fill='nearest', max_distance=0.5)
+        self.assertTrue(np.isnan(grid[1, 2]))
+        self.assertAlmostEqual(grid[1, 4], 1.0)
+        self.assertRaises(ValueError, grid_horizon, az, el, values, az_pos, el_pos, 'cubic')
+
+    def test_default_max_distance(self):
+        """By default only cells within two cell diagonals of a sample should be filled."""
+        az, el, values = np.array([10.5, 100.5]), np.array([17.5, 15.5]), np.array([1.0, 2.0])
+        grid, counts, variance = grid_horizon(az, el, values, self.az_pos, self.el_pos)
+        filled = ~np.isnan(grid)
+        # Cells up to two cells away along each axis (within 2 sqrt(2) cells) are filled from the sample
+        np.testing.assert_array_equal(np.flatnonzero(filled[:, 10]), np.arange(5))
+        np.testing.assert_array_equal(np.flatnonzero(filled[2]), [8, 9, 10, 11, 12, 98, 99, 100, 101, 102])
+        self.assertTrue(filled[0, 8] and filled[4, 12] and not filled[3, 100])
+        self.assertAlmostEqual(grid[4, 12], 1.0)
+        # 5 x 5 cells around the first sample, and the 3 x 5 of them on the grid around the second
+        self.assertEqual(filled.sum(), 25 + 15)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+
+import numpy as np
+
+from katsdpscripts.reduction.jumps import find_jumps
+
+
+class TestFindJumps(unittest.TestCase):
+    def setUp(self):
+        self.timestamps = 1000.0 + np.arange(40.)
+        # Diode switches on 30% into dump 10 and off 80% into dump 25
+        self.power = np.tile(100.0, 40)
+        self.power[11:25] += 20.0
+        self.power[10] += 20.0 * 0.7
+        self.power[25] += 20.0 * 0.8
+        self.std_power = np.tile(0.01, 40)
+
+    def test_step(self):
+        """Jump instants and directions should be recovered from noiseless steps."""
+        jumps = find_jumps(self.timestamps, self.power, self.std_power, 24., 10., 5.)
+        np.testing.assert_array_equal(jumps.dump_index, [10, 25])
+        np.testing.assert_allclose(jumps.subdump, [0.3, 0.8], atol=1e-3)
+        np.testing.assert_allclose(jumps.time, [1010.3, 1025.8], atol=1e-3)
+        self.assertTrue(jumps.significance[0] > 0 and jumps.significance[1] < 0)
+
+    def test_multiple_series(self):
+        """Columns should be processed independently, as if each were on its own."""
+        power = np.c_[self.power, np.tile(100., 40), self.power[::-1]]
+        std_power = np.tile(self.std_power[:, np.newaxis], (1, 3))
+        jumps = find_jumps(self.timestamps, power, std_power, 24., 10., 5.)
+        np.testing.assert_array_equal(jumps.series, [0, 0, 2, 2])
+        for n in (0, 2):
+            single = find_jumps(self.timestamps, power[:, n], std_power[:, n], 24., 10., 5.)
+            np.testing.assert_array_equal(jumps[jumps.series == n].time, single.time)
+
+    def test_insignificant(self):
+        """Jumps within the margin should be ignored."""
+        jumps = find_jumps(self.timestamps, self.power, self.std_power * 1000., 24., 10., 5.)
+        self.assertEqual(len(jumps), 0)
+        self.assertEqual(len(find_jumps(self.timestamps[:2], self.power[:2], self.std_power[:2])), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
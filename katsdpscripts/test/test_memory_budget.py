@@ -0,0 +1,114 @@
+import os
+import unittest
+
+import numpy as np
+
+from katsdpscripts.reduction.memory_budget import (MemoryBudget, Footprint, MemoryUsage, parse_size,
+                                                   format_size, map_dumps, BUDGET_ENV_VAR)
+from katsdpscripts.reduction.obs_report_data import ObsReportData
+
+
+class CountingArray(object):
+    """Array that counts how many dumps are read from it at a time."""
+    def __init__(self, array):
+        self.array = array
+        self.shape, self.dtype = array.shape, array.dtype
+        self.reads = []
+
+    def __getitem__(self, keys):
+        data = self.array[keys]
+        self.reads.append(len(data))
+        return data
+
+
+class SyntheticDataSet(object):
+    """Autocorrelations of two inputs with the katdal interface used by ObsReportData."""
+    def __init__(self, num_dumps=50, num_chans=16):
+        rs = np.random.RandomState(5)
+        shape = (num_dumps, num_chans, 2)
+        self.vis = CountingArray((rs.rand(*shape) + 1j * rs.rand(*shape)).astype(np.complex64))
+        self._flags = rs.rand(*shape) > 0.8
+        self.shape = shape
+        self.channels = np.arange(num_chans)
+        self.channel_freqs = 1e9 + 1e6 * self.channels
+        self.channel_width = 1e6
+        self.timestamps = 1.4e9 + np.arange(num_dumps)
+        self.lst = np.linspace(23.9, 24.1, num_dumps) % 24
+        self.corr_products = np.array([('ant1h', 'ant1h'), ('ant1v', 'ant1v')])
+
+    def select(self, **kwargs):
+        pass
+
+    def flags(self):
+        return self._flags
+
+
+class TestMemoryBudget(unittest.TestCase):
+    def test_sizes(self):
+        """Memory sizes should be parsed from and formatted as strings with units."""
+        self.assertEqual(parse_size('512M'), 512 * 1024 ** 2)
+        self.assertEqual(parse_size('1.5GB'), 3 * 1024 ** 3 // 2)
+        self.assertEqual(parse_size(' 100 kib '), 102400)
+        self.assertEqual(parse_size(2e9), 2000000000)
+        self.assertRaises(ValueError, parse_size, 'lots')
+        self.assertEqual(format_size(512), '512 B')
+        self.assertEqual(format_size(3 * 1024 ** 3), '3.0 GB')
+        os.environ[BUDGET_ENV_VAR] = '3M'
+        try:
+            self.assertEqual(MemoryBudget().limit, 3 * 1024 ** 2)
+        finally:
+            del os.environ[BUDGET_ENV_VAR]
+        self.assertRaises(ValueError, MemoryBudget, 0)
+
+    def test_chunks(self):
+        """Selections that exceed the budget should be split into chunks that fit."""
+        footprint = Footprint().add((10, 2), np.complex64).add((10, 2), np.float64, per_dump=False)
+        self.assertEqual((footprint.fixed, footprint.per_dump), (160, 160))
+        budget = MemoryBudget(1000)
+        self.assertEqual(budget.dumps_per_chunk(footprint, 5), 5)
+        self.assertEqual(budget.dumps_per_chunk(footprint, 100), 5)
+        self.assertEqual([(s.start, s.stop) for s in budget.chunks(footprint, 12)], [(0, 5), (5, 10), (10, 12)])
+        self.assertEqual(MemoryBudget(100).dumps_per_chunk(footprint, 100), 1)
+        self.assertEqual(budget.chunks(footprint, 0), [])
+
+    def test_track(self):
+        """Tracked steps should record estimated and actual peak memory, also when nested."""
+        budget = MemoryBudget('1G')
+        footprint = Footprint(per_dump=1024 ** 2)
+        with budget.track('outer', footprint, 60):
+            with budget.track('inner', footprint, 40) as inner:
+                data = np.ones(40 * 1024 ** 2 // 8)
+                del data
+        self.assertEqual([usage.label for usage in budget.usage], ['inner', 'outer'])
+        self.assertEqual(inner.usage.estimate, 40 * 1024 ** 2)
+        for usage in budget.usage:
+            if usage.peak is not None:
+                self.assertTrue(usage.peak > 30 * 1024 ** 2)
+        self.assertTrue('inner: estimated 40.0 MB' in budget.report())
+        self.assertTrue('(60 dumps in one chunk)' in str(MemoryUsage('step', 0, None, 60, 60)))
+
+    def test_map_dumps(self):
+        """Function applied in chunks should match function applied to whole array."""
+        vis = CountingArray(np.arange(200, dtype=np.complex64).reshape(20, 5, 2))
+        budget = MemoryBudget(700)
+        amp = map_dumps(np.abs, vis, (5, 1), np.float32, budget, 'amplitudes', index=(slice(None), slice(1, 2)))
+        np.testing.assert_array_equal(amp, np.abs(vis.array[:, :, 1:2]))
+        self.assertEqual(amp.dtype, np.float32)
+        # 400 bytes of output plus 60 bytes per dump leaves room for 5 dumps per chunk
+        self.assertEqual(vis.reads, [5, 5, 5, 5])
+
+    def test_obs_report_data(self):
+        """Observation report products should not depend on the memory budget."""
+        whole = ObsReportData(SyntheticDataSet(), budget=MemoryBudget('1G'))
+        data = SyntheticDataSet()
+        chunked = ObsReportData(data, budget=MemoryBudget(4000))
+        self.assertEqual(whole.budget.usage[0].dumps_per_chunk, 50)
+        self.assertTrue(len(data.vis.reads) > 1 and max(data.vis.reads) < 50)
+        for name in ['spectrum_mean', 'spectrum_min', 'spectrum_max', 'time_series',
+                     'flags_per_channel', 'flags_per_dump']:
+            for key in whole.keys:
+                np.testing.assert_allclose(getattr(chunked, name)[key], getattr(whole, name)[key], rtol=1e-6)
+
+
+if __name__ == "__main__":
+    unittest.main()
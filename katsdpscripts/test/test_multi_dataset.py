@@ -0,0 +1,194 @@
+import unittest
+
+import numpy as np
+import katpoint
+
+from katsdpscripts.reduction.multi_dataset import MultiDataSet, LazyConcatenation, IncompatibleDataSets
+
+
+class SimpleDataSet(object):
+    """Minimal in-memory data set with the katdal interface used by MultiDataSet."""
+    def __init__(self, name, start, scan_lengths, targets, channel_freqs=np.arange(4.), dump_period=1.0):
+        self.name, self.dump_period, self._freqs = name, dump_period, channel_freqs
+        self.corr_products = np.array([('ant1h', 'ant1h'), ('ant1v', 'ant1v')])
+        self.catalogue = katpoint.Catalogue([katpoint.Target(t) for t in targets])
+        self._scan = np.repeat(np.arange(len(scan_lengths)), scan_lengths)
+        self._target = self._scan % len(targets)
+        num_dumps = len(self._scan)
+        self._timestamps = start + dump_period * np.arange(num_dumps)
+        self._vis = (np.arange(num_dumps)[:, np.newaxis, np.newaxis] + 1000 * start + np.zeros((1, 4, 2))).astype(
+            np.complex64)
+        self.start_time, self.end_time = start, start + dump_period * num_dumps
+        self.reads = 0
+        self.select(reset='TF')
+
+    def select(self, reset='auto', **kwargs):
+        # Like katdal, only reset the selections that are asked for or that get new criteria
+        if reset == 'auto':
+            reset = 'T' if any(key in kwargs for key in ('dumps', 'timerange', 'scans', 'compscans', 'targets')) else ''
+            reset += 'F' if 'channels' in kwargs else ''
+        if 'T' in reset:
+            self._keep = np.ones(len(self._scan), dtype=bool)
+        if 'F' in reset:
+            self._chans = np.arange(len(self._freqs))
+        if kwargs.get('channels') is not None:
+            self._chans = self._chans[kwargs['channels']]
+        scans, dumps, targets = kwargs.get('scans'), kwargs.get('dumps'), kwargs.get('targets')
+        if scans is not None:
+            self._keep &= np.in1d(self._scan, scans) if not isinstance(scans, basestring) else (self._scan % 2 == 1)
+        if dumps is not None:
+            self._keep &= np.in1d(np.arange(len(self._keep)), dumps)
+        if targets is not None:
+            targets = [targets] if isinstance(targets, basestring) else targets
+            if all(isinstance(target, int) for target in targets):
+                self._keep &= np.in1d(self._target, targets)
+            else:
+                names = np.array([target.name for target in self.catalogue.targets])[self._target]
+                self._keep &= np.in1d(names, targets)
+
+    @property
+    def channel_freqs(self):
+        return self._freqs[self._chans]
+
+    def _sensor(self, name):
+        return {'Observation/scan_index': self._scan, 'Observation/compscan_index': self._scan,
+                'Observation/target_index': self._target}[name][self._keep]
+
+    @property
+    def sensor(self):
+        data = self
+
+        class Cache(object):
+            def __getitem__(self, name):
+                return data._sensor(name)
+
+            def __contains__(self, name):
+                return True
+        return Cache()
+
+    @property
+    def shape(self):
+        return (self._keep.sum(), len(self._chans), 2)
+
+    @property
+    def timestamps(self):
+        return self._timestamps[self._keep]
+
+    @property
+    def vis(self):
+        data = self
+
+        class Indexer(object):
+            shape, dtype = data.shape, data._vis.dtype
+
+            def __getitem__(self, keys):
+                data.reads += 1
+                return data._vis[data._keep][:, data._chans][keys]
+        return Indexer()
+
+    @property
+    def scan_indices(self):
+        return sorted(set(self._scan[self._keep]))
+
+    def scans(self):
+        keep = self._keep
+        for scan in self.scan_indices:
+            self._keep = keep & (self._scan == scan)
+            yield scan, 'track', self.catalogue.targets[self._target[self._keep][0]]
+        self._keep = keep
+
+
+class TestMultiDataSet(unittest.TestCase):
+    def setUp(self):
+        self.first = SimpleDataSet('first', 100., [3, 2, 4], ['Sun, special', 'Moon, special'])
+        self.second = SimpleDataSet('second', 200., [2, 5], ['Moon, special', 'Jupiter, special'])
+        self.data = MultiDataSet([self.second, self.first])
+
+    def test_concatenation(self):
+        """Timestamps, visibilities and index sensors should be concatenated with global indices."""
+        data = self.data
+        self.assertEqual(data.shape, (16, 4, 2))
+        np.testing.assert_array_equal(data.timestamps, np.r_[100. + np.arange(9), 200. + np.arange(7)])
+        np.testing.assert_array_equal(data.sensor['Observation/scan_index'], [0] * 3 + [1] * 2 + [2] * 4 +
+                                      [3] * 2 + [4] * 5)
+        self.assertEqual([t.name for t in data.catalogue.targets], ['Sun', 'Moon', 'Jupiter'])
+        np.testing.assert_array_equal(data.sensor['Observation/target_index'][[0, 3, 9, 11]], [0, 1, 1, 2])
+        expected = np.r_[self.first._vis, self.second._vis]
+        np.testing.assert_array_equal(data.vis[:], expected)
+        np.testing.assert_array_equal(data.vis[7:12, 1], expected[7:12, 1])
+        np.testing.assert_array_equal(data.vis[[12, 2, 10]], expected[[12, 2, 10]])
+        np.testing.assert_array_equal(data.vis[-1], expected[-1])
+        self.assertEqual(data.vis[20:].shape, (0, 4, 2))
+        # Only the second file should be read for dumps in it
+        self.first.reads = 0
+        data.vis[10:12]
+        self.assertEqual(self.first.reads, 0)
+
+    def test_selection(self):
+        """Global scan and dump selections should be mapped to each file."""
+        data = self.data
+        data.select(scans=[1, 4])
+        self.assertEqual(data.scan_indices, [1, 4])
+        np.testing.assert_array_equal(data.timestamps, np.r_[103., 104., 202. + np.arange(5)])
+        self.assertEqual([(scan, target.name, data.shape[0]) for scan, state, target in data.scans()],
+                         [(1, 'Moon', 2), (4, 'Jupiter', 5)])
+        data.select(dumps=np.arange(16) < 4)
+        np.testing.assert_array_equal(data.timestamps, 100. + np.arange(4))
+        self.assertEqual(data.vis[:].shape, (4, 4, 2))
+        data.select(scans='track')
+        self.assertEqual(data.scan_indices, [1, 4])
+
+    def test_reselection(self):
+        """Every new time selection should start again from all files, and other selections keep it."""
+        data = self.data
+        data.select(scans=[1])
+        self.assertEqual(data.shape[0], 2)
+        data.select(ants='ant1')
+        self.assertEqual(data.scan_indices, [1])
+        # The second file was dropped by the scan selection, but has the selected target
+        data.select(targets='Jupiter')
+        np.testing.assert_array_equal(data.timestamps, 202. + np.arange(5))
+        data.select(dumps=[0])
+        data.select(timerange=(100., 300.))
+        self.assertEqual(data.shape[0], 16)
+        data.select(dumps=[0])
+        data.select(reset='T')
+        self.assertEqual(data.shape[0], 16)
+
+    def test_dropped_dataset_keeps_other_criteria(self):
+        """Data sets that drop out of a time selection should still get its other criteria."""
+        data = self.data
+        data.select(scans=[0], channels=slice(0, 2))
+        self.assertEqual([len(d.channel_freqs) for d in data.datasets], [2, 2])
+        data.select(scans='track')
+        self.assertEqual(data.shape, (7, 2, 2))
+        np.testing.assert_array_equal(data.vis[:], np.r_[self.first._vis[3:5], self.second._vis[2:]][:, :2])
+
+    def test_integer_targets(self):
+        """Integer targets should index the merged catalogue."""
+        data = self.data
+        # Global target 2 (Jupiter) is target 1 of the second file only
+        data.select(targets=[2])
+        np.testing.assert_array_equal(data.timestamps, 202. + np.arange(5))
+        data.select(targets=1)
+        np.testing.assert_array_equal(data.timestamps, np.r_[103., 104., 200., 201.])
+        np.testing.assert_array_equal(data.sensor['Observation/target_index'], [1] * 4)
+
+    def test_incompatible(self):
+        """Files with different channels or overlapping times should be reported."""
+        other = SimpleDataSet('other', 300., [2], ['Sun, special'], channel_freqs=np.arange(8.))
+        self.assertRaises(IncompatibleDataSets, MultiDataSet, [self.first, other])
+        overlap = SimpleDataSet('overlap', 105., [2], ['Sun, special'])
+        self.assertRaises(IncompatibleDataSets, MultiDataSet, [self.first, overlap])
+
+    def test_lazy_concatenation(self):
+        """Lazy concatenation should index like the concatenated array."""
+        arrays = [np.arange(6).reshape(3, 2), np.arange(6, 8).reshape(1, 2), np.arange(8, 14).reshape(3, 2)]
+        lazy, full = LazyConcatenation(arrays), np.concatenate(arrays)
+        for key in [np.s_[:], np.s_[2:5, 1], np.s_[::2], np.s_[[6, 0, 3]], np.s_[np.arange(7) % 3 == 0], 4]:
+            np.testing.assert_array_equal(lazy[key], full[key])
+        self.assertEqual(lazy().shape, (7, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import time
+import datetime as dt
+import unittest
+
+import numpy as np
+
+from katsdpscripts.reduction.obs_report_data import ObsReportData
+
+
+class FakeDataSet(object):
+    """Autocorrelations of two antennas with the katdal selection interface used by the observation report."""
+    def __init__(self, num_dumps=30, num_chans=1024):
+        rs = np.random.RandomState(11)
+        self.inputs = ['ant1h', 'ant1v', 'ant2h', 'ant2v']
+        shape = (num_dumps, num_chans, len(self.inputs))
+        self._vis = (rs.rand(*shape) + 1j * rs.rand(*shape) + 0.1).astype(np.complex64)
+        self._flags = rs.rand(*shape) > 0.9
+        self._freqs = 1.9e9 - 0.39e6 * np.arange(num_chans)
+        self.channel_width = 0.39e6
+        self.timestamps = 1.4e9 + 60. * np.arange(num_dumps)
+        # LST passes through midnight
+        self.lst = (23.8 + np.arange(num_dumps) / 60.) % 24
+        self._chans = np.arange(num_chans)
+        self._prods = np.arange(len(self.inputs))
+
+    def select(self, ants=None, corrprods=None, pol=None, channels=None):
+        # Like katdal, only reset the parts of the selection that are specified
+        if ants is not None or corrprods is not None or pol is not None:
+            ants = [ants] if isinstance(ants, basestring) else ants
+            self._prods = np.array([n for n, inp in enumerate(self.inputs)
+                                    if (ants is None or inp[:-1] in ants) and (pol is None or inp[-1] in pol)])
+        if channels is not None:
+            self._chans = np.asarray(channels)
+
+    @property
+    def channels(self):
+        return self._chans
+
+    @property
+    def channel_freqs(self):
+        return self._freqs[self._chans]
+
+    @property
+    def corr_products(self):
+        return np.array([(self.inputs[n], self.inputs[n]) for n in self._prods])
+
+    @property
+    def shape(self):
+        return (len(self.timestamps), len(self._chans), len(self._prods))
+
+    @property
+    def vis(self):
+        return self._vis[:, self._chans][:, :, self._prods]
+
+    def flags(self):
+        return self._flags[:, self._chans][:, :, self._prods]
+
+
+def reference_lst_date(f):
+    """LST and local time axes as originally built by formatting and parsing strings."""
+    lststring = ["%s:%s" % (("00" if int(np.modf(lst)[1]) == 0 else int(np.modf(lst)[1])), int(np.modf(lst)[0] * 60))
+                 for lst in f.lst]
+    elem = None
+    for a in range(len(lststring)):
+        if lststring[a] == '23:59':
+            elem = a
+    if elem is not None:
+        for a in range(0, elem + 1):
+            lststring[a] = "18/4/2013 " + lststring[a]
+        for b in range(elem, len(f.lst) - 1):
+            lststring[b + 1] = "19/4/2013 " + lststring[b + 1]
+    else:
+        lststring = ["18/4/2013 " + s for s in lststring]
+    lstime = [dt.datetime.strptime(d, "%d/%m/%Y %H:%M") for d in lststring]
+    time_string = [time.strftime("%Y/%m/%d %H:%M:%S", time.localtime(t)) for t in f.timestamps]
+    return lstime, [dt.datetime.strptime(d, "%Y/%m/%d %H:%M:%S") for d in time_string]
+
+
+class TestObsReportData(unittest.TestCase):
+    def test_matches_repeated_reads(self):
+        """Products gathered in one pass should match those of selecting and reading per antenna and pol."""
+        f = FakeDataSet()
+        data = ObsReportData(f, chunk_dumps=7)
+        lst_time, loc_datetime = reference_lst_date(f)
+        self.assertEqual(data.lst_time, lst_time)
+        self.assertEqual(data.loc_datetime, loc_datetime)
+        self.assertEqual(sorted(data.keys), [('ant1', 'h'), ('ant1', 'v'), ('ant2', 'h'), ('ant2', 'v')])
+        for ant in ('ant1', 'ant2'):
+            for pol in ('h', 'v'):
+                key = (ant, pol)
+                # Time series over central channels of 1K mode
+                f.select(ants=ant, corrprods='auto', pol=pol)
+                f.select(channels=range(200, 800))
+                np.testing.assert_allclose(data.time_series[key], np.mean(abs(f.vis[:]), 1)[:, 0], rtol=1e-6)
+                # Spectra and flags over all channels
+                f.select(ants=ant, corrprods='auto', pol=pol, channels=np.arange(1024))
+                abs_vis = np.abs(f.vis[:])
+                for stat in ('mean', 'min', 'max'):
+                    np.testing.assert_allclose(getattr(data, 'spectrum_' + stat)[key],
+                                               getattr(abs_vis, stat)(axis=0)[:, 0], rtol=1e-6)
+                flag = f.flags()[:]
+                perc = [100 * (flag[:, i, 0].sum() / float(flag[:, i, 0].size)) for i in range(len(f.channels))]
+                np.testing.assert_allclose(data.flags_per_channel[key], perc)
+                np.testing.assert_allclose(data.flags_per_dump[key], 100. * flag[:, :, 0].mean(axis=1))
+
+    def test_wide_band(self):
+        """Time series should use all channels in modes with more than 1K channels."""
+        f = FakeDataSet(num_dumps=5, num_chans=2048)
+        data = ObsReportData(f)
+        f.select(ants='ant2', corrprods='auto', pol='v')
+        np.testing.assert_allclose(data.time_series['ant2', 'v'], np.mean(abs(f.vis[:]), 1)[:, 0], rtol=1e-6)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+
+import numpy as np
+import katpoint
+
+from katsdpscripts.obstime import (slew_time, catalogue_azel,
+                                   ObservationTimeEstimator, PlanTimer)
+
+
+ANTS = ['m062, -30:42:47.412, 21:26:38.004, 1035, 13.5, -1440.69969 -2269.26759 6',
+        'm063, -30:42:47.412, 21:26:38.004, 1035, 13.5, -3419.58252 -1606.01511 2']
+
+
+class TestObservationTime(unittest.TestCase):
+    def setUp(self):
+        self.antennas = [katpoint.Antenna(ant) for ant in ANTS]
+        self.targets = [katpoint.Target('PKS 1934-63, radec, 19:39:25.03, -63:42:45.7'),
+                        katpoint.Target('3C 273, radec, 12:29:06.70, 02:03:08.6'),
+                        katpoint.Target('Sun, special')]
+        self.start = 1400000000.0
+        self.timestamps = self.start + np.arange(0., 86400., 1800.)
+
+    def test_slew_time(self):
+        """Drive model should match the one of TimeSession."""
+        self.assertEqual(slew_time(10., 40., 0., 40.), 6.0)
+        self.assertEqual(slew_time(350., 40., 10., 40.), 11.0)
+        self.assertEqual(slew_time(0., -10., 0., 12.5), 11.0)
+        np.testing.assert_array_equal(slew_time([10., 20.], 40., 0., 30.), [11., 11.])
+
+    def test_catalogue_azel(self):
+        """Closed-form (az, el) should agree with katpoint."""
+        az, el = catalogue_azel(self.targets, self.antennas[0], self.timestamps)
+        self.assertEqual(az.shape, (len(self.targets), len(self.timestamps)))
+        for n, target in enumerate(self.targets):
+            ref_az, ref_el = target.azel(self.timestamps, self.antennas[0])
+            np.testing.assert_allclose(katpoint.wrap_angle(az[n] - ref_az), 0.0, atol=1e-5)
+            np.testing.assert_allclose(el[n], ref_el, atol=1e-5)
+
+    def test_visible(self):
+        """Visibility should follow the elevation of targets."""
+        estimator = ObservationTimeEstimator(self.antennas, horizon=3.0)
+        visible = estimator.visible(self.targets, self.timestamps)
+        self.assertEqual(visible.shape, (len(self.targets), len(self.timestamps)))
+        # The southern calibrator is circumpolar at the site
+        self.assertTrue(visible[0].all())
+        el = np.array([self.targets[1].azel(t + 45., self.antennas[0])[1]
+                       for t in self.timestamps])
+        up = el >= katpoint.deg2rad(3.0)
+        np.testing.assert_array_equal(visible[1][up], True)
+
+    def test_plan_timer(self):
+        """Repeated tracks on the same target should not incur slews."""
+        plan = PlanTimer(ANTS, self.start)
+        self.assertTrue(plan.track(self.targets[0], 60.0))
+        first = plan.duration
+        self.assertTrue(first > 61.0)
+        self.assertTrue(plan.track(self.targets[0], 60.0))
+        self.assertAlmostEqual(plan.duration - first, 61.0)
+        self.assertTrue(plan.raster_scan(self.targets[0], num_scans=3, scan_duration=20.0))
+        self.assertTrue(plan.duration - first > 61.0 + 3 * 21.0)
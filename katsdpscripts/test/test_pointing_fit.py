@@ -0,0 +1,62 @@
+import unittest
+import warnings
+
+import numpy as np
+import katpoint
+
+from katsdpscripts.reduction.pointing_fit import PointingFit
+
+
+class TestPointingFit(unittest.TestCase):
+    def setUp(self):
+        rs = np.random.RandomState(42)
+        num_points = 200
+        self.az = rs.uniform(-np.pi, np.pi, num_points)
+        self.el = rs.uniform(0.3, 1.4, num_points)
+        true_model = katpoint.PointingModel(rs.randn(22) * 1e-3)
+        self.delta_az, self.delta_el = true_model.offset(self.az, self.el)
+        self.delta_az += rs.randn(num_points) * 1e-4
+        self.delta_el += rs.randn(num_points) * 1e-4
+        self.sigma_daz = rs.uniform(5e-5, 2e-4, num_points)
+        self.sigma_del = rs.uniform(5e-5, 2e-4, num_points)
+        self.keep = rs.rand(num_points) > 0.2
+        self.enabled = np.zeros(22, dtype=bool)
+        self.enabled[[0, 1, 2, 3, 4, 5, 6, 7, 8, 11]] = True
+
+    def reference_fit(self, keep, enabled):
+        """Fit katpoint pointing model from scratch."""
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            return katpoint.PointingModel().fit(self.az[keep], self.el[keep], self.delta_az[keep],
+                                                self.delta_el[keep], self.sigma_daz[keep],
+                                                self.sigma_del[keep], enabled.copy())
+
+    def test_incremental_updates(self):
+        """Incremental updates should give the same fit as katpoint fits from scratch."""
+        fit = PointingFit(self.az, self.el, self.delta_az, self.delta_el, self.sigma_daz, self.sigma_del,
+                          self.keep, self.enabled)
+        for n in range(0, 200, 7):
+            fit.toggle(n)
+        fit.set_enabled(12)
+        fit.set_enabled(8, False)
+        params, sigma_params = fit.fit()
+        ref_params, ref_sigma_params = self.reference_fit(fit.keep, fit.enabled)
+        np.testing.assert_allclose(params, ref_params, rtol=1e-9, atol=1e-15)
+        np.testing.assert_allclose(sigma_params, ref_sigma_params, rtol=1e-9, atol=1e-15)
+        # Invalid parameter P2 is never fitted
+        self.assertEqual(params[1], 0.0)
+
+    def test_results(self):
+        """Residuals should be consistent with katpoint model offsets."""
+        fit = PointingFit(self.az, self.el, self.delta_az, self.delta_el, self.sigma_daz, self.sigma_del,
+                          self.keep, self.enabled)
+        results = fit.results()
+        model_delta_az, model_delta_el = fit.model().offset(self.az, self.el)
+        np.testing.assert_allclose(results.residual_el, self.delta_el - model_delta_el, atol=1e-15)
+        np.testing.assert_allclose(results.residual_az, self.delta_az - model_delta_az, atol=1e-12)
+        self.assertTrue(results.clipped_sky_rms <= results.sky_rms * (1 + 1e-12))
+        self.assertTrue(results.chi2 > 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
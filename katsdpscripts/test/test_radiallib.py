@@ -0,0 +1,86 @@
+import unittest
+
+import numpy as np
+
+from katsdpscripts.RTS.radiallib import radial_data
+
+
+STATISTICS = ('mean', 'std', 'median', 'numel', 'max', 'min', 'per10', 'per25')
+
+
+def reference_radial_data(data, annulus_width=1, working_mask=None, rmax=None):
+    """Radial statistics computed one annulus at a time, as in the original radial_data."""
+    if working_mask is None:
+        working_mask = np.ones(data.shape, bool)
+    npix, npiy = data.shape
+    x1 = np.arange(-npix/2., npix/2.)
+    y1 = np.arange(-npiy/2., npiy/2.)
+    x, y = np.meshgrid(y1, x1)
+    r = abs(x + 1j * y)
+    if rmax is None:
+        rmax = r[working_mask].max()
+    dr = np.abs([x[0, 0] - x[0, 1]]) * annulus_width
+    radial = np.arange(rmax / dr) * dr + dr / 2.
+    stats = dict((name, np.zeros(len(radial))) for name in STATISTICS)
+    stats['r'] = radial
+    for irad in range(len(radial)):
+        minrad = irad * dr
+        maxrad = minrad + dr
+        thisindex = (r >= minrad) * (r < maxrad) * working_mask
+        if not thisindex.ravel().any():
+            # The original left per25 at zero for empty annuli
+            for name in ('mean', 'std', 'median', 'numel', 'per10', 'max', 'min'):
+                stats[name][irad] = np.nan
+        else:
+            values = data[thisindex]
+            stats['mean'][irad] = values.mean()
+            stats['std'][irad] = values.std()
+            stats['median'][irad] = np.median(values)
+            stats['numel'][irad] = values.size
+            stats['max'][irad] = values.max()
+            stats['min'][irad] = values.min()
+            stats['per10'][irad] = np.percentile(values, 10)
+            stats['per25'][irad] = np.percentile(values, 25)
+    return stats
+
+
+class TestRadialData(unittest.TestCase):
+    def assert_matches_reference(self, new, ref):
+        # Empty annuli now have NaN per25 instead of zero
+        empty = np.isnan(ref['numel'])
+        np.testing.assert_array_equal(ref['per25'][empty], 0.)
+        ref['per25'][empty] = np.nan
+        for name in STATISTICS + ('r',):
+            np.testing.assert_allclose(getattr(new, name), ref[name], rtol=1e-10, err_msg=name)
+
+    def test_matches_annulus_loop(self):
+        """Binned statistics should match the annulus-by-annulus calculation."""
+        rs = np.random.RandomState(1)
+        for shape, annulus_width, rmax in [((64, 64), 1, None), ((65, 40), 0.5, None), ((50, 50), 1, 20.)]:
+            data = rs.randn(*shape)
+            self.assert_matches_reference(radial_data(data, annulus_width, rmax=rmax),
+                                          reference_radial_data(data, annulus_width, rmax=rmax))
+
+    def test_empty_annulus(self):
+        """Empty annuli should give NaN for all statistics, including per25 (which used to be zero)."""
+        data = np.random.RandomState(2).randn(40, 40)
+        x, y = np.meshgrid(np.arange(-20., 20.), np.arange(-20., 20.))
+        r = abs(x + 1j * y)
+        working_mask = (r < 5) | (r >= 8)
+        new = radial_data(data, 1, working_mask)
+        ref = reference_radial_data(data, 1, working_mask)
+        empty = np.isnan(ref['numel'])
+        np.testing.assert_array_equal(np.flatnonzero(empty), [5, 6, 7])
+        self.assertTrue(np.isnan(new.per25[empty]).all())
+        self.assert_matches_reference(new, ref)
+
+    def test_masked_array(self):
+        """Masked pixels should be ignored like pixels outside the working mask."""
+        data = np.random.RandomState(3).randn(30, 30)
+        mask = data > 1.5
+        new = radial_data(np.ma.masked_array(data, mask))
+        self.assert_matches_reference(new, reference_radial_data(data, 1, ~mask, rmax=new.r[-1] + 0.5))
+
+
+if __name__ == "__main__":
+    unittest.main()
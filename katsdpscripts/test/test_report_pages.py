@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+from katsdpscripts.reduction.report_pages import (ReportPages, PdfConcatenator, render_page,
+                                                  _split_pdf, _dictionary, _REFERENCE)
+
+
+def line_page(n, data, extra=False):
+    plt.figure()
+    plt.plot(data)
+    plt.title('Page %d' % (n,))
+    if extra:
+        plt.figure()
+        plt.imshow(np.outer(data, data))
+
+
+def failing_page():
+    plt.figure()
+    raise RuntimeError('Cannot draw this page')
+
+
+def page_sizes(pdf):
+    """Media box widths of pages, in page order."""
+    objects, pages, skip = _split_pdf(pdf)
+    return [float(_dictionary(objects[num]).split('/MediaBox [')[1].split()[2]) for num in pages]
+
+
+def wide_page(width):
+    plt.figure(figsize=(width, 3))
+
+
+class TestReportPages(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'report.pdf')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def check_pdf(self, pdf):
+        """Check that all references of PDF document resolve."""
+        objects, pages, skip = _split_pdf(pdf)
+        for body in objects.values():
+            for ref in _REFERENCE.finditer(_dictionary(body)):
+                self.assertTrue(int(ref.group(1)) in objects)
+        return pages
+
+    def test_render_page(self):
+        """Page functions should produce one page per new figure and leave no figures open."""
+        pdf = render_page(line_page, (0, np.arange(10.)), {'extra': True})
+        self.assertEqual(len(self.check_pdf(pdf)), 2)
+        self.assertEqual(plt.get_fignums(), [])
+        self.assertRaises(RuntimeError, render_page, failing_page)
+        self.assertEqual(plt.get_fignums(), [])
+
+    def test_concatenate(self):
+        """Pages of several documents should be merged in order."""
+        with open(self.filename, 'wb') as f:
+            merged = PdfConcatenator(f)
+            for width in (4, 5, 6):
+                merged.add(render_page(wide_page, (width,)))
+            merged.close()
+        pdf = open(self.filename, 'rb').read()
+        self.check_pdf(pdf)
+        self.assertEqual(page_sizes(pdf), [288., 360., 432.])
+
+    def test_report(self):
+        """Reports rendered in worker processes or in-process should have pages in queued order."""
+        for processes in (0, 2):
+            with ReportPages(self.filename, processes, max_pending=1) as report:
+                for n, width in enumerate([3, 7, 5, 4]):
+                    report.add(wide_page, width)
+                report.add(line_page, 4, np.arange(5.), extra=True)
+            self.assertEqual(report.num_pages, 6)
+            pdf = open(self.filename, 'rb').read()
+            self.assertEqual(len(self.check_pdf(pdf)), 6)
+            self.assertEqual(page_sizes(pdf)[:4], [216., 504., 360., 288.])
+
+    def test_report_error(self):
+        """Errors in page functions should propagate to the script."""
+        def make_report():
+            with ReportPages(self.filename, 2) as report:
+                report.add(failing_page)
+                report.close()
+        self.assertRaises(RuntimeError, make_report)
+
+
+if __name__ == "__main__":
+    unittest.main()
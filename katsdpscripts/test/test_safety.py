@@ -0,0 +1,51 @@
+import unittest
+import os.path
+
+from katsdpscripts.fake.telescope import FakeTelescope
+from katsdpscripts.safety import SafetyMonitor, SafetyInterrupt
+
+
+CONFIG = os.path.join(os.path.dirname(__file__), os.path.pardir, 'fake', 'rts_model.cfg')
+
+
+class TestSafetyMonitor(unittest.TestCase):
+    def setUp(self):
+        self.kat = FakeTelescope(CONFIG)
+        self.kat.dry_run = True
+
+    def tearDown(self):
+        self.kat.updater.stop()
+        self.kat.updater.join()
+
+    def test_stow(self):
+        """Monitor should follow stows of any antenna via sensor events."""
+        with SafetyMonitor(self.kat.rcps) as safety:
+            safety.check()
+            self.kat.m063.req.mode('STOW')
+            self.assertTrue(safety.unsafe)
+            self.assertTrue('m063 mode' in safety.reason)
+            self.assertRaises(SafetyInterrupt, safety.check)
+            self.assertFalse(safety.wait_until_safe(timeout=0.1))
+            self.kat.m063.req.mode('STOP')
+            self.assertTrue(safety.wait_until_safe(timeout=0.1))
+            safety.check()
+            self.assertEqual(safety.changes, 2)
+        # Monitor no longer follows sensors after leaving context
+        self.kat.m062.req.mode('STOW')
+        self.assertFalse(safety.unsafe)
+
+    def test_lock(self):
+        """Lock state should be tracked without affecting safety."""
+        with SafetyMonitor(self.kat.rcps) as safety:
+            self.kat.rcps.req.target('azel, 20, 30')
+            self.kat.rcps.req.mode('POINT')
+            self.assertEqual(safety.unlocked_ants, ['m062', 'm063'])
+            self.kat.rcps.wait('lock', True, 300)
+            self.assertEqual(safety.unlocked_ants, [])
+            self.assertFalse(safety.unsafe)
+
+    def test_disabled(self):
+        """Disabled monitor (e.g. for dry runs) should never be unsafe."""
+        with SafetyMonitor(self.kat.rcps, enabled=False) as safety:
+            self.kat.rcps.req.mode('STOW')
+            safety.check()
@@ -0,0 +1,89 @@
+import unittest
+
+import numpy as np
+
+from katsdpscripts.reduction.scan_blocks import ScanBlockReader
+from katsdpscripts.reduction.memory_budget import MemoryBudget
+
+
+class FakeDataSet(object):
+    """Minimal stand-in for a katdal data set with two scans."""
+    def __init__(self, fail_on_scan=None):
+        self.scan_dumps = [(0, 'track', np.arange(0, 7)), (1, 'slew', np.arange(7, 10)), (2, 'track', np.arange(10, 15))]
+        self._vis = np.arange(15 * 4 * 2).reshape(15, 4, 2) + 1j
+        self._flags = self._vis.real % 3 == 0
+        self.selection = {}
+        self.fail_on_scan = fail_on_scan
+        self._dumps = np.arange(15)
+
+    def select(self, **kwargs):
+        self.selection = kwargs
+
+    def scans(self):
+        for index, state, dumps in self.scan_dumps:
+            if self.selection.get('scans', state) != state:
+                continue
+            if index == self.fail_on_scan:
+                raise IOError('Broken scan')
+            self._dumps = dumps
+            yield index, state, 'target%d' % (index,)
+
+    @property
+    def shape(self):
+        return (len(self._dumps),) + self._vis.shape[1:]
+
+    @property
+    def timestamps(self):
+        return 100. + self._dumps
+
+    @property
+    def vis(self):
+        return self._vis[self._dumps]
+
+    def flags(self):
+        return self._flags[self._dumps]
+
+    def weights(self):
+        return np.ones(self.shape)
+
+
+class TestScanBlockReader(unittest.TestCase):
+    def test_whole_scans(self):
+        """Blocks should match a synchronous loop over scans."""
+        data = FakeDataSet()
+        blocks = list(ScanBlockReader(data, scans='track'))
+        self.assertEqual(data.selection, {'scans': 'track'})
+        self.assertEqual([block.scan_index for block in blocks], [0, 2])
+        np.testing.assert_array_equal(blocks[1].vis, data._vis[10:15])
+        np.testing.assert_array_equal(blocks[1].flags, data._flags[10:15])
+        np.testing.assert_array_equal(blocks[0].timestamps, 100. + np.arange(7))
+        self.assertEqual(blocks[0].target, 'target0')
+
+    def test_chunks(self):
+        """Scans should be split into blocks of at most the requested number of dumps."""
+        blocks = list(ScanBlockReader(FakeDataSet(), dumps_per_block=3, prefetch=1, read_weights=False))
+        self.assertEqual([(b.scan_index, b.dumps.start, b.dumps.stop) for b in blocks],
+                         [(0, 0, 3), (0, 3, 6), (0, 6, 7), (1, 0, 3), (2, 0, 3), (2, 3, 5)])
+        np.testing.assert_array_equal(np.concatenate([b.vis for b in blocks]), FakeDataSet()._vis)
+        self.assertTrue(blocks[0].weights is None)
+
+    def test_budget(self):
+        """Scans that do not fit in the memory budget should be split into blocks that do."""
+        # Each dump of vis, flags and weights takes 8 * 13 bytes, and 3 blocks are in flight
+        budget = MemoryBudget(3 * 8 * 13 * 5)
+        blocks = list(ScanBlockReader(FakeDataSet(), prefetch=1, budget=budget))
+        self.assertEqual([(b.scan_index, b.dumps.start, b.dumps.stop) for b in blocks],
+                         [(0, 0, 5), (0, 5, 7), (1, 0, 3), (2, 0, 5)])
+        np.testing.assert_array_equal(np.concatenate([b.vis for b in blocks]), FakeDataSet()._vis)
+
+    def test_errors_and_early_exit(self):
+        """Reader errors should reach the consumer, and stopping early should stop the reader."""
+        reader = ScanBlockReader(FakeDataSet(fail_on_scan=2), dumps_per_block=2)
+        self.assertRaises(IOError, list, reader)
+        for block in ScanBlockReader(FakeDataSet(), dumps_per_block=1, prefetch=1):
+            break
+        self.assertEqual(block.scan_index, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+
+import numpy as np
+
+from katsdpscripts.sensor_rules import RuleSet, AlarmWindows
+
+
+RULES = [("kat.ant1.sensor.cryo_lna_temperature.get_value()", 67.0, 87.0, 1, 1),
+         ("kat.ant1.sensor.mode.get_value()", ["POINT", "STOP", "STOW", "SCAN"], '', 1, 1),
+         ("", "", "", "", ""),
+         ("kat.dbe7.sensor.dbe_ant1h_adc_power.get_value()", -28.0, -24.0, 2, 3)]
+
+
+class FakeSensor(object):
+    def __init__(self, value, status='nominal'):
+        self.value, self.status = value, status
+
+    def get_value(self):
+        return self.value
+
+
+class FakeObject(object):
+    pass
+
+
+class TestSensorRules(unittest.TestCase):
+    def setUp(self):
+        self.rules = RuleSet(RULES)
+
+    def test_parse(self):
+        """Rules should be validated up front and keep their layout."""
+        self.assertEqual(len(self.rules), 3)
+        self.assertEqual(self.rules.layout, [0, 1, None, 2])
+        self.assertEqual(self.rules[0].path, ('ant1', 'sensor', 'cryo_lna_temperature'))
+        self.assertRaises(ValueError, RuleSet, [("kat.ant1.sensor.mode.get_value() + 1", 0, 1, 1, 1)])
+        self.assertRaises(ValueError, RuleSet, [("kat.ant1.sensor.mode.get_value()", 2, 1, 1, 1)])
+        self.assertRaises(ValueError, RuleSet, [("kat.ant1.sensor.mode.get_value()", 0, 1, 3, 2)])
+
+    def test_evaluate(self):
+        """Values, options and statuses should all be checked."""
+        ok = self.rules.evaluate([70.0, 'STOW', -26.0], ['nominal'] * 3)
+        np.testing.assert_array_equal(ok, [True, True, True])
+        ok = self.rules.evaluate([90.0, 'SLEW', None], ['nominal', 'nominal', 'unknown'])
+        np.testing.assert_array_equal(ok, [False, False, False])
+        ok = self.rules.evaluate([70.0, 'STOW', -26.0], ['error', 'warn', 'nominal'])
+        np.testing.assert_array_equal(ok, [False, True, True])
+        ok = self.rules.evaluate([70.0, 'STOW', -26.0], ['nominal', 'warn', 'nominal'], warn_is_error=True)
+        np.testing.assert_array_equal(ok, [True, False, True])
+
+    def test_alarm_windows(self):
+        """Alarms should follow the m-of-n rule over a sliding window."""
+        alarms = AlarmWindows([2], [3])
+        results = [alarms.update([failed]) for failed in (True, False, False, True, False, True, False, False)]
+        raised = [r[0] for r, c in results]
+        cleared = [c[0] for r, c in results]
+        self.assertEqual(raised, [False, False, False, False, False, True, False, False])
+        self.assertEqual(cleared, [False, False, False, False, False, False, True, False])
+
+    def test_replay(self):
+        """Recorded histories should be replayable offline."""
+        power = [-26.0, -20.0, -20.0, -26.0, -26.0, -26.0]
+        history = {RULES[0][0]: [70.0] * 6, RULES[1][0]: ['POINT'] * 6, RULES[3][0]: power}
+        ok, active = self.rules.replay(history)
+        np.testing.assert_array_equal(ok[:, 2], [True, False, False, True, True, True])
+        np.testing.assert_array_equal(active[:, 2], [False, False, True, True, False, False])
+        self.assertFalse(active[:, :2].any())
+
+    def test_resolve_and_read(self):
+        """Sensor objects should be resolved once and read directly."""
+        kat = FakeObject()
+        kat.ant1 = FakeObject()
+        kat.ant1.sensor = FakeObject()
+        kat.ant1.sensor.cryo_lna_temperature = FakeSensor(75.0)
+        kat.ant1.sensor.mode = FakeSensor('POINT', 'warn')
+        resolved = self.rules.resolve(kat)
+        np.testing.assert_array_equal(resolved, [True, True, False])
+        values, statuses = self.rules.read()
+        self.assertEqual(values, [75.0, 'POINT', None])
+        np.testing.assert_array_equal(self.rules.evaluate(values, statuses), [True, True, False])
@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import h5py
+
+from katsdpscripts.reduction.sensor_store import (SensorStore, coverage_intervals,
+                                                  import_h5_sensors, import_csv_sensor)
+
+
+class TestSensorStore(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.store = SensorStore(os.path.join(self.tempdir, 'store.h5'), chunk_size=16)
+        self.timestamps = 1000. + np.arange(100.)
+        self.values = np.random.RandomState(1).randn(100)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_append_and_get(self):
+        """Out-of-order and overlapping appends should be merged into sorted, unique samples."""
+        name = 'Enviro/asc.wind.speed'
+        self.store.append(name, self.timestamps[50:], self.values[50:])
+        self.store.append(name, self.timestamps[:60], self.values[:60] + 1)
+        self.store.append(name, self.timestamps[[20, 10, 30]], self.values[[20, 10, 30]])
+        expected = self.values.copy()
+        expected[:60] += 1
+        expected[[10, 20, 30]] = self.values[[10, 20, 30]]
+        t, v = self.store.get(name)
+        np.testing.assert_array_equal(t, self.timestamps)
+        np.testing.assert_array_equal(v, expected)
+        for start, end in [(1017., 1051.5), (990., 1003.), (1098.5, 2000.), (1032., 1032.), (900., 950.)]:
+            t, v = self.store.get(name, start, end)
+            select = (self.timestamps >= start) & (self.timestamps <= end)
+            np.testing.assert_array_equal(t, self.timestamps[select])
+            np.testing.assert_array_equal(v, expected[select])
+        self.assertEqual(self.store.names(), [name])
+        self.assertEqual(self.store.time_range(name), (1000., 1099.))
+
+    def test_discrete(self):
+        """String sensors should be stored and refuse values that are too long."""
+        self.store.append('activity', [3., 1., 2.], ['track', 'slew', 'scan'])
+        np.testing.assert_array_equal(self.store.get('activity', 1.5)[1], ['scan', 'track'])
+        self.assertRaises(ValueError, self.store.append, 'activity', [4.], ['x' * 40])
+
+    def test_resample(self):
+        """Resampled aggregates should match aggregates of each bin."""
+        self.store.append('temp', self.timestamps, self.values)
+        for how, func in [('mean', np.mean), ('max', np.max), ('min', np.min), ('last', lambda x: x[-1])]:
+            t, v = self.store.resample('temp', 1005., 1125., 10., how)
+            np.testing.assert_array_equal(t, 1005. + 10. * np.arange(12))
+            np.testing.assert_allclose(v[:9], [func(self.values[5 + 10 * n:15 + 10 * n]) for n in range(9)])
+            np.testing.assert_allclose(v[9], func(self.values[95:]))
+            self.assertTrue(np.isnan(v[10:]).all())
+        t, v = self.store.resample('temp', 1005., 1125., 10., 'count')
+        np.testing.assert_array_equal(v, [10] * 9 + [5, 0, 0])
+
+    def test_rolling(self):
+        """Rolling aggregates should use the trailing window, including samples before start."""
+        self.store.append('temp', self.timestamps, self.values)
+        for how, func in [('mean', np.mean), ('std', np.std), ('max', np.max), ('count', len)]:
+            t, v = self.store.rolling('temp', 4.5, 1010., 1050., how)
+            np.testing.assert_array_equal(t, self.timestamps[10:51])
+            np.testing.assert_allclose(v, [func(self.values[n - 4:n + 1]) for n in range(10, 51)], atol=1e-12)
+
+    def test_coverage(self):
+        """Samples should be grouped into intervals without long gaps."""
+        timestamps = np.r_[0., 10., 20., 500., 510., 2000.]
+        self.assertEqual(coverage_intervals(timestamps, 300.), [(0., 20.), (500., 510.), (2000., 2000.)])
+        self.assertEqual(coverage_intervals(timestamps, 300., timestamps + [50., 0., 0., 1200., 0., 10.]),
+                         [(0., 50.), (500., 2010.)])
+        self.store.append('temp', timestamps, np.zeros(6))
+        self.assertEqual(self.store.coverage('temp', 300., start=15.), [(20., 20.), (500., 510.), (2000., 2000.)])
+
+    def test_importers(self):
+        """Sensors should be imported from observation files and CSV exports."""
+        filename = os.path.join(self.tempdir, 'obs.h5')
+        dtype = [('timestamp', np.float64), ('value', 'S16'), ('status', 'S7')]
+        with h5py.File(filename, 'w') as f:
+            f['MetaData/Sensors/Enviro/asc.air.temperature'] = np.array(
+                [(t, str(v), 'nominal') for t, v in zip(self.timestamps, self.values)], dtype=dtype)
+            f['MetaData/Sensors/Antennas/ant1/activity'] = np.array([(1000., 'track', 'nominal')], dtype=dtype)
+        imported, skipped = import_h5_sensors(self.store, filename)
+        self.assertEqual((imported, skipped), (['Enviro/asc.air.temperature'], ['Antennas/ant1/activity']))
+        np.testing.assert_allclose(self.store.get('Enviro/asc.air.temperature')[1], self.values, rtol=1e-10)
+        csv_file = os.path.join(self.tempdir, 'anc.asc.wind.speed.csv')
+        with open(csv_file, 'w') as f:
+            f.write('Timestamp, Value\n')
+            f.write(''.join('%d, %r\n' % (1000 * (1.4e9 + t), v) for t, v in zip(self.timestamps, self.values)))
+        self.assertEqual(import_csv_sensor(self.store, csv_file), 100)
+        t, v = self.store.get('anc.asc.wind.speed', 1.4e9 + 1050.)
+        np.testing.assert_array_equal(t, 1.4e9 + self.timestamps[50:])
+        np.testing.assert_array_equal(v, self.values[50:])
+
+
+if __name__ == "__main__":
+    unittest.main()
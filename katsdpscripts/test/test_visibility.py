@@ -0,0 +1,68 @@
+import unittest
+
+import numpy as np
+import katpoint
+
+from katsdpscripts import visibility
+from katsdpscripts.visibility import VisibilityEngine, cached_tracks
+
+
+ANT = 'm062, -30:42:47.412, 21:26:38.004, 1035, 13.5, -1440.69969 -2269.26759 6'
+
+
+class TestVisibilityEngine(unittest.TestCase):
+    def setUp(self):
+        self.antenna = katpoint.Antenna(ANT)
+        self.catalogue = katpoint.Catalogue(antenna=self.antenna)
+        for n, ra in enumerate(range(0, 360, 30)):
+            for dec in (-80, -40, 0, 30):
+                self.catalogue.add('src%d_%d, radec, %d, %d' % (n, dec, ra, dec))
+        self.engine = VisibilityEngine([self.antenna], horizon=15.0)
+        self.timestamp = 1400000123.0
+
+    def test_elevation(self):
+        """Interpolated elevation should agree with katpoint."""
+        el = self.engine.elevation(self.catalogue, self.timestamp)
+        ref_el = [katpoint.rad2deg(t.azel(self.timestamp, self.antenna)[1]) for t in self.catalogue]
+        np.testing.assert_allclose(el, ref_el, atol=0.01)
+
+    def test_cache(self):
+        """Nearby queries should share the same tracks."""
+        tracks = cached_tracks(self.catalogue, self.antenna, self.timestamp)
+        self.assertTrue(cached_tracks(self.catalogue, self.antenna, self.timestamp + 600.) is tracks)
+
+    def test_rise_and_set(self):
+        """Targets should be up between rise and set times."""
+        rise = self.engine.next_rise(self.catalogue, self.timestamp)
+        sets = self.engine.next_set(self.catalogue, self.timestamp)
+        up = self.engine.visible(self.catalogue, self.timestamp)
+        for n, target in enumerate(self.catalogue):
+            if np.isfinite(sets[n]):
+                self.assertTrue(self.engine.visible(target, self.timestamp, sets[n] - self.timestamp - 60.) == up[n])
+                self.assertFalse(self.engine.visible(target, self.timestamp, sets[n] - self.timestamp + 60.))
+            if np.isfinite(rise[n]) and not up[n]:
+                self.assertTrue(self.engine.elevation(target, rise[n] + 60.) > 15.0)
+                self.assertTrue(self.engine.elevation(target, rise[n] - 60.) < 15.0)
+
+    def test_iterfilter(self):
+        """Filtering should match katpoint at a fixed time."""
+        fast = [t.name for t in self.engine.iterfilter(self.catalogue, el_limit_deg=20.0,
+                                                       timestamp=self.timestamp)]
+        ref = [t.name for t in self.catalogue.iterfilter(el_limit_deg=20.0, timestamp=self.timestamp)]
+        self.assertEqual(fast, ref)
+
+    def test_reuse_catalogue_tracks(self):
+        """Targets picked by iterfilter should be checked using the tracks of their catalogue."""
+        visibility._track_cache.clear()
+        target = list(self.engine.iterfilter(self.catalogue, el_limit_deg=20.0, timestamp=self.timestamp))[0]
+        num_tracks = len(visibility._track_cache)
+        el = self.engine.elevation(target, self.timestamp + 300.)
+        up = self.engine.visible(target, self.timestamp + 300., 1800.)
+        rise = self.engine.next_rise(target, self.timestamp)
+        self.assertEqual(len(visibility._track_cache), num_tracks)
+        # Answers should be the same as from tracks of the target itself
+        engine = VisibilityEngine([self.antenna], horizon=15.0)
+        self.assertAlmostEqual(el, engine.elevation(target, self.timestamp + 300.))
+        self.assertEqual(up, engine.visible(target, self.timestamp + 300., 1800.))
+        self.assertEqual(rise, engine.next_rise(target, self.timestamp))
+        self.assertEqual(len(visibility._track_cache), num_tracks + 1)
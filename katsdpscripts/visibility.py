@@ -0,0 +1,372 @@
+###############################################################################
+# SKA South Africa (http://ska.ac.za/)                                        #
+# Author: cam@ska.ac.za                                                       #
+# Copyright @ 2013 SKA SA. All rights reserved.                               #
+#                                                                             #
+# THIS SOFTWARE MAY NOT BE COPIED OR DISTRIBUTED IN ANY FORM WITHOUT THE      #
+# WRITTEN PERMISSION OF SKA SA.                                               #
+###############################################################################
+"""Cached visibility and rise / set prediction for catalogues of targets.
+
+The elevation tracks of all targets in a catalogue are precomputed for each
+antenna on a regular time grid covering a window of time, using the closed-form
+calculation of :mod:`katsdpscripts.obstime`. The tracks are cached by
+(catalogue, antenna, window), so that repeated queries during an observation
+script (target selection, visibility checks before every track or scan) reduce
+to table lookups. The rise and set times within the window are found once per
+horizon, which makes "is the target up for the next *d* seconds" and "when does
+the target rise / set next" O(1) queries per target.
+
+"""
+
+import time
+
+import numpy as np
+import katpoint
+
+from .obstime import catalogue_azel, _as_target_list
+
+
+# Cache of ElevationTracks objects, keyed on (target descriptions, antenna description, window start)
+_track_cache = {}
+# Limit the number of cached track sets to keep memory bounded
+MAX_CACHED_TRACKS = 64
+
+
+class ElevationTracks(object):
+    """Elevation of catalogue targets seen by one antenna on a regular time grid.
+
+    Parameters
+    ----------
+    targets : :class:`katpoint.Catalogue` object, or sequence of targets
+        Targets as objects or description strings
+    antenna : :class:`katpoint.Antenna` object
+        Antenna pointing at the targets
+    start_time, end_time : float
+        Time window covered by tracks, in UTC seconds since Unix epoch
+    resolution : float, optional
+        Spacing of time grid, in seconds
+
+    """
+    def __init__(self, targets, antenna, start_time, end_time, resolution=60.):
+        self.targets = _as_target_list(targets)
+        self.antenna = antenna
+        self.resolution = resolution
+        num_samples = max(int(np.ceil((end_time - start_time) / resolution)), 1) + 1
+        self.timestamps = start_time + resolution * np.arange(num_samples)
+        self.start_time, self.end_time = self.timestamps[0], self.timestamps[-1]
+        self.index = {}
+        for n, target in enumerate(self.targets):
+            self.index.setdefault(target.description, n)
+            self.index.setdefault(target.name, n)
+        az, el = catalogue_azel(self.targets, antenna, self.timestamps)
+        self.el = katpoint.rad2deg(el)
+        self._crossings = {}
+
+    def covers(self, timestamp):
+        """True if *timestamp* falls inside the time window of the tracks."""
+        return self.start_time <= timestamp <= self.end_time
+
+    def rows(self, targets=None):
+        """Row indices of targets (all targets by default)."""
+        if targets is None:
+            return np.arange(len(self.targets))
+        return np.array([self.index[getattr(t, 'description', t)] for t in _as_sequence(targets)],
+                        dtype=np.int)
+
+    def _locate(self, timestamp):
+        """Grid sample just before *timestamp* and fractional offset from it."""
+        pos = (np.asarray(timestamp, dtype=np.float64) - self.start_time) / self.resolution
+        k = np.clip(np.floor(pos).astype(np.int), 0, len(self.timestamps) - 2)
+        return k, pos - k
+
+    def elevation(self, timestamp, rows=None):
+        """Interpolated elevation of targets at given time, in degrees."""
+        rows = self.rows() if rows is None else rows
+        if len(self.timestamps) < 2:
+            return self.el[rows, 0]
+        k, frac = self._locate(timestamp)
+        return (1.0 - frac) * self.el[rows, k] + frac * self.el[rows, k + 1]
+
+    def crossings(self, horizon):
+        """Next rise and set times after each grid sample for given horizon.
+
+        Parameters
+        ----------
+        horizon : float
+            Elevation limit, in degrees
+
+        Returns
+        -------
+        next_rise, next_set : array, shape (num_targets, num_samples)
+            Time of first rise / set at or after each grid sample (linearly
+            interpolated between samples), or inf if it does not happen
+            within the window
+
+        """
+        if horizon not in self._crossings:
+            el0, el1 = self.el[:, :-1], self.el[:, 1:]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                crossing = self.timestamps[:-1] + self.resolution * (horizon - el0) / (el1 - el0)
+            rises = np.where((el0 < horizon) & (el1 >= horizon), crossing, np.inf)
+            sets = np.where((el0 >= horizon) & (el1 < horizon), crossing, np.inf)
+            # Reverse cumulative minimum gives the first event at or after each sample
+            pad = np.inf * np.ones((len(self.targets), 1))
+            next_rise = np.minimum.accumulate(np.hstack((rises, pad))[:, ::-1], axis=1)[:, ::-1]
+            next_set = np.minimum.accumulate(np.hstack((sets, pad))[:, ::-1], axis=1)[:, ::-1]
+            self._crossings[horizon] = (next_rise, next_set)
+        return self._crossings[horizon]
+
+    def _next_event(self, events, timestamp, rows):
+        """First event at or after *timestamp* from a table of next events."""
+        k, frac = self._locate(timestamp)
+        # The event found for sample k might be before the timestamp (between sample k and timestamp)
+        event = events[rows, k]
+        return np.where(event >= timestamp, event, events[rows, k + 1])
+
+    def next_rise(self, horizon, timestamp, rows=None):
+        """Time at which targets next rise above horizon (inf if not in window)."""
+        rows = self.rows() if rows is None else rows
+        return self._next_event(self.crossings(horizon)[0], timestamp, rows)
+
+    def next_set(self, horizon, timestamp, rows=None):
+        """Time at which targets next set below horizon (inf if not in window)."""
+        rows = self.rows() if rows is None else rows
+        return self._next_event(self.crossings(horizon)[1], timestamp, rows)
+
+
+def _as_sequence(targets):
+    """Ensure that a single target or description string becomes a list."""
+    if isinstance(targets, (katpoint.Target, basestring)):
+        return [targets]
+    return list(targets)
+
+
+def _catalogue_key(targets):
+    """Hashable key identifying a catalogue or list of targets."""
+    return tuple(t.description for t in targets)
+
+
+def cached_tracks(targets, antenna, timestamp, window=43200., resolution=60.):
+    """Obtain elevation tracks of targets covering given time, using cache.
+
+    The tracks cover a window of twice *window* seconds, starting at the
+    multiple of *window* just before *timestamp*, so that nearby queries and
+    queries with durations up to *window* seconds share the same tracks.
+
+    Parameters
+    ----------
+    targets : :class:`katpoint.Catalogue` object, or sequence of targets
+        Targets as objects or description strings
+    antenna : :class:`katpoint.Antenna` object
+        Antenna pointing at the targets
+    timestamp : float
+        Time that should be covered, in UTC seconds since Unix epoch
+    window : float, optional
+        Alignment of time windows, in seconds
+    resolution : float, optional
+        Spacing of time grid, in seconds
+
+    Returns
+    -------
+    tracks : :class:`ElevationTracks` object
+        Tracks of targets covering *timestamp*
+
+    """
+    targets = _as_target_list(targets)
+    start_time = np.floor(timestamp / window) * window
+    key = (_catalogue_key(targets), antenna.description, start_time, window, resolution)
+    tracks = _track_cache.get(key)
+    if tracks is None:
+        if len(_track_cache) >= MAX_CACHED_TRACKS:
+            _track_cache.clear()
+        tracks = _track_cache[key] = ElevationTracks(targets, antenna, start_time,
+                                                     start_time + 2 * window, resolution)
+    return tracks
+
+
+class VisibilityEngine(object):
+    """Answer visibility questions about targets for a set of antennas.
+
+    Parameters
+    ----------
+    antennas : sequence of :class:`katpoint.Antenna` objects or strings, optional
+        Antennas taking part in the observation (can also be set later)
+    horizon : float, optional
+        Elevation limit serving as horizon, in degrees
+    window : float, optional
+        Alignment of cached time windows, in seconds
+    resolution : float, optional
+        Spacing of time grid, in seconds
+
+    """
+    def __init__(self, antennas=None, horizon=3.0, window=43200., resolution=60.):
+        self.antennas = antennas if antennas is not None else []
+        self.horizon = horizon
+        self.window = window
+        self.resolution = resolution
+        # Targets of the catalogue last filtered by iterfilter, whose tracks serve later queries
+        self._catalogue = []
+
+    @property
+    def antennas(self):
+        """Antennas taking part in the observation."""
+        return self._antennas
+
+    @antennas.setter
+    def antennas(self, antennas):
+        self._antennas = [ant if isinstance(ant, katpoint.Antenna) else katpoint.Antenna(ant)
+                          for ant in antennas]
+
+    def tracks(self, targets, antenna, timestamp):
+        """Cached elevation tracks of targets for antenna covering *timestamp*."""
+        return cached_tracks(targets, antenna, timestamp, self.window, self.resolution)
+
+    def _lookup(self, targets, antenna, timestamp):
+        """Cached tracks containing targets and their rows in the tracks.
+
+        Targets from the catalogue last passed to :meth:`iterfilter` (e.g. a
+        target checked by the session before it is observed) are looked up in
+        the tracks of that catalogue instead of getting tracks of their own.
+
+        """
+        if self._catalogue:
+            tracks = self.tracks(self._catalogue, antenna, timestamp)
+            try:
+                return tracks, tracks.rows(targets)
+            except KeyError:
+                pass
+        return self.tracks(targets, antenna, timestamp), None
+
+    def elevation(self, targets, timestamp=None, antenna=None):
+        """Elevation of targets at given time, in degrees.
+
+        Parameters
+        ----------
+        targets : :class:`katpoint.Catalogue` object, target, or sequence of targets
+            Targets as objects or description strings
+        timestamp : float, optional
+            Time in UTC seconds since Unix epoch (defaults to now)
+        antenna : :class:`katpoint.Antenna` object, optional
+            Antenna pointing at targets (defaults to first session antenna)
+
+        Returns
+        -------
+        el : float or array
+            Elevation angle(s), in degrees (scalar for a single target)
+
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        antenna = self.antennas[0] if antenna is None else antenna
+        tracks, rows = self._lookup(targets, antenna, timestamp)
+        el = tracks.elevation(timestamp, rows)
+        return el[0] if isinstance(targets, (katpoint.Target, basestring)) else el
+
+    def _visible_for_antenna(self, targets, antenna, timestamp, duration, horizon):
+        """Visibility of targets for one antenna, chaining windows if needed."""
+        tracks, rows = self._lookup(targets, antenna, timestamp)
+        up = tracks.elevation(timestamp, rows) >= horizon
+        sets = tracks.next_set(horizon, timestamp, rows)
+        end = timestamp + duration
+        visible = up & (sets > end)
+        # If the observation extends beyond the cached window, continue checking from its end
+        beyond = visible & (end > tracks.end_time)
+        if beyond.any():
+            later = self._visible_for_antenna(targets, antenna, tracks.end_time,
+                                              end - tracks.end_time, horizon)
+            visible &= ~beyond | later
+        return visible
+
+    def visible(self, targets, timestamp=None, duration=0., horizon=None):
+        """Check whether targets are above horizon for given duration.
+
+        Parameters
+        ----------
+        targets : :class:`katpoint.Catalogue` object, target, or sequence of targets
+            Targets as objects or description strings
+        timestamp : float, optional
+            Start time in UTC seconds since Unix epoch (defaults to now)
+        duration : float, optional
+            Duration for which targets should remain up, in seconds
+        horizon : float, optional
+            Elevation limit, in degrees (defaults to engine horizon)
+
+        Returns
+        -------
+        visible : bool or array of bool
+            True if target is visible from all antennas for entire duration
+
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        horizon = self.horizon if horizon is None else horizon
+        visible = np.ones(len(_as_sequence(targets)), dtype=np.bool)
+        for antenna in self.antennas:
+            visible &= self._visible_for_antenna(targets, antenna, timestamp, duration, horizon)
+        if not self.antennas:
+            visible[:] = False
+        return visible[0] if isinstance(targets, (katpoint.Target, basestring)) else visible
+
+    def next_rise(self, targets, timestamp=None, horizon=None):
+        """Time when targets are next above horizon for all antennas (inf if not in window)."""
+        timestamp = time.time() if timestamp is None else timestamp
+        horizon = self.horizon if horizon is None else horizon
+        rises = [tracks.next_rise(horizon, timestamp, rows)
+                 for tracks, rows in [self._lookup(targets, ant, timestamp) for ant in self.antennas]]
+        rise = np.max(rises, axis=0) if rises else np.inf * np.ones(len(_as_sequence(targets)))
+        return rise[0] if isinstance(targets, (katpoint.Target, basestring)) else rise
+
+    def next_set(self, targets, timestamp=None, horizon=None):
+        """Time when targets next set below horizon for any antenna (inf if not in window)."""
+        timestamp = time.time() if timestamp is None else timestamp
+        horizon = self.horizon if horizon is None else horizon
+        sets = [tracks.next_set(horizon, timestamp, rows)
+                for tracks, rows in [self._lookup(targets, ant, timestamp) for ant in self.antennas]]
+        set_time = np.min(sets, axis=0) if sets else np.inf * np.ones(len(_as_sequence(targets)))
+        return set_time[0] if isinstance(targets, (katpoint.Target, basestring)) else set_time
+
+    def iterfilter(self, catalogue, el_limit_deg=None, duration=0., timestamp=None, antenna=None):
+        """Yield targets in catalogue order that are up, as the time progresses.
+
+        This is a drop-in replacement for the elevation filter of
+        :meth:`katpoint.Catalogue.iterfilter`, which evaluates all remaining
+        targets from the cached tracks at each iteration. Optionally the
+        targets can also be required to stay up for a given duration.
+
+        Parameters
+        ----------
+        catalogue : :class:`katpoint.Catalogue` object
+            Catalogue of candidate targets
+        el_limit_deg : float or sequence of 2 floats, optional
+            Allowed elevation range, in degrees. If this is a single number, it
+            is the lower limit, otherwise it takes the form [lower, upper].
+        duration : float, optional
+            Duration for which targets should remain above lower limit, in seconds
+        timestamp : float, optional
+            Time at which to evaluate target positions. If None, the current
+            time *at each iteration* is used.
+        antenna : :class:`katpoint.Antenna` object, optional
+            Antenna which points at targets (defaults to catalogue antenna,
+            or else first session antenna)
+
+        """
+        targets = list(catalogue.targets)
+        antenna = antenna if antenna is not None else getattr(catalogue, 'antenna', None)
+        antenna = antenna if antenna is not None else self.antennas[0]
+        el_limit_deg = [-90.0, 90.0] if el_limit_deg is None else el_limit_deg
+        if np.isscalar(el_limit_deg):
+            el_limit_deg = [el_limit_deg, 90.0]
+        # Keep the full catalogue as cache key and pick out the remaining targets by row
+        self._catalogue = targets
+        remaining = list(range(len(targets)))
+        while remaining:
+            latest_timestamp = time.time() if timestamp is None else timestamp
+            tracks = self.tracks(targets, antenna, latest_timestamp)
+            rows = np.array(remaining)
+            el = tracks.elevation(latest_timestamp, rows)
+            good = (el >= el_limit_deg[0]) & (el <= el_limit_deg[1])
+            if duration > 0 and good.any():
+                good &= tracks.next_set(el_limit_deg[0], latest_timestamp, rows) > latest_timestamp + duration
+            if not good.any():
+                return
+            found = remaining.pop(int(np.flatnonzero(good)[0]))
+            yield targets[found]
@@ -7,14 +7,15 @@ import os
 import textwrap
 import time
 import socket
-import datetime as dt
 import matplotlib.dates as mdates
 import katpoint
+from katsdpscripts.reduction.obs_report_data import ObsReportData
+from katsdpscripts.reduction.memory_budget import MemoryBudget, map_dumps
 
 from matplotlib.backends.backend_pdf import PdfPages
 from matplotlib.ticker import AutoMinorLocator
 from optparse import OptionParser
-from pylab import axes, figure, legend, mean, plot, plt, savefig, sys, text, title, xlabel, xticks, ylabel, ylim, yticks, xlim
+from pylab import axes, figure, legend, plot, plt, savefig, sys, text, title, xlabel, xticks, ylabel, ylim, yticks, xlim
 
 class ObsReporterError(Exception):
     pass
@@ -25,6 +26,7 @@ def get_options():
     parser.add_option('-d', '--tempdir', default='.', help='Name of the temporary directory to use for creating output files [default: current directory]')
     parser.add_option('-k', '--keep', action='store_true', default=False, help='Keep temporary files')
     parser.add_option('--noarchive', action='store_true', default=False, help='Access the file directly, do not use the archive')
+    parser.add_option('--memory-budget', default=None, help='Memory available for data (e.g. 4G), larger selections are read in chunks [default: $KATSDP_MEMORY_BUDGET or half of RAM]')
     opts, args = parser.parse_args()
 
     if opts.filename is None:
@@ -100,40 +102,7 @@ def make_last_page():
     return '\n'.join(lastpage)
 
 
-def lst_date(f):
-    lststring=[]
-    #changing lst to string
-    for t in range(len(f.lst)):
-        lststring.append(("%s:%s"%(("00" if int(np.modf(f.lst[t])[1])==0 else int(np.modf(f.lst[t])[1])), int(np.modf(f.lst[t])[0]*60))))
-
-    elem="None"
-    for a in range(len(lststring)):
-        if lststring[a]=='23:59':
-            elem=a
-
-
-    if elem!="None":
-        for a in range(0,(elem+1)):
-            lststring[a]="18/4/2013 "+lststring[a]
-        for b in range(elem,(len(f.lst)-1)):
-            lststring[b+1]="19/4/2013 "+lststring[b+1]
-    else:
-        for c in range(len(f.lst)):
-            lststring[c]="18/4/2013 "+lststring[c]
-
-    # converting string to time
-    lstime=[dt.datetime.strptime(d,"%d/%m/%Y %H:%M") for d in lststring]
-
-    loc_time=[]
-    for t in range(len(f.timestamps)):
-        loc_time.append(time.localtime(f.timestamps[t]))
-    time_string=[time.strftime("%Y/%m/%d %H:%M:%S",d) for d in loc_time]
-    date_time=[dt.datetime.strptime(d,"%Y/%m/%d %H:%M:%S") for d in time_string]
-
-    return lstime, date_time
-
-
-def plot_time_series(ants,pol,startime,lst_time,loc_datetime):
+def plot_time_series(data,ants,pol,startime,lst_time,loc_datetime):
     #Time Series
     fig=plt.figure(figsize=(13,10), facecolor='w', edgecolor='k')
     plt.suptitle("Time series plot",fontsize=16, fontweight="bold")
@@ -142,15 +111,12 @@ def plot_time_series(ants,pol,startime,lst_time,loc_datetime):
     sub1.set_ylabel("Amplitude",fontweight="bold")
     for ant in ants:
         print ("plotting "+ant.name+"_" +pol+pol+ " time series")
-        f.select(ants=ant,corrprods='auto',pol=pol)
-        if len(f.channels)<1025:
-            f.select(channels=range(200,800))
-        sub1.plot(loc_datetime,10*np.log10(mean(abs(f.vis[:]),1)),label=(ant.name+'_'+pol+pol))
+        sub1.plot(loc_datetime,10*np.log10(data.time_series[ant.name,pol]),label=(ant.name+'_'+pol+pol))
         plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
     legend(loc='right', bbox_to_anchor=(1.13, 0.92), ncol=2, fancybox=True, shadow=False)
     #create a dummy array to plot LST on top x axis
     sub2=sub1.twiny()
-    dummy=[min(sub1.get_yticks()) for i in range(len(f.lst))]
+    dummy=[min(sub1.get_yticks()) for i in range(len(lst_time))]
     sub2.plot(lst_time,dummy,'k')
     sub2.set_xlabel("LST on "+starttime,fontweight="bold")
     plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
@@ -162,7 +128,7 @@ def plot_time_series(ants,pol,startime,lst_time,loc_datetime):
 
 
 
-def plot_spectrum(pol, ant):
+def plot_spectrum(data, pol, ant):
     #Spectrum function
     fig=figure(figsize=(13,10), facecolor='w', edgecolor='k')
     fig.subplots_adjust(hspace=0.25)
@@ -174,20 +140,19 @@ def plot_spectrum(pol, ant):
     for  count in (0,1):
         ab.append(fig.add_subplot(2,1,(count+1)))
         ab[-1].set_ylim(2,16)
-        if len(f.channels)<1025:
+        if len(data.channels)<1025:
             ab[-1].set_xlim(195,805)
         ab[-1].set_xlabel("Channels", fontweight="bold")
         ab[-1].set_ylabel("Amplitude", fontweight="bold")
-        f.select(ants=ant,corrprods='auto',pol=pol[count])
-        abs_vis=np.abs(f.vis[:])
-        if (10*np.log10((abs_vis.max(axis=0)).max())) >16:
-            ab[-1].set_ylim(2,ymax=0.5+(10*np.log10((abs_vis.max(axis=0)).max())))
+        key=(ant.name,pol[count])
+        if (10*np.log10(data.spectrum_max[key].max())) >16:
+            ab[-1].set_ylim(2,ymax=0.5+(10*np.log10(data.spectrum_max[key].max())))
         label_format = '%s_%s%s' % (ant.name, pol[count], pol[count])
         print "Starting to plot the %s spectrum." % (label_format,)
         plotcolours=['g','b','m']
         colours=0
         for stat in ('mean', 'min', 'max'):
-            ab[-1].plot(f.channels, 10*np.log10(getattr(abs_vis,stat)(axis=0)), label=('%s_%s' % (label_format, stat)),color=plotcolours[colours] )
+            ab[-1].plot(data.channels, 10*np.log10(getattr(data,'spectrum_'+stat)[key]), label=('%s_%s' % (label_format, stat)),color=plotcolours[colours] )
             colours+=1
         ab[-1].legend(loc='upper center', bbox_to_anchor=(0.5, 1.03), ncol=4, fancybox=True, shadow=False)
         minorLocator   = AutoMinorLocator()
@@ -200,30 +165,22 @@ def plot_spectrum(pol, ant):
         ylocs,ylabels=yticks()
         xaxis2=ab[-1].twiny()
         dummy=[]
-        for ts in range(len(f.channels)):
+        for ts in range(len(data.channels)):
             dummy.append(min(ylocs))
-        xaxis2.plot(f.channel_freqs/1e6, dummy,'k-')
+        xaxis2.plot(data.channel_freqs/1e6, dummy,'k-')
         xaxis2.ticklabel_format(axis='x', style='plain', useOffset=False)
         xaxis2.set_ylim(min(ylocs),max(ylocs))
         xaxis2.invert_xaxis()
-        xaxis2.set_xlim(xmin=(f.channel_freqs[0]-(f.channel_width*170))/1e6, xmax=(f.channel_freqs[-1]+(f.channel_width*170))/1e6)
+        xaxis2.set_xlim(xmin=(data.channel_freqs[0]-(data.channel_width*170))/1e6, xmax=(data.channel_freqs[-1]+(data.channel_width*170))/1e6)
         xaxis2.set_xlabel("Frequency MHz",fontweight="bold")
 
-        #still to take a closer look at the calculation of the flags
         ab.append(ab[-1].twinx())
-        flag=f.flags()[:]
-        # total_sum=0
-        perc=[]
-        for i in range(len(f.channels)):
-            f_chan=flag[:,i,0].squeeze()
-            suming=f_chan.sum()
-            perc.append(100*(suming/float(f_chan.size)))
-        ab[-1].bar(f.channels,perc,color='r',edgecolor='none')
+        ab[-1].bar(data.channels,data.flags_per_channel[key],color='r',edgecolor='none')
         minorLocator   = AutoMinorLocator()
         ab[-1].xaxis.set_minor_locator(minorLocator)
         ab[-1].set_ylabel("% flagged", fontweight="bold")
         ab[-1].set_ylim(0,100)
-        if len(f.channels)<1025:
+        if len(data.channels)<1025:
             ab[-1].set_xlim(195,805)
     savefig(pp,format='pdf')
 
@@ -354,7 +311,7 @@ def plot_bpcal_selection(f):
                 raise ObsReporterError('The selection criteria resulted in an empty data set.')
             crosscorr = [(f.inputs.index(inpA), f.inputs.index(inpB)) for inpA, inpB in f.corr_products]
             #extract the fringes
-            fringes = np.angle(f.vis[:,:,:])
+            fringes = map_dumps(np.angle, f.vis, f.shape[1:], np.float32, budget, '%s pol fringes' % (pol,))
             #For plotting the fringes
             fig.subplots_adjust(wspace=0., hspace=0.)
             #debug_here()
@@ -447,6 +404,7 @@ def plot_target_selection(f):
 ###########################################################################################################################################
 
 opts = get_options()
+budget = MemoryBudget(opts.memory_budget)
 
 #get data file using katarchive and open it using katfile
 datafile = os.path.basename(opts.filename)
@@ -486,16 +444,19 @@ text(0,0,frontpage,fontsize=12)
 savefig(pp,format='pdf')
 print f
 
-lst_time,loc_datetime=lst_date(f)
-
 ants=f.ants
 pol=['h','v']
+#read the autocorrelations once, gathering all products needed for the time series and spectrum plots
+print "Reading autocorrelation data"
+data=ObsReportData(f,pol,budget=budget)
+lst_time,loc_datetime=data.lst_time,data.loc_datetime
+
 starttime = time.strftime('%d %b %y', time.localtime(f.start_time))
-plot_time_series(ants, pol[0], starttime,lst_time,loc_datetime)
-plot_time_series(ants, pol[1], starttime,lst_time,loc_datetime)
+plot_time_series(data, ants, pol[0], starttime,lst_time,loc_datetime)
+plot_time_series(data, ants, pol[1], starttime,lst_time,loc_datetime)
 
 for ant in ants:
-    plot_spectrum(pol,ant)
+    plot_spectrum(data,pol,ant)
 
 plot_envioronmental_sensors(f,starttime,lst_time,loc_datetime)
 f.select()
@@ -520,6 +481,9 @@ text(0,0,lastpage,fontsize=12)
 savefig(pp,format='pdf')
 plt.close('all')
 pp.close()
+#compare estimated and actual memory use of the data reads
+text_log.write('\n' + budget.report() + '\n')
+print budget.report()
 text_log.close()
 print 'The results are save in %s and the text report in %s' % (pdf_filename, text_log_filename,)
 
@@ -22,8 +22,10 @@ import numpy as np
 from katcorelib.observe import standard_script_options, verify_and_connect, collect_targets, user_logger,start_session
 from katcorelib import colors
 #import katpoint
+from katsdpscripts.attenuation import AttenuatorInput, PowerSampler, adjust_attenuation
 
 wait_secs = 0.5 # time to wait in secs to allow power levels to settle after changing attenuators
+num_samples = 10 # number of power sensor samples to take the median of
 
 def ant_pedestal(kat, ant_name):
     """Pedestal device associated with antenna device."""
@@ -47,114 +49,62 @@ def set_k7_gains(kat,value):
 
 
 
-###################### RFE Stage 5 getters and setters ########################
+###################### RFE Stage 5 inputs ########################
 
 # RFE5 minimum attenuation, maximum attenuation, finest resolution to which attenuation can be set, all in dB
 rfe5_min_att, rfe5_max_att, rfe5_att_step = 0.0, 63.5, 0.5
 rfe5_power_range = 2.
 rfe5_out_max_meas_power = -40 # dBm - power sensor cannot measure larger signals than this
 
-def get_rfe5_input_power(kat, inputs):
-    power = np.zeros((len(inputs),100))
-    sensor_list = []
-    for key,(ant_name,pol) in enumerate(inputs):
-        ped = ant_pedestal(kat, ant_name)
-        sensor_list.append(getattr(ped.sensor, 'rfe5_%s_power_in' % ('horizontal' if pol == 'H' else 'vertical',)))
-    for t in range(100): # Read sensor 100 times in one second and return median to obtain a more stable value
-        for key,sensor in  enumerate(sensor_list):
-            power[key,t] = sensor.get_value()
-        time.sleep(0.01) # second sample
-    return np.median(power,axis=1)
-
-def get_rfe5_attenuation(kat, inputs):
-    sensor_val = []
-    for ant_name,pol in inputs:
-        ped = ant_pedestal(kat, ant_name)
-        sensor = getattr(ped.sensor, 'rfe5_attenuator_%s' % ('horizontal' if pol == 'H' else 'vertical',))
-        sensor_val.append(sensor.get_value())
-    return np.array(sensor_val)
-
-def set_rfe5_attenuation(kat, inputs, inputs_attenuation):
-    #sensor_val = []
-    for (ant_name,pol),value in zip(inputs,inputs_attenuation):
-        ped = ant_pedestal(kat, ant_name)
-        ped.req.rfe5_attenuation(pol.lower(), value)
-
-def get_rfe5_output_power(kat, inputs):
-    power = np.zeros((len(inputs),100))
-    sensor_list = []
-    for key,(ant_name,pol) in enumerate(inputs):
-        ped = ant_pedestal(kat, ant_name)
-        sensor_list.append(getattr(ped.sensor, 'rfe5_%s_power_out' % ('horizontal' if pol == 'H' else 'vertical',)))
-    for t in range(100): # Read sensor 100 times in one second and return median to obtain a more stable value
-        for key,sensor in  enumerate(sensor_list):
-            power[key,t] = sensor.get_value()
-        time.sleep(0.01) # second sample
-    return np.median(power,axis=1)
-
-###################### RFE Stage 7 getters and setters ########################
+def rfe5_power_sensors(kat, inputs, direction='out'):
+    """RFE5 input ('in') or output ('out') power sensors of inputs."""
+    return [(ant_pedestal(kat, ant_name), 'rfe5_%s_power_%s' % ('horizontal' if pol == 'H' else 'vertical', direction))
+            for ant_name, pol in inputs]
+
+def rfe5_inputs(kat, inputs, power_sensors):
+    """RFE5 attenuators of inputs, followed by the given power sensors."""
+    def set_att(ped, pol):
+        return lambda value: ped.req.rfe5_attenuation(pol.lower(), value)
+    return [AttenuatorInput('%s %s' % (ant_name, pol),
+                            (ant_pedestal(kat, ant_name), 'rfe5_attenuator_%s' % ('horizontal' if pol == 'H' else 'vertical',)),
+                            set_att(ant_pedestal(kat, ant_name), pol), power_sensor)
+            for (ant_name, pol), power_sensor in zip(inputs, power_sensors)]
+
+###################### RFE Stage 7 inputs ########################
 
 # RFE7 minimum attenuation, maximum attenuation, finest resolution to which attenuation can be set, all in dB
 rfe7_min_att, rfe7_max_att, rfe7_att_step = 0.0, 31.5, 0.5
 
-def get_rfe7_attenuation(kat, inputs):
-    sensor_val = []
-    for ant_name,pol in inputs:
-        sensor = getattr(kat.rfe7.sensor, 'rfe7_downconverter_%s_%s_attenuation' % (ant_name, pol.lower()))
-        sensor_val.append(sensor.get_value())
-    return np.array(sensor_val)
-
-def set_rfe7_attenuation(kat, inputs, inputs_attenuation):
-    #sensor_val = []
-    for (ant_name,pol),value in zip(inputs,inputs_attenuation):
+def rfe7_inputs(kat, inputs, power_sensors):
+    """RFE7 attenuators of inputs, followed by the given power sensors."""
+    def set_att(ant_name, pol):
         # This assumes that antenna names have the format 'antx', where x is an integer (the antenna number)
         ant_num = int(ant_name.strip()[3:])
-        kat.rfe7.req.rfe7_downconverter_attenuation(str(ant_num), pol, value)
+        return lambda value: kat.rfe7.req.rfe7_downconverter_attenuation(str(ant_num), pol, value)
+    return [AttenuatorInput('%s %s' % (ant_name, pol),
+                            (kat.rfe7, 'rfe7_downconverter_%s_%s_attenuation' % (ant_name, pol.lower())),
+                            set_att(ant_name, pol), power_sensor)
+            for (ant_name, pol), power_sensor in zip(inputs, power_sensors)]
 
-################################ DBE getters ##################################
+################################ DBE sensors ##################################
 
 connected_antpols = {}
 dbe_power_range = 2. # dBm - Jason reckons we need to get within 1 dBm of the target DBE input power level
 
-def get_dbe_input_power(kat, inputs, dbe):
-    sensor_val = []
-    for ant_name,pol in inputs:
-        if dbe == 'dbe7':
-            dbe_input = ant_name + pol.lower()
-            dbe_device = getattr(kat, dbe)
-            power_sensor = getattr(dbe_device.sensor, "dbe_%s_adc_power" % dbe_input)
-            if power_sensor.get_value() is None :
-                raise ValueError("The sensor dbe_%s_adc_power on %s is not returning a value." % (dbe_input,dbe))
-            sensor_val.append( power_sensor.get_value())
-        else:
-            raise ValueError("Unknown dbe device (%s) specified. Expecting either 'dbe' or 'dbe7'" % (dbe))
-    return np.array(sensor_val)
-
-####################### Generic iterative adjustment ##########################
-
-def adjust(kat, inputs, get_att, set_att, dbe, desired_power, min_att, max_att, att_step, wait=wait_secs):
-    """Iteratively adjust attenuator to move power towards desired value."""
-    # This should converge in a few iterations, else stop anyway
-    for n in range(5):
-        att = get_att(kat, inputs)
-        power = get_dbe_input_power(kat, inputs, dbe)
-        # The difference between actual and desired power is roughly the extra attenuation needed
-        new_att = att + power - desired_power
-        # Round desired attenuation to the nearest allowed one
-        new_att = np.round((new_att - min_att) / att_step) * att_step + min_att
-        # Force attenuation to stay within allowed range
-        new_att = np.clip(new_att, min_att, max_att)
-        # Stop once attenuator value has settled
-        #if new_att == att:
-        #    break
-        set_att(kat, inputs, new_att)
-        # Wait until power has stabilised before making the next measurement
-        time.sleep(wait)
-        # Obtain latest measurements on the last iteration
-        if n == 4:
-            att = get_att(kat, inputs)
-            power = get_dbe_input_power(kat, inputs, dbe)
-    return att, power
+def dbe_power_sensors(kat, inputs, dbe):
+    """DBE ADC power sensors of inputs."""
+    if dbe != 'dbe7':
+        raise ValueError("Unknown dbe device (%s) specified. Expecting either 'dbe' or 'dbe7'" % (dbe))
+    return [(getattr(kat, dbe), "dbe_%s%s_adc_power" % (ant_name, pol.lower())) for ant_name, pol in inputs]
+
+def median_power(power_sensors, num_samples=num_samples):
+    """Median of latest power samples of all sensors, sampled concurrently."""
+    with PowerSampler(power_sensors) as sampler:
+        sampler.wait(num_samples)
+        return sampler.medians()
+
+def attenuations(stage_inputs):
+    return np.array([inp.get_att() for inp in stage_inputs])
 
 ############################### Main script ###################################
 
@@ -243,45 +193,43 @@ with verify_and_connect(opts) as kat:
                     inputs.append([ant.name, pol.upper()])
 
             # Adjust RFE stage 5 attenuation to give desired output power
-            rfe5_att = get_rfe5_attenuation(kat, inputs)
-            rfe5_in = get_rfe5_input_power(kat, inputs)
-            rfe5_out = get_rfe5_output_power(kat, inputs)
+            rfe5_in_sensors = rfe5_power_sensors(kat, inputs, 'in')
+            rfe5_out_sensors = rfe5_power_sensors(kat, inputs, 'out')
+            dbe_sensors = dbe_power_sensors(kat, inputs, 'dbe7')
+            rfe5_stage = rfe5_inputs(kat, inputs, rfe5_out_sensors)
+            rfe5_att = attenuations(rfe5_stage)
+            rfe5_in = median_power(rfe5_in_sensors)
+            rfe5_out = median_power(rfe5_out_sensors)
             for key,data in enumerate(inputs):
                 user_logger.info("%s %s: Start RFE5 input power | atten | output power = %-4.1f | %-4.1f | %-4.1f" % (data[0],data[1],rfe5_in[key], rfe5_att[key], rfe5_out[key]))
 
-            # The difference between actual and desired power is roughly the extra attenuation needed
-            rfe5_att = rfe5_att + rfe5_out - opts.rfe5_desired_power
-            # Round desired attenuation to the nearest allowed one
-            rfe5_att = np.round((rfe5_att - rfe5_min_att) / rfe5_att_step) * rfe5_att_step + rfe5_min_att
-            # Force attenuation to stay within allowed range
-            rfe5_att = np.clip(rfe5_att, rfe5_min_att, rfe5_max_att )
-
-            for key,data in enumerate(inputs):
-                user_logger.info("%s %s: Setting updated RFE5 attenuation of %-4.1f dB" %  (data[0],data[1],rfe5_att[key]))
-            set_rfe5_attenuation(kat, inputs, rfe5_att)
-            time.sleep(wait_secs) # add a small sleep to allow change to propagate
-
-            # Get the newly-set rfe5 attenuation value as a check and new
-            # rfe5 input and output power value (input should be approx same)
-            rfe5_att = get_rfe5_attenuation(kat, inputs)
-            rfe5_in = get_rfe5_input_power(kat, inputs)
-            rfe5_out = get_rfe5_output_power(kat, inputs)
+            # All inputs are adjusted concurrently and each input stops once it is in range
+            rfe5_att, rfe5_out, rfe5_success = adjust_attenuation(rfe5_stage, opts.rfe5_desired_power,
+                                                                  rfe5_min_att, rfe5_max_att, rfe5_att_step,
+                                                                  rfe5_power_range, settle_time=wait_secs,
+                                                                  num_samples=num_samples)
+            # Get new rfe5 input power value (should be approx same)
+            rfe5_in = median_power(rfe5_in_sensors)
             for key,data in enumerate(inputs):
                 user_logger.info("%s %s: Updated RFE5 input power | atten | output power = %-4.1f | %-4.1f | %-4.1f" % (data[0],data[1],rfe5_in[key], rfe5_att[key], rfe5_out[key]))
 
             # Adjust RFE stage 7 attenuation to give desired DBE input power
-            rfe7_att, dbe_in = adjust(kat, inputs, get_rfe7_attenuation, set_rfe7_attenuation,
-                                      'dbe7', opts.dbe_desired_power,
-                                      rfe7_min_att, rfe7_max_att, rfe7_att_step)
+            rfe7_att, dbe_in, dbe_success = adjust_attenuation(rfe7_inputs(kat, inputs, dbe_sensors),
+                                                               opts.dbe_desired_power,
+                                                               rfe7_min_att, rfe7_max_att, rfe7_att_step,
+                                                               dbe_power_range, settle_time=wait_secs,
+                                                               num_samples=num_samples)
             # If RFE7 hits minimum attenuation, go back to RFE5 to try and reach desired DBE input power
-            rfe5_att, dbe_in = adjust(kat, inputs, get_rfe5_attenuation, set_rfe5_attenuation,
-                                      'dbe7', opts.dbe_desired_power,
-                                      rfe5_min_att, rfe5_max_att, rfe5_att_step)
-            rfe5_out = get_rfe5_output_power(kat, inputs)
+            # (inputs that are already in range are left alone)
+            rfe5_att, dbe_in, dbe_success = adjust_attenuation(rfe5_inputs(kat, inputs, dbe_sensors),
+                                                               opts.dbe_desired_power,
+                                                               rfe5_min_att, rfe5_max_att, rfe5_att_step,
+                                                               dbe_power_range, settle_time=wait_secs,
+                                                               num_samples=num_samples)
+            rfe5_out = median_power(rfe5_out_sensors)
             # Check whether final power levels are within expected bounds
             rfe5_success = np.abs(rfe5_out - opts.rfe5_desired_power) <= rfe5_power_range / 2
 
-            dbe_success = np.abs(dbe_in - opts.dbe_desired_power) <= dbe_power_range / 2.
             for key,data in enumerate(inputs):
                 user_logger.info('%s %s: %-4.1f | %4.1f | %s%-4.1f%s | %4.1f | %s%-4.1f%s' %
                              (data[0],data[1], rfe5_in[key], rfe5_att[key],
@@ -24,9 +24,12 @@
 from optparse import OptionParser
 import sys, math, time
 
+import numpy as np
+
 import katcorelib, katpoint
 from katcorelib.defaults import activity_logger, user_logger
 from katmisc.utils.ansi import col, getKeyIf
+from katsdpscripts.sensor_rules import RuleSet
 
 # Some globals
 busy_colour = 'blue'
@@ -36,8 +39,6 @@ critical_colour2 = 'blinkyellow'
 error_colour = 'red'
 warn_colour = 'brown'
 normal_colour = 'normal'
-# other possibilities are warn, nominal, inactive
-sensor_status_errors = ['unreachable', 'failure', 'error', 'unknown']
 # array centre position
 K7 = katpoint.Antenna('K7, -30:43:17.3, 21:24:38.5, 1038.0, 12.0')
 quiet_check_refresh = 5 # time in secs between sensor checks in quiet mode (under the hood)
@@ -229,97 +230,56 @@ def print_sensor(colour,sensor,val,min_val,max_val,m,n,quiet,action=''):
           (val).ljust(25),str(min_val).ljust(25),str(max_val).ljust(25)+col(normal_colour))
 
 
-def update_alarm(alarms,sensor,m,n,action):
-    updated = False
-    if m==1 and n==1: # if not m from n case
-        if action == 'trigger':
-            if not alarms.has_key(sensor):
-                alarms[sensor] = 1 # the 1 is arb and not used currently
-                updated = True
-        elif action == 'clear':
-            if alarms.has_key(sensor):
-                alarms.pop(sensor) # remove sensor from alarm
-                updated = True
-    else: # for an m from n case:
-        if not alarms.has_key(sensor):
-            if action == 'trigger':
-                alarms[sensor] = [1,1] # 1 from 1
-            else: # action must be 'clear'
-                alarms[sensor] = [0,1] # 0 from 1
-        else:
-            if alarms[sensor][1] < n:
-                alarms[sensor][1] = alarms[sensor][1] + 1
-                if action == 'trigger':
-                    alarms[sensor][0] = alarms[sensor][0] + 1
-                    if alarms[sensor][0] == m:
-                        updated = True
-            else: # n values have already been checked
-                if action == 'trigger' and alarms[sensor][0] < n:
-                    alarms[sensor][0] = alarms[sensor][0] + 1
-                    if alarms[sensor][0] == m: updated = True
-                else: # action must be 'clear'
-                    if alarms[sensor][0] == m: updated = True
-                    alarms[sensor][0] = max(alarms[sensor][0] - 1,0)
-    return updated
-
-
-def check_sensors(kat, opts, selected_sensors, quiet=False, alarms={}):
+def check_sensors(kat, opts, rules, quiet=False, alarms=None):
     """ Check current system setting and compare with expected range as specified above.
     Things appear colour-coded according to whether in expected range and sensor status.
+    The rules are compiled and their sensors resolved once at startup (see katsdpscripts.sensor_rules),
+    so that each check is a single pass over the latest sensor readings. In quiet mode, the m-of-n
+    state of each sensor is kept in the *alarms* ring buffers and only changes in alarm state are shown.
     """
     
     potential_problems = False
     
-    if len(selected_sensors) == 0:
+    if len(rules) == 0:
         potential_problems = True
         print col(error_colour) + 'No sensors to check! Are you sure this device is connected?' + col(normal_colour)
-    
-    for checker, min_val, max_val, m, n in selected_sensors:
-        if checker.strip() == '':
+        return potential_problems
+
+    values, statuses = rules.read()
+    ok = rules.evaluate(values, statuses)
+    quiet_warning = np.zeros(len(rules), dtype=bool)
+    if quiet and opts.warn:
+        quiet_warning = ok & (statuses == 'warn')
+        ok &= ~quiet_warning
+    if quiet:
+        raised, cleared = alarms.update(~ok)
+    potential_problems = not ok.all()
+
+    for index in rules.layout:
+        if index is None:
             if opts.verbose: print '' # print a blank line, but skip this if only showing errors
-        else:
-            try:
-                current_val = str(eval(checker))
-                sensor_status = str(eval(checker.split('.get_value()')[0] + '.status'))
-                sensor_ok = False
-                quiet_warning = False
-
-                if current_val == 'None':
-                    potential_problems = True
-                    if not quiet or (quiet and update_alarm(alarms,checker,m,n,'trigger')):
-                        print_sensor(error_colour,checker,'<no value>',min_val,max_val,m,n,quiet,'trigger')
-                    return potential_problems
-                
-                if type(min_val) is list:
-                    if current_val in min_val and sensor_status not in sensor_status_errors:
-                        sensor_ok = True
-                elif (min_val <= float(current_val) and float(current_val) <=  max_val) and sensor_status not in sensor_status_errors:
-                    sensor_ok = True
-                
-                if quiet and opts.warn and sensor_status == 'warn' and sensor_ok == True:
-                    sensor_ok = False
-                    quiet_warning = True
-
-                if sensor_ok:
-                    if opts.verbose: # won't be verbose in quiet mode (check is performed earlier)
-                        if sensor_status == 'warn':
-                            print_sensor(warn_colour,checker,str(current_val)+' (' + sensor_status + ')',min_val,max_val,m,n,quiet)
-                        else:
-                            print_sensor(ok_colour,checker,current_val,min_val,max_val,m,n,quiet,'clear')
-                    elif quiet and update_alarm(alarms,checker,m,n,'clear'): # quiet mode where sensor alarm toggles to 'clear'
-                        print_sensor(ok_colour,checker,current_val,min_val,max_val,m,n,quiet,'clear')
-                else:
-                    potential_problems = True
-                    if not quiet or (quiet and update_alarm(alarms,checker,m,n,'trigger')):
-                        if quiet_warning:
-                            print_sensor(warn_colour,checker,str(current_val)+' (' + sensor_status + ')',min_val,max_val,m,n,quiet,'trigger')
-                        else:
-                            print_sensor(error_colour,checker,str(current_val)+' (' + sensor_status + ')',min_val,max_val,m,n,quiet,'trigger')
-                            
-            except Exception, e:
-                potential_problems = True
+            continue
+        rule, current_val, sensor_status = rules[index], values[index], statuses[index]
+        checker, min_val, max_val, m, n = rule.checker, rule.min_val, rule.max_val, rule.m, rule.n
+        if current_val is None:
+            if rules.sensors[index] is None or rules.errors[index]:
                 print col(error_colour) + 'Could not check ',checker, ' [expected range: %r , %r]' % (min_val,max_val)
-                print str(e) + col(normal_colour)
+                print str(rules.errors[index]) + col(normal_colour)
+            elif not quiet or raised[index]:
+                print_sensor(error_colour,checker,'<no value>',min_val,max_val,m,n,quiet,'trigger')
+            continue
+        current_val = str(current_val)
+        if ok[index]:
+            if opts.verbose: # won't be verbose in quiet mode (check is performed earlier)
+                if sensor_status == 'warn':
+                    print_sensor(warn_colour,checker,current_val+' (' + sensor_status + ')',min_val,max_val,m,n,quiet)
+                else:
+                    print_sensor(ok_colour,checker,current_val,min_val,max_val,m,n,quiet,'clear')
+            elif quiet and cleared[index]: # quiet mode where sensor alarm toggles to 'clear'
+                print_sensor(ok_colour,checker,current_val,min_val,max_val,m,n,quiet,'clear')
+        elif not quiet or raised[index]:
+            colour = warn_colour if quiet_warning[index] else error_colour
+            print_sensor(colour,checker,current_val+' (' + sensor_status + ')',min_val,max_val,m,n,quiet,'trigger')
 
     return potential_problems
 
@@ -621,6 +581,9 @@ if __name__ == '__main__':
             selected_sensors = sensor_group_dict[opts.sensor_group]
         except KeyError:
             raise KeyError('Unknown sensor group "%s", expected one of %s' % (opts.sensor_group, sensor_group_dict_keys))
+        # parse and validate the sensor rules and look up their sensors once, up front
+        rules = RuleSet(selected_sensors)
+        rules.resolve(kat)
 
         activity_logger.info("basic_health_check.py: start")
         user_interupt = False
@@ -637,12 +600,12 @@ if __name__ == '__main__':
                 refresh_cycle_start =  time.time()
                 refresh_forced = False # keyboard input forced refresh
                 print '\nCurrent local time: %s' % (time.ctime(refresh_cycle_start))
-                alarms = {} # reset any alarms when full refresh
+                alarms = rules.alarm_windows() # reset any alarms when full refresh
                 show_status_header(kat,opts,selected_sensors)
                 if not opts.header_only:
                     if not opts.quiet:
                         print_checks_header()
-                        potential_problems = check_sensors(kat,opts,selected_sensors)
+                        potential_problems = check_sensors(kat,opts,rules)
                         print_check_result(potential_problems)
                         print_msg(opts.quiet,opts.header_only,opts.refresh,opts.max_duration,end_time)
                     else:
@@ -655,7 +618,7 @@ if __name__ == '__main__':
                             this_cycle_start = time.time()
                             if (quiet_cycles % 360) == 0: # 360 -> 30 mins for 5 sec quiet_cycle_refresh
                                 print 'In quiet loop: Current local time: ' + time.ctime()
-                            check_sensors(kat,opts,selected_sensors,opts.quiet,alarms)
+                            check_sensors(kat,opts,rules,opts.quiet,alarms)
                             time_now = time.time()
                             if opts.refresh > 1.0:
                                 if time_now > quiet_cycles_start + opts.refresh: quiet_cycles_ended = True
@@ -33,125 +33,8 @@ import katpoint
 from katcorelib import standard_script_options, verify_and_connect, collect_targets, \
                        start_session, user_logger, ant_array
 import numpy as np
-import scipy
-from scikits.fitting import NonLinearLeastSquaresFit, PiecewisePolynomial1DFit
-
-#anystowed=np.any([res._returns[0][4]=='STOW' for res in all_ants.req.sensor_value('mode').values()])
-def plane_to_sphere_holography(targetaz,targetel,ll,mm):
-    scanaz=targetaz-np.arcsin(np.clip(ll/np.cos(targetel),-1.0,1.0))
-    scanel=np.arcsin(np.clip((np.sqrt(1.0-ll**2-mm**2)*np.sin(targetel)+np.sqrt(np.cos(targetel)**2-ll**2)*mm)/(1.0-ll**2),-1.0,1.0))
-    return scanaz,scanel
-    
-#same as katpoint.projection._sphere_to_plane_common(az0=scanaz,el0=scanel,az=targetaz,el=targetel) with ll=ortho_x,mm=-ortho_y
-def sphere_to_plane_holography(targetaz,targetel,scanaz,scanel):
-    #produces direction cosine coordinates from scanning antenna azimuth,elevation coordinates
-    #see _coordinate options.py for derivation
-    ll=np.cos(targetel)*np.sin(targetaz-scanaz)
-    mm=np.cos(targetel)*np.sin(scanel)*np.cos(targetaz-scanaz)-np.cos(scanel)*np.sin(targetel)
-    return ll,mm
-
-def spiral(params,indep):
-    x0=indep[0]
-    y0=indep[1]
-    r=params[0]
-    x=r*np.cos(2.0*np.pi*r)
-    y=r*np.sin(2.0*np.pi*r)
-    return np.sqrt((x-x0)**2+(y-y0)**2)
-
-#note that we want spiral to only extend to above horizon for first few scans in case source is rising
-#should test if source is rising or setting before each composite scan, and use -compositey if setting
-def generatespiral(totextent,tottime,tracktime=1,sampletime=1,kind='uniform',mirrorx=False):
-    totextent=np.float(totextent)
-    tottime=np.float(tottime)
-    sampletime=np.float(sampletime)
-    nextrazeros=int(np.float(tracktime)/sampletime)
-    print 'nextrazeros',nextrazeros
-    tracktime=nextrazeros*sampletime
-    radextent=np.float(totextent)/2.0
-    if (kind=='dense-core'):
-        c=np.sqrt(2)*180.0/(16.0*np.pi)
-        narms=2*int(np.sqrt(tottime/c+(tracktime/c)**2)-tracktime/c)#ensures even number of arms - then scan pattern ends on target (if odd it will not)
-        ntime=int((tottime-tracktime*narms)/(sampletime*narms))
-        armrad=radextent*(np.linspace(0,1,ntime))
-        armtheta=np.linspace(0,np.pi,ntime)
-        armx=armrad*np.cos(armtheta)
-        army=armrad*np.sin(armtheta)
-    elif (kind=='approx'):
-        c=180.0/(16.0*np.pi)
-        narms=2*int(np.sqrt(tottime/c+(tracktime/c)**2)-tracktime/c)#ensures even number of arms - then scan pattern ends on target (if odd it will not)
-        ntime=int((tottime-tracktime*narms)/(sampletime*narms))
-        armrad=radextent*(np.linspace(0,1,ntime))
-        armtheta=np.linspace(0,np.pi,ntime)
-        armx=armrad*np.cos(armtheta)
-        army=armrad*np.sin(armtheta)
-        dist=np.sqrt((armx[:-1]-armx[1:])**2+(army[:-1]-army[1:])**2)
-        narmrad=np.cumsum(np.concatenate([np.array([0]),1.0/dist]))
-        narmrad*=radextent/max(narmrad)
-        narmtheta=narmrad/radextent*np.pi
-        armx=narmrad*np.cos(narmtheta)
-        army=narmrad*np.sin(narmtheta)
-    else:#'uniform'
-        c=180.0/(16.0*np.pi)
-        narms=2*int(np.sqrt(tottime/c+(tracktime/c)**2)-tracktime/c)#ensures even number of arms - then scan pattern ends on target (if odd it will not)
-        ntime=int((tottime-tracktime*narms)/(sampletime*narms))
-        armx=np.zeros(ntime)
-        army=np.zeros(ntime)
-        #must be on curve x=t*cos(np.pi*t),y=t*sin(np.pi*t)
-        #intersect (x-x0)**2+(y-y0)**2=1/ntime**2 with spiral
-        lastr=0.0
-        for it in range(1,ntime):
-            data=np.array([1.0/ntime])
-            indep=np.array([armx[it-1],army[it-1]])#last calculated coordinate in arm, is x0,y0
-            initialparams=np.array([lastr+1.0/ntime]);
-            fitter=NonLinearLeastSquaresFit(spiral,initialparams)
-            fitter.fit(indep,data)
-            lastr=fitter.params[0];
-            armx[it]=lastr*np.cos(2.0*np.pi*lastr)
-            army[it]=lastr*np.sin(2.0*np.pi*lastr)
-
-        maxrad=np.sqrt(armx[it]**2+army[it]**2)
-        armx=armx*radextent/maxrad
-        army=army*radextent/maxrad
-    # ndist=sqrt((armx[:-1]-armx[1:])**2+(army[:-1]-army[1:])**2)
-    # print ndist
-
-    compositex=[[] for ia in range(narms)]
-    compositey=[[] for ia in range(narms)]
-    ncompositex=[[] for ia in range(narms)]
-    ncompositey=[[] for ia in range(narms)]
-    reverse=False
-    for ia in range(narms):
-        rot=-ia*np.pi*2.0/narms
-        x=armx*np.cos(rot)-army*np.sin(rot)
-        y=armx*np.sin(rot)+army*np.cos(rot)
-        nrot=ia*np.pi*2.0/narms
-        nx=armx*np.cos(nrot)-army*np.sin(nrot)
-        ny=armx*np.sin(nrot)+army*np.cos(nrot)
-        if (nextrazeros>0):
-            x=np.r_[np.repeat(0.0,nextrazeros),x]
-            y=np.r_[np.repeat(0.0,nextrazeros),y]
-            nx=np.r_[np.repeat(0.0,nextrazeros),nx]
-            ny=np.r_[np.repeat(0.0,nextrazeros),ny]
-        if reverse:
-            reverse=False
-            x=x[::-1]
-            y=y[::-1]
-            nx=nx[::-1]
-            ny=ny[::-1]
-        else:
-            reverse=True
-        if (mirrorx):
-            compositex[ia]=-x
-            compositey[ia]=y
-            ncompositex[ia]=-nx
-            ncompositey[ia]=ny
-        else:
-            compositex[ia]=x
-            compositey[ia]=y
-            ncompositex[ia]=nx
-            ncompositey[ia]=ny
-    
-    return compositex,compositey,ncompositex,ncompositey
+from katsdpscripts.holography import generatespiral, scan_offsets
+from katsdpscripts.safety import SafetyMonitor, SafetyInterrupt
 
 
 # Set up standard script options
@@ -177,6 +60,9 @@ parser.add_option('--sampletime', type='float', default=1.0,
                   help='time in seconds to spend on pointing (default=%default)')
 parser.add_option('--mirrorx', action="store_true", default=False,
                   help='Mirrors x coordinates of pattern (default=%default)')
+parser.add_option('--max-accel', type='float', default=None,
+                  help='Limit centripetal acceleration along uniform spiral arms to this many degrees per second '
+                       'squared, which lengthens the arms (default=no limit)')
 parser.add_option('--no-delays', action="store_true", default=False,
                   help='Do not use delay tracking, and zero delays')
 # Set default value for any option (both standard and experiment-specific options)
@@ -184,7 +70,7 @@ parser.set_defaults(description='Spiral holography scan', nd_params='off')
 # Parse the command line
 opts, args = parser.parse_args()
 
-compositex,compositey,ncompositex,ncompositey=generatespiral(totextent=opts.scan_extent,tottime=opts.cycle_duration,tracktime=opts.tracktime,sampletime=opts.sampletime,kind=opts.kind,mirrorx=opts.mirrorx)
+compositex,compositey,ncompositex,ncompositey=generatespiral(totextent=opts.scan_extent,tottime=opts.cycle_duration,tracktime=opts.tracktime,sampletime=opts.sampletime,kind=opts.kind,mirrorx=opts.mirrorx,max_accel=opts.max_accel)
 timeperstep=opts.sampletime;
 
 if len(args) == 0:
@@ -225,6 +111,9 @@ with verify_and_connect(opts) as kat:
         scan_ants = ant_array(kat, opts.scan_ants if opts.scan_ants else session.ants[0], 'scan_ants')
         # Assign rest of antennas to tracking antenna subarray
         track_ants = ant_array(kat, [ant for ant in all_ants if ant not in scan_ants], 'track_ants')
+        # Subscribe once to the mode / stow sensors of all antennas instead of polling them on every step
+        safety = SafetyMonitor(all_ants, enabled=not kat.dry_run)
+        safety.start()
         # Disable noise diode by default (to prevent it firing on scan antennas only during scans)
         nd_params = session.nd_params
         session.nd_params = {'diode': 'coupler', 'off': 0, 'on': 0, 'period': -1}
@@ -267,7 +156,7 @@ with verify_and_connect(opts) as kat:
                         session.ants = all_ants
                         user_logger.info("Using all antennas: %s" % (' '.join([ant.name for ant in session.ants]),))
                         session.track(target, duration=0, announce=False)
-                        if (not any([res._returns[0][4]=='STOW' for res in all_ants.req.sensor_value('mode').values()])):
+                        if not safety.unsafe:
                             scan_index=0
                             wasstowed=False
                             session.fire_noise_diode(announce=False, **nd_params)#provides opportunity to fire noise diode
@@ -275,34 +164,33 @@ with verify_and_connect(opts) as kat:
                             user_logger.info("Using scan antennas: %s" % (' '.join([ant.name for ant in session.ants]),))
                             if (cx[iarm][scan_index]!=0.0 or cy[iarm][scan_index]!=0.0):
                                 targetaz_rad,targetel_rad=target.azel()
-                                scanaz,scanel=plane_to_sphere_holography(targetaz_rad,targetel_rad,cx[iarm][scan_index]*np.pi/180.0,cy[iarm][scan_index]*np.pi/180.0)
-                                # targetx,targety=katpoint.sphere_to_plane[opts.projection](targetaz_rad,targetel_rad,scanaz,scanel)
-                                targetx,targety=sphere_to_plane_holography(scanaz,scanel,targetaz_rad,targetel_rad)
-                                session.ants.req.offset_fixed(targetx*180.0/np.pi,-targety*180.0/np.pi,opts.projection)
+                                offsetx,offsety=scan_offsets(targetaz_rad,targetel_rad,cx[iarm][scan_index],cy[iarm][scan_index])
+                                session.ants.req.offset_fixed(offsetx,offsety,opts.projection)
                                 # session.ants.req.offset_fixed(cx[iarm][scan_index],cy[iarm][scan_index],opts.projection)
                                 time.sleep(10)#gives 10 seconds to slew to outside arm if that is where pattern commences
                             user_logger.info("Recovered from wind stow, repeating cycle %d scan %d"%(cycle+1,iarm+1))
                         else:
-                            time.sleep(60)
+                            safety.wait_until_safe(timeout=60)
                     lastproctime=time.time()
-                    for scan_index in range(len(cx[iarm])):#spiral arm scan
-                        targetaz_rad,targetel_rad=target.azel()
-                        scanaz,scanel=plane_to_sphere_holography(targetaz_rad,targetel_rad,cx[iarm][scan_index]*np.pi/180.0,cy[iarm][scan_index]*np.pi/180.0)
-                        # targetx,targety=katpoint.sphere_to_plane[opts.projection](targetaz_rad,targetel_rad,scanaz,scanel)
-                        targetx,targety=sphere_to_plane_holography(scanaz,scanel,targetaz_rad,targetel_rad)
-                        session.ants.req.offset_fixed(targetx*180.0/np.pi,-targety*180.0/np.pi,opts.projection)
-                        # session.ants.req.offset_fixed(cx[iarm][scan_index],cy[iarm][scan_index],opts.projection)
-                        curproctime=time.time()
-                        proctime=curproctime-lastproctime
-                        if (timeperstep>proctime):
-                            time.sleep(timeperstep-proctime)
-                        lastproctime=time.time()
-                        if not kat.dry_run and (np.any([res._returns[0][4]=='STOW' for res in all_ants.req.sensor_value('mode').values()])):
-                            if (wasstowed==False):
-                                user_logger.info("Cycle %d scan %d interrupted. Some antennas are stowed ... waiting to resume scanning"%(cycle+1,iarm+1) )
-                            wasstowed=True
-                            time.sleep(60)
-                            break#repeats this spiral arm scan if stow occurred
+                    #offsets for the whole arm, evaluated at the times when each point is due to be requested
+                    targetaz_rad,targetel_rad=target.azel(lastproctime+np.arange(len(cx[iarm]))*timeperstep)
+                    offsetx,offsety=scan_offsets(targetaz_rad,targetel_rad,cx[iarm],cy[iarm])
+                    try:
+                        for scan_index in range(len(cx[iarm])):#spiral arm scan
+                            session.ants.req.offset_fixed(offsetx[scan_index],offsety[scan_index],opts.projection)
+                            # session.ants.req.offset_fixed(cx[iarm][scan_index],cy[iarm][scan_index],opts.projection)
+                            curproctime=time.time()
+                            proctime=curproctime-lastproctime
+                            if (timeperstep>proctime):
+                                time.sleep(timeperstep-proctime)
+                            lastproctime=time.time()
+                            safety.check()
+                    except SafetyInterrupt, e:#repeats this spiral arm scan if stow occurred
+                        if (wasstowed==False):
+                            user_logger.info("Cycle %d scan %d interrupted (%s) ... waiting to resume scanning"%(cycle+1,iarm+1,e) )
+                        wasstowed=True
+                        safety.wait_until_safe(timeout=60)
+        safety.stop()
         #set session antennas to all so that stow-when-done option will stow all used antennas and not just the scanning antennas
         session.ants = all_ants
                 
@@ -14,107 +14,7 @@ import sys
 import numpy as np
 import katfile
 
-################################################### Helper routines ###################################################
-
-def contiguous_cliques(x, step=1):
-    """Partition *x* into contiguous cliques, where elements in clique differ by *step*."""
-    if len(x) == 0:
-        return []
-    cliques, current, prev = [], [x[0]], x[0]
-    for n in x[1:]:
-        if n == prev + step:
-            current.append(n)
-        else:
-            cliques.append(current)
-            current = [n]
-        prev = n
-    cliques.append(current)
-    return cliques
-
-def ratio_stats(mean_num, std_num, mean_den, std_den, corrcoef=0):
-    """Approximate second-order statistics of ratio of correlated normal variables."""
-    # Transform num/den to standard form (a + x) / (b + y), with x and y uncorrelated standard normal vars
-    # Then num/den is distributed as 1/r (a + x) / (b + y) + s
-    # Therefore determine parameters a and b, scale r and translation s
-    s = corrcoef * std_num / std_den
-    a, b = mean_num - s * mean_den, mean_den / std_den
-    # Pick the sign of h so that a and b have the same sign
-    sign_h = 2 * (a >= 0) * (b >= 0) - 1
-    h = sign_h * std_num * np.sqrt(1. - corrcoef ** 2)
-    a, r = a / h, std_den / h
-    # Calculate the approximate mean and standard deviation of (a + x) / (b + y) a la F-distribution
-    mean_axby = a * b / (b**2 - 1)
-    std_axby = np.abs(b) / (b**2 - 1) * np.sqrt((a**2 + b**2 - 1) / (b**2 - 2))
-    # Translate by s and scale by r
-    return s + mean_axby / r, std_axby / np.abs(r)
-
-def find_jumps(timestamps, power, std_power, margin_factor, jump_significance, max_onoff_segment_duration, **kwargs):
-    """Find significant jumps in power and estimate the time instant of each jump."""
-    # Margin within which power is deemed to be constant (i.e. expected variation of power)
-    # This works around potential biases in power levels, such as small linear slopes across jump
-    margin = margin_factor * std_power
-    upper, lower = power + margin, power - margin
-    delta_power = np.r_[power[1:], power[-1]] - np.r_[power[0], power[:-1]]
-    # Shifted versions of the upper and lower power bounds
-    previous_upper, next_upper = np.r_[upper[0], upper[:-1]], np.r_[upper[1:], upper[-1]]
-    previous_lower, next_lower = np.r_[lower[0], lower[:-1]], np.r_[lower[1:], lower[-1]]
-    # True for each power value that is considered to be the same as the one on its left
-    same_as_previous = ((power > previous_lower) & (power < previous_upper)).tolist()
-    same_as_previous[0] = False
-    # True for each power value that is considered to be the same as the one on its right
-    same_as_next = ((power > next_lower) & (power < next_upper)).tolist()
-    same_as_next[-1] = False
-
-    jumps = []
-    # Look for large instantaneous rises in power (spanning at most 2 dumps)
-    # Then pick midpoint of jump (or end of jump if no clear midpoint), and add it to candidate jumps
-    rise = np.where((power > previous_upper) & (power < next_upper))[0].tolist()
-    jumps += [clique[0] for clique in contiguous_cliques(rise)
-              if (len(clique) == 1) or ((len(clique) == 2) and (delta_power[clique[0]] > delta_power[clique[1]]))]
-    # Look for large instantaneous drops in power (spanning at most 2 dumps)
-    # Then pick midpoint of jump (or end of jump if no clear midpoint), and add it to candidate jumps
-    drop = np.where((power < previous_lower) & (power > next_lower))[0].tolist()
-    jumps += [clique[0] for clique in contiguous_cliques(drop)
-              if (len(clique) == 1) or ((len(clique) == 2) and (delta_power[clique[0]] < delta_power[clique[1]]))]
-    # Throw out jumps on the very edges of time series (we need a dump before and after the jump)
-    jumps = [jump for jump in jumps if jump not in (0, len(power) - 1)]
-
-    # Investigate each jump and determine accurate timestamp with corresponding uncertainty
-    jump_time, jump_std_time, jump_size = [], [], []
-    for jump in jumps:
-        # Margin / uncertainty associated with power difference between samples adjacent to jump
-        jump_margin = np.sqrt(margin[jump - 1] ** 2 + margin[jump + 1] ** 2)
-        # Throw out insignificant jumps
-        if np.abs(delta_power[jump]) / jump_margin <= jump_significance:
-            continue
-        # Limit the range of points around jump to use in estimation of jump instant (to ensure stationarity)
-        segment_range = np.abs(timestamps - timestamps[jump]) <= max_onoff_segment_duration
-        # Determine earliest (and last) sample to use to estimate the mean power before (and after) the jump
-        before = min(np.where(segment_range)[0][0], jump - 1)
-        after = max(len(segment_range) - 1 - np.where(segment_range[::-1])[0][0], jump + 1)
-        before = max(jump - 1 - same_as_previous[jump - 1::-1].index(False), before)
-        after = min(same_as_next.index(False, jump + 1), after)
-        # Estimate power before and after jump, with corresponding uncertainty
-        mean_power_before, mean_power_after = power[before:jump].mean(), power[jump + 1:after + 1].mean()
-        std_power_before = np.sqrt(np.sum(std_power[before:jump] ** 2)) / (jump - before)
-        std_power_after = np.sqrt(np.sum(std_power[jump + 1:after + 1] ** 2)) / (after - jump)
-        # Use ratio of power differences (at - before) / (after - before) to estimate where in dump the jump happened
-        mean_num, mean_den = power[jump] - mean_power_before, mean_power_after - mean_power_before
-        std_num = np.sqrt(std_power[jump] ** 2 + std_power_before ** 2)
-        std_den = np.sqrt(std_power_after ** 2 + std_power_before ** 2)
-        # Since "before" power appears in both numerator and denominator, they are (slightly) correlated.
-        # NOTE: The complementary ratio (after - at) / (after - before) can also be used, and at first glance
-        # it appears to be better if std_power_after < std_power_before, which will result in smaller std_num
-        # for the same std_den. The correlation coefficient will change in such a way to cancel out this advantage,
-        # however, resulting in the same stats. We therefore do not need to consider the complementary ratio.
-        corrcoef = std_power_before ** 2 / std_num / std_den
-        mean_subdump, std_subdump = ratio_stats(mean_num, std_num, mean_den, std_den, corrcoef)
-        # Estimate instant of jump with corresponding uncertainty (assumes timestamps are accurately known)
-        jump_time.append(mean_subdump * timestamps[jump] + (1. - mean_subdump) * timestamps[jump + 1])
-        jump_std_time.append(std_subdump * (timestamps[jump + 1] - timestamps[jump]))
-        # Refined estimate of the significance of the jump, using averaged data instead of single dumps
-        jump_size.append(mean_den / std_den / margin_factor)
-    return jump_time, jump_std_time, jump_size
+from katsdpscripts.reduction.jumps import find_jumps
 
 #################################################### Main function ####################################################
 
@@ -140,18 +40,37 @@ if len(args) < 1:
 data = katfile.open(args[0])
 chan_range = slice(*[int(chan_str) for chan_str in opts.freq_chans.split(',')]) \
              if opts.freq_chans is not None else slice(data.shape[1] // 4, 3 * data.shape[1] // 4)
-data.select(channels=chan_range)
+data.select(channels=chan_range, corrprods='auto')
 
 # Number of real normal variables squared and added together
 dof = 2 * data.shape[1] * data.channel_width * data.dump_period
 corrprod_to_index = dict([(tuple(cp), ind) for cp, ind in zip(data.corr_products, range(len(data.corr_products)))])
 
+# Detect power jumps of all antennas in each scan in one go, reading the autocorrelations only once per scan
+ants = [ant for ant in data.ants if (ant.name + 'h', ant.name + 'h') in corrprod_to_index or
+                                    (ant.name + 'v', ant.name + 'v') in corrprod_to_index]
+scan_jumps = []
+for scan_index, state, target in data.scans():
+    # Extract averaged power data time series and DBE timestamps (at start of each dump)
+    dbe_timestamps = data.timestamps[:] - 0.5 * data.dump_period
+    if len(dbe_timestamps) < 3:
+        continue
+    auto_power = data.vis[:].real.mean(axis=1)
+    power = np.zeros((len(dbe_timestamps), len(ants)))
+    power_dof = np.zeros(len(ants))
+    for n, ant in enumerate(ants):
+        indices = [corrprod_to_index[(inp, inp)] for inp in (ant.name + 'h', ant.name + 'v')
+                   if (inp, inp) in corrprod_to_index]
+        power[:, n] = auto_power[:, indices].sum(axis=1)
+        # Since I = HH + VV and not the average of HH and VV, the dof actually halves instead of doubling
+        power_dof[n] = dof / len(indices)
+    jumps = find_jumps(dbe_timestamps, power, power * np.sqrt(2. / power_dof), **vars(opts))
+    scan_jumps.append((dbe_timestamps, jumps))
+
 offset_stats = {}
 print 'Individual firings: timestamp | offset +/- uncertainty (magnitude of jump)'
 print '--------------------------------------------------------------------------'
-for ant in data.ants:
-    hh_index = corrprod_to_index.get((ant.name + 'h', ant.name + 'h'))
-    vv_index = corrprod_to_index.get((ant.name + 'v', ant.name + 'v'))
+for n, ant in enumerate(ants):
     for diode_name in ('pin', 'coupler'):
         # Ignore missing sensors or sensors with one entry (which serves as an initial value instead of real event)
         try:
@@ -164,42 +83,35 @@ for ant in data.ants:
         print "Diode:", ant.name, diode_name
         nd_timestamps = sensor['timestamp']
         nd_state = np.array(sensor['value'], dtype=np.int)
-        for scan_index, state, target in data.scans():
-            # Extract averaged power data time series and DBE timestamps (at start of each dump)
-            dbe_timestamps = data.timestamps[:] - 0.5 * data.dump_period
-            if len(dbe_timestamps) < 3:
-                continue
-            power = data.vis[:, :, hh_index][:, :, 0].real.mean(axis=1) if hh_index is not None \
-                    else np.zeros(data.shape[0], dtype=np.float32)
-            power += data.vis[:, :, vv_index][:, :, 0].real.mean(axis=1) if vv_index is not None \
-                     else np.zeros(data.shape[0], dtype=np.float32)
-            # Since I = HH + VV and not the average of HH and VV, the dof actually halves instead of doubling
-            power_dof = dof / 2 if (hh_index is not None and vv_index is not None) else dof
-            jump_time, jump_std_time, jump_size = find_jumps(dbe_timestamps, power, power * np.sqrt(2. / power_dof),
-                                                             **vars(opts))
+        for dbe_timestamps, jumps in scan_jumps:
+            jumps = jumps[jumps.series == n]
             # Focus on noise diode events within this scan (and not on the edges of scan either)
             firings_in_scan = (nd_timestamps > dbe_timestamps[1]) & (nd_timestamps < dbe_timestamps[-1])
-            for n, firing in enumerate(nd_timestamps[firings_in_scan]):
-                # Obtain closest time offset between expected firing and power jump
-                offsets = np.array(jump_time) - firing
-                # Ensure that jump is in the expected direction (up or down)
-                same_direction = (2 * nd_state[firings_in_scan][n] - 1) * np.sign(jump_size) > 0
-                if same_direction.any():
-                    same_direction = np.where(same_direction)[0]
-                    closest_jump = same_direction[np.argmin(np.abs(offsets[same_direction]))]
-                    offset = offsets[closest_jump]
-                    # Only match the jump if it is within a certain window of the expected firing
-                    if np.abs(offset) < opts.max_offset:
-                        std_offset, jump = jump_std_time[closest_jump], jump_size[closest_jump]
-                        stats_key = ant.name + ' ' + diode_name
-                        # For each diode, collect the offsets and their uncertainties
-                        stats = offset_stats.get(stats_key, [])
-                        offset_stats[stats_key] = stats + [(offset, std_offset)]
-                        print '%s | offset %8.2f +/- %5.2f ms (magnitude of %+.0f margins)' % \
-                              (time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(firing)),
-                               1000 * offset, 1000 * std_offset, jump)
-                    else:
-                        print '%s | not found' % (time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(firing)),)
+            firings = nd_timestamps[firings_in_scan]
+            if len(firings) == 0:
+                continue
+            # Time offset between each expected firing (rows) and each power jump (columns)
+            offsets = jumps.time[np.newaxis, :] - firings[:, np.newaxis]
+            # Ensure that jump is in the expected direction (up or down)
+            same_direction = (2 * nd_state[firings_in_scan][:, np.newaxis] - 1) * np.sign(jumps.significance) > 0
+            # Obtain closest time offset between expected firing and power jump
+            distance = np.where(same_direction, np.abs(offsets), np.inf)
+            found = same_direction.any(axis=1)
+            closest_jump = distance.argmin(axis=1) if len(jumps) else np.zeros(len(firings), dtype=np.int)
+            for firing, closest, offset in zip(firings[found], closest_jump[found],
+                                               offsets[found, closest_jump[found]]):
+                # Only match the jump if it is within a certain window of the expected firing
+                if np.abs(offset) < opts.max_offset:
+                    std_offset, jump = jumps.std_time[closest], jumps.significance[closest]
+                    stats_key = ant.name + ' ' + diode_name
+                    # For each diode, collect the offsets and their uncertainties
+                    stats = offset_stats.get(stats_key, [])
+                    offset_stats[stats_key] = stats + [(offset, std_offset)]
+                    print '%s | offset %8.2f +/- %5.2f ms (magnitude of %+.0f margins)' % \
+                          (time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(firing)),
+                           1000 * offset, 1000 * std_offset, jump)
+                else:
+                    print '%s | not found' % (time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(firing)),)
 
 print
 print 'Summary of offsets (DBE - CAM) per diode'
@@ -3,24 +3,94 @@
 # Apply Van Vleck (quantisation) correction to an HDF5 file. This uses the
 # online system itself in an offline mode to perform the correction.
 #
+# The visibilities are read in blocks of whole HDF5 chunks, corrected in a pool
+# of worker processes and written to a new file, which only replaces the output
+# (or optionally the original) once it is complete. The original file is only
+# opened for reading, so an interrupted run leaves it untouched.
+#
 # Ludwig Schwardt
 # 7 May 2012
 #
 
+import collections
+import multiprocessing
 import optparse
+import os
+import shutil
+import tempfile
+import time
+
 import h5py
 import numpy as np
 from katcapture import sigproc
 
+# Attribute on corrected visibility dataset recording the correction (its provenance)
+PROVENANCE_ATTR = 'van_vleck_correction'
+
 parser = optparse.OptionParser(usage="%prog [opts] <file>",
-                               description="This applies Van Vleck correction to the given HDF5 file.")
+                               description="This applies Van Vleck correction to the given HDF5 file, "
+                                           "writing the result to a new file.")
+parser.add_option('-o', '--output', default=None,
+                  help="Name of corrected output file (default is '<file base>_vanvleck.h5')")
+parser.add_option('--replace', action='store_true', default=False,
+                  help="Replace the original file with the corrected one once correction succeeded")
+parser.add_option('-j', '--workers', type='int', default=multiprocessing.cpu_count(),
+                  help="Number of worker processes doing the correction (default=%default)")
+parser.add_option('-b', '--block-size', type='float', default=64.0,
+                  help="Approximate amount of visibility data corrected per work unit, in MB "
+                       "(rounded to whole HDF5 chunks, default=%default)")
 (opts, args) = parser.parse_args()
 if len(args) < 1:
     raise RuntimeError('Please specify an HDF5 file to correct')
 filename = args[0]
+if opts.replace:
+    output = filename
+else:
+    output = opts.output if opts.output else os.path.splitext(filename)[0] + '_vanvleck.h5'
+if os.path.abspath(output) == os.path.abspath(filename) and not opts.replace:
+    raise ValueError('Output file is the same as input file - use --replace to overwrite the original')
+
+def get_single_value(group, name):
+    """Return single value from attribute or dataset with given name in group."""
+    return group.attrs[name] if name in group.attrs else group[name].value[-1]
+
+def init_worker(accum_per_int, corrprods, auto):
+    """Create online processing block for Van Vleck correction in each worker process."""
+    global vanvleck, auto_index
+    vanvleck = sigproc.VanVleck(accum_per_int, bls_ordering=corrprods)
+    auto_index = auto
+
+def correct_block(start, block):
+    """Correct a block of dumps, also returning auto power per dump before and after correction.
+
+    Returns the start dump, the index of the dump within the block at which the
+    correction went out of range (None if it succeeded), the corrected block
+    and the median auto power per dump before and after the correction.
 
-# Open HDF5 file with write access
-f = h5py.File(filename, 'r+')
+    """
+    power_before = np.zeros((len(auto_index), len(block)))
+    power_after = np.zeros((len(auto_index), len(block)))
+    for n in range(len(block)):
+        sigproc.ProcBlock.current = block[n]
+        power_before[:, n] = np.median(sigproc.ProcBlock.current[:, auto_index, 0], axis=0)
+        try:
+            vanvleck.proc()
+        except sigproc.VanVleckOutOfRangeError:
+            return start, n, None, power_before, power_after
+        power_after[:, n] = np.median(sigproc.ProcBlock.current[:, auto_index, 0], axis=0)
+        block[n] = sigproc.ProcBlock.current
+    return start, None, block, power_before, power_after
+
+def copy_except(src_group, dest_group, skip):
+    """Copy attributes and members of *src_group* to *dest_group*, except member named *skip*."""
+    for key, value in src_group.attrs.iteritems():
+        dest_group.attrs[key] = value
+    for name in src_group:
+        if name != skip:
+            src_group.copy(src_group[name], dest_group, name)
+
+# Open HDF5 file read-only - the original is never modified in place
+f = h5py.File(filename, 'r')
 
 version = f.attrs.get('version', '1.x')
 if not version.startswith('2.'):
@@ -28,9 +98,8 @@ if not version.startswith('2.'):
 
 data_group, config_group = f['Data'], f['MetaData/Configuration']
 vis = data_group['correlator_data']
-def get_single_value(group, name):
-    """Return single value from attribute or dataset with given name in group."""
-    return group.attrs[name] if name in group.attrs else group[name].value[-1]
+if PROVENANCE_ATTR in vis.attrs:
+    raise ValueError('Van Vleck correction has already been applied to this file: %s' % (vis.attrs[PROVENANCE_ATTR],))
 corrprods = get_single_value(config_group['Correlator'], 'bls_ordering')
 accum_per_int = get_single_value(config_group['Correlator'], 'n_accs')
 
@@ -50,30 +119,73 @@ if len(corrprods) != vis.shape[2]:
 auto = [n for n, (inpA, inpB) in enumerate(corrprods) if inpA == inpB]
 labels = [inpA for inpA, inpB in corrprods[auto]]
 
-# Create online processing block for Van Vleck correction
-vanvleck = sigproc.VanVleck(accum_per_int, bls_ordering=corrprods)
-
-# Iterate through visibility data, one dump at a time, keeping track of power statistics
-power_before = np.zeros((len(auto), vis.shape[0]))
-power_after = np.zeros((len(auto), vis.shape[0]))
-aborted = False
-for t in range(vis.shape[0]):
-    sigproc.ProcBlock.current = vis[t]
-    power_before[:, t] = np.median(sigproc.ProcBlock.current[:, auto, 0], axis=0)
-    try:
-        vanvleck.proc()
-    except sigproc.VanVleckOutOfRangeError:
-        print 'Van Vleck correction seems to be applied already at dump %d - aborting conversion' % (t,)
-        aborted = True
-        break
-    power_after[:, t] = np.median(sigproc.ProcBlock.current[:, auto, 0], axis=0)
-    vis[t] = sigproc.ProcBlock.current
+# Work on blocks of whole chunks along the time axis, so that every read and write covers full chunks
+num_dumps = vis.shape[0]
+chunk_dumps = vis.chunks[0] if vis.chunks else 1
+dump_bytes = vis.dtype.itemsize * np.prod(vis.shape[1:])
+block_dumps = chunk_dumps * max(int(opts.block_size * 1e6 / (chunk_dumps * dump_bytes)), 1)
+workers = max(opts.workers, 1)
 
-if not aborted:
-    # Flush changes to disk
-    f.close()
+# Write corrected file next to its final destination so that it can be renamed into place atomically
+fd, temp_filename = tempfile.mkstemp(suffix='.partial', prefix=os.path.basename(output) + '.',
+                                     dir=os.path.dirname(os.path.abspath(output)))
+os.close(fd)
+shutil.copymode(filename, temp_filename)
+pool = multiprocessing.Pool(workers, init_worker, (accum_per_int, corrprods, auto))
+aborted, out = True, None
+try:
+    out = h5py.File(temp_filename, 'w')
+    copy_except(f, out, 'Data')
+    out_data_group = out.create_group('Data')
+    copy_except(data_group, out_data_group, 'correlator_data')
+    out_vis = out_data_group.create_dataset('correlator_data', vis.shape, vis.dtype, chunks=vis.chunks,
+                                            compression=vis.compression, compression_opts=vis.compression_opts,
+                                            shuffle=vis.shuffle, fletcher32=vis.fletcher32)
+    for key, value in vis.attrs.iteritems():
+        out_vis.attrs[key] = value
+
+    # Correct blocks in parallel, keeping a bounded number of blocks in flight and writing them in order
+    power_before = np.zeros((len(auto), num_dumps))
+    power_after = np.zeros((len(auto), num_dumps))
+    pending = collections.deque()
+    starts = range(0, num_dumps, block_dumps)
+    out_of_range = None
+    while (starts or pending) and out_of_range is None:
+        while starts and len(pending) < 2 * workers:
+            start = starts.pop(0)
+            pending.append(pool.apply_async(correct_block, (start, vis[start:start + block_dumps])))
+        start, bad_dump, block, before, after = pending.popleft().get()
+        stop = start + len(before[0])
+        power_before[:, start:stop], power_after[:, start:stop] = before, after
+        if bad_dump is not None:
+            out_of_range = start + bad_dump
+        else:
+            out_vis[start:stop] = block
 
+    if out_of_range is not None:
+        print 'Van Vleck correction seems to be applied already at dump %d - aborting conversion' % (out_of_range,)
+    else:
+        out_vis.attrs[PROVENANCE_ATTR] = ('Applied by correct_vanvleck.py (katcapture sigproc.VanVleck, n_accs=%d) '
+                                          'to %s on %s UTC' % (accum_per_int, os.path.basename(filename),
+                                                               time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())))
+        # Flush corrected file to disk before it replaces the output
+        out.close()
+        fd = os.open(temp_filename, os.O_RDONLY)
+        os.fsync(fd)
+        os.close(fd)
+        f.close()
+        os.rename(temp_filename, output)
+        aborted = False
+finally:
+    pool.terminate()
+    if aborted:
+        if out:
+            out.close()
+        os.remove(temp_filename)
+
+if not aborted:
+    print 'Corrected data written to %s' % (output,)
     print "Median power before and after correction:"
-    print '\n'.join([("%s: %6.3g %6.3g" % (label, before, after))
-                     for label, before, after in zip(labels, np.median(power_before, axis=1),
-                                                             np.median(power_after, axis=1))])
+    print '\n'.join([("%s: %6.3g %6.3g" % (label, median_before, median_after))
+                     for label, median_before, median_after in zip(labels, np.median(power_before, axis=1),
+                                                                           np.median(power_after, axis=1))])
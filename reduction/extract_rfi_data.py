@@ -8,6 +8,7 @@ import os
 import matplotlib.pyplot as plt
 import numpy as np
 
+import multiprocessing
 import optparse
 import string
 import sys
@@ -17,9 +18,16 @@ import logging
 
 logger = logging.root
 
-def LoadHDF5(HDF5Filename, header=False):
+# Column headings of output CSV file
+DATA_LINE = ('FILENAME,START TIME,END TIME,ANT NAME,TARGET NAME, ANT MIN AZIM,ANT MAX AZIM,ANT MIN ELEV, ANT MAX ELEV,LO FREQUENCY, RFI CHANNELS, RFI FREQUENCY')
+# Size of output file buffer, in bytes (rows are written out in large blocks)
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+def LoadHDF5(HDF5Filename, baseline='sd'):
+    """Extract RFI channels of each compound scan in file, returning CSV lines for output file."""
+    lines = []
     try:
-        d = scape.DataSet(HDF5Filename,baseline=opts.baseline)
+        d = scape.DataSet(HDF5Filename,baseline=baseline)
     except ValueError:
         print "WARNING:THIS FILE",HDF5Filename.split('/')[-1], "IS CORRUPTED AND SCAPE WILL NOT PROCESS IT, YOU MAY NEED TO REAUGMENT IT,BUT ITS AN EXPENSIVE TASK..!!"
     else:
@@ -61,21 +69,90 @@ def LoadHDF5(HDF5Filename, header=False):
             #ant_el = katpoint.rad2deg(np.array(requested_azel[1]))
             target = compscan.target.name
 
-            f = file(opts.outfilebase + '.csv', 'a')
             for index in range(0,len(rfi_channels)):
                 rfi_chan = rfi_channels[index] + 100
                 rfi_freq = freqs[rfi_channels[index]]
-                f.write('%s, %s, %s, %s, %s,%f, %f,%f,%f, %f, %d, %f\n' % (data_filename,start_time, end_time, ant,target,min_compscan_az,max_compscan_az,\
+                lines.append('%s, %s, %s, %s, %s,%f, %f,%f,%f, %f, %d, %f\n' % (data_filename,start_time, end_time, ant,target,min_compscan_az,max_compscan_az,\
                 min_compscan_el, max_compscan_el,lo_freq, rfi_chan, rfi_freq))
-            f.close()
-
-def loop_througth(observationDataDir):
+    return lines
+
+def harvest_file(args):
+    """Process pool task extracting RFI data from one file (returns file name and its CSV lines)."""
+    filename, baseline = args
+    print "\nReading HDF5 file:", os.path.basename(filename),'\n'
+    return os.path.basename(filename), LoadHDF5(filename, baseline)
+
+def load_done_files(outfilebase):
+    """Names of files already harvested, as recorded in '<outfilebase>.done'."""
+    if not os.path.exists(outfilebase + '.done'):
+        return set()
+    return set(line.strip() for line in file(outfilebase + '.done') if line.strip())
+
+def drop_unfinished_rows(outfilebase, done):
+    """Remove CSV rows of files that were not completed (e.g. due to a crash while writing them).
+
+    This only applies to output with a '<outfilebase>.done' record, as it
+    would otherwise discard all rows of the CSV file.
+
+    """
+    csv_name = outfilebase + '.csv'
+    if not os.path.exists(csv_name) or not os.path.exists(outfilebase + '.done'):
+        return
+    lines = file(csv_name).readlines()
+    keep = [line for line in lines[1:] if line.split(',', 1)[0] in done]
+    if len(keep) < len(lines) - 1:
+        temp_name = csv_name + '.partial'
+        f = file(temp_name, 'w')
+        f.writelines(lines[:1] + keep)
+        f.close()
+        os.rename(temp_name, csv_name)
+
+def loop_througth(observationDataDir, outfilebase, baseline='sd', workers=1, restart=False):
+    """Harvest RFI data from all files in directory in parallel, resuming an interrupted harvest.
+
+    The files are processed by a pool of *workers* processes, which send their
+    results back to this process as the single writer of the output CSV file.
+    Each file is recorded in '<outfilebase>.done' once all its rows are
+    written, and files found there are skipped on the next run unless
+    *restart* is True. An existing CSV file without a '.done' record (e.g.
+    from an older harvest) is left alone unless *restart* is True.
+
+    """
+    if restart:
+        for suffix in ('.csv', '.done'):
+            if os.path.exists(outfilebase + suffix):
+                os.remove(outfilebase + suffix)
+    elif os.path.exists(outfilebase + '.csv') and not os.path.exists(outfilebase + '.done'):
+        raise IOError("Output file '%s.csv' exists but has no record of processed files in '%s.done' - "
+                      "use --restart to overwrite it or choose another output name" % (outfilebase, outfilebase))
+    done = load_done_files(outfilebase)
+    drop_unfinished_rows(outfilebase, done)
     # data is stored in time stamped directories -- use this to read data files in sequence sorted by date and time
-    for file in sorted(os.listdir(observationDataDir)):
-            # from the observation directory -- read the fits file
-            if os.path.splitext(file)[1] == '.h5':
-                print "\nReading HDF5 file:", file,'\n'
-                LoadHDF5(os.path.join(observationDataDir, file))
+    filenames = [os.path.join(observationDataDir, name) for name in sorted(os.listdir(observationDataDir))
+                 if os.path.splitext(name)[1] == '.h5' and name not in done]
+    print "%d files to process (%d done previously)" % (len(filenames), len(done))
+    new_output = not os.path.exists(outfilebase + '.csv')
+    out = file(outfilebase + '.csv', 'a', OUTPUT_BUFFER_SIZE)
+    done_log = file(outfilebase + '.done', 'a')
+    if new_output:
+        out.write('%s\n' % (DATA_LINE))
+    pool = multiprocessing.Pool(workers)
+    try:
+        for name, lines in pool.imap_unordered(harvest_file, [(filename, baseline) for filename in filenames]):
+            out.writelines(lines)
+            # Only mark file as done once its rows are safely on disk
+            out.flush()
+            os.fsync(out.fileno())
+            done_log.write(name + '\n')
+            done_log.flush()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        out.close()
+        done_log.close()
 
 if __name__ == '__main__':
 
@@ -85,7 +162,11 @@ if __name__ == '__main__':
     parser.add_option('-p', '--path', dest='data_dir',
             help='Directory containing observation data')
     parser.add_option("-o", "--output", dest="outfilebase", default='rfi_data_points',
-                      help="Base name of output files (*.csv for output data)")
+                      help="Base name of output files (*.csv for output data, *.done for list of processed files)")
+    parser.add_option('-j', '--workers', type='int', default=multiprocessing.cpu_count(),
+                      help="Number of files processed in parallel (default=%default)")
+    parser.add_option('--restart', action='store_true', default=False,
+                      help="Discard existing output and start afresh, instead of resuming interrupted harvest")
 
     (opts, args) = parser.parse_args()
     if len(args) > 0 or not opts.data_dir:
@@ -95,9 +176,4 @@ if __name__ == '__main__':
         sys.exit(1)
 
     observationDataDir = os.path.dirname(opts.data_dir)
-    # writing out the outup csv file
-    data_line = ('FILENAME,START TIME,END TIME,ANT NAME,TARGET NAME, ANT MIN AZIM,ANT MAX AZIM,ANT MIN ELEV, ANT MAX ELEV,LO FREQUENCY, RFI CHANNELS, RFI FREQUENCY')
-    f = file(opts.outfilebase + '.csv', 'a')
-    f.write('%s\n' % (data_line))
-    f.close()
-    loop_througth(observationDataDir)
+    loop_througth(observationDataDir, opts.outfilebase, opts.baseline, max(opts.workers, 1), opts.restart)
@@ -21,6 +21,8 @@ from matplotlib.projections import PolarAxes
 import katpoint
 from katpoint import rad2deg, deg2rad
 
+from katsdpscripts.reduction.pointing_fit import PointingFit
+
 def angle_wrap(angle, period=2.0 * np.pi):
     """Wrap angle into the interval -*period* / 2 ... *period* / 2."""
     return (angle + 0.5 * period) % period - 0.5 * period
@@ -42,6 +44,8 @@ parser.add_option('-o', '--output', dest='outfilebase', default='pointing_model_
                        "default is 'pointing_model_<time>')")
 parser.add_option('-n', '--no-stats', dest='use_stats', action='store_false', default=True,
                   help="Ignore uncertainties of data points during fitting")
+parser.add_option('-b', '--batch', action='store_true', default=False,
+                  help="Fit the default parameters to the kept data points and save the results without the GUI")
 # Minimum pointing uncertainty is arbitrarily set to 1e-12 degrees, which corresponds to a maximum error
 # of about 10 nano-arcseconds, as the least-squares solver does not like zero uncertainty
 parser.add_option('-m', '--min-rms', type='float', default=np.sqrt(2) * 60. * 1e-12,
@@ -110,36 +114,11 @@ display_params = range(num_params)
 display_params.pop(9)
 display_params.pop(1)
 
-class PointingResults(object):
-    """Calculate and store results related to given pointing model."""
-    def __init__(self, model):
-        self.update(model)
-
-    def update(self, model):
-        """Determine new residuals and sky RMS from pointing model."""
-        model_delta_az, model_delta_el = model.offset(az, el)
-        self.residual_az = measured_delta_az - model_delta_az
-        self.residual_el = measured_delta_el - model_delta_el
-        self.residual_xel = self.residual_az * np.cos(el)
-        self.abs_sky_error = rad2deg(np.sqrt(self.residual_xel ** 2 + self.residual_el ** 2)) * 60.
-        self.metrics(keep)
-
-    def metrics(self, keep):
-        ###### On the calculation of all-sky RMS #####
-        # Assume the el and cross-el errors have zero mean, are distributed normally, and are uncorrelated
-        # They are therefore described by a 2-dimensional circular Gaussian pdf with zero mean and *per-component*
-        # standard deviation of sigma
-        # The absolute sky error (== Euclidean length of 2-dim error vector) then has a Rayleigh distribution
-        # The RMS sky error has a mean value of sqrt(2) * sigma, since each squared error term is the sum of
-        # two squared Gaussian random values, each with an expected value of sigma^2.
-        self.sky_rms = np.sqrt(np.mean(self.abs_sky_error[keep] ** 2))
-        # A more robust estimate of the RMS sky error is obtained via the median of the Rayleigh distribution,
-        # which is sigma * sqrt(log(4)) -> convert this to the RMS sky error = sqrt(2) * sigma
-        self.robust_sky_rms = np.median(self.abs_sky_error[keep]) * np.sqrt(2. / np.log(4.))
-        # The chi^2 value is what is actually optimised by the least-squares fitter (evaluated on the training set)
-        self.chi2 = np.sum(((self.residual_xel / std_delta_az) ** 2 + (self.residual_el / std_delta_el) ** 2)[keep])
-old = PointingResults(old_model)
-new = PointingResults(new_model)
+# Pointing fit engine shared by interactive and batch fitting - it owns the point and parameter selections
+fit = PointingFit(az, el, measured_delta_az, measured_delta_el, std_delta_az, std_delta_el, keep, enabled_params)
+keep, enabled_params = fit.keep, fit.enabled
+old = fit.results(np.array(old_model.params))
+new = fit.results(np.zeros(num_params))
 
 def quiver_segments(delta_az, delta_el, scale):
     """Produce line segments that indicate size and direction of residuals."""
@@ -154,6 +133,7 @@ def quiver_segments(delta_az, delta_el, scale):
 
 def update(fig):
     """Fit new pointing model and update plots."""
+    global new_model
     # Perform early redraw to improve interactivity of clicks (which typically change state of target dots)
     # Target state: 0 = flagged, 1 = unflagged, 2 = highlighted
     target_state = keep * ((target_index == fig.highlighted_target) + 1)
@@ -164,9 +144,9 @@ def update(fig):
     fig.canvas.draw()
 
     # Fit new pointing model and update results
-    params, sigma_params = new_model.fit(az[keep], el[keep], measured_delta_az[keep], measured_delta_el[keep],
-                                         std_delta_az[keep], std_delta_el[keep], enabled_params)
-    new.update(new_model)
+    params, sigma_params = fit.fit()
+    new_model = fit.model()
+    new.update(params)
 
     # Update rest of figure
     fig.texts[3].set_text("$\chi^2$ = %.1f" % new.chi2)
@@ -211,6 +191,52 @@ def update(fig):
     # Redraw the figure
     fig.canvas.draw()
 
+def save_results():
+    """Save new pointing model and residuals of old and new models to files."""
+    # Save pointing model to file
+    outfile = file(opts.outfilebase + '.csv', 'w')
+    outfile.write(new_model.description)
+    outfile.close()
+    logger.debug("Saved %d-parameter pointing model to '%s'" % (len(new_model.params), opts.outfilebase + '.csv'))
+    # Turn data recarray into list of dicts and add residuals to the mix
+    extended_data = []
+    for n in range(len(data)):
+        rec_dict = dict(zip(data.dtype.names, data[n]))
+        rec_dict['keep'] = int(keep[n])
+        rec_dict['old_residual_xel'] = rad2deg(old.residual_xel[n])
+        rec_dict['old_residual_el'] = rad2deg(old.residual_el[n])
+        rec_dict['new_residual_xel'] = rad2deg(new.residual_xel[n])
+        rec_dict['new_residual_el'] = rad2deg(new.residual_el[n])
+        extended_data.append(rec_dict)
+    # Format the data similar to analyse_point_source_scans output CSV file, with four new columns at the end
+    fields = '%(dataset)s, %(target)s, %(timestamp_ut)s, %(azimuth).7f, %(elevation).7f, ' \
+             '%(delta_azimuth).7f, %(delta_azimuth_std).7f, %(delta_elevation).7f, %(delta_elevation_std).7f, ' \
+             '%(data_unit)s, %(beam_height_I).7f, %(beam_height_I_std).7f, %(beam_width_I).7f, ' \
+             '%(beam_width_I_std).7f, %(baseline_height_I).7f, %(baseline_height_I_std).7f, %(refined_I).0f, ' \
+             '%(beam_height_HH).7f, %(beam_width_HH).7f, %(baseline_height_HH).7f, %(refined_HH).0f, ' \
+             '%(beam_height_VV).7f, %(beam_width_VV).7f, %(baseline_height_VV).7f, %(refined_VV).0f, ' \
+             '%(frequency).7f, %(flux).4f, %(temperature).2f, %(pressure).2f, %(humidity).2f, %(wind_speed).2f, ' \
+             '%(keep)d, %(old_residual_xel).7f, %(old_residual_el).7f, %(new_residual_xel).7f, %(new_residual_el).7f\n'
+    field_names = [name.partition(')')[0] for name in fields[2:].split(', %(')]
+    # Save residual data and flags to file
+    outfile2 = file(opts.outfilebase + '_data.csv', 'w')
+    outfile2.write('# antenna = %s\n' % antenna.description)
+    outfile2.write(', '.join(field_names) + '\n')
+    outfile2.writelines([fields % rec for rec in extended_data])
+    outfile2.close()
+
+# In batch mode, fit the default selection of parameters and data points and save the results without the GUI
+if opts.batch:
+    params, sigma_params = fit.fit()
+    new_model = fit.model()
+    new.update(params)
+    logger.info("Fitted %d parameters to %d of %d data points: chi^2 = %.1f" %
+                (len(fit.active_params), keep.sum(), len(keep), new.chi2))
+    logger.info("All sky rms = %.3f' (robust %.3f', %.1f-sigma clipped %.3f' excluding %d points)" %
+                (new.sky_rms, new.robust_sky_rms, new.clip_sigma, new.clipped_sky_rms, new.num_clipped))
+    save_results()
+    sys.exit(0)
+
 theta_formatter = PolarAxes.ThetaFormatter()
 def angle_formatter(x, pos=None):
     return theta_formatter(angle_wrap(np.pi / 2.0 - x), pos)
@@ -357,7 +383,7 @@ def on_click(event):
             select = props['ind'][0]
             if event.button == 1:
                 # Left mouse button toggles flag on selected data point
-                keep[select] = ~keep[select]
+                fit.toggle(select)
             else:
                 # Right mouse button highlights the target of selected data point
                 fig.highlighted_target = target_index[select]
@@ -369,37 +395,7 @@ fig.canvas.mpl_connect('button_release_event', on_click)
 save_button = mpl.widgets.Button(fig.add_axes([0.51, 0.81, 0.05, 0.04]), 'SAVE',
                                  color=(0.85, 0, 0), hovercolor=(0.95, 0, 0))
 def save_callback(event):
-    # Save pointing model to file
-    outfile = file(opts.outfilebase + '.csv', 'w')
-    outfile.write(new_model.description)
-    outfile.close()
-    logger.debug("Saved %d-parameter pointing model to '%s'" % (len(new_model.params), opts.outfilebase + '.csv'))
-    # Turn data recarray into list of dicts and add residuals to the mix
-    extended_data = []
-    for n in range(len(data)):
-        rec_dict = dict(zip(data.dtype.names, data[n]))
-        rec_dict['keep'] = int(keep[n])
-        rec_dict['old_residual_xel'] = rad2deg(old.residual_xel[n])
-        rec_dict['old_residual_el'] = rad2deg(old.residual_el[n])
-        rec_dict['new_residual_xel'] = rad2deg(new.residual_xel[n])
-        rec_dict['new_residual_el'] = rad2deg(new.residual_el[n])
-        extended_data.append(rec_dict)
-    # Format the data similar to analyse_point_source_scans output CSV file, with four new columns at the end
-    fields = '%(dataset)s, %(target)s, %(timestamp_ut)s, %(azimuth).7f, %(elevation).7f, ' \
-             '%(delta_azimuth).7f, %(delta_azimuth_std).7f, %(delta_elevation).7f, %(delta_elevation_std).7f, ' \
-             '%(data_unit)s, %(beam_height_I).7f, %(beam_height_I_std).7f, %(beam_width_I).7f, ' \
-             '%(beam_width_I_std).7f, %(baseline_height_I).7f, %(baseline_height_I_std).7f, %(refined_I).0f, ' \
-             '%(beam_height_HH).7f, %(beam_width_HH).7f, %(baseline_height_HH).7f, %(refined_HH).0f, ' \
-             '%(beam_height_VV).7f, %(beam_width_VV).7f, %(baseline_height_VV).7f, %(refined_VV).0f, ' \
-             '%(frequency).7f, %(flux).4f, %(temperature).2f, %(pressure).2f, %(humidity).2f, %(wind_speed).2f, ' \
-             '%(keep)d, %(old_residual_xel).7f, %(old_residual_el).7f, %(new_residual_xel).7f, %(new_residual_el).7f\n'
-    field_names = [name.partition(')')[0] for name in fields[2:].split(', %(')]
-    # Save residual data and flags to file
-    outfile2 = file(opts.outfilebase + '_data.csv', 'w')
-    outfile2.write('# antenna = %s\n' % antenna.description)
-    outfile2.write(', '.join(field_names) + '\n')
-    outfile2.writelines([fields % rec for rec in extended_data])
-    outfile2.close()
+    save_results()
     save_button.color = '0.85'
     save_button.hovercolor = '0.95'
 save_button.on_clicked(save_callback)
@@ -419,7 +415,7 @@ def setup_param_button(p):
     param_button.label.set_weight(param_button_weight[state])
     def toggle_param_callback(event):
         state = not enabled_params[param]
-        enabled_params[param] = state
+        fit.set_enabled(param, state)
         param_button.label.set_color(param_button_color[state])
         param_button.label.set_weight(param_button_weight[state])
         save_button.color = (0.85, 0, 0)
@@ -6,35 +6,34 @@ import optparse
 
 import numpy as np
 import matplotlib.pyplot as plt
-import matplotlib.mlab as mlab
+import h5py
 
 import katfile
 
-def plot_horizon(xyz_data, xyz_titles, az_lims, el_lims):
-    """Calculate and plot horizon.
+from katsdpscripts.reduction.horizon_grid import grid_horizon
+
+def plot_horizon(grid, az_pos, el_pos, xyz_titles, az_lims, el_lims):
+    """Plot gridded horizon.
 
     Parameters
     ----------
-    xyz_data : tuple of (azimuth, elevation, power_db) data lists
-        Data to plot.
+    grid : array of float, shape (len(el_pos), len(az_pos))
+        Gridded power_db data to plot.
+    az_pos, el_pos : arrays of float
+        Azimuth and elevation of grid cell centres.
     xyz_titles : tuple of titles for (azimuth, elevation and power_db) axes
         Titles for axes.
     az_lims : tuple of (min azimuth, max azimuth)
         Azimuth limits for the plot.
     el_lims : tuple of (min elevation, max elevation)
         Elevation limits for the plot.
-    pow_lims : tuple of (min power, max power)
-        Power limits for the plot.
     """
-    azimuth, elevation, power_db = xyz_data
     az_title, el_title, pow_title = xyz_titles
     az_min, az_max = az_lims
     el_min, el_max = el_lims
-    #pow_min, pow_max = pow_lims
-    az_pos = np.linspace(az_min, az_max, (az_max - az_min) / 0.1)
-    el_pos = np.linspace(el_min, el_max, (el_max - el_min) / 0.1)
-    power_db_pos = mlab.griddata(azimuth[:,0], elevation[:,0], power_db[:,0], az_pos, el_pos)
-    plt.imshow(power_db_pos, aspect='auto', origin='lower')
+    az_cols = (az_pos >= az_min) & (az_pos <= az_max)
+    el_rows = (el_pos >= el_min) & (el_pos <= el_max)
+    plt.imshow(grid[el_rows][:, az_cols], aspect='auto', origin='lower')
     #cs = plt.contour(az_pos, el_pos, power_db_pos, pow_levels)
     #plt.contourf(az_pos,el_pos, power_db_pos, pow_levels, antialiased=True)
     plt.colorbar()
@@ -50,7 +49,15 @@ def plot_horizon(xyz_data, xyz_titles, az_lims, el_lims):
 parser = optparse.OptionParser(usage='%prog [options] <data file> [<data file> ...]',description='Display a horizon mask from a set of data files.')
 parser.add_option('-a', '--baseline', dest='baseline',type="string", metavar='BASELINE', default='ant1',help="Baseline to load (e.g. 'ant1' for antenna 1),\
                 default is first single-dish baseline in file")
-parser.add_option('-o', '--output', dest='output', type="string", metavar='OUTPUTFILE', default=None,help="Write out intermediate h5 file")
+parser.add_option('-o', '--output', dest='output', type="string", metavar='OUTPUTFILE', default=None,help="Write out intermediate h5 file\
+                containing gridded power with per-cell sample counts and variance")
+parser.add_option('-r', '--resolution', type='float', default=0.1, help="Size of grid cells, in degrees (default %default)")
+parser.add_option('-f', '--fill', type='choice', choices=['nearest', 'idw', 'none'], default='nearest',
+                  help="Fill empty grid cells from nearest sampled cell, inverse-distance weighted \
+                  average of nearby sampled cells, or not at all (default %default)")
+parser.add_option('-m', '--max-distance', type='float', default=None,
+                  help="Only fill empty grid cells within this distance of a sampled cell, in degrees \
+                  (default is twice the cell diagonal)")
 parser.add_option('-s', '--split', dest='split', action="store_true", metavar='SPLIT', default=False,help="Whether to split each horizon plot in half")
 parser.add_option('-p', '--pol', dest = 'pol',type ='string',metavar ='POLARIZATION', default = 'HH',help = 'Polarization to load (e.g. HH for horizontal polarization ),\
                 the default is the horizontal polarization')
@@ -79,21 +86,33 @@ print "Contour plotting horizon from %d points ..." % len(azimuth)
     #plt.figure(1)
     #plt.clf()
     #plt.subplots_adjust(hspace=0.5)
-data = (azimuth, elevation, power_db)
 titles = ('Azimuth (deg)', 'Elevation (deg)', 'Power (dB) for %s %s' % (opts.baseline,opts.pol))
 az_min, az_max = 0.95*min(azimuth), 0.95*max(azimuth)
 el_min, el_max = 1.05*min(elevation), 0.95*max(elevation)
 pow_max, pow_min = max(power_db[:,0]), min(power_db[:,0])
 az_mid = (az_max + az_min) / 2.0
 el_mid = (el_max + el_min)/2.0
+az_pos = np.linspace(az_min, az_max, max(int((az_max - az_min) / opts.resolution), 2))
+el_pos = np.linspace(el_min, el_max, max(int((el_max - el_min) / opts.resolution), 2))
+fill = None if opts.fill == 'none' else opts.fill
+power_db_pos, counts, variance = grid_horizon(azimuth[:,0], elevation[:,0], power_db[:,0], az_pos, el_pos, fill,
+                                              max_distance=opts.max_distance)
+print "%d of %d grid cells contain samples" % ((counts > 0).sum(), counts.size)
+if opts.output:
+    out = h5py.File(opts.output, 'w')
+    for name, value in zip(('azimuth', 'elevation', 'power_db', 'counts', 'variance'),
+                           (az_pos, el_pos, power_db_pos, counts, variance)):
+        out[name] = value
+    out.attrs['baseline'], out.attrs['pol'], out.attrs['fill'] = opts.baseline, opts.pol, opts.fill
+    out.close()
 if opts.split:
     plt.subplot(2, 1, 1)
-    plot_horizon(data, titles, (az_min, az_mid), (el_min, el_max))
+    plot_horizon(power_db_pos, az_pos, el_pos, titles, (az_min, az_mid), (el_min, el_max))
     plt.subplot(2, 1, 2)
-    plot_horizon(data,titles, (az_mid, az_max), (el_min, el_max))
+    plot_horizon(power_db_pos, az_pos, el_pos, titles, (az_mid, az_max), (el_min, el_max))
 else:
     plt.subplot(1, 1, 1)
-    plot_horizon(data,titles, (az_min, az_max), (el_min, el_max))
+    plot_horizon(power_db_pos, az_pos, el_pos, titles, (az_min, az_max), (el_min, el_max))
 # Display plots - this should be called ONLY ONCE, at the VERY END of the script
 # The script stops here until you close the plots...
 plt.show()
@@ -6,6 +6,7 @@
 from katuilib.katcp_client import KATBaseSensor
 from katuilib.data import AnimatableSensorPlot
 import katcp
+from katsdpscripts.reduction.sensor_store import SensorStore, coverage_intervals, import_csv_sensor
 import calendar
 import datetime
 import optparse
@@ -44,6 +45,10 @@ $ ./retrieve_sensor_data.py -p --start 2010-01-01 --end 2010-02-01 \\
 # Download same data to .csv files in current folder
 $ ./retrieve_sensor_data.py --start 2010-01-01 --end 2010-02-01 \\
  anc.asc.air.pressure anc.asc.air.temperature
+
+# Also add the downloaded data to a local sensor store for later analysis
+$ ./retrieve_sensor_data.py --store sensors.h5 --start 2010-01-01 --end 2010-02-01 \\
+ anc.asc.air.pressure anc.asc.air.temperature
 """
 
 
@@ -79,6 +84,8 @@ parser.add_option('--end', dest='end_time', type="string", metavar='END_TIME', d
                   help="End of sensor data retrieval range [%default].")
 parser.add_option('--cache', dest='sensor_cache', type="string", metavar='SENSOR_CACHE', default="./sensor_cache.csv",
                   help="File to cache sensor names in [%default].")
+parser.add_option('--store', dest='sensor_store', type="string", metavar='SENSOR_STORE', default=None,
+                  help="Also import downloaded data into this local sensor store (HDF5 file) [%default].")
 parser.add_option('--title', dest='title', type="string", metavar='PLOT_TITLE', default=None,
                   help="Title for graph; only useful when using -p [%default].")
 parser.add_option('--legend-loc', dest='legend_loc', type="int", metavar='LEGEND_LOC', default=0,
@@ -269,18 +276,10 @@ def main():
             history = [(entry[0], entry[1]) for entry in history]
             history.sort()
 
-            compacted = []
-            current_start, current_end = 0, 0
+            # Merge history periods that are separated by small gaps
             allowed_gap = 60*5
-            for start, end in history:
-                if start > current_end + allowed_gap:
-                    if current_start:
-                        compacted.append((current_start, current_end))
-                    current_start, current_end = start, end
-                else:
-                    current_end = end
-            if current_start:
-                compacted.append((current_start, current_end))
+            compacted = coverage_intervals([period_start for period_start, period_end in history], allowed_gap,
+                                           [period_end for period_start, period_end in history])
 
             print
             print "Available data for", fullname
@@ -304,9 +303,14 @@ def main():
         return
 
     if True:
+        store = SensorStore(opts.sensor_store) if opts.sensor_store else None
         for sensor in sensors:
             dump_file = "%s.%s.csv" % (sensor.parent_name, sensor.name)
             sensor.get_stored_history(start_time=start_s, end_time=end_s, dump_file=dump_file, select=False)
+            if store is not None:
+                print "Imported %d samples of %s into %s" % (import_csv_sensor(store, dump_file), dump_file, store.filename)
+        if store is not None:
+            store.close()
         return
 
 